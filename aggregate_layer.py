@@ -0,0 +1,947 @@
+"""Materialized summaries of the fact tables, mined from training SQL and the query log, with query rewriting"""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, AsyncGenerator, Callable, Deque, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+import pandas as pd
+from vanna.capabilities.sql_runner import SqlRunner, RunSqlToolArgs
+from vanna.core.tool import ToolContext
+from vanna.core.user import User
+
+from sql_utils import (
+    SQL_KEYWORDS, SqlToken, canonicalize_sql, extract_write_tables, parse_foreign_keys, parse_not_null_columns,
+    parse_primary_key, parse_schema_tables, tokenize_sql,
+)
+
+logger = logging.getLogger(__name__)
+
+FACT_TABLES = ("factinternetsales", "factresellersales")
+FACT = "fact"  # the fact source in column references and join edges ("fact.orderdatekey")
+
+_AGGREGATES = frozenset("""
+    avg count max min sum stddev stddev_pop stddev_samp variance var_pop var_samp string_agg array_agg bool_and
+    bool_or every json_agg jsonb_agg percentile_cont percentile_disc mode corr covar_pop covar_samp
+""".split())
+# pg_try_advisory_lock key electing the one worker that creates, refreshes and drops the views
+BUILDER_LOCK_KEY = int.from_bytes(hashlib.sha1(b"aggregate_layer").digest()[:8], "big", signed=True)
+# The summaries in the database, with the definition each builder stores as the view's comment
+SUMMARIES_SQL = ("SELECT c.relname, obj_description(c.oid, 'pg_class') AS definition FROM pg_class c "
+                 "WHERE c.relkind = 'm' AND c.relname LIKE 'agg\\_%'")
+_CLAUSES = ("select", "from", "where", "group", "having", "order", "limit", "offset")
+# Anything that changes how rows are grouped or combined; such queries are left alone
+_UNSUPPORTED = frozenset("""
+    with union intersect except window over distinct fetch for lateral using natural left right full cross outer
+    filter within grouping rollup cube sets tablesample
+""".split())
+
+
+@dataclass(frozen=True)
+class StarShape:
+    """What an aggregate query over one fact source needs from a summary"""
+    source: str  # a fact table, or "factinternetsales+factresellersales" for the UNION ALL of both
+    joins: FrozenSet[Tuple[str, str]]  # ("dimdate.datekey", "fact.orderdatekey"), each pair sorted
+    columns: FrozenSet[str]  # grouped or filtered columns, "dimdate.calendaryear" or "fact.productkey"
+    measures: FrozenSet[str]  # summed fact columns
+
+
+@dataclass
+class StarQuery:
+    """An analyzed aggregate query: its shape and the tokens a rewrite replaces"""
+    shape: StarShape
+    tokens: List[SqlToken]
+    from_span: Tuple[int, int]  # FROM keyword up to the next clause
+    refs: Dict[int, Tuple[int, str]]  # first token -> (token after it, "table.column")
+    sums: Dict[int, Tuple[int, str]]  # SUM(col)/COUNT(*) first token -> (token after it, column or "*")
+    renames: Dict[int, str]  # last token of an unaliased select item -> the output name to keep
+
+
+@dataclass
+class SummaryTable:
+    """A materialized view grouping one fact source by dimension columns, with SUMs of its measures"""
+    source: str
+    joins: Tuple[Tuple[str, str], ...]
+    columns: Tuple[str, ...]
+    measures: Tuple[str, ...]
+    support: int = 0  # queries (training and log) whose shape it covers
+    rows: Optional[int] = None
+    source_rows: Optional[int] = None
+    refreshed_at: Optional[float] = None  # wall clock
+    refresh_ms: Optional[float] = None
+    stale: bool = True
+
+    @property
+    def name(self) -> str:
+        definition = repr((self.source, self.joins, self.columns, self.measures))
+        label = self.source if "+" not in self.source else "allsales"
+        return f"agg_{label}_{hashlib.sha1(definition.encode('utf-8')).hexdigest()[:10]}"
+
+    @property
+    def tables(self) -> Set[str]:
+        tables = set(self.source.split("+"))
+        for edge in self.joins:
+            tables.update(ref.split(".")[0] for ref in edge)
+        tables.discard(FACT)
+        return tables
+
+    def column_name(self, ref: str) -> str:
+        table, column = ref.split(".")
+        clashes = sum(1 for c in self.columns if c.split(".")[1] == column)
+        return f"{table}_{column}" if clashes > 1 else column
+
+    def covers(self, shape: StarShape, many_to_one: Set[Tuple[str, str]] = frozenset()) -> bool:
+        """Whether the summary answers the shape: joins beyond the shape's must be in many_to_one"""
+        return (shape.source == self.source and shape.joins <= set(self.joins)
+                and shape.columns <= set(self.columns) and shape.measures <= set(self.measures)
+                and _keeps_fact_rows(self.source, self.joins, shape.joins, many_to_one))
+
+    def select_sql(self) -> str:
+        """The defining query: the fact source joined to its dimensions, grouped by the summary's columns"""
+        fact_columns = sorted(
+            {ref.split(".")[1] for ref in self.columns if ref.startswith(f"{FACT}.")}
+            | set(self.measures)
+            | {ref.split(".")[1] for edge in self.joins for ref in edge if ref.startswith(f"{FACT}.")}
+        )
+        if "+" in self.source:
+            listed = ", ".join(fact_columns) or "1"
+            first, second = self.source.split("+")
+            source = f"(SELECT {listed} FROM {first} UNION ALL SELECT {listed} FROM {second})"
+        else:
+            source = self.source
+
+        aliases = {FACT: "f"}
+        joins = []
+        pending = list(self.joins)
+        while pending:
+            for edge in pending:
+                tables = [ref.split(".")[0] for ref in edge]
+                new = [t for t in tables if t not in aliases]
+                if len(new) == 1:
+                    aliases[new[0]] = f"t{len(aliases)}"
+                    (left_table, left_col), (right_table, right_col) = (ref.split(".") for ref in edge)
+                    joins.append(f" JOIN {new[0]} {aliases[new[0]]} ON "
+                                 f"{aliases[left_table]}.{left_col} = {aliases[right_table]}.{right_col}")
+                    pending.remove(edge)
+                    break
+            else:
+                raise ValueError(f"Join edges of {self.name} do not form a tree from the fact source")
+
+        def qualified(ref: str) -> str:
+            table, column = ref.split(".")
+            return f"{aliases[table]}.{column}"
+
+        select = [f"{qualified(ref)} AS {self.column_name(ref)}" for ref in self.columns]
+        select += [f"SUM(f.{m}) AS sum_{m}" for m in self.measures] + ["COUNT(*) AS line_count"]
+        sql = f"SELECT {', '.join(select)} FROM {source} f{''.join(joins)}"
+        if self.columns:
+            sql += f" GROUP BY {', '.join(qualified(ref) for ref in self.columns)}"
+        return sql
+
+    def create_sql(self) -> List[str]:
+        statements = [f"CREATE MATERIALIZED VIEW IF NOT EXISTS {self.name} AS {self.select_sql()}"]
+        if self.columns:
+            # Lets REFRESH ... CONCURRENTLY keep serving reads while it runs
+            columns = ", ".join(self.column_name(ref) for ref in self.columns)
+            statements.append(f"CREATE UNIQUE INDEX IF NOT EXISTS {self.name}_key ON {self.name} ({columns})")
+        return statements
+
+    def refresh_sql(self) -> str:
+        return f"REFRESH MATERIALIZED VIEW {'CONCURRENTLY ' if self.columns else ''}{self.name}"
+
+    def comment_sql(self) -> str:
+        """Stores the definition and refresh stats on the view, for workers that do not build"""
+        definition = json.dumps({
+            "source": self.source,
+            "joins": [list(edge) for edge in self.joins],
+            "columns": list(self.columns),
+            "measures": list(self.measures),
+            "support": self.support,
+            "rows": self.rows,
+            "source_rows": self.source_rows,
+            "refreshed_at": self.refreshed_at,
+            "refresh_ms": self.refresh_ms,
+        })
+        return f"COMMENT ON MATERIALIZED VIEW {self.name} IS '{definition.replace(chr(39), chr(39) * 2)}'"
+
+    @classmethod
+    def from_comment(cls, comment: Optional[str]) -> Optional["SummaryTable"]:
+        try:
+            definition = json.loads(comment or "")
+            return cls(
+                source=definition["source"],
+                joins=tuple(tuple(edge) for edge in definition["joins"]),
+                columns=tuple(definition["columns"]),
+                measures=tuple(definition["measures"]),
+                support=definition.get("support", 0),
+                rows=definition.get("rows"),
+                source_rows=definition.get("source_rows"),
+                refreshed_at=definition.get("refreshed_at"),
+                refresh_ms=definition.get("refresh_ms"),
+                stale=definition.get("refreshed_at") is None,
+            )
+        except (TypeError, ValueError, KeyError):
+            return None
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "source": self.source,
+            "joins": [" = ".join(edge) for edge in self.joins],
+            "columns": list(self.columns),
+            "measures": list(self.measures),
+            "support": self.support,
+            "rows": self.rows,
+            "source_rows": self.source_rows,
+            "age_seconds": time.time() - self.refreshed_at if self.refreshed_at else None,
+            "refresh_ms": self.refresh_ms,
+            "stale": self.stale,
+        }
+
+
+@dataclass
+class RewriteStats:
+    """Runtime of one query answered from a summary, next to its runtime on the fact tables"""
+    summary: str
+    runs: int = 0
+    total_ms: float = 0.0
+    baseline_runs: int = 0
+    baseline_ms: float = 0.0
+
+    def as_dict(self, sql: str) -> Dict[str, Any]:
+        avg = self.total_ms / self.runs if self.runs else None
+        baseline = self.baseline_ms / self.baseline_runs if self.baseline_runs else None
+        return {
+            "sql": sql[:300],
+            "summary": self.summary,
+            "runs": self.runs,
+            "avg_ms": avg,
+            "baseline_ms": baseline,
+            "speedup": baseline / avg if avg and baseline else None,
+        }
+
+
+@dataclass
+class Route:
+    """How a query runs: the SQL to send, and the summary it was rewritten onto (if any)"""
+    sql: str
+    key: Optional[str] = None  # canonical SQL of an aggregate query over a fact source
+    summary: Optional[SummaryTable] = None
+    candidates: List[SummaryTable] = field(default_factory=list)  # summaries covering it, fresh or not
+
+
+def _keeps_fact_rows(
+    source: str, joins: Iterable[Tuple[str, str]], required: FrozenSet[Tuple[str, str]],
+    many_to_one: Set[Tuple[str, str]],
+) -> bool:
+    """
+    Whether every join not in `required` leaves the fact rows as they are:
+    walking away from the fact source, each extra join must go from a
+    NOT NULL foreign key to the primary key it references (a pair in
+    many_to_one), so no row is dropped or repeated
+    """
+    reached = {FACT}
+    pending = list(joins)
+    while pending:
+        for edge in pending:
+            near, far = edge
+            if far.split(".")[0] in reached:
+                near, far = far, near
+            if near.split(".")[0] not in reached or far.split(".")[0] in reached:
+                continue
+            table, column = near.split(".")
+            keys = [f"{t}.{column}" for t in source.split("+")] if table == FACT else [near]
+            if edge not in required and not all((key, far) in many_to_one for key in keys):
+                return False
+            reached.add(far.split(".")[0])
+            pending.remove(edge)
+            break
+        else:
+            return False
+    return True
+
+
+def _render(pieces: List[str]) -> str:
+    out = ""
+    for piece in pieces:
+        glue = (not out or piece in (",", ")", ".", "::") or out.endswith(("(", ".", "::"))
+                or (piece == "(" and out[-1:].isalnum() and out.split()[-1].lower() not in SQL_KEYWORDS))
+        out += piece if glue else f" {piece}"
+    return out
+
+
+class AggregateLayer:
+    """
+    Mines the training SQL and the query log for aggregate queries over the
+    fact tables (one fact table or the UNION ALL of both, inner joins to
+    dimensions, SUM and COUNT(*)), and keeps a materialized view per common
+    join shape, grouped by every dimension column those queries group or
+    filter on. Matching queries are rewritten onto the smallest fresh view
+    that covers them: columns read from the view, SUM(x) re-summed from
+    sum_x, COUNT(*) from line_count. A view may join more dimensions than
+    the query only through NOT NULL foreign keys to primary keys, which
+    neither drop nor repeat fact rows.
+
+    A shape becomes a summary once `min_support` queries share its joins
+    (at most `max_summaries`). Views with more than `max_row_ratio` of the
+    source's rows are dropped, as they would not save much, and not planned
+    again. Summaries are refreshed by `build()`, every `refresh_seconds`
+    once started; one older than `max_age_seconds`, or whose tables were
+    written through the runner, is not used until its next refresh.
+
+    With several worker processes, `builder_lock` (an AdvisoryLock) elects
+    the one that creates, refreshes and drops the views; it stores each
+    view's definition as its comment, and the other workers route onto
+    the views listed in the database instead of building their own.
+    """
+
+    def __init__(
+        self,
+        runner: SqlRunner,
+        ddl_provider: Callable[[], List[str]],
+        training_sql_provider: Callable[[], List[str]],
+        fact_tables: Tuple[str, ...] = FACT_TABLES,
+        min_support: int = 2,
+        max_summaries: int = 8,
+        max_row_ratio: float = 0.2,
+        max_age_seconds: float = 3600.0,
+        refresh_seconds: float = 900.0,
+        log_size: int = 1000,
+        builder_lock: Optional[Any] = None,
+    ):
+        self.runner = runner
+        self.ddl_provider = ddl_provider
+        self.training_sql_provider = training_sql_provider
+        self.fact_tables = fact_tables
+        self.min_support = min_support
+        self.max_summaries = max_summaries
+        self.max_row_ratio = max_row_ratio
+        self.max_age_seconds = max_age_seconds
+        self.refresh_seconds = refresh_seconds
+        self.builder_lock = builder_lock
+        self.leader: Optional[bool] = None  # whether this worker built at the last build()
+        self.schema: Dict[str, Set[str]] = {}
+        self.many_to_one: Set[Tuple[str, str]] = set()  # ("factinternetsales.orderdatekey", "dimdate.datekey")
+        self.summaries: Dict[str, SummaryTable] = {}
+        self.log: Deque[StarShape] = deque(maxlen=log_size)
+        self.rewrites: "OrderedDict[str, RewriteStats]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+        self.routed = 0
+        self.not_covered = 0
+        self.stale_skips = 0
+        self.fallbacks = 0
+        self.builds = 0
+        self.build_errors = 0
+        self.dropped: Dict[str, str] = {}  # summary name -> reason
+        self.oversized: Set[str] = set()  # summaries dropped for their size, not planned again
+        self.load_schema()
+
+    def load_schema(self) -> None:
+        ddls = self.ddl_provider()
+        self.schema = {name: set(columns) for name, columns in parse_schema_tables(ddls).items()}
+        tables = {name: ddl for ddl in ddls for name in parse_schema_tables([ddl])}
+        self.many_to_one = set()
+        for name, ddl in tables.items():
+            not_null = parse_not_null_columns(ddl)
+            for columns, referenced, referenced_columns in parse_foreign_keys(ddl):
+                if (len(columns) == 1 and columns[0] in not_null and referenced in tables
+                        and referenced_columns == parse_primary_key(tables[referenced])):
+                    self.many_to_one.add((f"{name}.{columns[0]}", f"{referenced}.{referenced_columns[0]}"))
+
+    # ---- analysis ----
+
+    def analyze(self, sql: str) -> Optional[StarQuery]:
+        """The star shape of an aggregate query over a fact source, or None if it is not one we can serve"""
+        tokens, problems = tokenize_sql(sql or "")
+        while tokens and tokens[-1].value == ";":
+            tokens.pop()
+        if problems or not tokens or tokens[0].value != "select" or any(t.value == ";" for t in tokens):
+            return None
+
+        matching: Dict[int, int] = {}
+        stack: List[int] = []
+        clauses: Dict[str, int] = {}
+        for i, token in enumerate(tokens):
+            if token.kind == "op" and token.value == "(":
+                stack.append(i)
+            elif token.kind == "op" and token.value == ")":
+                if not stack:
+                    return None
+                matching[stack.pop()] = i
+            elif token.kind == "word" and not stack and token.value in _CLAUSES:
+                if token.value in clauses:
+                    return None
+                clauses[token.value] = i
+        if stack or "from" not in clauses or list(clauses) != [c for c in _CLAUSES if c in clauses]:
+            return None
+        bounds = sorted(clauses.values()) + [len(tokens)]
+        span = {name: (start, bounds[bounds.index(start) + 1]) for name, start in clauses.items()}
+
+        parsed = self._parse_from(tokens, span["from"], matching)
+        if parsed is None:
+            return None
+        source, fact_columns, aliases, joins, subquery = parsed
+        if any(t.kind == "word" and t.value in _UNSUPPORTED and not subquery[0] <= i < subquery[1]
+               for i, t in enumerate(tokens)):
+            return None
+        for name in ("limit", "offset"):
+            if name in span and any(t.kind not in ("number",) and t.value != "all"
+                                    for t in tokens[span[name][0] + 1:span[name][1]]):
+                return None
+
+        select_start, select_end = span["select"]
+        outputs, alias_tokens, renames = self._select_items(tokens, select_start + 1, select_end, matching)
+        refs: Dict[int, Tuple[int, str]] = {}
+        sums: Dict[int, Tuple[int, str]] = {}
+        for name in ("select", "where", "group", "having", "order"):
+            if name not in span:
+                continue
+            i, end = span[name][0] + 1, span[name][1]
+            while i < end:
+                token = tokens[i]
+                if token.kind == "op" and token.value == "*":
+                    return None  # SELECT *, f.*
+                if token.kind == "word" and token.value == "select":
+                    return None  # nested subquery
+                if i in alias_tokens or token.kind not in ("word", "quoted"):
+                    i += 1
+                    continue
+                if token.kind == "word" and token.value in _AGGREGATES and i + 1 in matching:
+                    close = matching[i + 1]
+                    measure = self._aggregate(tokens[i + 2:close], token.value, aliases, fact_columns)
+                    if measure is None:
+                        return None
+                    sums[i] = (close + 1, measure)
+                    i = close + 1
+                    continue
+                if i + 1 < end and tokens[i + 1].value == "(" or i > 0 and tokens[i - 1].value in ("::", "as"):
+                    i += 1  # function name, type name or output name
+                    continue
+                if i + 2 < end and tokens[i + 1].value == "." and tokens[i + 2].kind in ("word", "quoted"):
+                    ref = self._resolve(tokens[i + 2].value, aliases, fact_columns, tokens[i].value)
+                    if ref is None:
+                        return None
+                    refs[i] = (i + 3, ref)
+                    i += 3
+                    continue
+                if token.kind == "word" and token.value in SQL_KEYWORDS or name == "order" and token.value in outputs:
+                    i += 1  # ORDER BY prefers output names over input columns
+                    continue
+                ref = self._resolve(token.value, aliases, fact_columns)
+                if ref is None and name == "group" and token.value in outputs:
+                    i += 1  # GROUP BY falls back to them
+                    continue
+                if ref is None:
+                    return None
+                refs[i] = (i + 1, ref)
+                i += 1
+
+        if not sums and "group" not in clauses:
+            return None  # detail rows, not an aggregate
+        shape = StarShape(
+            source=source,
+            joins=frozenset(joins),
+            columns=frozenset(ref for _, ref in refs.values()),
+            measures=frozenset(m for _, m in sums.values() if m != "*"),
+        )
+        return StarQuery(shape, tokens, span["from"], refs, sums, renames)
+
+    def _parse_from(
+        self, tokens: List[SqlToken], span: Tuple[int, int], matching: Dict[int, int]
+    ) -> Optional[Tuple[str, Set[str], Dict[str, str], List[Tuple[str, str]], Tuple[int, int]]]:
+        """Fact source, its columns, alias -> table, join edges and the span of a UNION ALL subquery"""
+        j, end = span[0] + 1, span[1]
+        subquery = (0, 0)
+        if tokens[j].value == "(" and j in matching:
+            close = matching[j]
+            union = self._union_source(tokens[j + 1:close])
+            if union is None:
+                return None
+            source, fact_columns = union
+            subquery = (j, close + 1)
+            j = close + 1
+            name = None
+        elif tokens[j].value in self.fact_tables:
+            source = name = tokens[j].value
+            fact_columns = self.schema.get(source, set())
+            j += 1
+        else:
+            return None
+
+        def alias_at(k: int) -> Tuple[Optional[str], int]:
+            k += tokens[k].value == "as" if k < end else 0
+            if k < end and tokens[k].kind in ("word", "quoted") and tokens[k].value not in SQL_KEYWORDS:
+                return tokens[k].value, k + 1
+            return None, k
+
+        alias, j = alias_at(j)
+        if alias is None and name is None:
+            return None
+        aliases = {alias or name: FACT}
+        joins: List[Tuple[str, str]] = []
+        while j < end:
+            j += tokens[j].value == "inner"
+            if j + 1 >= end or tokens[j].value != "join":
+                return None
+            table = tokens[j + 1].value
+            if table not in self.schema or table in self.fact_tables or table in aliases.values():
+                return None
+            alias, j = alias_at(j + 2)
+            alias = alias or table
+            on = tokens[j:j + 8]
+            if len(on) < 8 or [t.value for t in on[0:1] + on[2:3] + on[4:5] + on[6:7]] != ["on", ".", "=", "."]:
+                return None
+            j += 8
+            aliases[alias] = table
+            sides = []
+            for qualifier, column in ((on[1].value, on[3].value), (on[5].value, on[7].value)):
+                ref = self._resolve(column, aliases, fact_columns, qualifier)
+                if ref is None:
+                    return None
+                sides.append(ref)
+            tables = {ref.split(".")[0] for ref in sides}
+            if table not in tables or len(tables) != 2:
+                return None
+            joins.append(tuple(sorted(sides)))
+        return source, fact_columns, aliases, joins, subquery
+
+    def _union_source(self, tokens: List[SqlToken]) -> Optional[Tuple[str, Set[str]]]:
+        """(SELECT a, b FROM fact_1 UNION ALL SELECT a, b FROM fact_2): the combined source and its columns"""
+        parts: List[List[SqlToken]] = [[]]
+        i = 0
+        while i < len(tokens):
+            if tokens[i].value == "union" and i + 1 < len(tokens) and tokens[i + 1].value == "all":
+                parts.append([])
+                i += 2
+                continue
+            parts[-1].append(tokens[i])
+            i += 1
+        if len(parts) != 2:
+            return None
+        selected = []
+        for part in parts:
+            values = [t.value for t in part]
+            if len(values) < 4 or values[0] != "select" or values[-2] != "from" or values[-1] not in self.fact_tables:
+                return None
+            columns = values[1:-2]
+            if columns[1::2] != [","] * (len(columns) // 2) or len(columns) % 2 == 0:
+                return None
+            names = columns[0::2]
+            if any(n not in self.schema.get(values[-1], set()) for n in names):
+                return None
+            selected.append((values[-1], names))
+        (first, first_columns), (second, second_columns) = selected
+        if first == second or first_columns != second_columns:
+            return None
+        return "+".join(sorted((first, second))), set(first_columns)
+
+    def _select_items(
+        self, tokens: List[SqlToken], start: int, end: int, matching: Dict[int, int]
+    ) -> Tuple[Set[str], Set[int], Dict[int, str]]:
+        """Output names, the tokens that define them, and unaliased items whose output name must be kept"""
+        outputs: Set[str] = set()
+        alias_tokens: Set[int] = set()
+        renames: Dict[int, str] = {}
+        items: List[Tuple[int, int]] = []
+        i, item_start = start, start
+        while i < end:
+            if tokens[i].value == "(" and i in matching:
+                i = matching[i] + 1
+                continue
+            if tokens[i].value == ",":
+                items.append((item_start, i))
+                item_start = i + 1
+            i += 1
+        items.append((item_start, end))
+        for first, last in items:
+            values = [t.value for t in tokens[first:last]]
+            kinds = [t.kind for t in tokens[first:last]]
+            if len(values) >= 2 and values[-2] == "as":
+                outputs.add(values[-1])
+                alias_tokens.add(last - 1)
+            elif len(values) >= 2 and kinds[-1] in ("word", "quoted") and values[-1] not in SQL_KEYWORDS \
+                    and (kinds[-2] in ("word", "quoted", "number", "string") or values[-2] == ")"):
+                outputs.add(values[-1])  # "expr name"
+                alias_tokens.add(last - 1)
+            elif values == ["count", "(", "*", ")"]:
+                renames[last - 1] = "count"
+            elif kinds and kinds[-1] in ("word", "quoted") and (len(values) == 1 or values[-2] == "."):
+                renames[last - 1] = values[-1]
+        return outputs, alias_tokens, renames
+
+    def _aggregate(
+        self, inner: List[SqlToken], function: str, aliases: Dict[str, str], fact_columns: Set[str]
+    ) -> Optional[str]:
+        """The fact column a SUM() reads, or "*" for COUNT(*); None for anything a summary cannot answer"""
+        values = [t.value for t in inner]
+        if function == "count" and values == ["*"]:
+            return "*"
+        if function != "sum":
+            return None
+        if len(values) == 1 and inner[0].kind in ("word", "quoted"):
+            ref = self._resolve(values[0], aliases, fact_columns)
+        elif len(values) == 3 and values[1] == ".":
+            ref = self._resolve(values[2], aliases, fact_columns, values[0])
+        else:
+            return None
+        if ref is None or not ref.startswith(f"{FACT}."):
+            return None
+        return ref.split(".")[1]
+
+    def _resolve(
+        self, column: str, aliases: Dict[str, str], fact_columns: Set[str], qualifier: Optional[str] = None
+    ) -> Optional[str]:
+        """ "table.column" for a column reference, "fact.column" on the fact source; None if unknown or ambiguous"""
+        if qualifier is not None:
+            table = aliases.get(qualifier)
+            if table is None:
+                return None
+            known = fact_columns if table == FACT else self.schema.get(table, set())
+            return f"{table}.{column}" if column in known else None
+        owners = [table for table in dict.fromkeys(aliases.values())
+                  if column in (fact_columns if table == FACT else self.schema.get(table, set()))]
+        return f"{owners[0]}.{column}" if len(owners) == 1 else None
+
+    # ---- rewriting ----
+
+    def rewrite(self, query: StarQuery, summary: SummaryTable) -> str:
+        pieces: List[str] = []
+        tokens = query.tokens
+        i = 0
+        while i < len(tokens):
+            if i == query.from_span[0]:
+                pieces += ["FROM", summary.name]
+                i = query.from_span[1]
+                continue
+            if i in query.sums:
+                end, measure = query.sums[i]
+                if measure == "*":
+                    # COUNT(*) of no rows is 0, not NULL
+                    pieces += ["COALESCE", "(", "SUM", "(", summary.name, ".", "line_count", ")", ",", "0", ")"]
+                else:
+                    pieces += ["SUM", "(", summary.name, ".", f"sum_{measure}", ")"]
+            elif i in query.refs:
+                end, ref = query.refs[i]
+                pieces += [summary.name, ".", summary.column_name(ref)]
+            else:
+                end = i + 1
+                pieces.append(tokens[i].text)
+            rename = query.renames.get(end - 1)
+            if rename is not None and (i in query.sums
+                                       or i in query.refs and rename != summary.column_name(query.refs[i][1])):
+                pieces += ["AS", rename]
+            i = end
+        return _render(pieces)
+
+    def route(self, sql: str) -> Route:
+        """Rewrite an aggregate query onto the smallest fresh summary covering it"""
+        query = self.analyze(sql)
+        if query is None:
+            return Route(sql)
+        self.log.append(query.shape)
+        key = canonicalize_sql(sql)
+        candidates = [s for s in self.summaries.values() if s.covers(query.shape, self.many_to_one)]
+        fresh = [s for s in candidates if not s.stale and s.refreshed_at is not None
+                 and time.time() - s.refreshed_at <= self.max_age_seconds]
+        if not fresh:
+            if candidates:
+                self.stale_skips += 1
+            else:
+                self.not_covered += 1
+            return Route(sql, key, None, candidates)
+        summary = min(fresh, key=lambda s: (s.rows if s.rows is not None else float("inf"), len(s.columns)))
+        self.routed += 1
+        return Route(self.rewrite(query, summary), key, summary, candidates)
+
+    def record(self, route: Route, elapsed_ms: float) -> None:
+        """Runtime of a routable query: on its summary, or on the fact tables as a baseline"""
+        if route.key is None or not route.candidates:
+            return
+        stats = self.rewrites.get(route.key)
+        if stats is None:
+            stats = self.rewrites[route.key] = RewriteStats(summary=(route.summary or route.candidates[0]).name)
+            while len(self.rewrites) > 500:
+                self.rewrites.popitem(last=False)
+        if route.summary is not None:
+            stats.summary = route.summary.name
+            stats.runs += 1
+            stats.total_ms += elapsed_ms
+        else:
+            stats.baseline_runs += 1
+            stats.baseline_ms += elapsed_ms
+
+    def mark_stale(self, tables: Iterable[str]) -> None:
+        written = set(tables)
+        for summary in self.summaries.values():
+            if summary.tables & written and not summary.stale:
+                summary.stale = True
+                logger.info(f"Summary {summary.name} is stale after a write to {sorted(summary.tables & written)}")
+
+    # ---- mining and building ----
+
+    def plan(self) -> List[SummaryTable]:
+        """Summaries for the join shapes shared by at least `min_support` training or logged queries"""
+        shapes: Counter = Counter()
+        for sql in self.training_sql_provider():
+            query = self.analyze(sql)
+            if query is not None:
+                shapes[query.shape] += 1
+        shapes.update(self.log)
+
+        groups: Dict[Tuple[str, FrozenSet[Tuple[str, str]]], List[Tuple[StarShape, int]]] = {}
+        for shape, count in shapes.items():
+            groups.setdefault((shape.source, shape.joins), []).append((shape, count))
+        # A shape whose joins are a subset of another group's is served by that group's summary,
+        # if the extra joins are NOT NULL foreign keys to primary keys (they keep every fact row once)
+        keys = sorted(groups, key=lambda k: -len(k[1]))
+        for key in sorted(groups, key=lambda k: len(k[1])):
+            wider = [k for k in keys if k != key and k[0] == key[0] and key[1] < k[1]
+                     and _keeps_fact_rows(k[0], k[1], key[1], self.many_to_one)]
+            if wider:
+                target = max(wider, key=lambda k: sum(c for _, c in groups[k]))
+                groups[target].extend(groups.pop(key))
+                keys.remove(key)
+
+        planned = []
+        for (source, joins), members in groups.items():
+            support = sum(count for _, count in members)
+            if support < self.min_support:
+                continue
+            summary = SummaryTable(
+                source=source,
+                joins=tuple(sorted(joins)),
+                columns=tuple(sorted(set().union(*(s.columns for s, _ in members)))),
+                measures=tuple(sorted(set().union(*(s.measures for s, _ in members)))),
+                support=support,
+            )
+            if summary.name not in self.oversized:
+                planned.append(summary)
+        planned.sort(key=lambda s: -s.support)
+        return planned[:self.max_summaries]
+
+    @staticmethod
+    def _context() -> ToolContext:
+        return ToolContext.model_construct(
+            user=User(id="aggregate_layer", group_memberships=["admin"]),
+            conversation_id="aggregate_layer",
+            request_id="aggregate_layer",
+            agent_memory=None,
+            metadata={},
+        )
+
+    async def _scalar(self, sql: str) -> Optional[int]:
+        df = await self.runner.run_sql(RunSqlToolArgs(sql=sql), self._context())
+        return int(df.iloc[0, 0]) if len(df) and df.iloc[0, 0] is not None else None
+
+    async def _existing(self, context: ToolContext) -> Dict[str, Optional[SummaryTable]]:
+        """The summary views in the database, with the definitions stored in their comments"""
+        try:
+            df = await self.runner.run_sql(RunSqlToolArgs(sql=SUMMARIES_SQL), context)
+        except Exception as e:
+            logger.warning(f"Could not list summary views: {e}")
+            return {}
+        return {name: SummaryTable.from_comment(comment) for name, comment in df.itertuples(index=False)}
+
+    async def build(self) -> Dict[str, Any]:
+        """
+        Create planned summaries, refresh existing ones and drop those no
+        longer planned or too large; a worker that is not the elected
+        builder loads the builder's summaries instead
+        """
+        async with self._lock:
+            self.builds += 1
+            self.load_schema()
+            context = self._context()
+            if self.builder_lock is not None:
+                self.leader = await self.builder_lock.try_acquire()
+                if not self.leader:
+                    return await self._follow(context)
+            planned = {s.name: s for s in self.plan()}
+            existing = await self._existing(context)  # views left by an earlier builder
+            for name in [n for n in set(self.summaries) | set(existing) if n not in planned]:
+                self.summaries.pop(name, None)
+                await self._drop(name, "no longer planned", context)
+            for name, summary in planned.items():
+                current = self.summaries.get(name)
+                if current is not None:
+                    current.support = summary.support
+                    summary = current
+                start = time.perf_counter()
+                try:
+                    exists = current is not None or name in existing
+                    statements = [summary.refresh_sql()] if exists else summary.create_sql()
+                    for statement in statements:
+                        await self.runner.run_sql(RunSqlToolArgs(sql=statement), context)
+                    summary.rows = await self._scalar(f"SELECT COUNT(*) FROM {name}")
+                    summary.source_rows = sum([
+                        await self._scalar(f"SELECT reltuples::bigint FROM pg_class WHERE relname = '{table}'") or 0
+                        for table in summary.source.split("+")
+                    ])
+                except Exception as e:
+                    self.build_errors += 1
+                    logger.warning(f"Could not build summary {name}: {e}")
+                    summary.stale = True
+                    continue
+                summary.refresh_ms = (time.perf_counter() - start) * 1000
+                summary.refreshed_at = time.time()
+                summary.stale = False
+                if summary.source_rows and summary.rows is not None \
+                        and summary.rows > self.max_row_ratio * summary.source_rows:
+                    self.summaries.pop(name, None)
+                    self.oversized.add(name)
+                    await self._drop(name, f"{summary.rows:,} rows for {summary.source_rows:,} source rows", context)
+                    continue
+                try:
+                    await self.runner.run_sql(RunSqlToolArgs(sql=summary.comment_sql()), context)
+                except Exception as e:
+                    logger.warning(f"Could not store the definition of summary {name}: {e}")
+                self.summaries[name] = summary
+                logger.info(f"Summary {name} ready: {summary.rows} rows, {summary.refresh_ms:.0f} ms "
+                            f"({', '.join(summary.columns) or 'totals'})")
+            return {name: s.describe() for name, s in self.summaries.items()}
+
+    async def _follow(self, context: ToolContext) -> Dict[str, Any]:
+        """Route onto the views the elected builder keeps, as listed in the database"""
+        summaries: Dict[str, SummaryTable] = {}
+        for name, summary in (await self._existing(context)).items():
+            if summary is None or summary.name != name:
+                continue
+            local = self.summaries.get(name)
+            if local is not None and local.stale and (local.refreshed_at or 0) >= (summary.refreshed_at or 0):
+                summary.stale = True  # written through this worker since the builder's last refresh
+            summaries[name] = summary
+        self.summaries = summaries
+        return {name: s.describe() for name, s in self.summaries.items()}
+
+    async def _drop(self, name: str, reason: str, context: ToolContext) -> None:
+        self.dropped[name] = reason
+        logger.info(f"Dropping summary {name}: {reason}")
+        try:
+            await self.runner.run_sql(RunSqlToolArgs(sql=f"DROP MATERIALIZED VIEW IF EXISTS {name}"), context)
+        except Exception as e:
+            logger.warning(f"Could not drop summary {name}: {e}")
+
+    async def benchmark(self, sqls: Iterable[str]) -> List[Dict[str, Any]]:
+        """Run each routable query on the fact tables and on its summary once, recording both"""
+        context = self._context()
+        for sql in sqls:
+            route = self.route(sql)
+            if route.summary is None:
+                continue
+            for current in (Route(sql, route.key, None, route.candidates), route):
+                start = time.perf_counter()
+                await self.runner.run_sql(RunSqlToolArgs(sql=current.sql), context)
+                self.record(current, (time.perf_counter() - start) * 1000)
+        return [stats.as_dict(sql) for sql, stats in self.rewrites.items()]
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.build()
+            except Exception as e:
+                logger.error(f"Aggregate layer refresh failed: {e}")
+            # Other workers look for the builder's refreshes (or its lock) more often
+            await asyncio.sleep(self.refresh_seconds if self.leader is not False else min(self.refresh_seconds, 60))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.builder_lock is not None:
+            await self.builder_lock.release()
+
+    def get_stats(self) -> Dict[str, Any]:
+        rewrites = sorted(self.rewrites.items(), key=lambda item: -item[1].runs)[:20]
+        return {
+            "summaries": [s.describe() for s in self.summaries.values()],
+            "dropped": dict(self.dropped),
+            "builder": self.leader,
+            "routed": self.routed,
+            "not_covered": self.not_covered,
+            "stale_skips": self.stale_skips,
+            "fallbacks": self.fallbacks,
+            "builds": self.builds,
+            "build_errors": self.build_errors,
+            "logged_shapes": len(set(self.log)),
+            "rewrites": [stats.as_dict(sql) for sql, stats in rewrites],
+        }
+
+
+class AggregateRoutingSqlRunner(SqlRunner):
+    """
+    Wraps the SQL runner and sends aggregate queries that a fresh summary
+    covers to the summary instead of the fact tables. Every read feeds the
+    layer's query log; writes through the runner mark the summaries over the
+    written tables stale. If a rewritten query fails (a view dropped behind
+    the layer's back), the original runs instead.
+    """
+
+    def __init__(self, runner: SqlRunner, layer: AggregateLayer):
+        self.runner = runner
+        self.layer = layer
+
+    def __getattr__(self, name: str) -> Any:
+        # close, warm_up, get_stats of the pool, ... of the wrapped runner
+        return getattr(self.runner, name)
+
+    def _route(self, sql: str) -> Route:
+        written = extract_write_tables(sql)
+        if written:
+            self.layer.mark_stale(written)
+            return Route(sql)
+        return self.layer.route(sql)
+
+    def _fall_back(self, route: Route, error: Exception) -> None:
+        self.layer.fallbacks += 1
+        route.summary.stale = True
+        logger.warning(f"Query on summary {route.summary.name} failed, running on the fact tables: {error}")
+
+    async def run_sql(self, args: RunSqlToolArgs, context: ToolContext) -> pd.DataFrame:
+        route = self._route(args.sql)
+        start = time.perf_counter()
+        try:
+            df = await self.runner.run_sql(RunSqlToolArgs(sql=route.sql), context)
+        except Exception as e:
+            if route.summary is None:
+                raise
+            self._fall_back(route, e)
+            return await self.runner.run_sql(args, context)
+        self.layer.record(route, (time.perf_counter() - start) * 1000)
+        return df
+
+    async def stream_sql(
+        self, args: RunSqlToolArgs, context: ToolContext, chunk_size: int = 5000
+    ) -> AsyncGenerator[pd.DataFrame, None]:
+        stream_sql = getattr(self.runner, "stream_sql", None)
+        if stream_sql is None:
+            yield await self.run_sql(args, context)
+            return
+
+        route = self._route(args.sql)
+        start = time.perf_counter()
+        rows_sent = False
+        try:
+            async for chunk in stream_sql(RunSqlToolArgs(sql=route.sql), context, chunk_size=chunk_size):
+                rows_sent = True
+                yield chunk
+        except Exception as e:
+            if route.summary is None or rows_sent:
+                raise
+            self._fall_back(route, e)
+            async for chunk in stream_sql(args, context, chunk_size=chunk_size):
+                yield chunk
+            return
+        self.layer.record(route, (time.perf_counter() - start) * 1000)
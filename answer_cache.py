@@ -0,0 +1,218 @@
+"""Answer cache for repeated questions in front of the Vanna Agent"""
+import re
+import time
+import logging
+from datetime import datetime
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Tuple
+
+from vanna.core.storage import Conversation, Message
+from vanna.core.user import User, RequestContext
+
+logger = logging.getLogger(__name__)
+
+CacheKey = Tuple[str, Tuple[str, ...], str]
+
+# run_sql's tool result when it saved the rows to the user's own directory
+RESULT_FILE_MARKER = "Results saved to file: "
+_RESULT_FILE_RE = re.compile(re.escape(RESULT_FILE_MARKER) + r"(\S+)")
+
+
+def normalize_question(question: str) -> str:
+    """Normalize question text: lowercase, drop punctuation, collapse whitespace"""
+    question = question.lower()
+    question = re.sub(r"[^\w\s]", " ", question)
+    return " ".join(question.split())
+
+
+def result_files(messages: List[Message]) -> List[str]:
+    """Result files the exchange saved; they live in (and link to) the asking user's directory"""
+    return [match.group(1) for msg in messages for match in _RESULT_FILE_RE.finditer(msg.content or "")]
+
+
+def has_result_files(messages: List[Message]) -> bool:
+    return bool(result_files(messages))
+
+
+@dataclass
+class CachedAnswer:
+    """A cached agent run: the UI components and the conversation messages it produced"""
+    components: List[Any]
+    messages: List[Message]
+    created_at: float = field(default_factory=time.monotonic)
+
+
+class AnswerCache:
+    """
+    LRU + TTL cache of complete agent answers.
+    Keyed on normalized question text plus the user's access groups, and
+    tagged with the knowledge base version so a training data or schema
+    change invalidates every entry. Answers that saved result files are
+    keyed to their user as well, since the files and their download links
+    are only valid for the user who asked.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 512,
+        ttl_seconds: float = 3600,
+        version_provider: Optional[Callable[[], str]] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.version_provider = version_provider
+        self._entries: "OrderedDict[CacheKey, CachedAnswer]" = OrderedDict()
+        self._version: Optional[str] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(question: str, user: User, per_user: bool = False) -> CacheKey:
+        owner = user.id if per_user else ""
+        return normalize_question(question), tuple(sorted(user.group_memberships or [])), owner
+
+    def get(self, key: CacheKey, *fallbacks: CacheKey) -> Optional[CachedAnswer]:
+        """Return the first fresh answer under key or fallbacks, or None (counts one hit or miss)"""
+        self._check_version()
+        for candidate in (key, *fallbacks):
+            entry = self._entries.get(candidate)
+            if entry is not None and time.monotonic() - entry.created_at > self.ttl_seconds:
+                del self._entries[candidate]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(candidate)
+                self.hits += 1
+                return entry
+
+        self.misses += 1
+        return None
+
+    def put(self, key: CacheKey, answer: CachedAnswer) -> None:
+        """Store an answer, evicting the least recently used entries when full"""
+        self._check_version()
+        self._entries[key] = answer
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self) -> None:
+        """Drop every cached answer"""
+        if self._entries:
+            logger.info(f"Answer cache invalidated ({len(self._entries)} entries dropped)")
+        self._entries.clear()
+        self.invalidations += 1
+
+    def _check_version(self) -> None:
+        if self.version_provider is None:
+            return
+        version = self.version_provider()
+        if self._version is not None and version != self._version:
+            self.invalidate()
+        self._version = version
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class CachedAgent:
+    """
+    Wraps a Vanna Agent and serves repeated questions from an AnswerCache.
+    Only the first question of a conversation is cached, since follow-ups
+    depend on earlier turns. Hits replay the cached components and append the
+    cached messages to the conversation, without any LLM or SQL call.
+    """
+
+    def __init__(self, agent: Any, cache: AnswerCache):
+        self.agent = agent
+        self.cache = cache
+
+    def __getattr__(self, name: str) -> Any:
+        # Everything except send_message is served by the wrapped agent
+        return getattr(self.agent, name)
+
+    async def send_message(
+        self,
+        request_context: RequestContext,
+        message: str,
+        *,
+        conversation_id: Optional[str] = None,
+    ) -> AsyncGenerator[Any, None]:
+        if not message.strip() or request_context.metadata.get("starter_ui_request", False):
+            async for component in self.agent.send_message(
+                request_context, message, conversation_id=conversation_id
+            ):
+                yield component
+            return
+
+        user = await self.agent.user_resolver.resolve_user(request_context)
+        store = self.agent.conversation_store
+        conversation = None
+        if conversation_id:
+            conversation = await store.get_conversation(conversation_id, user)
+
+        if conversation is not None and conversation.messages:
+            # Follow-up question: the answer depends on history
+            async for component in self.agent.send_message(
+                request_context, message, conversation_id=conversation_id
+            ):
+                yield component
+            return
+
+        key = AnswerCache.make_key(message, user)
+        cached = self.cache.get(key, AnswerCache.make_key(message, user, per_user=True))
+        if cached is not None:
+            logger.info(f"Answer cache hit: {key[0]!r} groups={list(key[1])}")
+            await self._replay_messages(cached, conversation_id, conversation, user)
+            for component in cached.components:
+                yield component
+            return
+
+        components: List[Any] = []
+        failed = False
+        async for component in self.agent.send_message(
+            request_context, message, conversation_id=conversation_id
+        ):
+            components.append(component)
+            if getattr(getattr(component, "rich_component", None), "status", None) == "error":
+                failed = True
+            yield component
+
+        if failed or not conversation_id:
+            return
+
+        conversation = await store.get_conversation(conversation_id, user)
+        if conversation is None:
+            return
+        messages = list(conversation.messages)
+        if has_result_files(messages):
+            key = AnswerCache.make_key(message, user, per_user=True)
+        self.cache.put(key, CachedAnswer(components=components, messages=messages))
+
+    async def _replay_messages(
+        self,
+        cached: CachedAnswer,
+        conversation_id: Optional[str],
+        conversation: Optional[Conversation],
+        user: User,
+    ) -> None:
+        """Record the cached exchange so follow-up questions keep their context"""
+        if not conversation_id:
+            return
+        store = self.agent.conversation_store
+        if conversation is None:
+            conversation = Conversation(id=conversation_id, user=user, messages=[])
+        for msg in cached.messages:
+            conversation.add_message(msg.model_copy(update={"timestamp": datetime.utcnow()}, deep=True))
+        await store.update_conversation(conversation)
@@ -1,14 +1,59 @@
 """Custom Azure OpenAI LLM Service for Vanna 2.0"""
 import os
 import json
-from typing import Any, Dict, Optional, List, AsyncGenerator
+import asyncio
+import time
+from typing import Any, Callable, Dict, Optional, List, AsyncGenerator, Iterator
 from vanna.core.llm import LlmService, LlmRequest, LlmResponse, LlmStreamChunk
 from vanna.core.llm.models import ToolCall
 from vanna.core.tool import ToolSchema
 
+from prompt_cache import TokenUsage, UsageTracker, prefix_fingerprint, split_system_prompt
+from history_compaction import HistoryCompactor
+from llm_resilience import DeadlineExceededError, ResilientCaller
+from rate_limiter import QuotaScheduler, current_priority
+from token_budget import PromptBudgeter
+from tool_call_stream import EarlyArgument, ToolCallAssembler
+
+# First API version that accepts stream_options={"include_usage": true}
+STREAM_USAGE_API_VERSION = "2024-09-01"
+
 
 class AzureOpenAILlmService(LlmService):
-    """Azure OpenAI LLM Service for Vanna 2.0"""
+    """Azure OpenAI LLM Service for Vanna 2.0
+
+    Uses the native `AsyncAzureOpenAI` client so a slow completion never
+    blocks the event loop. The synchronous `AzureOpenAI` client is kept as an
+    opt-in fallback (`use_sync_client=True` or AZURE_OPENAI_USE_SYNC_CLIENT=true);
+    its blocking calls are offloaded to a worker thread.
+
+    The payload keeps a byte-stable prefix for provider prompt caching: the
+    static part of the system prompt (see prompt_cache.PROMPT_CACHE_BOUNDARY)
+    and the tools, in name order, come before anything that varies per
+    question. Token usage, including cached prompt tokens, goes to an
+    optional UsageTracker. An optional HistoryCompactor shrinks old turns
+    of long conversations, and an optional PromptBudgeter then trims history
+    and context sections so the request fits the deployment's context window.
+
+    Streamed tool-call arguments are assembled incrementally; `on_tool_argument`
+    is called with (request, EarlyArgument) as soon as a top-level string
+    argument such as `sql` is complete, before the stream has finished.
+
+    With a ResilientCaller, each completion runs under its deadline, retry,
+    hedging and circuit breaker policy (the SDK's own retries are then off
+    unless max_retries is passed). `hedge_model` names a second deployment,
+    optionally on `hedge_endpoint`, that slow or failing calls are hedged
+    to. For streams the policy covers opening the stream: once events
+    arrive, the response is not retried, but the deadline still bounds
+    reading the body, so a stream that stalls mid-response fails with
+    DeadlineExceededError instead of hanging.
+
+    With a QuotaScheduler, every attempt first waits for room in its
+    deployment's RPM/TPM quota, queued by user and priority (the request's
+    metadata "priority", else the X-Request-Priority of the HTTP request).
+    The wait happens before the attempt is timed, so it never counts as
+    deployment latency for hedging.
+    """
     
     def __init__(
         self,
@@ -16,10 +61,21 @@ class AzureOpenAILlmService(LlmService):
         api_key: Optional[str] = None,
         azure_endpoint: Optional[str] = None,
         api_version: Optional[str] = None,
+        use_sync_client: Optional[bool] = None,
+        usage_tracker: Optional[UsageTracker] = None,
+        stream_usage: Optional[bool] = None,
+        budgeter: Optional[PromptBudgeter] = None,
+        compactor: Optional[HistoryCompactor] = None,
+        on_tool_argument: Optional[Callable[[LlmRequest, EarlyArgument], None]] = None,
+        resilience: Optional[ResilientCaller] = None,
+        hedge_model: Optional[str] = None,
+        hedge_endpoint: Optional[str] = None,
+        hedge_api_key: Optional[str] = None,
+        rate_limiter: Optional[QuotaScheduler] = None,
         **extra_client_kwargs: Any,
     ) -> None:
         try:
-            from openai import AzureOpenAI
+            from openai import AsyncAzureOpenAI, AzureOpenAI
         except Exception as e:
             raise ImportError(
                 "openai package is required. Install with: pip install openai"
@@ -29,6 +85,14 @@ class AzureOpenAILlmService(LlmService):
         api_key = api_key or os.getenv("AZURE_OPENAI_API_KEY")
         azure_endpoint = azure_endpoint or os.getenv("AZURE_OPENAI_ENDPOINT")
         api_version = api_version or os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
+        if use_sync_client is None:
+            use_sync_client = os.getenv("AZURE_OPENAI_USE_SYNC_CLIENT", "false").lower() == "true"
+        if stream_usage is None:
+            env_value = os.getenv("AZURE_OPENAI_STREAM_USAGE")
+            if env_value is not None:
+                stream_usage = env_value.lower() == "true"
+            else:
+                stream_usage = (api_version or "")[:10] >= STREAM_USAGE_API_VERSION
         
         client_kwargs: Dict[str, Any] = {**extra_client_kwargs}
         if api_key:
@@ -37,15 +101,42 @@ class AzureOpenAILlmService(LlmService):
             client_kwargs["azure_endpoint"] = azure_endpoint
         if api_version:
             client_kwargs["api_version"] = api_version
+        if resilience is not None:
+            client_kwargs.setdefault("max_retries", 0)
         
-        self._client = AzureOpenAI(**client_kwargs)
+        self.use_sync_client = use_sync_client
+        self.usage_tracker = usage_tracker
+        self.stream_usage = stream_usage
+        self.budgeter = budgeter
+        self.compactor = compactor
+        self.on_tool_argument = on_tool_argument
+        self.rate_limiter = rate_limiter
+
+        # Streamed tool-call metrics
+        self._streamed_tool_calls = 0
+        self._early_sql = 0
+        self._early_sql_lead_ms = 0.0
+        client_class = AzureOpenAI if use_sync_client else AsyncAzureOpenAI
+        self._client = client_class(**client_kwargs)
+
+        # Deployments a call may go to: (client, deployment name)
+        self.resilience = resilience
+        self._targets: Dict[str, Any] = {"primary": (self._client, self.model)}
+        if hedge_model:
+            hedge_client = self._client
+            if (hedge_endpoint and hedge_endpoint != azure_endpoint) or (hedge_api_key and hedge_api_key != api_key):
+                hedge_client = client_class(**{
+                    **client_kwargs,
+                    "azure_endpoint": hedge_endpoint or azure_endpoint,
+                    "api_key": hedge_api_key or api_key,
+                })
+            self._targets["hedge"] = (hedge_client, hedge_model)
     
     async def send_request(self, request: LlmRequest) -> LlmResponse:
         """Send a non-streaming request to Azure OpenAI and return the response."""
         payload = self._build_payload(request)
 
-        # Call the API synchronously; this function is async but we can block here.
-        resp = self._client.chat.completions.create(**payload, stream=False)
+        resp = await self._create_completion(request, payload, stream=False)
 
         if not resp.choices:
             return LlmResponse(content=None, tool_calls=None, finish_reason=None)
@@ -54,22 +145,16 @@ class AzureOpenAILlmService(LlmService):
         content: Optional[str] = getattr(choice.message, "content", None)
         tool_calls = self._extract_tool_calls_from_message(choice.message)
 
-        usage: Dict[str, int] = {}
+        usage: Optional[TokenUsage] = None
         if getattr(resp, "usage", None):
-            usage = {
-                k: int(v)
-                for k, v in {
-                    "prompt_tokens": getattr(resp.usage, "prompt_tokens", 0),
-                    "completion_tokens": getattr(resp.usage, "completion_tokens", 0),
-                    "total_tokens": getattr(resp.usage, "total_tokens", 0),
-                }.items()
-            }
+            usage = TokenUsage.from_openai(resp.usage)
+            self._record_usage(request, payload, usage)
 
         return LlmResponse(
             content=content,
             tool_calls=tool_calls or None,
             finish_reason=getattr(choice, "finish_reason", None),
-            usage=usage or None,
+            usage=usage.to_dict() if usage else None,
         )
 
     async def stream_request(
@@ -81,15 +166,23 @@ class AzureOpenAILlmService(LlmService):
         accumulated and emitted in a final chunk when the stream ends.
         """
         payload = self._build_payload(request)
+        if self.stream_usage:
+            # Usage arrives in a last event with no choices
+            payload["stream_options"] = {"include_usage": True}
 
-        # Synchronous streaming iterator; iterate within async context.
-        stream = self._client.chat.completions.create(**payload, stream=True)
+        # One deadline for opening the stream and reading all of it
+        deadline = self.resilience.new_deadline() if self.resilience is not None else None
+        stream = await self._create_completion(request, payload, stream=True, deadline=deadline)
 
-        # Builders for streamed tool-calls (index -> partial)
-        tc_builders: Dict[int, Dict[str, Optional[str]]] = {}
+        # Streamed tool-calls (by index), with complete arguments reported early
+        assembler = ToolCallAssembler(
+            on_argument=(lambda early: self.on_tool_argument(request, early)) if self.on_tool_argument else None
+        )
         last_finish: Optional[str] = None
 
-        for event in stream:
+        async for event in self._iterate_stream(stream, deadline):
+            if getattr(event, "usage", None):
+                self._record_usage(request, payload, TokenUsage.from_openai(event.usage))
             if not getattr(event, "choices", None):
                 continue
 
@@ -109,42 +202,27 @@ class AzureOpenAILlmService(LlmService):
             streamed_tool_calls = getattr(delta, "tool_calls", None)
             if streamed_tool_calls:
                 for tc in streamed_tool_calls:
-                    idx = getattr(tc, "index", 0) or 0
-                    b = tc_builders.setdefault(
-                        idx, {"id": None, "name": None, "arguments": ""}
-                    )
-                    if getattr(tc, "id", None):
-                        b["id"] = tc.id
                     fn = getattr(tc, "function", None)
-                    if fn is not None:
-                        if getattr(fn, "name", None):
-                            b["name"] = fn.name
-                        if getattr(fn, "arguments", None):
-                            b["arguments"] = (b["arguments"] or "") + fn.arguments
+                    assembler.feed(
+                        getattr(tc, "index", 0) or 0,
+                        id=getattr(tc, "id", None),
+                        name=getattr(fn, "name", None),
+                        arguments=getattr(fn, "arguments", None),
+                    )
 
             last_finish = getattr(choice, "finish_reason", last_finish)
 
         # Emit final tool-calls chunk if any
-        final_tool_calls: List[ToolCall] = []
-        for b in tc_builders.values():
-            if not b.get("name"):
-                continue
-            args_raw = b.get("arguments") or "{}"
-            try:
-                loaded = json.loads(args_raw)
-                if isinstance(loaded, dict):
-                    args_dict: Dict[str, Any] = loaded
-                else:
-                    args_dict = {"args": loaded}
-            except Exception:
-                args_dict = {"_raw": args_raw}
-            final_tool_calls.append(
-                ToolCall(
-                    id=b.get("id") or "tool_call",
-                    name=b["name"] or "tool",
-                    arguments=args_dict,
-                )
-            )
+        final_tool_calls: List[ToolCall] = [
+            ToolCall(id=b.id or "tool_call", name=b.name or "tool", arguments=b.parse_arguments())
+            for b in assembler.completed()
+        ]
+        self._streamed_tool_calls += len(final_tool_calls)
+        stream_end = time.perf_counter()
+        for early in assembler.early:
+            if early.key == "sql":
+                self._early_sql += 1
+                self._early_sql_lead_ms += (stream_end - early.detected_at) * 1000
 
         if final_tool_calls:
             yield LlmStreamChunk(tool_calls=final_tool_calls, finish_reason=last_finish)
@@ -152,6 +230,14 @@ class AzureOpenAILlmService(LlmService):
             # Still emit a terminal chunk to signal completion
             yield LlmStreamChunk(finish_reason=last_finish or "stop")
 
+    def get_stats(self) -> Dict[str, Any]:
+        """Streamed tool-call counters; lead = how long before the stream ended the SQL was known"""
+        return {
+            "streamed_tool_calls": self._streamed_tool_calls,
+            "early_sql": self._early_sql,
+            "avg_early_sql_lead_ms": self._early_sql_lead_ms / self._early_sql if self._early_sql else 0.0,
+        }
+
     async def validate_tools(self, tools: List[ToolSchema]) -> List[str]:
         """Validate tool schemas. Returns a list of error messages."""
         errors: List[str] = []
@@ -162,12 +248,106 @@ class AzureOpenAILlmService(LlmService):
         return errors
 
     # Internal helpers
+    async def _create_completion(
+        self, request: LlmRequest, payload: Dict[str, Any], stream: bool, deadline: Optional[float] = None
+    ) -> Any:
+        """Create a chat completion without blocking the event loop."""
+        if self.resilience is None:
+            await self._acquire_quota("primary", request, payload)
+            return await self._create_on("primary", request, payload, stream)
+        return await self.resilience.call(
+            lambda target: self._create_on(target, request, payload, stream),
+            list(self._targets),
+            discard=self._close_stream if stream else None,
+            prepare=(lambda target: self._acquire_quota(target, request, payload)) if self.rate_limiter else None,
+            deadline=deadline,
+        )
+
+    async def _acquire_quota(self, target: str, request: LlmRequest, payload: Dict[str, Any]) -> None:
+        """Wait for room in the target deployment's quota"""
+        if self.rate_limiter is None:
+            return
+        await self.rate_limiter.acquire(
+            getattr(getattr(request, "user", None), "id", None),
+            self.rate_limiter.estimate_tokens(payload),
+            priority=(request.metadata or {}).get("priority") or current_priority.get(),
+            key=self._targets[target][1],
+        )
+
+    async def _create_on(self, target: str, request: LlmRequest, payload: Dict[str, Any], stream: bool) -> Any:
+        client, model = self._targets[target]
+        if model != payload.get("model"):
+            payload = {**payload, "model": model}
+        if self.use_sync_client:
+            return await asyncio.to_thread(
+                client.chat.completions.create, **payload, stream=stream
+            )
+        return await client.chat.completions.create(**payload, stream=stream)
+
+    async def _close_stream(self, stream: Any) -> None:
+        """Close a stream that lost a hedge race"""
+        if self.use_sync_client:
+            await asyncio.to_thread(stream.close)
+        else:
+            await stream.close()
+
+    async def _iterate_stream(self, stream: Any, deadline: Optional[float] = None) -> AsyncGenerator[Any, None]:
+        """Yield stream events from either the async or the sync client, until the deadline (monotonic)."""
+        sentinel = object()
+        if self.use_sync_client:
+            # Sync fallback: pull each event on a worker thread
+            iterator: Iterator[Any] = iter(stream)
+
+            def pull() -> Any:
+                return asyncio.to_thread(next, iterator, sentinel)
+        else:
+            async_iterator = stream.__aiter__()
+
+            def pull() -> Any:
+                return anext(async_iterator, sentinel)
+
+        while True:
+            if deadline is None:
+                event = await pull()
+            else:
+                try:
+                    event = await asyncio.wait_for(pull(), timeout=max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError as e:
+                    self.resilience.deadline_exceeded += 1
+                    await self._close_stream(stream)
+                    raise DeadlineExceededError(
+                        f"LLM stream exceeded its {self.resilience.deadline_seconds:.0f}s deadline"
+                    ) from e
+            if event is sentinel:
+                break
+            yield event
+
+    def _record_usage(self, request: LlmRequest, payload: Dict[str, Any], usage: TokenUsage) -> None:
+        if self.usage_tracker is None:
+            return
+        user = getattr(request, "user", None)
+        self.usage_tracker.record(
+            usage,
+            user_id=getattr(user, "id", None),
+            prefix=self._prefix_fingerprint(payload),
+        )
+
+    @staticmethod
+    def _prefix_fingerprint(payload: Dict[str, Any]) -> str:
+        """Fingerprint of what should be byte-identical across requests: static system prompt and tools"""
+        messages = payload.get("messages") or []
+        static = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+        return prefix_fingerprint(payload.get("model"), static, payload.get("tools"))
+
     def _build_payload(self, request: LlmRequest) -> Dict[str, Any]:
         messages: List[Dict[str, Any]] = []
 
-        # Add system prompt as first message if provided
-        if request.system_prompt:
-            messages.append({"role": "system", "content": request.system_prompt})
+        # Static system prompt first, then the per-question part, so the prefix is reusable
+        static_prompt, dynamic_prompt = split_system_prompt(request.system_prompt)
+        if static_prompt:
+            messages.append({"role": "system", "content": static_prompt})
+        if dynamic_prompt:
+            messages.append({"role": "system", "content": dynamic_prompt})
 
         for m in request.messages:
             msg: Dict[str, Any] = {"role": m.role, "content": m.content}
@@ -199,9 +379,14 @@ class AzureOpenAILlmService(LlmService):
                         "parameters": t.parameters,
                     },
                 }
-                for t in request.tools
+                for t in sorted(request.tools, key=lambda t: t.name)
             ]
 
+        if self.compactor is not None:
+            messages = self.compactor.compact(messages)
+        if self.budgeter is not None:
+            messages, _ = self.budgeter.fit(messages, tools_payload, request.max_tokens)
+
         payload: Dict[str, Any] = {
             "model": self.model,
             "messages": messages,
@@ -0,0 +1,277 @@
+"""Columnar, compressed encoding of query results for SSE delivery"""
+import base64
+import zlib
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from vanna.components import DataFrameComponent
+
+FORMAT = "columnar/v1"
+ALIGNMENT = 8  # buffers start on 8-byte boundaries so clients can view them as typed arrays
+
+
+@dataclass
+class Column:
+    """
+    One result column as a typed array. kind is int, float, bool,
+    timestamp (int64 ms since the epoch, UTC), date (int32 days since the
+    epoch) or string; a string column is either dictionary encoded (values
+    are int codes into dictionary) or plain (values are str objects).
+    valid is None when the column has no nulls.
+    """
+    name: str
+    kind: str
+    values: np.ndarray
+    valid: Optional[np.ndarray] = None
+    dictionary: Optional[np.ndarray] = None
+
+    def slice(self, start: int, stop: int) -> "Column":
+        # Views of the same buffers; the dictionary is shared
+        return Column(
+            self.name,
+            self.kind,
+            self.values[start:stop],
+            None if self.valid is None else self.valid[start:stop],
+            self.dictionary,
+        )
+
+    def to_series(self) -> pd.Series:
+        values = self.values
+        if self.kind == "int":
+            if self.valid is None:
+                return pd.Series(values, name=self.name)
+            return pd.Series(pd.arrays.IntegerArray(values.astype(np.int64), ~self.valid), name=self.name)
+        if self.kind == "float":
+            data = values if self.valid is None else np.where(self.valid, values, np.nan)
+        elif self.kind == "timestamp":
+            data = values.astype(np.int64).view("datetime64[ms]")
+            if self.valid is not None:
+                data = np.where(self.valid, data, np.datetime64("NaT"))
+        elif self.kind == "date":
+            data = values.astype("datetime64[D]")
+            if self.valid is not None:
+                data = np.where(self.valid, data, np.datetime64("NaT"))
+        elif self.kind == "string" and self.dictionary is not None:
+            data = self.dictionary[values]
+            if self.valid is not None:
+                data = np.where(self.valid, data, None)
+        else:
+            data = values if self.valid is None else np.where(self.valid, values, None)
+        return pd.Series(data, name=self.name)
+
+
+class ColumnarResult:
+    """
+    Query result held column by column, in the layout of an Arrow record
+    batch: typed value buffers, a validity bitmap per nullable column and
+    dictionary-encoded low-cardinality strings. Built from the DataFrame
+    chunks read off the cursor without a row-wise pass (only string
+    columns touch each value). slice() is zero-copy, so previews of any
+    size share the result's buffers; to_frame() converts back to pandas
+    and is meant for capped subsets such as the LLM's text preview.
+    """
+
+    def __init__(self, columns: List[Column], row_count: int):
+        self.columns = columns
+        self.row_count = row_count
+
+    def __len__(self) -> int:
+        return self.row_count
+
+    @property
+    def names(self) -> List[str]:
+        return [c.name for c in self.columns]
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, dictionary_ratio: float = 0.5) -> "ColumnarResult":
+        """Convert a DataFrame; strings with at most dictionary_ratio distinct values per row use a dictionary"""
+        columns = [_to_column(str(name), series, dictionary_ratio) for name, series in df.items()]
+        return cls(columns, len(df))
+
+    def slice(self, start: int, stop: Optional[int] = None) -> "ColumnarResult":
+        start, stop, _ = slice(start, stop).indices(self.row_count)
+        return ColumnarResult([c.slice(start, stop) for c in self.columns], max(0, stop - start))
+
+    def head(self, n: int) -> "ColumnarResult":
+        return self.slice(0, n)
+
+    def to_frame(self) -> pd.DataFrame:
+        if not self.columns:
+            return pd.DataFrame()
+        return pd.concat([c.to_series() for c in self.columns], axis=1)
+
+    def column_types(self) -> Dict[str, str]:
+        return {c.name: c.kind for c in self.columns}
+
+    def encode(self, level: int = 6) -> Dict[str, Any]:
+        """
+        Serialize to a JSON-safe dict: a header describing each column's
+        buffers (byte offset and length) and one base64 blob holding every
+        buffer, zlib-compressed when that is smaller. Numbers are
+        little-endian; ints use the narrowest width that holds them and
+        validity bitmaps are LSB-first, as in Arrow.
+        """
+        blob = bytearray()
+
+        def add(data: bytes) -> List[int]:
+            blob.extend(b"\0" * (-len(blob) % ALIGNMENT))
+            offset = len(blob)
+            blob.extend(data)
+            return [offset, len(data)]
+
+        specs = []
+        for column in self.columns:
+            spec: Dict[str, Any] = {"name": column.name, "type": column.kind}
+            values = column.values
+            if column.valid is not None:
+                spec["validity"] = add(np.packbits(column.valid, bitorder="little").tobytes())
+            if column.kind == "string" and column.dictionary is None:
+                encoded = [v.encode("utf-8") if isinstance(v, str) else b"" for v in values]
+                offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+                np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)), out=offsets[1:])
+                width = 4 if offsets[-1] < 2 ** 31 else 8
+                spec["offsets"] = add(offsets.astype(f"<i{width}").tobytes())
+                spec["offset_width"] = width
+                spec["data"] = add(b"".join(encoded))
+            elif column.kind == "bool":
+                spec["data"] = add(np.packbits(values.astype(bool), bitorder="little").tobytes())
+            else:
+                if column.valid is not None and column.kind != "float":
+                    values = np.where(column.valid, values, 0)
+                if column.kind == "float":
+                    values = values.astype("<f8")
+                elif column.kind == "date":
+                    values = values.astype("<i4")
+                elif column.kind == "timestamp":
+                    values = values.astype("<i8")
+                else:
+                    values = values.astype(_int_dtype(values))
+                    spec["width"] = values.dtype.itemsize
+                if column.dictionary is not None:
+                    spec["dictionary"] = column.dictionary.tolist()
+                spec["data"] = add(values.tobytes())
+            specs.append(spec)
+
+        raw = bytes(blob)
+        packed = zlib.compress(raw, level)
+        compression = "zlib" if len(packed) < len(raw) else "none"
+        return {
+            "format": FORMAT,
+            "rows": self.row_count,
+            "columns": specs,
+            "compression": compression,
+            "buffer": base64.b64encode(packed if compression == "zlib" else raw).decode("ascii"),
+        }
+
+    @classmethod
+    def decode(cls, payload: Dict[str, Any]) -> "ColumnarResult":
+        """Reference decoder for encode(); clients do the same with typed arrays"""
+        if payload.get("format") != FORMAT:
+            raise ValueError(f"Unsupported result format: {payload.get('format')!r}")
+        rows = payload["rows"]
+        blob = base64.b64decode(payload["buffer"])
+        if payload["compression"] == "zlib":
+            blob = zlib.decompress(blob)
+
+        def buffer(ref: List[int], dtype: str, count: int) -> np.ndarray:
+            return np.frombuffer(blob, dtype=dtype, count=count, offset=ref[0])
+
+        def bits(ref: List[int]) -> np.ndarray:
+            packed = np.frombuffer(blob, dtype=np.uint8, count=ref[1], offset=ref[0])
+            return np.unpackbits(packed, count=rows, bitorder="little").astype(bool)
+
+        columns = []
+        for spec in payload["columns"]:
+            kind = spec["type"]
+            valid = bits(spec["validity"]) if "validity" in spec else None
+            dictionary = None
+            if kind == "string" and "offsets" in spec:
+                offsets = buffer(spec["offsets"], f"<i{spec['offset_width']}", rows + 1)
+                data = blob[spec["data"][0]:spec["data"][0] + spec["data"][1]]
+                values = np.array(
+                    [data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(rows)], dtype=object
+                )
+            elif kind == "bool":
+                values = bits(spec["data"])
+            else:
+                dtype = {"float": "<f8", "date": "<i4", "timestamp": "<i8"}.get(kind, f"<i{spec.get('width', 8)}")
+                values = buffer(spec["data"], dtype, rows)
+                if "dictionary" in spec:
+                    dictionary = np.array(spec["dictionary"], dtype=object)
+            if kind == "float" and valid is not None:
+                values = np.where(valid, values, np.nan)
+            columns.append(Column(spec["name"], kind, values, valid, dictionary))
+        return cls(columns, rows)
+
+
+class ColumnarDataFrameComponent(DataFrameComponent):
+    """DataFrameComponent whose rows travel as one ColumnarResult.encode() payload instead of row dicts"""
+
+    columnar: Optional[Dict[str, Any]] = None
+
+
+def _int_dtype(values: np.ndarray) -> str:
+    if not len(values):
+        return "<i1"
+    low, high = int(values.min()), int(values.max())
+    for width in (1, 2, 4):
+        bound = 2 ** (8 * width - 1)
+        if -bound <= low and high < bound:
+            return f"<i{width}"
+    return "<i8"
+
+
+def _to_column(name: str, series: pd.Series, dictionary_ratio: float) -> Column:
+    dtype = series.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return Column(name, "bool", series.to_numpy(dtype=bool))
+    if pd.api.types.is_integer_dtype(dtype):
+        if series.hasnans:  # nullable Int64
+            return Column(name, "int", series.to_numpy(dtype=np.int64, na_value=0), series.notna().to_numpy())
+        return Column(name, "int", series.to_numpy())
+    if pd.api.types.is_float_dtype(dtype):
+        values = series.to_numpy()
+        nulls = np.isnan(values)
+        return Column(name, "float", values, ~nulls if nulls.any() else None)
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return _timestamp_column(name, series)
+
+    valid = series.notna().to_numpy()
+    valid_or_none = None if valid.all() else valid
+    inferred = pd.api.types.infer_dtype(series, skipna=True)
+    if inferred == "empty":
+        return Column(name, "string", np.full(len(series), None, dtype=object), valid)
+    try:
+        # Postgres NUMERIC arrives as Decimal, DATE as datetime.date, TIMESTAMP as datetime
+        if inferred == "boolean":
+            return Column(name, "bool", series.fillna(False).to_numpy(dtype=bool), valid_or_none)
+        if inferred in ("integer", "floating", "decimal", "mixed-integer-float"):
+            numeric = pd.to_numeric(series, errors="raise")
+            kind = "int" if pd.api.types.is_integer_dtype(numeric.dtype) else "float"
+            values = numeric.to_numpy(dtype=np.int64 if kind == "int" else np.float64)
+            return Column(name, kind, values, valid_or_none)
+        if inferred == "datetime":
+            first = series[valid].iloc[0]
+            return _timestamp_column(name, pd.to_datetime(series, utc=getattr(first, "tzinfo", None) is not None))
+        if inferred == "date":
+            days = pd.to_datetime(series).to_numpy(dtype="datetime64[D]")
+            return Column(name, "date", np.where(valid, days, np.datetime64(0, "D")).astype(np.int64), valid_or_none)
+    except (TypeError, ValueError, OverflowError):
+        pass
+
+    if inferred != "string":
+        series = series.map(str, na_action="ignore")
+    codes, uniques = pd.factorize(series)
+    if len(uniques) <= dictionary_ratio * len(series):
+        return Column(name, "string", codes, valid_or_none, np.asarray(uniques, dtype=object))
+    return Column(name, "string", series.to_numpy(dtype=object), valid_or_none)
+
+
+def _timestamp_column(name: str, series: pd.Series) -> Column:
+    if series.dt.tz is not None:
+        series = series.dt.tz_convert("UTC").dt.tz_localize(None)
+    valid = series.notna().to_numpy()
+    values = series.to_numpy(dtype="datetime64[ms]").view(np.int64)
+    return Column(name, "timestamp", values, None if valid.all() else valid)
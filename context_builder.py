@@ -0,0 +1,264 @@
+"""Question-relevant system context assembly from the knowledge base"""
+import logging
+from dataclasses import dataclass, field, asdict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from vanna.core.enhancer import LlmContextEnhancer
+from vanna.core.user import User
+
+from knowledge_base import (
+    KnowledgeBase,
+    count_section_tokens,
+    format_example,
+    format_rule,
+    format_table,
+    format_term,
+)
+from prompt_cache import join_system_prompt
+from retrieval_index import Bm25Index, Document
+from sql_utils import extract_tables, parse_ddl_columns, parse_foreign_keys
+
+logger = logging.getLogger(__name__)
+
+# compact: only what the question needs, all in one block
+# cache_prefix: full schema and business rules as a byte-stable prefix, then terms and examples per question
+PROMPT_LAYOUTS = ("compact", "cache_prefix")
+
+
+@dataclass
+class ContextStats:
+    """Per-request accounting of what went into the context"""
+    full_tokens: int
+    context_tokens: int
+    token_budget: int
+    tables: List[str] = field(default_factory=list)
+    terms: int = 0
+    rules: int = 0
+    examples: int = 0
+    dropped_items: int = 0
+    static_tokens: int = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return max(0, self.full_tokens - self.context_tokens)
+
+
+class ContextBuilder:
+    """
+    Builds a system context with only what a question needs: the relevant
+    tables (plus the tables they join to through foreign keys), business
+    rules, the closest business terms and the k nearest example queries,
+    trimmed by priority to fit a token budget.
+
+    With layout="cache_prefix" the schema and rules are not selected per
+    question: they form a static prefix (`static_prefix`) that is identical
+    for every request, so the provider can reuse its cached prompt, and the
+    budget bounds only the per-question terms and examples.
+    """
+
+    def __init__(
+        self,
+        kb: KnowledgeBase,
+        token_budget: int = 3000,
+        max_tables: int = 6,
+        max_terms: int = 6,
+        max_examples: int = 3,
+        token_counter: Optional[Callable[[str], int]] = None,
+        layout: str = "compact",
+    ):
+        if layout not in PROMPT_LAYOUTS:
+            raise ValueError(f"Unknown prompt layout {layout!r}, expected one of {PROMPT_LAYOUTS}")
+        self.kb = kb
+        self.layout = layout
+        self.token_budget = token_budget
+        self.max_tables = max_tables
+        self.max_terms = max_terms
+        self.max_examples = max_examples
+        # Defaults to the knowledge base's tokenizer, whose per-item counts are precomputed
+        self.count_tokens = token_counter or kb.token_counter
+
+        self.requests = 0
+        self.total_context_tokens = 0
+        self.total_tokens_saved = 0
+        self.last_stats: Optional[ContextStats] = None
+        self.refresh()
+
+    def refresh(self) -> None:
+        """(Re)index tables and the FK join graph from the knowledge base"""
+        schema = self.kb.get_cache().get('schema') or {}
+        self._tables: Dict[str, Dict[str, Any]] = {t['name']: t for t in schema.get('tables', [])}
+        self._joins: Dict[str, Set[str]] = {name: set() for name in self._tables}
+        for name, table in self._tables.items():
+            for _, ref_table, _ in parse_foreign_keys(table['ddl']):
+                if ref_table != name and ref_table in self._tables:
+                    self._joins[name].add(ref_table)
+                    self._joins[ref_table].add(name)
+
+        documents = []
+        for name, table in self._tables.items():
+            short_name = name
+            for prefix in ("fact", "dim", "v"):
+                if name.startswith(prefix):
+                    short_name = name[len(prefix):]
+                    break
+            columns = " ".join(parse_ddl_columns(table['ddl']))
+            documents.append(Document(
+                kind="table",
+                text=f"{table['description']} {name} {short_name} {columns}",
+                payload=table,
+            ))
+        self._table_index = Bm25Index(documents)
+        if getattr(self.count_tokens, "name", None) == self.kb.token_counter.name:
+            self._token_counts = self.kb.get_token_counts()
+        else:
+            self._token_counts = count_section_tokens(self.kb.get_cache(), self.kb.get_system_context(), self.count_tokens)
+        self._full_tokens = self._token_counts["full_context"]
+        self._header_tokens = self.count_tokens(
+            "=== DATABASE SCHEMA ===\n\n=== BUSINESS TERMINOLOGY ===\n\n=== BUSINESS RULES ===\n\n=== EXAMPLE QUERIES ==="
+        )
+        self.static_prefix = self._build_static_prefix() if self.layout == "cache_prefix" else ""
+        self._static_tokens = self.count_tokens(self.static_prefix) if self.static_prefix else 0
+
+    def _build_static_prefix(self) -> str:
+        """Every table and business rule, in training data order (no per-question input)"""
+        rules = (self.kb.get_cache().get('documentation') or {}).get('business_rules', [])
+        parts: List[str] = []
+        if self._tables:
+            parts.append("=== DATABASE SCHEMA ===")
+            parts.extend(format_table(t) for t in self._tables.values())
+        if rules:
+            parts.append("\n\n=== BUSINESS RULES ===")
+            parts.extend(format_rule(r) for r in rules)
+        return "\n".join(parts)
+
+    def select_tables(self, question: str, examples: List[Dict[str, Any]]) -> Tuple[List[str], List[str]]:
+        """Return (primary, joined) tables for a question, most relevant first"""
+        primary: List[str] = []
+        for example in examples:
+            for name in extract_tables(example.get('sql', '')):
+                if name in self._tables and name not in primary:
+                    primary.append(name)
+        hits = self._table_index.search(question, k=self.max_tables)
+        for hit in hits:
+            name = hit.document.payload['name']
+            if hit.score >= 0.5 * hits[0].score and name not in primary:
+                primary.append(name)
+        primary = primary[:self.max_tables]
+
+        # Tables reachable by one FK join, favouring those that link several primaries
+        links: Dict[str, int] = {}
+        for name in primary:
+            for neighbour in self._joins.get(name, ()):
+                if neighbour not in primary:
+                    links[neighbour] = links.get(neighbour, 0) + 1
+        joined = sorted(links, key=lambda n: (-links[n], n))
+        return primary, joined[:max(0, self.max_tables - len(primary))]
+
+    def build(self, question: str) -> Tuple[str, ContextStats]:
+        """Assemble the context for a question within the token budget"""
+        example_hits = self.kb.search(question, k=self.max_examples, kinds=["question"])
+        examples = [h.document.payload for h in example_hits]
+        # Only confident examples decide which tables are in play
+        primary, joined = self.select_tables(
+            question, [h.document.payload for h in example_hits if h.matched_terms >= 2]
+        )
+        terms = [h.document.payload for h in self.kb.search(question, k=self.max_terms, kinds=["term"])]
+        rules = (self.kb.get_cache().get('documentation') or {}).get('business_rules', [])
+
+        if self.layout == "cache_prefix":
+            # Tables and rules are already in the static prefix
+            primary, joined, rules = [], [], []
+
+        # Candidates in priority order: (section, label, text)
+        candidates: List[Tuple[str, str, str]] = []
+        candidates += [("rules", r['rule'], format_rule(r)) for r in rules]
+        candidates += [("tables", n, format_table(self._tables[n])) for n in primary[:2]]
+        candidates += [("examples", e['question'], format_example(e)) for e in examples]
+        candidates += [("tables", n, format_table(self._tables[n])) for n in primary[2:]]
+        candidates += [("terms", t['term'], format_term(t)) for t in terms]
+        candidates += [("tables", n, format_table(self._tables[n])) for n in joined]
+
+        selected: Dict[str, List[Tuple[str, str]]] = {"tables": [], "terms": [], "rules": [], "examples": []}
+        used = self._header_tokens
+        dropped = 0
+        for section, label, text in candidates:
+            # Precomputed per item; only text the knowledge base does not know gets counted
+            tokens = self._token_counts[section].get(label)
+            if tokens is None:
+                tokens = self.count_tokens(text)
+            tokens += 1  # joining newline
+            if used + tokens > self.token_budget:
+                dropped += 1
+                continue
+            selected[section].append((label, text))
+            used += tokens
+
+        parts: List[str] = []
+        if selected["tables"]:
+            parts.append("=== DATABASE SCHEMA ===")
+            parts.extend(text for _, text in selected["tables"])
+        if selected["terms"]:
+            parts.append("\n\n=== BUSINESS TERMINOLOGY ===")
+            parts.extend(text for _, text in selected["terms"])
+        if selected["rules"]:
+            parts.append("\n\n=== BUSINESS RULES ===")
+            parts.extend(text for _, text in selected["rules"])
+        if selected["examples"]:
+            parts.append("\n\n=== EXAMPLE QUERIES ===")
+            parts.extend(text for _, text in selected["examples"])
+        context = "\n".join(parts)
+
+        stats = ContextStats(
+            full_tokens=self._full_tokens,
+            context_tokens=(used if parts else 0) + self._static_tokens,
+            token_budget=self.token_budget,
+            tables=[label for label, _ in selected["tables"]],
+            terms=len(selected["terms"]),
+            rules=len(selected["rules"]),
+            examples=len(selected["examples"]),
+            dropped_items=dropped,
+            static_tokens=self._static_tokens,
+        )
+        self.requests += 1
+        self.total_context_tokens += stats.context_tokens
+        self.total_tokens_saved += stats.tokens_saved
+        self.last_stats = stats
+        logger.info(
+            f"Context built: {stats.context_tokens}/{stats.full_tokens} tokens "
+            f"(saved {stats.tokens_saved}), tables={stats.tables}"
+        )
+        return context, stats
+
+    def get_stats(self) -> Dict[str, Any]:
+        last = None
+        if self.last_stats:
+            last = {**asdict(self.last_stats), "tokens_saved": self.last_stats.tokens_saved}
+        return {
+            "requests": self.requests,
+            "layout": self.layout,
+            "token_budget": self.token_budget,
+            "static_prefix_tokens": self._static_tokens,
+            "full_context_tokens": self._full_tokens,
+            "avg_context_tokens": self.total_context_tokens / self.requests if self.requests else 0,
+            "total_tokens_saved": self.total_tokens_saved,
+            "last_request": last,
+        }
+
+
+class KnowledgeContextEnhancer(LlmContextEnhancer):
+    """
+    Appends the question-relevant knowledge base context to the system prompt.
+    In the cache_prefix layout the static prefix goes first and the question's
+    context follows the prompt cache boundary.
+    """
+
+    def __init__(self, builder: ContextBuilder):
+        self.builder = builder
+
+    async def enhance_system_prompt(self, system_prompt: str, user_message: str, user: User) -> str:
+        context, _ = self.builder.build(user_message)
+        if self.builder.layout == "cache_prefix":
+            return join_system_prompt(f"{system_prompt}\n\n{self.builder.static_prefix}", context)
+        if not context:
+            return system_prompt
+        return f"{system_prompt}\n\n{context}"
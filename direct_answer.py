@@ -0,0 +1,199 @@
+"""Direct answers for known questions: the stored SQL runs through the run_sql tool, no LLM call"""
+import logging
+import time
+import uuid
+from typing import Any, AsyncGenerator, Dict, List, Mapping, Optional, Set
+
+from vanna.capabilities.sql_runner import RunSqlToolArgs
+from vanna.components import (
+    ChatInputUpdateComponent,
+    RichTextComponent,
+    SimpleTextComponent,
+    StatusBarUpdateComponent,
+    UiComponent,
+)
+from vanna.core.llm.models import ToolCall
+from vanna.core.storage import Conversation, Message
+from vanna.core.tool import ToolContext
+from vanna.core.user import User, RequestContext
+
+logger = logging.getLogger(__name__)
+
+# group -> categories of queries.json it may get direct answers for (None = all)
+GroupAllowlist = Dict[str, Optional[Set[str]]]
+
+
+def parse_group_allowlist(spec: str) -> GroupAllowlist:
+    """
+    Parse "group=category,category;group=*" (e.g. "read_sales=sales_overview,time_analysis;admin=*").
+    A group without "=" or with "*" is allowed every category.
+    """
+    allowlist: GroupAllowlist = {}
+    for entry in spec.split(";"):
+        group, _, categories = entry.partition("=")
+        group = group.strip()
+        if not group:
+            continue
+        names = {c.strip() for c in categories.split(",") if c.strip()}
+        allowlist[group] = None if not names or "*" in names else names
+    return allowlist
+
+
+class DirectAnswerAgent:
+    """
+    Wraps a Vanna Agent and answers questions that match a training query
+    almost verbatim (KnowledgeBase.find_matching_question at `min_overlap`)
+    without the LLM: the stored SQL runs through the run_sql tool and its
+    result is streamed as the same components an agent turn ends with. Only
+    users in a group whose allowlist covers the query's category take this
+    path. The exchange is written to the conversation as a tool call and
+    result, so LLM follow-ups see it. Tool errors fall back to the agent.
+    """
+
+    def __init__(
+        self,
+        agent: Any,
+        tool: Any,
+        kb: Any,
+        min_overlap: float = 1.0,
+        allowlist: Optional[Mapping[str, Optional[Set[str]]]] = None,
+    ):
+        self.agent = agent
+        self.tool = tool
+        self.kb = kb
+        self.min_overlap = min_overlap
+        self.allowlist: GroupAllowlist = dict(allowlist) if allowlist is not None else {}
+        self.questions = 0
+        self.direct_answers = 0
+        self.not_allowed = 0
+        self.fallbacks = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def __getattr__(self, name: str) -> Any:
+        # Everything except send_message is served by the wrapped agent
+        return getattr(self.agent, name)
+
+    def is_allowed(self, user: User, category: Optional[str]) -> bool:
+        for group in user.group_memberships or []:
+            if group in self.allowlist:
+                categories = self.allowlist[group]
+                if categories is None or category in categories:
+                    return True
+        return False
+
+    async def send_message(
+        self,
+        request_context: RequestContext,
+        message: str,
+        *,
+        conversation_id: Optional[str] = None,
+    ) -> AsyncGenerator[Any, None]:
+        if message.strip() and not request_context.metadata.get("starter_ui_request", False):
+            components = await self._direct_answer(request_context, message, conversation_id)
+            if components is not None:
+                for component in components:
+                    yield component
+                return
+
+        async for component in self.agent.send_message(
+            request_context, message, conversation_id=conversation_id
+        ):
+            yield component
+
+    async def _direct_answer(
+        self, request_context: RequestContext, message: str, conversation_id: Optional[str]
+    ) -> Optional[List[Any]]:
+        start = time.perf_counter()
+        self.questions += 1
+        try:
+            match = self.kb.find_matching_question(message, self.min_overlap)
+        except Exception as e:
+            logger.warning(f"Direct answer lookup failed: {e}")
+            return None
+        if not match or not match.get("sql"):
+            return None
+
+        user = await self.agent.user_resolver.resolve_user(request_context)
+        if not self.is_allowed(user, match.get("category")):
+            self.not_allowed += 1
+            return None
+
+        context = ToolContext.model_construct(
+            user=user,
+            conversation_id=conversation_id or "",
+            request_id=str(uuid.uuid4()),
+            agent_memory=getattr(self.agent, "agent_memory", None),
+            metadata={"direct_answer": True},
+        )
+        result = await self.tool.execute(context, RunSqlToolArgs(sql=match["sql"]))
+        if not result.success:
+            self.fallbacks += 1
+            logger.warning(f"Direct answer failed for {match['question']!r} ({result.error}); asking the LLM")
+            return None
+
+        text = f"Answered with the verified query for \"{match['question']}\":\n\n```sql\n{match['sql']}\n```"
+        await self._record(conversation_id, user, message, match["sql"], result.result_for_llm, text)
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.direct_answers += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        logger.info(
+            f"Direct answer (LLM bypassed): user={user.id} groups={user.group_memberships} "
+            f"question={message!r} matched={match['question']!r} "
+            f"rows={(result.metadata or {}).get('row_count')} {elapsed_ms:.1f} ms"
+        )
+        components = [result.ui_component] if result.ui_component else []
+        components += [
+            UiComponent(  # type: ignore
+                rich_component=StatusBarUpdateComponent(
+                    status="idle", message="Response complete", detail="Ready for next message"
+                )
+            ),
+            UiComponent(  # type: ignore
+                rich_component=ChatInputUpdateComponent(placeholder="Ask a follow-up question...", disabled=False)
+            ),
+            UiComponent(
+                rich_component=RichTextComponent(content=text, markdown=True),
+                simple_component=SimpleTextComponent(text=text),
+            ),
+        ]
+        return components
+
+    async def _record(
+        self,
+        conversation_id: Optional[str],
+        user: User,
+        message: str,
+        sql: str,
+        tool_result: str,
+        text: str,
+    ) -> None:
+        """Store the exchange as the agent would have: question, run_sql call, its result, answer"""
+        if not conversation_id:
+            return
+        store = self.agent.conversation_store
+        conversation = await store.get_conversation(conversation_id, user)
+        if conversation is None:
+            conversation = Conversation(id=conversation_id, user=user, messages=[])
+        call_id = f"call_direct_{uuid.uuid4().hex[:12]}"
+        conversation.add_message(Message(role="user", content=message))
+        conversation.add_message(Message(
+            role="assistant", content="",
+            tool_calls=[ToolCall(id=call_id, name=self.tool.name, arguments={"sql": sql})],
+        ))
+        conversation.add_message(Message(role="tool", content=tool_result, tool_call_id=call_id))
+        conversation.add_message(Message(role="assistant", content=text))
+        await store.update_conversation(conversation)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "questions": self.questions,
+            "direct_answers": self.direct_answers,
+            "bypass_rate": self.direct_answers / self.questions if self.questions else 0.0,
+            "not_allowed": self.not_allowed,
+            "fallbacks": self.fallbacks,
+            "avg_ms": self.total_ms / self.direct_answers if self.direct_answers else 0.0,
+            "max_ms": self.max_ms,
+        }
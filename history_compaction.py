@@ -0,0 +1,212 @@
+"""Incremental compaction of conversation history for long multi-turn sessions"""
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from token_budget import Message, TokenCounter, count_message_tokens, get_token_counter, split_turns
+
+logger = logging.getLogger(__name__)
+
+# Parts of a StreamingRunSqlTool result worth keeping once its rows are elided
+_RESULT_SUMMARY = re.compile(r"^Summary: .*?(?=\n\n|\Z)", re.MULTILINE | re.DOTALL)
+_RESULT_FILE = re.compile(r"^Results saved to file: \S+", re.MULTILINE)
+
+
+def _turn_hash(turn: List[Message]) -> str:
+    return hashlib.sha256(json.dumps(turn, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+@dataclass
+class CompactTurn:
+    """An old turn in two strengths: tool results elided, or collapsed to one exchange"""
+    original_tokens: int
+    elided: List[Message]
+    elided_tokens: int
+    collapsed: List[Message]
+    collapsed_tokens: int
+
+
+class HistoryCompactor:
+    """
+    Keeps the most recent `keep_recent_turns` turns (and the current one)
+    verbatim and compacts older ones in two steps:
+
+    1. Tool results over `max_tool_chars` are elided: SQL results keep their
+       column header, a few preview rows, the summary stats and the result
+       file name; other outputs keep their head.
+    2. While the history is still over `max_history_tokens`, the oldest
+       turns are collapsed to the question and a short note of the SQL that
+       ran and the answer given.
+
+    Turns never change once they are history, so each one is compacted once
+    and cached under its conversation (identified by the opening question);
+    later requests of the same session only compact the turn that just
+    left the recent window. Sessions that open with the same question share
+    a bucket, so each bucket is an LRU of at most `max_turns_per_conversation`
+    turns as well as there being at most `max_conversations` buckets.
+    """
+
+    def __init__(
+        self,
+        keep_recent_turns: int = 3,
+        max_history_tokens: int = 6000,
+        max_tool_chars: int = 1500,
+        preview_rows: int = 3,
+        counter: Optional[TokenCounter] = None,
+        max_conversations: int = 1024,
+        max_turns_per_conversation: int = 256,
+    ):
+        self.keep_recent_turns = keep_recent_turns
+        self.max_history_tokens = max_history_tokens
+        self.max_tool_chars = max_tool_chars
+        self.preview_rows = preview_rows
+        self.counter = counter or get_token_counter()
+        self.max_conversations = max_conversations
+        self.max_turns_per_conversation = max_turns_per_conversation
+        self._conversations: "OrderedDict[str, OrderedDict[str, CompactTurn]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.requests = 0
+        self.compacted_requests = 0
+        self.turns_compacted = 0
+        self.cache_hits = 0
+        self.elided_results = 0
+        self.collapsed_turns = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.total_ms = 0.0
+
+    def compact(self, messages: List[Message]) -> List[Message]:
+        """Return the messages with old turns compacted (the input list is not modified)"""
+        system, turns, current = split_turns(messages)
+        self.requests += 1
+        if len(turns) <= self.keep_recent_turns:
+            return messages
+
+        start = time.perf_counter()
+        split = len(turns) - self.keep_recent_turns
+        old, recent = turns[:split], turns[split:]
+        cache = self._conversation_cache(turns[0])
+        compacted: List[CompactTurn] = []
+        before = 0
+        for turn in old:
+            key = _turn_hash(turn)
+            entry = cache.get(key)
+            if entry is None:
+                entry = self._compact_turn(turn)
+                cache[key] = entry
+                while len(cache) > self.max_turns_per_conversation:
+                    cache.popitem(last=False)
+                self.turns_compacted += 1
+            else:
+                cache.move_to_end(key)
+                self.cache_hits += 1
+            compacted.append(entry)
+            before += entry.original_tokens
+
+        recent_tokens = sum(count_message_tokens(m, self.counter) for turn in recent for m in turn)
+        total = recent_tokens + sum(entry.elided_tokens for entry in compacted)
+        collapse = 0
+        while collapse < len(compacted) and total > self.max_history_tokens:
+            total -= compacted[collapse].elided_tokens - compacted[collapse].collapsed_tokens
+            collapse += 1
+
+        history: List[Message] = []
+        for i, entry in enumerate(compacted):
+            history.extend(entry.collapsed if i < collapse else entry.elided)
+        for turn in recent:
+            history.extend(turn)
+
+        self.compacted_requests += 1
+        self.collapsed_turns += collapse
+        self.tokens_before += before + recent_tokens
+        self.tokens_after += total
+        self.total_ms += (time.perf_counter() - start) * 1000
+        return system + history + current
+
+    def _conversation_cache(self, first_turn: List[Message]) -> "OrderedDict[str, CompactTurn]":
+        conversation = _turn_hash(first_turn[:1])
+        with self._lock:
+            cache = self._conversations.get(conversation)
+            if cache is None:
+                cache = self._conversations[conversation] = OrderedDict()
+                while len(self._conversations) > self.max_conversations:
+                    self._conversations.popitem(last=False)
+            else:
+                self._conversations.move_to_end(conversation)
+            return cache
+
+    def _compact_turn(self, turn: List[Message]) -> CompactTurn:
+        elided: List[Message] = []
+        for msg in turn:
+            content = msg.get("content") or ""
+            if msg["role"] == "tool" and len(content) > self.max_tool_chars:
+                msg = {**msg, "content": self.elide_result(content)}
+                self.elided_results += 1
+            elided.append(msg)
+
+        # Collapsed: the question plus one assistant note (no tool calls left to pair)
+        note = ["(Earlier turn, compacted)"]
+        for msg in turn:
+            for tc in msg.get("tool_calls") or []:
+                sql = _sql_argument(tc.get("function") or {})
+                if sql:
+                    note.append(f"Ran SQL: {' '.join(sql.split())}")
+        answers = [m["content"] for m in turn if m["role"] == "assistant" and m.get("content")]
+        if answers:
+            answer = answers[-1]
+            note.append(f"Answer: {answer[:300]}{'...' if len(answer) > 300 else ''}")
+        collapsed = [msg for msg in turn[:1] if msg["role"] == "user"]
+        collapsed.append({"role": "assistant", "content": "\n".join(note)})
+
+        return CompactTurn(
+            original_tokens=sum(count_message_tokens(m, self.counter) for m in turn),
+            elided=elided,
+            elided_tokens=sum(count_message_tokens(m, self.counter) for m in elided),
+            collapsed=collapsed,
+            collapsed_tokens=sum(count_message_tokens(m, self.counter) for m in collapsed),
+        )
+
+    def elide_result(self, content: str) -> str:
+        """Shrink one tool output, keeping what later turns may refer back to"""
+        summary = _RESULT_SUMMARY.search(content)
+        if summary is None:
+            head = content[:self.max_tool_chars // 2]
+            return f"{head}\n(... {len(content) - len(head)} more characters elided from an earlier result)"
+
+        rows = content[:summary.start()].strip().splitlines()
+        preview = [line for line in rows[:self.preview_rows + 1] if not line.startswith("(")]
+        parts = ["\n".join(preview), "(Rows elided from an earlier result)", summary.group(0)]
+        result_file = _RESULT_FILE.search(content)
+        if result_file:
+            parts.append(result_file.group(0))
+        return "\n\n".join(part for part in parts if part)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "compacted_requests": self.compacted_requests,
+            "conversations": len(self._conversations),
+            "cached_turns": sum(len(cache) for cache in list(self._conversations.values())),
+            "turns_compacted": self.turns_compacted,
+            "cache_hits": self.cache_hits,
+            "elided_results": self.elided_results,
+            "collapsed_turns": self.collapsed_turns,
+            "history_tokens_before": self.tokens_before,
+            "history_tokens_after": self.tokens_after,
+            "avg_ms": self.total_ms / self.compacted_requests if self.compacted_requests else 0.0,
+        }
+
+
+def _sql_argument(function: Dict[str, Any]) -> str:
+    try:
+        args = json.loads(function.get("arguments") or "{}")
+    except (TypeError, ValueError):
+        return ""
+    return args.get("sql", "") if isinstance(args, dict) else ""
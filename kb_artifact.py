@@ -0,0 +1,178 @@
+"""
+Precompiled knowledge base artifact.
+Compiles training_data/ into one binary file holding each source section
+(minified JSON), the prebuilt system context, token counts and the pickled
+retrieval index. The file is memory-mapped read-only: sections are decoded
+only when first used, and the index's numpy arrays point straight into the
+mapping (pickle protocol 5 out-of-band buffers), so worker processes share
+the same pages.
+
+    python kb_artifact.py [--training-data training_data] [--output data/knowledge_base.kba]
+"""
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import os
+import pickle
+import struct
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"VKBA"
+FORMAT_VERSION = 2
+_PREAMBLE = struct.Struct("<4sIQ")  # magic, format version, header offset
+_ALIGN = 16
+
+SOURCE_FILES = {
+    'schema': 'schema.json',
+    'queries': 'queries.json',
+    'documentation': 'documentation.json',
+    'sql_patterns': 'sql_patterns.json',
+    'samples': 'samples.json',
+}
+DEFAULT_ARTIFACT_PATH = "data/knowledge_base.kba"
+
+
+def hash_training_files(training_data_dir: Path) -> Dict[str, str]:
+    """sha256 of each source file that exists (read, not parsed)"""
+    hashes = {}
+    for filename in SOURCE_FILES.values():
+        path = Path(training_data_dir) / filename
+        if path.exists():
+            hashes[filename] = hashlib.sha256(path.read_bytes()).hexdigest()
+    return hashes
+
+
+class LazySections(Mapping):
+    """Read-only mapping that decodes each section on first access"""
+
+    def __init__(self, names: List[str], loader: Callable[[str], Any]):
+        self._names = list(names)
+        self._loader = loader
+        self._loaded: Dict[str, Any] = {}
+
+    def __getitem__(self, name: str) -> Any:
+        if name not in self._loaded:
+            if name not in self._names:
+                raise KeyError(name)
+            self._loaded[name] = self._loader(name)
+        return self._loaded[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._names)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def loaded_sections(self) -> List[str]:
+        return list(self._loaded)
+
+
+class KnowledgeBaseArtifact:
+    """Read-only, memory-mapped view of a compiled knowledge base"""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, header_offset = _PREAMBLE.unpack_from(self._mmap, 0)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise ValueError(f"not a knowledge base artifact (format {version})")
+            self.header: Dict[str, Any] = json.loads(self._mmap[header_offset:].decode("utf-8"))
+        except (struct.error, ValueError):
+            self._mmap.close()
+            raise
+        self._view = memoryview(self._mmap)
+
+    @property
+    def file_hashes(self) -> Dict[str, str]:
+        return self.header["file_hashes"]
+
+    def section(self, name: str) -> memoryview:
+        offset, length = self.header["sections"][name]
+        return self._view[offset:offset + length]
+
+    def load_json(self, name: str) -> Any:
+        return json.loads(self.section(name).tobytes().decode("utf-8"))
+
+    def load_text(self, name: str) -> str:
+        return self.section(name).tobytes().decode("utf-8")
+
+    def load_index(self) -> Any:
+        """Unpickle the retrieval index with its arrays backed by the mapping (zero-copy)"""
+        buffers = [self._view[offset:offset + length] for offset, length in self.header["index_buffers"]]
+        return pickle.loads(self.section("index"), buffers=buffers)
+
+
+def compile_artifact(
+    training_data_dir: str = "training_data",
+    output_path: str = DEFAULT_ARTIFACT_PATH,
+    use_vector_index: bool = False,
+) -> Path:
+    """Parse training_data once and write the compiled artifact (atomically)"""
+    from knowledge_base import KnowledgeBase
+    kb = KnowledgeBase(training_data_dir, use_vector_index=use_vector_index, artifact_path="")
+    cache = kb.load_all()
+    system_context = kb.get_system_context()
+
+    sections: Dict[str, bytes] = {}
+    for name in SOURCE_FILES:
+        if cache.get(name) is not None:
+            sections[name] = json.dumps(cache[name], ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    sections["system_context"] = system_context.encode("utf-8")
+    sections["token_counts"] = json.dumps(kb.get_token_counts()).encode("utf-8")
+    index_buffers: List[pickle.PickleBuffer] = []
+    sections["index"] = pickle.dumps(kb._index, protocol=5, buffer_callback=index_buffers.append)
+
+    output = Path(output_path)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = output.with_suffix(output.suffix + ".tmp")
+    header: Dict[str, Any] = {
+        "version": kb.get_version(),
+        "file_hashes": kb._file_hashes,
+        "stats": kb.get_stats(),
+        "use_vector_index": use_vector_index,
+        "sections": {},
+        "index_buffers": [],
+    }
+    with open(tmp_path, "wb") as f:
+        f.write(b"\0" * _PREAMBLE.size)
+
+        def write_aligned(data) -> List[int]:
+            f.write(b"\0" * (-f.tell() % _ALIGN))
+            offset = f.tell()
+            f.write(data)
+            return [offset, f.tell() - offset]
+
+        for name, data in sections.items():
+            header["sections"][name] = write_aligned(data)
+        for buffer in index_buffers:
+            header["index_buffers"].append(write_aligned(buffer.raw()))
+        header_offset = f.tell()
+        f.write(json.dumps(header).encode("utf-8"))
+        f.seek(0)
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, header_offset))
+    os.replace(tmp_path, output)
+    logger.info(f"✓ Compiled knowledge base artifact {output} ({output.stat().st_size} bytes, version {header['version']})")
+    return output
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compile training_data/ into a knowledge base artifact")
+    parser.add_argument("--training-data", default="training_data")
+    parser.add_argument("--output", default=os.getenv('KB_ARTIFACT_PATH', DEFAULT_ARTIFACT_PATH))
+    parser.add_argument("--vector-index", action="store_true",
+                        default=os.getenv('KB_VECTOR_INDEX', 'false').lower() == 'true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    compile_artifact(args.training_data, args.output, use_vector_index=args.vector_index)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,111 @@
 import os
 import json
+import asyncio
+import hashlib
+import threading
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Any
+from typing import Callable, Dict, List, Any, Optional, Tuple
 import logging
 
+from kb_artifact import (
+    DEFAULT_ARTIFACT_PATH,
+    SOURCE_FILES,
+    KnowledgeBaseArtifact,
+    LazySections,
+    hash_training_files,
+)
+from retrieval_index import RetrievalIndex, SearchHit, tokenize
+from token_budget import TokenCounter, get_token_counter
+
 logger = logging.getLogger(__name__)
 
+# Sections each derived structure is built from
+SYSTEM_CONTEXT_SECTIONS = {'schema', 'documentation', 'queries'}
+INDEX_SECTIONS = {'queries', 'sql_patterns', 'documentation'}
+
+
+# How each item appears in a system context
+def format_table(table: Dict[str, Any]) -> str:
+    return f"\n{table['name']}: {table['description']}\n{table['ddl']}"
+
+
+def format_term(term: Dict[str, Any]) -> str:
+    return f"\n{term['term']}: {term['definition']}"
+
+
+def format_rule(rule: Dict[str, Any]) -> str:
+    return f"\n{rule['rule']}: {rule['description']}"
+
+
+def format_example(example: Dict[str, Any]) -> str:
+    return f"\nQ: {example['question']}\nSQL: {example['sql']}"
+
+
+def count_section_tokens(cache: Dict[str, Any], system_context: str, counter: TokenCounter) -> Dict[str, Any]:
+    """Token count of the full context and of every table, term, rule and example"""
+    schema = cache.get('schema') or {}
+    documentation = cache.get('documentation') or {}
+    queries = cache.get('queries') or {}
+    return {
+        "counter": counter.name,
+        "full_context": counter(system_context or ""),
+        "tables": {t['name']: counter(format_table(t)) for t in schema.get('tables', [])},
+        "terms": {t['term']: counter(format_term(t)) for t in documentation.get('business_terms', [])},
+        "rules": {r['rule']: counter(format_rule(r)) for r in documentation.get('business_rules', [])},
+        "examples": {q['question']: counter(format_example(q)) for q in queries.get('question_sql_pairs', [])},
+    }
+
+
+@dataclass
+class KnowledgeBaseUpdate:
+    """A reload prepared off to the side, swapped in by apply_reload"""
+    changed_sections: List[str]
+    cache: Dict[str, Any]
+    file_hashes: Dict[str, str]
+    system_context: str
+    index: RetrievalIndex
+    token_counts: Dict[str, Any]
+
+
 class KnowledgeBase:
     """
     Loads and caches training data to provide context to the Vanna agent.
     Since Vanna 2.0 doesn't have a .train() method, we provide this data
     as system context that can be injected into prompts.
+    When a compiled artifact (see kb_artifact.py) matching the training data
+    exists, it is memory-mapped instead and sections load on first use.
     """
     
-    def __init__(self, training_data_dir: str = "training_data"):
+    def __init__(
+        self,
+        training_data_dir: str = "training_data",
+        use_vector_index: Optional[bool] = None,
+        artifact_path: Optional[str] = None,
+        token_counter: Optional[TokenCounter] = None,
+    ):
         self.training_data_dir = Path(training_data_dir)
         self._cache = {}
         self._system_context = None
+        self._file_hashes: Dict[str, str] = {}
+        self._index: Optional[RetrievalIndex] = None
+        self._artifact: Optional[KnowledgeBaseArtifact] = None
+        self._token_counts: Optional[Dict[str, Any]] = None
+        self.token_counter = token_counter or get_token_counter()
+        if use_vector_index is None:
+            use_vector_index = os.getenv('KB_VECTOR_INDEX', 'false').lower() == 'true'
+        self.use_vector_index = use_vector_index
+        if artifact_path is None:
+            artifact_path = os.getenv('KB_ARTIFACT_PATH', DEFAULT_ARTIFACT_PATH)
+        self.artifact_path = Path(artifact_path) if artifact_path else None
+        self._reload_listeners: List[Callable[[List[str]], None]] = []
+        self._reload_lock = threading.Lock()
+        self.reloads = 0
         
     def load_all(self) -> Dict[str, Any]:
         """Load all training data files into cache"""
+        if self._load_artifact():
+            return self._cache
         logger.info("Loading knowledge base...")
         
         # Load each file
@@ -29,12 +115,62 @@ class KnowledgeBase:
         self._cache['sql_patterns'] = self._load_json('sql_patterns.json')
         self._cache['samples'] = self._load_json('samples.json')
         
-        # Build system context
+        # Build system context, retrieval index and token counts
         self._system_context = self._build_system_context()
+        self._index = RetrievalIndex.from_training_data(self._cache, use_vectors=self.use_vector_index)
+        self._token_counts = count_section_tokens(self._cache, self._system_context, self.token_counter)
         
         logger.info(f"✓ Knowledge base loaded: {self.get_stats()}")
         return self._cache
     
+    def _load_artifact(self) -> bool:
+        """Map the compiled artifact if it exists and matches the training data files"""
+        if not self.artifact_path or not self.artifact_path.exists():
+            return False
+        try:
+            artifact = KnowledgeBaseArtifact(self.artifact_path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠ Ignoring unreadable knowledge base artifact {self.artifact_path}: {e}")
+            return False
+        if artifact.file_hashes != hash_training_files(self.training_data_dir):
+            logger.warning(f"⚠ Knowledge base artifact {self.artifact_path} is stale, loading JSON files")
+            return False
+
+        self._artifact = artifact
+        self._file_hashes = dict(artifact.file_hashes)
+        names = [name for name in artifact.header["sections"] if name not in ("system_context", "token_counts", "index")]
+        self._cache = LazySections(names, artifact.load_json)
+        self._system_context = None
+        self._index = None
+        self._token_counts = None
+        logger.info(f"✓ Knowledge base mapped from {self.artifact_path}: {self.get_stats()}")
+        return True
+
+    def _get_index(self) -> RetrievalIndex:
+        if self._index is None:
+            if not self._cache:
+                self.load_all()
+            if self._index is None:
+                if self._artifact is not None and self._artifact.header["use_vector_index"] == self.use_vector_index:
+                    self._index = self._artifact.load_index()
+                else:
+                    self._index = RetrievalIndex.from_training_data(self._cache, use_vectors=self.use_vector_index)
+        return self._index
+
+    def get_token_counts(self) -> Dict[str, Any]:
+        """Token counts of the full context and every table, term, rule and example (see count_section_tokens)"""
+        if self._token_counts is None:
+            if not self._cache:
+                self.load_all()
+            if self._token_counts is None and self._artifact is not None:
+                counts = self._artifact.load_json("token_counts")
+                if counts.get("counter") == self.token_counter.name:
+                    # Counted when the artifact was compiled
+                    self._token_counts = counts
+            if self._token_counts is None:
+                self._token_counts = count_section_tokens(self._cache, self.get_system_context(), self.token_counter)
+        return self._token_counts
+
     def _load_json(self, filename: str) -> Any:
         """Load a JSON file"""
         filepath = self.training_data_dir / filename
@@ -43,50 +179,162 @@ class KnowledgeBase:
             return None
         
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                logger.info(f"  ✓ Loaded {filename}")
-                return data
+            with open(filepath, 'rb') as f:
+                raw = f.read()
+            data = json.loads(raw.decode('utf-8'))
+            self._file_hashes[filename] = hashlib.sha256(raw).hexdigest()
+            logger.info(f"  ✓ Loaded {filename}")
+            return data
         except Exception as e:
             logger.error(f"  ✗ Error loading {filename}: {e}")
             return None
     
-    def _build_system_context(self) -> str:
+    def _build_system_context(self, cache: Optional[Dict[str, Any]] = None) -> str:
         """Build a comprehensive system context string from all training data"""
+        cache = self._cache if cache is None else cache
         context_parts = []
         
         # Add schema information
-        if self._cache.get('schema'):
+        if cache.get('schema'):
             context_parts.append("=== DATABASE SCHEMA ===")
-            for table in self._cache['schema'].get('tables', []):
-                context_parts.append(f"\n{table['name']}: {table['description']}")
-                context_parts.append(table['ddl'])
+            for table in cache['schema'].get('tables', []):
+                context_parts.append(format_table(table))
         
         # Add business documentation
-        if self._cache.get('documentation'):
+        if cache.get('documentation'):
             context_parts.append("\n\n=== BUSINESS TERMINOLOGY ===")
-            for term in self._cache['documentation'].get('business_terms', []):
-                context_parts.append(f"\n{term['term']}: {term['definition']}")
+            for term in cache['documentation'].get('business_terms', []):
+                context_parts.append(format_term(term))
             
             context_parts.append("\n\n=== BUSINESS RULES ===")
-            for rule in self._cache['documentation'].get('business_rules', []):
-                context_parts.append(f"\n{rule['rule']}: {rule['description']}")
+            for rule in cache['documentation'].get('business_rules', []):
+                context_parts.append(format_rule(rule))
         
         # Add query examples
-        if self._cache.get('queries'):
+        if cache.get('queries'):
             context_parts.append("\n\n=== EXAMPLE QUERIES ===")
-            for q in self._cache['queries'].get('question_sql_pairs', [])[:5]:  # Top 5 examples
-                context_parts.append(f"\nQ: {q['question']}")
-                context_parts.append(f"SQL: {q['sql']}")
+            for q in cache['queries'].get('question_sql_pairs', [])[:5]:  # Top 5 examples
+                context_parts.append(format_example(q))
         
         return "\n".join(context_parts)
     
+    # Hot reload
+    def add_reload_listener(self, listener: Callable[[List[str]], None]) -> None:
+        """Call listener(changed_sections) after every reload that changed something"""
+        self._reload_listeners.append(listener)
+
+    def prepare_reload(self) -> Optional[KnowledgeBaseUpdate]:
+        """
+        Re-parse only the training files whose content changed and rebuild the
+        structures that depend on them, without touching the live state.
+        Returns None when nothing changed or a changed file does not parse.
+        """
+        if not self._cache:
+            self.load_all()
+        hashes = hash_training_files(self.training_data_dir)
+        changed = [name for name, filename in SOURCE_FILES.items()
+                   if hashes.get(filename) != self._file_hashes.get(filename)]
+        if not changed:
+            return None
+
+        cache = {name: self._cache.get(name) for name in SOURCE_FILES if name not in changed}
+        for name in changed:
+            filepath = self.training_data_dir / SOURCE_FILES[name]
+            if not filepath.exists():
+                cache[name] = None
+                continue
+            try:
+                cache[name] = json.loads(filepath.read_bytes().decode('utf-8'))
+            except (OSError, ValueError) as e:
+                logger.error(f"  ✗ Not reloading, {filepath.name} is invalid: {e}")
+                return None
+
+        changed_set = set(changed)
+        system_context = (self._build_system_context(cache) if changed_set & SYSTEM_CONTEXT_SECTIONS
+                          else self.get_system_context())
+        index = (RetrievalIndex.from_training_data(cache, use_vectors=self.use_vector_index)
+                 if changed_set & INDEX_SECTIONS else self._get_index())
+        token_counts = (count_section_tokens(cache, system_context, self.token_counter)
+                        if changed_set & SYSTEM_CONTEXT_SECTIONS else self.get_token_counts())
+        return KnowledgeBaseUpdate(
+            changed_sections=changed,
+            cache=cache,
+            file_hashes=hashes,
+            system_context=system_context,
+            index=index,
+            token_counts=token_counts,
+        )
+
+    def apply_reload(self, update: KnowledgeBaseUpdate) -> None:
+        """Swap a prepared update in and notify dependents (no I/O, no parsing)"""
+        self._cache = update.cache
+        self._file_hashes = update.file_hashes
+        self._system_context = update.system_context
+        self._index = update.index
+        self._token_counts = update.token_counts
+        self._artifact = None  # compiled from the old files
+        self.reloads += 1
+        logger.info(f"✓ Knowledge base reloaded ({', '.join(update.changed_sections)}): {self.get_stats()}")
+        for listener in self._reload_listeners:
+            try:
+                listener(update.changed_sections)
+            except Exception as e:
+                logger.error(f"Knowledge base reload listener failed: {e}")
+
+    def reload(self) -> List[str]:
+        """Reload changed training files now; returns the changed sections"""
+        with self._reload_lock:
+            update = self.prepare_reload()
+            if update is None:
+                return []
+            self.apply_reload(update)
+            return update.changed_sections
+
+    async def reload_async(self) -> List[str]:
+        """Reload with parsing and index builds on a worker thread; the swap runs on the event loop"""
+        # Polled rather than acquired on a worker thread: a cancelled wait must not leave the lock taken
+        while not self._reload_lock.acquire(blocking=False):
+            await asyncio.sleep(0.05)
+        prepare = asyncio.ensure_future(asyncio.to_thread(self.prepare_reload))
+        release = True
+        try:
+            update = await asyncio.shield(prepare)
+            if update is None:
+                return []
+            self.apply_reload(update)
+            return update.changed_sections
+        except asyncio.CancelledError:
+            # The worker thread carries on; the lock is released once it is done
+            release = False
+            prepare.add_done_callback(self._release_after_prepare)
+            raise
+        finally:
+            if release:
+                self._reload_lock.release()
+
+    def _release_after_prepare(self, prepare: "asyncio.Future[Any]") -> None:
+        if not prepare.cancelled() and prepare.exception() is not None:
+            logger.error(f"Knowledge base reload failed: {prepare.exception()}")
+        self._reload_lock.release()
+
     def get_system_context(self) -> str:
         """Get the cached system context string"""
         if self._system_context is None:
-            self.load_all()
+            if not self._cache:
+                self.load_all()
+            if self._artifact is not None:
+                self._system_context = self._artifact.load_text("system_context")
         return self._system_context
     
+    def get_version(self) -> str:
+        """Get a fingerprint of the loaded training data (changes when any file changes)"""
+        if not self._file_hashes:
+            self.load_all()
+        digest = hashlib.sha256()
+        for filename in sorted(self._file_hashes):
+            digest.update(f"{filename}:{self._file_hashes[filename]}\n".encode('utf-8'))
+        return digest.hexdigest()[:16]
+    
     def get_schema_ddl(self) -> List[str]:
         """Get all DDL statements"""
         if not self._cache.get('schema'):
@@ -99,19 +347,37 @@ class KnowledgeBase:
             return []
         return self._cache['queries'].get('question_sql_pairs', [])
     
+    def search(self, query: str, k: int = 5, kinds: Optional[List[str]] = None) -> List[SearchHit]:
+        """Rank questions, SQL patterns and documentation against a query (top-k)"""
+        return self._get_index().search(query, k=k, kinds=kinds)
+    
     def find_similar_question(self, question: str) -> Dict[str, str]:
-        """Find a similar question in the examples (simple keyword matching)"""
-        question_lower = question.lower()
-        examples = self.get_example_queries()
-        
-        for example in examples:
-            example_q = example['question'].lower()
-            # Simple keyword matching
-            keywords = [word for word in question_lower.split() if len(word) > 3]
-            matches = sum(1 for kw in keywords if kw in example_q)
-            
-            if matches >= 2:  # If at least 2 keywords match
-                return example
+        """Find the most similar example question (BM25 ranked, at least 2 shared terms)"""
+        exact = self._get_index().lookup_exact(question, kind="question")
+        if exact is not None:
+            return exact.payload
+        
+        for hit in self.search(question, k=1, kinds=["question"]):
+            if hit.matched_terms >= 2:
+                return hit.document.payload
+        
+        return None
+    
+    def find_matching_question(self, question: str, min_overlap: float = 0.8) -> Optional[Dict[str, str]]:
+        """
+        Find the example question asked for almost verbatim: the same terms,
+        or a top hit whose terms overlap the question's by min_overlap
+        (Jaccard, so a short question does not match a longer stored one)
+        """
+        exact = self._get_index().lookup_exact(question, kind="question")
+        if exact is not None:
+            return exact.payload
+        
+        terms = set(tokenize(question))
+        for hit in self.search(question, k=1, kinds=["question"]):
+            stored = set(tokenize(hit.document.text))
+            if terms and len(terms & stored) / len(terms | stored) >= min_overlap:
+                return hit.document.payload
         
         return None
     
@@ -133,6 +399,8 @@ class KnowledgeBase:
     
     def get_stats(self) -> str:
         """Get statistics about loaded data"""
+        if self._artifact is not None:
+            return self._artifact.header["stats"]
         stats = []
         
         if self._cache.get('schema'):
@@ -156,6 +424,51 @@ class KnowledgeBase:
         return self._cache
 
 
+class KnowledgeBaseWatcher:
+    """Polls the training data files and hot-reloads the knowledge base when one changes"""
+
+    def __init__(self, kb: KnowledgeBase, interval: float = 2.0):
+        self.kb = kb
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self._last = self._snapshot()
+
+    def _snapshot(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        for filename in SOURCE_FILES.values():
+            try:
+                stat = (self.kb.training_data_dir / filename).stat()
+                snapshot[filename] = (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                pass
+        return snapshot
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            snapshot = self._snapshot()
+            if snapshot == self._last:
+                continue
+            self._last = snapshot
+            try:
+                await self.kb.reload_async()
+            except Exception as e:
+                logger.error(f"Knowledge base reload failed: {e}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
 # Global instance
 _kb_instance = None
 
@@ -0,0 +1,412 @@
+"""Deadlines, retries, hedged requests and circuit breaking for LLM calls"""
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Sequence, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# HTTP statuses worth another attempt (throttling, overload, server errors)
+RETRYABLE_STATUSES = frozenset({408, 409, 429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised without calling the endpoint while its circuit breaker is open"""
+
+
+class DeadlineExceededError(TimeoutError):
+    """The call did not complete within its deadline (all attempts included)"""
+
+
+def status_of(error: BaseException) -> Optional[int]:
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Throttling, server errors, timeouts and connection failures; not 4xx request errors"""
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    status = status_of(error)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    # openai.APIConnectionError / APITimeoutError carry no status
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """Delay requested by the server (retry-after-ms, or retry-after in seconds or as an HTTP date)"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls
+    for `reset_seconds`; then lets a single probe through (half-open) and
+    closes again if it succeeds.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_seconds:
+            self.state = "half_open"
+            self._probing = False
+        if self.state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._probing = False
+        if self.state != "closed":
+            logger.info("LLM circuit breaker closed")
+        self.state = "closed"
+
+    def cancel_probe(self) -> None:
+        """An admitted call was never sent; let the next one probe instead"""
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._probing = False
+        if self.state == "half_open" or (self.state == "closed" and self._failures >= self.failure_threshold):
+            self.state = "open"
+            self._opened_at = time.monotonic()
+            self.opened += 1
+            logger.warning(f"⚠ LLM circuit breaker opened after {self._failures} failures")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "consecutive_failures": self._failures,
+                "opened": self.opened, "rejected": self.rejected}
+
+
+class LatencyWindow:
+    """Latencies of the last `size` successful calls, for the hedging threshold"""
+
+    def __init__(self, size: int = 200):
+        self._samples: Deque[float] = deque(maxlen=size)
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ResilientCaller:
+    """
+    Runs a call against one or more named targets (deployments) with:
+
+    - a deadline for the whole call, retries included;
+    - up to `max_retries` retries of retryable errors, after full-jitter
+      exponential backoff or the server's Retry-After, whichever is longer
+      (a Retry-After past the deadline fails the call at once);
+    - a hedged request: if the first target has not answered after its
+      `hedge_quantile` latency (once `hedge_min_samples` calls are known,
+      and never before `hedge_min_delay`), the same call starts on the next
+      target and the first success wins;
+    - a circuit breaker per target: an open target is skipped, and with no
+      target left the call fails fast with CircuitOpenError.
+
+    `discard` is awaited with any result that lost a hedge race (e.g. to
+    close an opened stream). `prepare` is awaited before each attempt is
+    sent, e.g. to wait for rate-limit quota; that wait counts against the
+    deadline but not towards the attempt's latency, so queueing for quota
+    never looks like a slow deployment and never triggers a hedge.
+    """
+
+    def __init__(
+        self,
+        deadline_seconds: float = 120.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        hedge_quantile: float = 0.95,
+        hedge_min_samples: int = 20,
+        hedge_min_delay: float = 0.5,
+        failure_threshold: int = 5,
+        reset_seconds: float = 30.0,
+    ):
+        self.deadline_seconds = deadline_seconds
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.latencies: Dict[str, LatencyWindow] = {}
+
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.retry_after_waits = 0
+        self.failures = 0
+        self.deadline_exceeded = 0
+        self.fast_failures = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def breaker(self, target: str) -> CircuitBreaker:
+        if target not in self.breakers:
+            self.breakers[target] = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+            self.latencies[target] = LatencyWindow()
+        return self.breakers[target]
+
+    def hedge_delay(self, target: str) -> Optional[float]:
+        """Seconds after which a call to `target` is hedged (None until enough samples)"""
+        self.breaker(target)
+        window = self.latencies[target]
+        if len(window) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, window.quantile(self.hedge_quantile))
+
+    def new_deadline(self) -> float:
+        """Deadline (monotonic) of a call starting now; pass it to call() to bound what follows, e.g. a stream body"""
+        return time.monotonic() + self.deadline_seconds
+
+    def backoff(self, retry: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retry))
+
+    async def call(
+        self,
+        attempt: Callable[[str], Awaitable[T]],
+        targets: Sequence[str],
+        discard: Optional[Callable[[T], Awaitable[None]]] = None,
+        prepare: Optional[Callable[[str], Awaitable[None]]] = None,
+        deadline: Optional[float] = None,
+    ) -> T:
+        self.calls += 1
+        if deadline is None:
+            deadline = self.new_deadline()
+        retry = 0
+        while True:
+            try:
+                return await self._attempt(attempt, targets, deadline, discard, prepare)
+            except CircuitOpenError:
+                self.fast_failures += 1
+                raise
+            except Exception as e:
+                remaining = deadline - time.monotonic()
+                if isinstance(e, DeadlineExceededError) or remaining <= 0:
+                    self.deadline_exceeded += 1
+                    raise e if isinstance(e, DeadlineExceededError) else DeadlineExceededError(
+                        f"LLM call exceeded its {self.deadline_seconds:.0f}s deadline"
+                    ) from e
+                if not is_retryable(e) or retry >= self.max_retries:
+                    self.failures += 1
+                    raise
+                wait = self.backoff(retry)
+                requested = retry_after_seconds(e)
+                if requested is not None:
+                    self.retry_after_waits += 1
+                    wait = max(wait, requested)
+                if wait >= remaining:
+                    self.deadline_exceeded += 1
+                    raise DeadlineExceededError(
+                        f"Retry in {wait:.1f}s would pass the {self.deadline_seconds:.0f}s deadline"
+                    ) from e
+                retry += 1
+                self.retries += 1
+                logger.info(f"LLM call failed ({status_of(e) or type(e).__name__}), retry {retry} in {wait:.2f}s")
+                await asyncio.sleep(wait)
+
+    async def _attempt(
+        self,
+        attempt: Callable[[str], Awaitable[T]],
+        targets: Sequence[str],
+        deadline: float,
+        discard: Optional[Callable[[T], Awaitable[None]]],
+        prepare: Optional[Callable[[str], Awaitable[None]]],
+    ) -> T:
+        # Breakers are asked only when a target is actually started (allow() may admit a probe)
+        remaining_targets = list(targets)
+        probes = set()
+
+        def next_target() -> Optional[str]:
+            while remaining_targets:
+                target = remaining_targets.pop(0)
+                breaker = self.breaker(target)
+                if breaker.allow():
+                    if breaker.state == "half_open":
+                        probes.add(target)
+                    return target
+            return None
+
+        first = next_target()
+        if first is None:
+            raise CircuitOpenError(f"Circuit open for {', '.join(targets)}")
+
+        if prepare is not None:
+            # Before the attempt's clock starts: the first target is timed from when it is sent
+            try:
+                await asyncio.wait_for(prepare(first), timeout=max(0.0, deadline - time.monotonic()))
+            except BaseException as e:
+                self.breaker(first).cancel_probe()
+                if isinstance(e, asyncio.TimeoutError):
+                    raise DeadlineExceededError(
+                        f"LLM call exceeded its {self.deadline_seconds:.0f}s deadline waiting for quota"
+                    ) from e
+                raise
+
+        self.attempts += 1
+        # Task -> (target, {"sent_at": time the request was (or is to be) sent, "sent": whether it was})
+        started: Dict["asyncio.Task[T]", tuple] = {}
+
+        def start(target: str, prepared: bool = False) -> None:
+            sending = {"sent_at": time.monotonic(), "sent": prepare is None or prepared}
+
+            async def run() -> T:
+                if not sending["sent"]:
+                    try:
+                        await prepare(target)
+                    except BaseException:
+                        self.breaker(target).cancel_probe()
+                        raise
+                    sending.update(sent_at=time.monotonic(), sent=True)
+                return await attempt(target)
+
+            started[asyncio.ensure_future(run())] = (target, sending)
+
+        start(first, prepared=True)
+        errors: List[BaseException] = []
+        timed_out = False
+        try:
+            while started:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise DeadlineExceededError(f"LLM call exceeded its {self.deadline_seconds:.0f}s deadline")
+                hedge_at = None
+                if remaining_targets:
+                    delay = self.hedge_delay(first)
+                    if delay is not None:
+                        hedge_at = min(s["sent_at"] for _, s in started.values()) + delay
+                        timeout = min(timeout, hedge_at - time.monotonic())
+
+                done, _ = await asyncio.wait(started, timeout=max(0.0, timeout),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if hedge_at is not None and time.monotonic() >= hedge_at:
+                        target = next_target()
+                        if target is not None:
+                            self.hedges += 1
+                            logger.info(f"LLM call slower than p{int(self.hedge_quantile * 100)}, hedging to {target}")
+                            start(target)
+                    continue
+
+                for task in done:
+                    target, sending = started.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        self.breaker(target).record_success()
+                        self.latencies[target].record(time.monotonic() - sending["sent_at"])
+                        if target != first:
+                            self.hedge_wins += 1
+                        return task.result()
+                    errors.append(error)
+                    if is_retryable(error):
+                        self.breaker(target).record_failure()
+                    else:
+                        self.breaker(target).record_success()  # the endpoint answered
+                # Every started target failed: fail over right away if one is left
+                if not started and is_retryable(errors[-1]):
+                    target = next_target()
+                    if target is not None:
+                        start(target)
+            raise errors[-1]
+        except DeadlineExceededError:
+            timed_out = True
+            raise
+        finally:
+            for task, (target, sending) in started.items():
+                task.cancel()
+                if not sending["sent"]:
+                    continue  # run() gives a probe back when its quota wait is cancelled
+                if timed_out:
+                    # The target did not answer in time: a failure (a timed-out probe reopens the breaker)
+                    self.breaker(target).record_failure()
+                elif target in probes:
+                    # Lost a hedge race or the caller went away: the probe proved nothing
+                    self.breaker(target).cancel_probe()
+            if started and discard is not None:
+                for task in started:
+                    asyncio.ensure_future(self._discard_when_done(task, discard))
+
+    @staticmethod
+    async def _discard_when_done(task: "asyncio.Task[T]", discard: Callable[[T], Awaitable[None]]) -> None:
+        try:
+            result = await task
+        except BaseException:
+            return
+        try:
+            await discard(result)
+        except Exception:
+            pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "retry_after_waits": self.retry_after_waits,
+            "failures": self.failures,
+            "deadline_exceeded": self.deadline_exceeded,
+            "fast_failures": self.fast_failures,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "targets": {
+                target: {
+                    **breaker.get_stats(),
+                    "p95_ms": 1000 * (self.latencies[target].quantile(0.95) or 0.0),
+                    "hedge_after_ms": 1000 * (self.hedge_delay(target) or 0.0),
+                }
+                for target, breaker in self.breakers.items()
+            },
+        }
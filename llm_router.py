@@ -0,0 +1,293 @@
+"""Routing of LLM requests across several deployments by difficulty, prompt size, cost and latency"""
+import logging
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Any, AsyncGenerator, Dict, List, Optional, Sequence
+
+from vanna.core.llm import LlmService, LlmRequest, LlmResponse, LlmStreamChunk
+
+from token_budget import TokenCounter, get_token_counter
+
+logger = logging.getLogger(__name__)
+
+# queries.json difficulty -> minimum quality tier
+DIFFICULTY_TIERS = {"simple": 1, "medium": 2, "complex": 3}
+ROUTING_STRATEGIES = ("cost", "latency")
+
+
+@dataclass
+class Deployment:
+    """One deployment the router may use; tier 1 = cheapest models, 3 = strongest"""
+    name: str
+    service: LlmService
+    tier: int
+    prompt_cost: float = 0.0  # per 1k prompt tokens
+    completion_cost: float = 0.0  # per 1k completion tokens
+    context_window: int = 128000
+    supports_tools: bool = True
+
+
+def parse_deployments(spec: str) -> List[Dict[str, Any]]:
+    """
+    Parse "name:tier:prompt_cost:completion_cost[:context_window]" entries,
+    comma separated (e.g. "gpt-4o-mini:1:0.15:0.6,gpt-4:3:30:60:8192").
+    """
+    deployments = []
+    for entry in spec.split(","):
+        parts = [p.strip() for p in entry.split(":")]
+        if not parts[0]:
+            continue
+        if len(parts) < 4:
+            raise ValueError(f"Deployment {entry!r} needs name:tier:prompt_cost:completion_cost")
+        deployment = {"name": parts[0], "tier": int(parts[1]),
+                      "prompt_cost": float(parts[2]), "completion_cost": float(parts[3])}
+        if len(parts) > 4:
+            deployment["context_window"] = int(parts[4])
+        deployments.append(deployment)
+    return deployments
+
+
+@dataclass
+class RequestProfile:
+    """What the router knows about a request before choosing a deployment"""
+    required_tier: int
+    prompt_tokens: int
+    uses_tools: bool
+    difficulty: Optional[str] = None
+    reasons: List[str] = field(default_factory=list)
+
+
+class RequestClassifier:
+    """
+    Sets the minimum tier of a request:
+    - the difficulty of the closest training question (queries.json
+      `difficulty`), or `default_tier` for questions unlike any of them;
+    - turns that only summarize tool results need no more than `summary_tier`;
+    - prompts over `large_prompt_tokens` need at least `large_prompt_tier`.
+    """
+
+    def __init__(
+        self,
+        kb: Any = None,
+        counter: Optional[TokenCounter] = None,
+        default_tier: int = 3,
+        summary_tier: int = 2,
+        large_prompt_tokens: int = 8000,
+        large_prompt_tier: int = 2,
+    ):
+        self.kb = kb
+        self.counter = counter or get_token_counter()
+        self.default_tier = default_tier
+        self.summary_tier = summary_tier
+        self.large_prompt_tokens = large_prompt_tokens
+        self.large_prompt_tier = large_prompt_tier
+
+    def classify(self, request: LlmRequest) -> RequestProfile:
+        prompt_tokens = self.counter(request.system_prompt or "") + sum(
+            self.counter(m.content or "") for m in request.messages
+        )
+        profile = RequestProfile(required_tier=self.default_tier, prompt_tokens=prompt_tokens,
+                                 uses_tools=bool(request.tools))
+
+        question = next((m.content for m in reversed(request.messages) if m.role == "user"), "") or ""
+        match = None
+        if self.kb is not None and question:
+            try:
+                match = self.kb.find_similar_question(question)
+            except Exception as e:
+                logger.warning(f"Router difficulty lookup failed: {e}")
+        if match and match.get("difficulty") in DIFFICULTY_TIERS:
+            profile.difficulty = match["difficulty"]
+            profile.required_tier = DIFFICULTY_TIERS[profile.difficulty]
+            profile.reasons.append(f"difficulty={profile.difficulty}")
+        else:
+            profile.reasons.append("unknown question")
+
+        if request.messages and request.messages[-1].role == "tool":
+            if profile.required_tier > self.summary_tier:
+                profile.required_tier = self.summary_tier
+                profile.reasons.append("tool result summary")
+        if prompt_tokens > self.large_prompt_tokens and profile.required_tier < self.large_prompt_tier:
+            profile.required_tier = self.large_prompt_tier
+            profile.reasons.append(f"large prompt ({prompt_tokens} tokens)")
+        return profile
+
+
+class _DeploymentStats:
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.latency_ewma: Optional[float] = None
+        self.requests = 0
+        self.errors = 0
+        self.fallbacks_from = 0
+        self.consecutive_errors = 0
+        self.cooldown_until = 0.0
+        self.estimated_cost = 0.0
+
+    def record_latency(self, seconds: float) -> None:
+        self.latency_ewma = seconds if self.latency_ewma is None else (
+            self.alpha * seconds + (1 - self.alpha) * self.latency_ewma
+        )
+
+
+class LlmRouter(LlmService):
+    """
+    LlmService that sends each request to one of several deployments.
+    A RequestClassifier sets the minimum quality tier; among deployments
+    that meet it, fit the prompt and support the request's tools, the
+    cheapest (strategy "cost", by estimated prompt + completion cost) or
+    the fastest (strategy "latency", by the live latency EWMA) is used,
+    the other criterion breaking ties. On an error before any output the
+    next qualified candidate is tried. A deployment that failed
+    `max_consecutive_errors` times in a row sits out `cooldown_seconds`
+    (it is still tried when nothing else is left). Streamed latency is
+    time to first chunk.
+    """
+
+    def __init__(
+        self,
+        deployments: Sequence[Deployment],
+        classifier: Optional[RequestClassifier] = None,
+        strategy: str = "cost",
+        expected_completion_tokens: int = 300,
+        ewma_alpha: float = 0.2,
+        max_consecutive_errors: int = 3,
+        cooldown_seconds: float = 30.0,
+    ):
+        if not deployments:
+            raise ValueError("LlmRouter needs at least one deployment")
+        if strategy not in ROUTING_STRATEGIES:
+            raise ValueError(f"Unknown routing strategy {strategy!r}; use one of {ROUTING_STRATEGIES}")
+        self.deployments = list(deployments)
+        self.classifier = classifier or RequestClassifier()
+        self.strategy = strategy
+        self.expected_completion_tokens = expected_completion_tokens
+        self.max_consecutive_errors = max_consecutive_errors
+        self.cooldown_seconds = cooldown_seconds
+        self._stats = {d.name: _DeploymentStats(ewma_alpha) for d in self.deployments}
+        self.requests = 0
+        self.fallbacks = 0
+        self.by_tier: Dict[int, int] = {}
+        self.last_route: Optional[Dict[str, Any]] = None
+
+    def estimated_cost(self, deployment: Deployment, prompt_tokens: int) -> float:
+        return (prompt_tokens * deployment.prompt_cost
+                + self.expected_completion_tokens * deployment.completion_cost) / 1000
+
+    def candidates(self, request: LlmRequest, profile: RequestProfile) -> List[Deployment]:
+        """Deployments in the order they should be tried"""
+        reserve = request.max_tokens or self.expected_completion_tokens
+        now = time.monotonic()
+
+        def usable(d: Deployment) -> bool:
+            return (profile.prompt_tokens + reserve <= d.context_window
+                    and (d.supports_tools or not profile.uses_tools))
+
+        def rank(d: Deployment):
+            cost = self.estimated_cost(d, profile.prompt_tokens)
+            # Unmeasured deployments count as fast so they get measured
+            latency = self._stats[d.name].latency_ewma or 0.0
+            return (cost, latency) if self.strategy == "cost" else (latency, cost)
+
+        eligible = [d for d in self.deployments if usable(d)] or list(self.deployments)
+        # Never route below the required tier, unless no deployment reaches it
+        top_tier = max(d.tier for d in eligible)
+        qualified = [d for d in eligible if d.tier >= min(profile.required_tier, top_tier)]
+        healthy = sorted((d for d in qualified if self._stats[d.name].cooldown_until <= now), key=rank)
+        # Cooling-down deployments are the last resort
+        cooling = sorted((d for d in qualified if d not in healthy), key=rank)
+        return healthy + cooling
+
+    def _route(self, request: LlmRequest) -> List[Deployment]:
+        profile = self.classifier.classify(request)
+        candidates = self.candidates(request, profile)
+        self.requests += 1
+        self.by_tier[profile.required_tier] = self.by_tier.get(profile.required_tier, 0) + 1
+        self.last_route = {**asdict(profile), "deployment": candidates[0].name}
+        logger.info(
+            f"LLM route: {candidates[0].name} (tier >= {profile.required_tier}: {', '.join(profile.reasons)}; "
+            f"{profile.prompt_tokens} prompt tokens)"
+        )
+        self._stats[candidates[0].name].estimated_cost += self.estimated_cost(candidates[0], profile.prompt_tokens)
+        return candidates
+
+    def _record_error(self, deployment: Deployment, error: Exception) -> None:
+        stats = self._stats[deployment.name]
+        stats.errors += 1
+        stats.consecutive_errors += 1
+        if stats.consecutive_errors >= self.max_consecutive_errors:
+            stats.cooldown_until = time.monotonic() + self.cooldown_seconds
+            logger.warning(f"⚠ LLM deployment {deployment.name} cooling down after {stats.consecutive_errors} errors")
+        logger.warning(f"LLM deployment {deployment.name} failed ({type(error).__name__}: {error})")
+
+    def _record_success(self, deployment: Deployment, seconds: float) -> None:
+        stats = self._stats[deployment.name]
+        stats.consecutive_errors = 0
+        stats.cooldown_until = 0.0
+        stats.record_latency(seconds)
+
+    async def send_request(self, request: LlmRequest) -> LlmResponse:
+        candidates = self._route(request)
+        for i, deployment in enumerate(candidates):
+            self._stats[deployment.name].requests += 1
+            start = time.perf_counter()
+            try:
+                response = await deployment.service.send_request(request)
+            except Exception as e:
+                self._record_error(deployment, e)
+                if i + 1 == len(candidates):
+                    raise
+                self._fallback(deployment, candidates[i + 1])
+                continue
+            self._record_success(deployment, time.perf_counter() - start)
+            response.metadata = {**(response.metadata or {}), "deployment": deployment.name}
+            return response
+        raise RuntimeError("No LLM deployment available")
+
+    async def stream_request(self, request: LlmRequest) -> AsyncGenerator[LlmStreamChunk, None]:
+        candidates = self._route(request)
+        for i, deployment in enumerate(candidates):
+            self._stats[deployment.name].requests += 1
+            start = time.perf_counter()
+            started = False
+            try:
+                async for chunk in deployment.service.stream_request(request):
+                    if not started:
+                        started = True
+                        self._record_success(deployment, time.perf_counter() - start)
+                    yield chunk
+                return
+            except Exception as e:
+                self._record_error(deployment, e)
+                if started or i + 1 == len(candidates):
+                    raise
+                self._fallback(deployment, candidates[i + 1])
+
+    def _fallback(self, failed: Deployment, next_deployment: Deployment) -> None:
+        self.fallbacks += 1
+        self._stats[failed.name].fallbacks_from += 1
+        logger.info(f"LLM falling back from {failed.name} to {next_deployment.name}")
+
+    async def validate_tools(self, tools: List[Any]) -> List[str]:
+        return await self.deployments[0].service.validate_tools(tools)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "strategy": self.strategy,
+            "requests": self.requests,
+            "fallbacks": self.fallbacks,
+            "by_required_tier": dict(sorted(self.by_tier.items())),
+            "deployments": {
+                d.name: {
+                    "tier": d.tier,
+                    "requests": s.requests,
+                    "errors": s.errors,
+                    "fallbacks_from": s.fallbacks_from,
+                    "latency_ewma_ms": 1000 * s.latency_ewma if s.latency_ewma is not None else None,
+                    "cooling_down": s.cooldown_until > time.monotonic(),
+                    "estimated_cost": s.estimated_cost,
+                }
+                for d, s in ((d, self._stats[d.name]) for d in self.deployments)
+            },
+            "last_route": self.last_route,
+        }
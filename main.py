@@ -1,11 +1,11 @@
 import os
+from typing import List, Optional
 from dotenv import load_dotenv
+from fastapi import HTTPException, Query, Request
 from vanna import Agent, AgentConfig
 from vanna.servers.fastapi import VannaFastAPIServer
 from vanna.core.registry import ToolRegistry
 from vanna.core.user import UserResolver, User, RequestContext
-from vanna.tools import RunSqlTool
-from vanna.integrations.postgres import PostgresRunner
 import logging
 
 # Load environment variables
@@ -13,7 +13,26 @@ load_dotenv()
 
 # Custom Azure OpenAI integration
 from azure_openai_llm import AzureOpenAILlmService
-from knowledge_base import get_knowledge_base
+from knowledge_base import KnowledgeBaseWatcher, get_knowledge_base
+from answer_cache import AnswerCache, CachedAgent
+from context_builder import ContextBuilder, KnowledgeContextEnhancer
+from postgres_pool import PooledPostgresRunner
+from postgres_replicas import ReplicatedPostgresRunner, parse_group_pins, parse_replicas
+from sql_result_cache import CachedSqlRunner, SqlResultCache
+from sql_guard import CostGuardedSqlRunner, parse_group_limits
+from sql_validator import SchemaValidator, ValidatingSqlRunner
+from aggregate_layer import BUILDER_LOCK_KEY, AggregateLayer, AggregateRoutingSqlRunner
+from result_streaming import StreamingRunSqlTool, register_result_routes
+from serve import InFlightMiddleware, InFlightRequests, WorkerBroadcast, default_broadcast_path
+from prompt_cache import RouteContextMiddleware, UsageTracker
+from token_budget import PromptBudgeter
+from history_compaction import HistoryCompactor
+from llm_resilience import ResilientCaller
+from llm_router import Deployment, LlmRouter, RequestClassifier, parse_deployments
+from rate_limiter import PriorityMiddleware, QuotaScheduler, create_backend
+from speculative_sql import EarlySqlDispatcher, SpeculativeAgent, SpeculativeSqlRunner
+from direct_answer import DirectAnswerAgent, parse_group_allowlist
+from request_coalescing import CoalescingAgent
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -34,17 +53,120 @@ azure_openai_config = {
     'api_key': os.getenv('AZURE_OPENAI_API_KEY'),
     'azure_endpoint': os.getenv('AZURE_OPENAI_ENDPOINT'),
     'api_version': os.getenv('AZURE_OPENAI_API_VERSION', '2024-02-15-preview'),
-    'deployment_name': os.getenv('AZURE_OPENAI_DEPLOYMENT_NAME', 'gpt-4')
+    'deployment_name': os.getenv('AZURE_OPENAI_DEPLOYMENT_NAME', 'gpt-4'),
+    # Async client by default; set to true to fall back to the sync client
+    'use_sync_client': os.getenv('AZURE_OPENAI_USE_SYNC_CLIENT', 'false').lower() == 'true',
 }
 
+# Prompt, cached and completion tokens per user and per route
+llm_usage = UsageTracker(cached_discount=float(os.getenv('AZURE_OPENAI_CACHED_TOKEN_DISCOUNT', 0.5)))
+
+# Trim history and context sections to fit the deployment's context window
+budget_config = {
+    'context_window': int(os.getenv('AZURE_OPENAI_CONTEXT_WINDOW', 128000)),
+    'completion_reserve': int(os.getenv('AZURE_OPENAI_COMPLETION_RESERVE', 4096)),
+    'keep_recent_turns': int(os.getenv('PROMPT_KEEP_RECENT_TURNS', 2)),
+}
+prompt_budgeter = PromptBudgeter(**budget_config)
+
+# Old turns of long sessions: large tool results elided, then whole turns collapsed
+compaction_config = {
+    'enabled': os.getenv('HISTORY_COMPACTION_ENABLED', 'true').lower() == 'true',
+    'keep_recent_turns': int(os.getenv('HISTORY_KEEP_RECENT_TURNS', 3)),
+    'max_history_tokens': int(os.getenv('HISTORY_MAX_TOKENS', 6000)),
+    'max_tool_chars': int(os.getenv('HISTORY_MAX_TOOL_CHARS', 1500)),
+}
+history_compactor = None
+if compaction_config['enabled']:
+    history_compactor = HistoryCompactor(
+        keep_recent_turns=compaction_config['keep_recent_turns'],
+        max_history_tokens=compaction_config['max_history_tokens'],
+        max_tool_chars=compaction_config['max_tool_chars'],
+    )
+
+# Deadline, retries (honoring Retry-After), hedging to a second deployment, circuit breaker
+resilience_config = {
+    'enabled': os.getenv('AZURE_OPENAI_RESILIENCE_ENABLED', 'true').lower() == 'true',
+    'deadline_seconds': float(os.getenv('AZURE_OPENAI_DEADLINE_SECONDS', 120)),
+    'max_retries': int(os.getenv('AZURE_OPENAI_MAX_RETRIES', 3)),
+    'hedge_min_delay': float(os.getenv('AZURE_OPENAI_HEDGE_MIN_DELAY_SECONDS', 2)),
+    'failure_threshold': int(os.getenv('AZURE_OPENAI_BREAKER_FAILURES', 5)),
+    'reset_seconds': float(os.getenv('AZURE_OPENAI_BREAKER_RESET_SECONDS', 30)),
+}
+hedge_config = {
+    'hedge_model': os.getenv('AZURE_OPENAI_HEDGE_DEPLOYMENT') or None,
+    'hedge_endpoint': os.getenv('AZURE_OPENAI_HEDGE_ENDPOINT') or None,
+    'hedge_api_key': os.getenv('AZURE_OPENAI_HEDGE_API_KEY') or None,
+}
+llm_resilience = None
+if resilience_config['enabled']:
+    llm_resilience = ResilientCaller(**{k: v for k, v in resilience_config.items() if k != 'enabled'})
+
+# Client-side RPM/TPM metering per deployment: bursts queue (fair per user, interactive first) instead of 429ing
+rate_limit_config = {
+    'requests_per_minute': int(os.getenv('AZURE_OPENAI_RPM_LIMIT', 0)),
+    'tokens_per_minute': int(os.getenv('AZURE_OPENAI_TPM_LIMIT', 0)),
+    'burst_seconds': float(os.getenv('AZURE_OPENAI_RATE_LIMIT_BURST_SECONDS', 10)),
+    # 'file' shares the quota between the workers of a host
+    'backend': os.getenv('AZURE_OPENAI_RATE_LIMIT_BACKEND', 'local'),
+    'path': os.getenv('AZURE_OPENAI_RATE_LIMIT_FILE', '/tmp/vanna_llm_quota.json'),
+}
+llm_rate_limiter = None
+if rate_limit_config['requests_per_minute'] or rate_limit_config['tokens_per_minute']:
+    llm_rate_limiter = QuotaScheduler(
+        requests_per_minute=rate_limit_config['requests_per_minute'],
+        tokens_per_minute=rate_limit_config['tokens_per_minute'],
+        burst_seconds=rate_limit_config['burst_seconds'],
+        backend=create_backend(rate_limit_config['backend'], rate_limit_config['path']),
+        counter=prompt_budgeter.counter,
+    )
+
 llm = AzureOpenAILlmService(
     api_key=azure_openai_config['api_key'],
     model=azure_openai_config['deployment_name'],
     azure_endpoint=azure_openai_config['azure_endpoint'],
-    api_version=azure_openai_config['api_version']
+    api_version=azure_openai_config['api_version'],
+    use_sync_client=azure_openai_config['use_sync_client'],
+    usage_tracker=llm_usage,
+    budgeter=prompt_budgeter,
+    compactor=history_compactor,
+    resilience=llm_resilience,
+    rate_limiter=llm_rate_limiter,
+    **(hedge_config if llm_resilience else {}),
 )
 
 logger.info(f"✓ Azure OpenAI configured: {azure_openai_config['deployment_name']}")
+logger.info(f"✓ Prompt budget: {budget_config} (tokenizer {prompt_budgeter.counter.name})")
+if history_compactor:
+    logger.info(f"✓ History compaction enabled: {compaction_config}")
+if llm_resilience:
+    logger.info(f"✓ LLM resilience enabled: {resilience_config} (hedge deployment: {hedge_config['hedge_model']})")
+if llm_rate_limiter:
+    logger.info(f"✓ LLM rate limiting enabled: {rate_limit_config}")
+
+# Route each request to the cheapest/fastest deployment good enough for it
+# (deployments as "name:tier:prompt_cost:completion_cost[:context_window]", costs per 1k tokens)
+router_config = {
+    'deployments': parse_deployments(os.getenv('AZURE_OPENAI_ROUTER_DEPLOYMENTS', '')),
+    'strategy': os.getenv('AZURE_OPENAI_ROUTER_STRATEGY', 'cost'),
+    'default_tier': int(os.getenv('AZURE_OPENAI_ROUTER_DEFAULT_TIER', 3)),
+    'summary_tier': int(os.getenv('AZURE_OPENAI_ROUTER_SUMMARY_TIER', 2)),
+}
+router_services = {}
+for deployment in router_config['deployments']:
+    router_services[deployment['name']] = AzureOpenAILlmService(
+        api_key=azure_openai_config['api_key'],
+        model=deployment['name'],
+        azure_endpoint=azure_openai_config['azure_endpoint'],
+        api_version=azure_openai_config['api_version'],
+        use_sync_client=azure_openai_config['use_sync_client'],
+        usage_tracker=llm_usage,
+        budgeter=prompt_budgeter,
+        compactor=history_compactor,
+        resilience=(ResilientCaller(**{k: v for k, v in resilience_config.items() if k != 'enabled'})
+                    if llm_resilience else None),
+        rate_limiter=llm_rate_limiter,
+    )
 
 # ============================================
 # 2. DATA SOURCE - Your business database that users will query
@@ -57,18 +179,170 @@ data_source_config = {
     'password': os.getenv('DATA_SOURCE_PASSWORD'),
 }
 
-postgres_runner = PostgresRunner(**data_source_config)
+# Connection pool: connections open lazily, blocking calls run off the event loop
+pool_config = {
+    'min_size': int(os.getenv('DATA_SOURCE_POOL_MIN', 1)),
+    'max_size': int(os.getenv('DATA_SOURCE_POOL_MAX', 10)),
+    'health_check_after': float(os.getenv('DATA_SOURCE_POOL_HEALTH_CHECK_SECONDS', 30)),
+}
+
+postgres_runner = PooledPostgresRunner(**data_source_config, **pool_config)
+
+logger.info(f"✓ Data source configured: {data_source_config['host']}/{data_source_config['database']} (pool {pool_config['min_size']}-{pool_config['max_size']})")
+
+# Read replicas (same database and credentials): writes stay on the primary, reads are balanced across
+# replicas within the lag bound; e.g. DATA_SOURCE_REPLICAS=pg-replica-1,eu=pg-replica-2:6432
+replica_config = {
+    'replicas': parse_replicas(os.getenv('DATA_SOURCE_REPLICAS', ''), data_source_config['port']),
+    'max_lag_seconds': float(os.getenv('DATA_SOURCE_REPLICA_MAX_LAG_SECONDS', 30)),
+    'pinned_groups': parse_group_pins(os.getenv('DATA_SOURCE_PINNED_GROUPS', 'admin=primary')),
+    'eject_after': int(os.getenv('DATA_SOURCE_REPLICA_EJECT_AFTER', 2)),
+    'eject_seconds': float(os.getenv('DATA_SOURCE_REPLICA_EJECT_SECONDS', 30)),
+    'health_check_seconds': float(os.getenv('DATA_SOURCE_REPLICA_CHECK_SECONDS', 5)),
+    'read_from_primary': os.getenv('DATA_SOURCE_READ_FROM_PRIMARY', 'false').lower() == 'true',
+}
+
+replicated_runner = None
+if replica_config['replicas']:
+    replicated_runner = ReplicatedPostgresRunner(
+        postgres_runner,
+        {name: PooledPostgresRunner(**{**data_source_config, 'host': host, 'port': port}, **pool_config)
+         for name, host, port in replica_config['replicas']},
+        **{k: v for k, v in replica_config.items() if k != 'replicas'},
+    )
+    # Everything below (cost guard, summaries, cache) runs on top of the routed runner
+    postgres_runner = replicated_runner
+    logger.info(f"✓ Read replicas enabled: {replica_config}")
+
+# EXPLAIN before every read: reject over max cost, LIMIT over max rows; statement_timeout per group (seconds)
+sql_guard_config = {
+    'enabled': os.getenv('SQL_GUARD_ENABLED', 'true').lower() == 'true',
+    'max_cost': float(os.getenv('SQL_GUARD_MAX_COST', 1_000_000)),
+    'max_rows': int(os.getenv('SQL_GUARD_MAX_ROWS', 100_000)),
+    'row_action': os.getenv('SQL_GUARD_ROW_ACTION', 'limit'),  # limit | reject
+    'group_timeouts': parse_group_limits(os.getenv('SQL_STATEMENT_TIMEOUTS', 'read_sales=30;admin=300')),
+    'default_timeout': float(os.getenv('SQL_STATEMENT_TIMEOUT_DEFAULT', 60)),
+}
+
+sql_runner = postgres_runner
+sql_guard = None
+if sql_guard_config['enabled']:
+    sql_guard = CostGuardedSqlRunner(postgres_runner, **{k: v for k, v in sql_guard_config.items() if k != 'enabled'})
+    sql_runner = sql_guard
+    logger.info(f"✓ SQL cost guard enabled: {sql_guard_config}")
+
+# Materialized summaries of the fact tables for the GROUP BY/join shapes the training SQL and query log share;
+# off by default as it creates materialized views in the warehouse (needs CREATE on the schema)
+aggregate_layer_config = {
+    'enabled': os.getenv('AGGREGATE_LAYER_ENABLED', 'false').lower() == 'true',
+    'min_support': int(os.getenv('AGGREGATE_LAYER_MIN_SUPPORT', 2)),
+    'max_summaries': int(os.getenv('AGGREGATE_LAYER_MAX_SUMMARIES', 8)),
+    'max_row_ratio': float(os.getenv('AGGREGATE_LAYER_MAX_ROW_RATIO', 0.2)),
+    'max_age_seconds': float(os.getenv('AGGREGATE_LAYER_MAX_AGE_SECONDS', 3600)),
+    'refresh_seconds': float(os.getenv('AGGREGATE_LAYER_REFRESH_SECONDS', 900)),
+}
+
+aggregate_layer = None
+if aggregate_layer_config['enabled']:
+    try:
+        aggregate_kb = get_knowledge_base()
+        # Summaries are built through the pool directly, outside the cost guard and its timeouts
+        aggregate_layer = AggregateLayer(
+            postgres_runner,
+            aggregate_kb.get_schema_ddl,
+            lambda: [example['sql'] for example in aggregate_kb.get_example_queries()],
+            # One worker process builds the views; the others route onto them
+            builder_lock=postgres_runner.advisory_lock(BUILDER_LOCK_KEY),
+            **{k: v for k, v in aggregate_layer_config.items() if k != 'enabled'},
+        )
+        sql_runner = AggregateRoutingSqlRunner(sql_runner, aggregate_layer)
+        logger.info(f"✓ Aggregate layer enabled: {aggregate_layer_config}")
+    except Exception as e:
+        logger.warning(f"⚠ Aggregate layer disabled, could not load the training data: {e}")
+
+# Result cache keyed on canonicalized SQL, invalidated per table
+sql_cache_config = {
+    'enabled': os.getenv('SQL_RESULT_CACHE_ENABLED', 'true').lower() == 'true',
+    'max_entries': int(os.getenv('SQL_RESULT_CACHE_MAX_ENTRIES', 256)),
+    'max_bytes': int(os.getenv('SQL_RESULT_CACHE_MAX_MB', 256)) * 1024 * 1024,
+    'ttl_seconds': float(os.getenv('SQL_RESULT_CACHE_TTL_SECONDS', 900)),
+    'disk_dir': os.getenv('SQL_RESULT_CACHE_DIR') or None,  # e.g. /app/data/sql_cache
+}
+
+sql_result_cache = None
+if sql_cache_config['enabled']:
+    sql_result_cache = SqlResultCache(
+        max_entries=sql_cache_config['max_entries'],
+        max_bytes=sql_cache_config['max_bytes'],
+        ttl_seconds=sql_cache_config['ttl_seconds'],
+        disk_dir=sql_cache_config['disk_dir'],
+    )
+    sql_runner = CachedSqlRunner(sql_runner, sql_result_cache)
+    logger.info(f"✓ SQL result cache enabled: {sql_cache_config}")
+
+# Table and column references are checked against the schema DDL before anything reaches Postgres
+sql_validation_config = {
+    'enabled': os.getenv('SQL_VALIDATION_ENABLED', 'true').lower() == 'true',
+}
 
-logger.info(f"✓ Data source configured: {data_source_config['host']}/{data_source_config['database']}")
+sql_validator = None
+if sql_validation_config['enabled']:
+    try:
+        sql_validator = ValidatingSqlRunner(sql_runner, SchemaValidator.from_knowledge_base(get_knowledge_base()))
+        sql_runner = sql_validator
+        logger.info(f"✓ SQL validation enabled: {len(sql_validator.validator.tables)} tables")
+    except Exception as e:
+        logger.warning(f"⚠ SQL validation disabled, could not load the schema: {e}")
 
 # ============================================
 # 3. Register tools
 # ============================================
+# Results stream through a server-side cursor; the LLM and UI get capped previews
+# (SQL_RESULT_ENCODING=columnar sends the UI preview as compressed columns)
+result_config = {
+    'llm_row_cap': int(os.getenv('SQL_LLM_ROW_CAP', 25)),
+    'ui_row_cap': int(os.getenv('SQL_UI_ROW_CAP', 1000)),
+    'chunk_size': int(os.getenv('SQL_STREAM_CHUNK_SIZE', 5000)),
+    'result_encoding': os.getenv('SQL_RESULT_ENCODING', 'rows'),
+}
+
+# Known SQL for questions matching the training queries starts ahead of the LLM
+speculation_config = {
+    'enabled': os.getenv('SQL_SPECULATION_ENABLED', 'false').lower() == 'true',
+    'min_overlap': float(os.getenv('SQL_SPECULATION_MIN_OVERLAP', 0.8)),
+    'max_rows': int(os.getenv('SQL_SPECULATION_MAX_ROWS', 50000)),
+    'max_age_seconds': float(os.getenv('SQL_SPECULATION_MAX_AGE_SECONDS', 60)),
+    # The LLM's own run_sql query starts as soon as its `sql` argument has streamed in
+    'early_dispatch': os.getenv('SQL_EARLY_DISPATCH_ENABLED', 'true').lower() == 'true',
+}
+
+speculative_runner = None
+if speculation_config['enabled'] or speculation_config['early_dispatch']:
+    speculative_runner = SpeculativeSqlRunner(
+        sql_runner,
+        max_rows=speculation_config['max_rows'],
+        chunk_size=result_config['chunk_size'],
+        max_age_seconds=speculation_config['max_age_seconds'],
+    )
+    sql_runner = speculative_runner
+
+sql_access_groups = ["read_sales", "admin"]
+
+early_sql = None
+if speculation_config['early_dispatch']:
+    early_sql = EarlySqlDispatcher(
+        speculative_runner,
+        validator=sql_validator.validator if sql_validator else None,
+        access_groups=sql_access_groups,
+    )
+    for service in [llm, *router_services.values()]:
+        service.on_tool_argument = early_sql
+    logger.info("✓ Early SQL dispatch enabled: run_sql queries start while the completion streams")
 tools = ToolRegistry()
-run_sql_tool = RunSqlTool(sql_runner=postgres_runner)
-tools.register_local_tool(run_sql_tool, access_groups=["read_sales", "admin"])
+run_sql_tool = StreamingRunSqlTool(sql_runner=sql_runner, **result_config)
+tools.register_local_tool(run_sql_tool, access_groups=sql_access_groups)
 
-logger.info("✓ Tools registered")
+logger.info(f"✓ Tools registered (result caps: {result_config})")
 
 # ============================================
 # 4. OPTIONAL: Vanna storage for conversations
@@ -100,7 +374,33 @@ else:
     logger.info("✓ Using in-memory conversation storage")
 
 # ============================================
-# 5. Create agent
+# 5. Load Knowledge Base (Training Data)
+# ============================================
+try:
+    kb = get_knowledge_base()
+    logger.info(f"✓ Knowledge base loaded and cached: {kb.get_stats()}")
+    logger.info(f"✓ System context ready ({kb.get_token_counts()['full_context']} tokens, {kb.token_counter.name})")
+except Exception as e:
+    logger.warning(f"⚠ Could not load knowledge base: {e}")
+    kb = None
+
+# Question-relevant context (tables, terms, examples) within a token budget
+context_config = {
+    'enabled': os.getenv('KB_DYNAMIC_CONTEXT', 'true').lower() == 'true',
+    'token_budget': int(os.getenv('KB_CONTEXT_TOKEN_BUDGET', 3000)),
+    # cache_prefix keeps schema and rules byte-stable ahead of the per-question part
+    'layout': os.getenv('KB_PROMPT_LAYOUT', 'compact'),
+}
+
+context_builder = None
+context_enhancer = None
+if kb and context_config['enabled']:
+    context_builder = ContextBuilder(kb, token_budget=context_config['token_budget'], layout=context_config['layout'])
+    context_enhancer = KnowledgeContextEnhancer(context_builder)
+    logger.info(f"✓ Dynamic context enabled: {context_config}")
+
+# ============================================
+# 6. Create agent
 # ============================================
 config = AgentConfig(
     max_tool_iterations=10,
@@ -108,31 +408,228 @@ config = AgentConfig(
     temperature=0.7,
 )
 
+llm_router = None
+if router_services:
+    llm_router = LlmRouter(
+        [Deployment(service=router_services[d['name']], **d) for d in router_config['deployments']],
+        classifier=RequestClassifier(
+            kb, default_tier=router_config['default_tier'], summary_tier=router_config['summary_tier'],
+        ),
+        strategy=router_config['strategy'],
+    )
+    logger.info(f"✓ LLM router enabled: {router_config}")
+
 agent = Agent(
-    llm_service=llm,
+    llm_service=llm_router or llm,
     tool_registry=tools,
     user_resolver=SimpleUserResolver(),
     conversation_store=conversation_store,
-    config=config
+    config=config,
+    llm_context_enhancer=context_enhancer,
 )
 
+speculative_agent = None
+served_agent = agent
+if speculative_runner:
+    # Scopes speculations (early dispatches included) to their turn and cancels unclaimed ones when it ends
+    speculative_agent = SpeculativeAgent(
+        agent, speculative_runner, kb if speculation_config['enabled'] else None,
+        min_overlap=speculation_config['min_overlap'],
+        access_groups=sql_access_groups,
+    )
+    served_agent = speculative_agent
+    if speculation_config['enabled'] and kb:
+        logger.info(f"✓ Speculative SQL enabled: {speculation_config}")
+
+# Near-verbatim training questions: stored SQL runs through the tool, no LLM call
+direct_answer_config = {
+    'enabled': os.getenv('DIRECT_ANSWER_ENABLED', 'false').lower() == 'true',
+    'min_overlap': float(os.getenv('DIRECT_ANSWER_MIN_OVERLAP', 1.0)),
+    # group=category,category;group=* (categories from queries.json)
+    'groups': os.getenv('DIRECT_ANSWER_GROUPS', 'read_sales=*;admin=*'),
+}
+
+direct_answer_agent = None
+if kb and direct_answer_config['enabled']:
+    direct_answer_agent = DirectAnswerAgent(
+        served_agent, run_sql_tool, kb,
+        min_overlap=direct_answer_config['min_overlap'],
+        allowlist=parse_group_allowlist(direct_answer_config['groups']),
+    )
+    served_agent = direct_answer_agent
+    logger.info(f"✓ Direct answers enabled: {direct_answer_config}")
+
+# Identical first questions asked at the same time share one agent run
+coalescing_config = {
+    'enabled': os.getenv('REQUEST_COALESCING_ENABLED', 'true').lower() == 'true',
+}
+
+coalescing_agent = None
+if coalescing_config['enabled']:
+    coalescing_agent = CoalescingAgent(served_agent, file_system=run_sql_tool.file_system)
+    served_agent = coalescing_agent
+    logger.info(f"✓ Request coalescing enabled: {coalescing_config}")
+
 # ============================================
-# 6. Load Knowledge Base (Training Data)
+# 7. Answer cache for repeated questions
 # ============================================
-try:
-    kb = get_knowledge_base()
-    logger.info(f"✓ Knowledge base loaded and cached: {kb.get_stats()}")
-    logger.info(f"✓ System context ready ({len(kb.get_system_context())} chars)")
-except Exception as e:
-    logger.warning(f"⚠ Could not load knowledge base: {e}")
-    kb = None
+answer_cache_config = {
+    'enabled': os.getenv('ANSWER_CACHE_ENABLED', 'true').lower() == 'true',
+    'max_entries': int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', 512)),
+    'ttl_seconds': float(os.getenv('ANSWER_CACHE_TTL_SECONDS', 3600)),
+}
+
+answer_cache = None
+if answer_cache_config['enabled']:
+    answer_cache = AnswerCache(
+        max_entries=answer_cache_config['max_entries'],
+        ttl_seconds=answer_cache_config['ttl_seconds'],
+        version_provider=kb.get_version if kb else None,
+    )
+    served_agent = CachedAgent(served_agent, answer_cache)
+    logger.info(f"✓ Answer cache enabled: {answer_cache_config}")
+
+# ============================================
+# 8. Hot reload of training data
+# ============================================
+kb_reload_config = {
+    'watch': os.getenv('KB_HOT_RELOAD', 'true').lower() == 'true',
+    'interval_seconds': float(os.getenv('KB_RELOAD_INTERVAL_SECONDS', 2)),
+}
+
+
+def on_kb_reload(changed_sections):
+    """Refresh everything derived from the knowledge base after a reload"""
+    if context_builder and set(changed_sections) & {'schema', 'documentation', 'queries'}:
+        context_builder.refresh()
+    if answer_cache:
+        answer_cache.invalidate()
+
+
+kb_watcher = None
+if kb:
+    kb.add_reload_listener(on_kb_reload)
+    if kb_reload_config['watch']:
+        kb_watcher = KnowledgeBaseWatcher(kb, interval=kb_reload_config['interval_seconds'])
+        logger.info(f"✓ Training data hot reload enabled: {kb_reload_config}")
 
 # Create server
-server = VannaFastAPIServer(agent)
+server = VannaFastAPIServer(served_agent)
 app = server.create_app()
+register_result_routes(app, run_sql_tool.file_system, SimpleUserResolver())
+
+# In-flight requests/SSE streams of this worker, drained before shutdown
+in_flight = InFlightRequests()
+app.add_middleware(InFlightMiddleware, tracker=in_flight)
+app.add_middleware(RouteContextMiddleware)
+app.add_middleware(PriorityMiddleware)
+
+
+def invalidate_local_sql_cache(tables: Optional[List[str]] = None) -> int:
+    """Drop this worker's cached results for the tables (all if none); returns how many"""
+    if sql_result_cache is None:
+        return 0
+    if tables:
+        return sql_result_cache.invalidate_tables(tables)
+    dropped = sql_result_cache.get_stats()["entries"]
+    sql_result_cache.invalidate()
+    return dropped
+
+
+# Admin actions run in every worker process: each one polls a file shared by the workers
+broadcast = WorkerBroadcast(
+    os.getenv('SERVER_BROADCAST_FILE') or default_broadcast_path(),
+    interval=float(os.getenv('SERVER_BROADCAST_INTERVAL_SECONDS', 1)),
+)
+broadcast.on("sql_cache_invalidate", invalidate_local_sql_cache)
+if kb:
+    broadcast.on("kb_reload", kb.reload_async)
+
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    """Cache and performance counters (including per-user LLM usage); admins only"""
+    await require_admin(request)
+    return {
+        "answer_cache": answer_cache.get_stats() if answer_cache else None,
+        "context": context_builder.get_stats() if context_builder else None,
+        "llm_usage": llm_usage.get_stats(),
+        "llm_stream": llm.get_stats(),
+        "llm_resilience": llm_resilience.get_stats() if llm_resilience else None,
+        "llm_rate_limit": llm_rate_limiter.get_stats() if llm_rate_limiter else None,
+        "llm_router": {
+            **llm_router.get_stats(),
+            "services": {name: {"stream": service.get_stats(),
+                                "resilience": service.resilience.get_stats() if service.resilience else None}
+                         for name, service in router_services.items()},
+        } if llm_router else None,
+        "prompt_budget": prompt_budgeter.get_stats(),
+        "history_compaction": history_compactor.get_stats() if history_compactor else None,
+        "knowledge_base": {"version": kb.get_version(), "reloads": kb.reloads} if kb else None,
+        "sql_pool": postgres_runner.get_stats(),
+        "sql_result_cache": sql_result_cache.get_stats() if sql_result_cache else None,
+        "sql_guard": sql_guard.get_stats() if sql_guard else None,
+        "sql_validation": sql_validator.get_stats() if sql_validator else None,
+        "aggregate_layer": aggregate_layer.get_stats() if aggregate_layer else None,
+        "sql_results": run_sql_tool.get_stats(),
+        "sql_speculation": speculative_agent.get_stats() if speculative_agent and speculative_agent.kb else None,
+        "early_sql_dispatch": {**early_sql.get_stats(), **speculative_runner.get_stats()} if early_sql else None,
+        "direct_answers": direct_answer_agent.get_stats() if direct_answer_agent else None,
+        "request_coalescing": coalescing_agent.get_stats() if coalescing_agent else None,
+        "worker": {**in_flight.get_stats(), "broadcast": broadcast.get_stats()},
+    }
+
+
+async def require_admin(request: Request) -> User:
+    user = await SimpleUserResolver().resolve_user(RequestContext(cookies=dict(request.cookies)))
+    if 'admin' not in user.group_memberships:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user
+
+
+@app.post("/api/sql-cache/invalidate")
+async def invalidate_sql_cache(request: Request, table: Optional[List[str]] = Query(None)):
+    """Drop cached results for the given tables (all results if none given) in every worker; admins only"""
+    await require_admin(request)
+    # The count is this worker's; the others drop theirs within SERVER_BROADCAST_INTERVAL_SECONDS
+    return {"invalidated": await broadcast.publish("sql_cache_invalidate", tables=table)}
+
+
+@app.post("/api/knowledge-base/reload")
+async def reload_knowledge_base(request: Request):
+    """Re-read changed training data files now, in every worker; admins only"""
+    await require_admin(request)
+    if kb is None:
+        raise HTTPException(status_code=404, detail="Knowledge base not loaded")
+    changed = await broadcast.publish("kb_reload")
+    return {"changed_sections": changed, "version": kb.get_version(), "reloads": kb.reloads}
+
+
+@app.on_event("startup")
+async def start_watchers():
+    broadcast.start()
+    if kb_watcher:
+        kb_watcher.start()
+    if aggregate_layer:
+        aggregate_layer.start()
+    if replicated_runner:
+        replicated_runner.start()
+
+
+@app.on_event("shutdown")
+async def close_pools():
+    await broadcast.stop()
+    if kb_watcher:
+        await kb_watcher.stop()
+    if aggregate_layer:
+        await aggregate_layer.stop()
+    # Let in-flight SSE streams finish before their pools go away
+    await in_flight.wait_idle(float(os.getenv('SERVER_GRACEFUL_TIMEOUT', 30)))
+    await postgres_runner.close()
 
 logger.info("✓ Vanna 2.0 application started successfully")
 
 if __name__ == "__main__":
+    # Single-process development server; use `python serve.py` for multiple workers
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
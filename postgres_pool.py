@@ -0,0 +1,412 @@
+"""Pooled, non-blocking PostgreSQL runner for the data source"""
+import asyncio
+import logging
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, AsyncGenerator, Callable, Deque, Dict, List, Optional, Tuple
+
+import pandas as pd
+from vanna.capabilities.sql_runner import SqlRunner, RunSqlToolArgs
+from vanna.core.tool import ToolContext
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _PooledConnection:
+    conn: Any
+    created_at: float
+    last_used: float
+    abandoned: bool = False
+
+
+class PooledPostgresRunner(SqlRunner):
+    """
+    PostgreSQL SqlRunner backed by a bounded connection pool.
+    Blocking psycopg2 calls (connect, execute, fetch) run on a dedicated
+    thread pool sized to the connection pool, so the event loop never waits
+    on the warehouse. Connections are created lazily (so the runner is safe
+    to build before a worker process forks), health-checked when they have
+    been idle, and replaced when broken. `statement_timeout_ms` bounds a
+    single query (SET for the query, then back to the server default).
+    A caller cancelled mid-query cancels the statement on the server; the
+    connection stays checked out until its thread returns and is then
+    replaced, so it is never handed to another caller while still busy.
+    """
+
+    def __init__(
+        self,
+        connection_string: Optional[str] = None,
+        min_size: int = 1,
+        max_size: int = 10,
+        health_check_after: float = 30.0,
+        max_idle_seconds: float = 300.0,
+        connection_factory: Optional[Callable[[], Any]] = None,
+        **connection_params: Any,
+    ):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min={min_size}, max={max_size}")
+
+        if connection_factory is None:
+            try:
+                import psycopg2
+            except Exception as e:
+                raise ImportError(
+                    "psycopg2 package is required. Install with: pip install psycopg2-binary"
+                ) from e
+            if connection_string:
+                connection_factory = lambda: psycopg2.connect(connection_string)
+            elif connection_params.get('host') and connection_params.get('database') and connection_params.get('user'):
+                connection_factory = lambda: psycopg2.connect(**connection_params)
+            else:
+                raise ValueError(
+                    "Either provide connection_string OR (host, database, and user) parameters"
+                )
+
+        self.min_size = min_size
+        self.max_size = max_size
+        self.health_check_after = health_check_after
+        self.max_idle_seconds = max_idle_seconds
+        self._connect = connection_factory
+
+        self._idle: Deque[_PooledConnection] = deque()
+        self._size = 0
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # Metrics
+        self._in_use = 0
+        self._waiting = 0
+        self._acquisitions = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._created = 0
+        self._discarded = 0
+        self._queries = 0
+        self._errors = 0
+        self._cancelled = 0
+
+    # Pool internals
+    def _ensure_started(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # First use, or first use in this process/event loop
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_size)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_size, thread_name_prefix="pg-pool")
+
+    async def _run_blocking(self, fn: Callable, *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def _run_query(self, pooled: _PooledConnection, fn: Callable, *args: Any) -> Any:
+        """_run_blocking for a statement on `pooled`; if the caller is cancelled, the statement is too"""
+        future = asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.done():
+                self._abandon(pooled, future)
+            raise
+
+    @staticmethod
+    def _cancel_backend(conn: Any) -> None:
+        try:
+            conn.cancel()
+        except Exception as e:
+            logger.warning(f"Could not cancel the running statement: {e}")
+
+    def _abandon(self, pooled: _PooledConnection, future: "asyncio.Future") -> None:
+        # Cancel on the server (off the pool's threads, which may all be busy) and keep the
+        # connection checked out until its thread returns; its session state is then unknown
+        pooled.abandoned = True
+        self._cancelled += 1
+        asyncio.get_running_loop().run_in_executor(None, self._cancel_backend, pooled.conn)
+
+        def release(done: "asyncio.Future") -> None:
+            if not done.cancelled():
+                done.exception()  # retrieved: the caller is gone
+            self._release(pooled, broken=True)
+
+        future.add_done_callback(release)
+
+    def _new_connection(self) -> _PooledConnection:
+        conn = self._connect()
+        try:
+            conn.autocommit = True
+        except Exception:
+            pass
+        now = time.monotonic()
+        self._created += 1
+        return _PooledConnection(conn=conn, created_at=now, last_used=now)
+
+    @staticmethod
+    def _ping(conn: Any) -> bool:
+        try:
+            if getattr(conn, "closed", 0):
+                return False
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                cur.fetchall()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, pooled: _PooledConnection) -> None:
+        self._size -= 1
+        self._discarded += 1
+        try:
+            pooled.conn.close()
+        except Exception:
+            pass
+
+    async def _acquire(self) -> _PooledConnection:
+        self._ensure_started()
+        start = time.monotonic()
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+        wait = time.monotonic() - start
+        self._acquisitions += 1
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+
+        try:
+            while self._idle:
+                pooled = self._idle.pop()  # most recently used first
+                idle_for = time.monotonic() - pooled.last_used
+                if idle_for > self.max_idle_seconds and self._size > self.min_size:
+                    self._discard(pooled)
+                    continue
+                if idle_for > self.health_check_after and not await self._run_blocking(self._ping, pooled.conn):
+                    logger.warning("Discarding unhealthy pooled connection")
+                    self._discard(pooled)
+                    continue
+                break
+            else:
+                self._size += 1
+                try:
+                    pooled = await self._run_blocking(self._new_connection)
+                except Exception:
+                    self._size -= 1
+                    raise
+        except Exception:
+            self._semaphore.release()
+            raise
+
+        self._in_use += 1
+        return pooled
+
+    def _release(self, pooled: _PooledConnection, broken: bool = False) -> None:
+        self._in_use -= 1
+        if broken or getattr(pooled.conn, "closed", 0):
+            self._discard(pooled)
+        else:
+            pooled.last_used = time.monotonic()
+            self._idle.append(pooled)
+        self._semaphore.release()
+
+    async def warm_up(self) -> None:
+        """Open min_size connections ahead of the first query"""
+        self._ensure_started()
+        conns = [await self._acquire() for _ in range(max(0, self.min_size - len(self._idle)))]
+        for pooled in conns:
+            self._release(pooled)
+
+    async def close(self) -> None:
+        """Close idle connections and stop the worker threads"""
+        while self._idle:
+            self._discard(self._idle.pop())
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._loop = None
+
+    def advisory_lock(self, key: int) -> "AdvisoryLock":
+        """A Postgres advisory lock on its own connection to this database (outside the pool)"""
+        return AdvisoryLock(self._connect, key)
+
+    # Query execution
+    @staticmethod
+    def _execute(conn: Any, sql: str, statement_timeout_ms: Optional[int] = None) -> pd.DataFrame:
+        with conn.cursor() as cur:
+            if statement_timeout_ms:
+                cur.execute(f"SET statement_timeout = {int(statement_timeout_ms)}")
+            try:
+                cur.execute(sql)
+                if cur.description is None:
+                    # INSERT, UPDATE, DELETE, etc.
+                    return pd.DataFrame({"rows_affected": [cur.rowcount]})
+                columns = [d[0] for d in cur.description]
+                rows = cur.fetchall()
+            finally:
+                if statement_timeout_ms:
+                    cur.execute("SET statement_timeout = DEFAULT")
+        if not rows:
+            return pd.DataFrame()
+        return pd.DataFrame.from_records(rows, columns=columns)
+
+    async def run_sql(
+        self, args: RunSqlToolArgs, context: ToolContext, statement_timeout_ms: Optional[int] = None
+    ) -> pd.DataFrame:
+        """Execute SQL on a pooled connection without blocking the event loop"""
+        pooled = await self._acquire()
+        broken = False
+        try:
+            self._queries += 1
+            return await self._run_query(pooled, self._execute, pooled.conn, args.sql, statement_timeout_ms)
+        except Exception:
+            self._errors += 1
+            broken = not await self._run_blocking(self._ping, pooled.conn)
+            raise
+        finally:
+            if not pooled.abandoned:
+                self._release(pooled, broken=broken)
+
+    @staticmethod
+    def _open_stream(
+        conn: Any, sql: str, chunk_size: int, statement_timeout_ms: Optional[int] = None
+    ) -> Tuple[Any, List[str], List[tuple]]:
+        """Open a server-side (named) cursor and fetch the first chunk"""
+        conn.autocommit = False  # named cursors live inside a transaction
+        if statement_timeout_ms:
+            # Ends with the transaction (rolled back in _close_stream)
+            with conn.cursor() as setup:
+                setup.execute(f"SET LOCAL statement_timeout = {int(statement_timeout_ms)}")
+        cur = conn.cursor(name=f"vanna_stream_{uuid.uuid4().hex[:12]}")
+        cur.itersize = chunk_size
+        cur.execute(sql)
+        rows = cur.fetchmany(chunk_size)
+        columns = [d[0] for d in cur.description] if cur.description else []
+        return cur, columns, rows
+
+    @staticmethod
+    def _close_stream(conn: Any, cur: Any) -> None:
+        try:
+            if cur is not None:
+                cur.close()
+            conn.rollback()
+        finally:
+            conn.autocommit = True
+
+    async def stream_sql(
+        self,
+        args: RunSqlToolArgs,
+        context: ToolContext,
+        chunk_size: int = 5000,
+        statement_timeout_ms: Optional[int] = None,
+    ) -> AsyncGenerator[pd.DataFrame, None]:
+        """Execute SQL and yield the result in DataFrames of at most chunk_size rows.
+
+        SELECT/WITH queries read through a server-side cursor, so only one
+        chunk is held in memory at a time; other statements yield the single
+        frame run_sql returns.
+        """
+        words = args.sql.strip().upper().split()
+        if not words or words[0] not in ("SELECT", "WITH"):
+            yield await self.run_sql(args, context, statement_timeout_ms)
+            return
+
+        pooled = await self._acquire()
+        failed = False
+        cur = None
+        try:
+            self._queries += 1
+            cur, columns, rows = await self._run_query(
+                pooled, self._open_stream, pooled.conn, args.sql, chunk_size, statement_timeout_ms
+            )
+            while rows:
+                yield pd.DataFrame.from_records(rows, columns=columns)
+                rows = await self._run_query(pooled, cur.fetchmany, chunk_size)
+        except Exception:
+            self._errors += 1
+            failed = True
+            raise
+        finally:
+            # Also runs when the consumer stops early (aclose); an abandoned connection releases itself
+            if not pooled.abandoned:
+                broken = False
+                try:
+                    await self._run_blocking(self._close_stream, pooled.conn, cur)
+                except Exception:
+                    broken = True
+                if failed and not broken:
+                    broken = not await self._run_blocking(self._ping, pooled.conn)
+                self._release(pooled, broken=broken)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "size": self._size,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "in_use": self._in_use,
+            "idle": len(self._idle),
+            "waiting": self._waiting,
+            "acquisitions": self._acquisitions,
+            "avg_wait_ms": 1000 * self._total_wait / self._acquisitions if self._acquisitions else 0.0,
+            "max_wait_ms": 1000 * self._max_wait,
+            "connections_created": self._created,
+            "connections_discarded": self._discarded,
+            "queries": self._queries,
+            "errors": self._errors,
+            "cancelled": self._cancelled,
+        }
+
+
+class AdvisoryLock:
+    """
+    Session-level pg_try_advisory_lock on a dedicated connection, e.g. to
+    elect one worker process for a background job. The lock is held for as
+    long as the connection lives; if it drops, the lock is lost and the
+    next try_acquire() competes for it again on a new connection. A worker
+    that does not get the lock closes its connection until the next try.
+    """
+
+    def __init__(self, connection_factory: Callable[[], Any], key: int):
+        self._connect = connection_factory
+        self.key = key
+        self.held = False
+        self._conn: Any = None
+
+    def _try_acquire(self) -> bool:
+        if self._conn is not None and not PooledPostgresRunner._ping(self._conn):
+            logger.warning(f"Lost advisory lock {self.key} with its connection")
+            self._close()
+        if self._conn is None:
+            self._conn = self._connect()
+            self._conn.autocommit = True
+        if not self.held:
+            with self._conn.cursor() as cur:
+                cur.execute(f"SELECT pg_try_advisory_lock({int(self.key)})")
+                self.held = bool(cur.fetchall()[0][0])
+            if not self.held:
+                self._close()
+        return self.held
+
+    def _close(self) -> None:
+        # Ending the session releases the lock
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+        self.held = False
+
+    async def try_acquire(self) -> bool:
+        """Whether this process holds the lock (acquiring it if it is free)"""
+        try:
+            return await asyncio.to_thread(self._try_acquire)
+        except Exception as e:
+            logger.warning(f"Could not take advisory lock {self.key}: {e}")
+            self._close()
+            return False
+
+    async def release(self) -> None:
+        await asyncio.to_thread(self._close)
@@ -0,0 +1,357 @@
+"""Primary/replica routing for the data source: health-aware read balancing, lag bounds, group pinning"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, AsyncGenerator, Dict, List, Mapping, Optional, Set, Tuple
+
+import pandas as pd
+from vanna.capabilities.sql_runner import SqlRunner, RunSqlToolArgs
+from vanna.core.tool import ToolContext
+from vanna.core.user import User
+
+from sql_utils import extract_write_tables
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = "primary"
+# Seconds behind the primary; 0 when nothing is waiting to be replayed (an idle primary is not lag)
+LAG_SQL = (
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END AS lag_seconds"
+)
+_READ_STATEMENTS = ("SELECT", "WITH", "EXPLAIN", "SHOW", "VALUES", "TABLE")
+
+
+def parse_replicas(spec: str, default_port: int = 5432) -> List[Tuple[str, str, int]]:
+    """Parse "host[:port],name=host[:port]" into (name, host, port); unnamed replicas are replica1, replica2, ..."""
+    replicas: List[Tuple[str, str, int]] = []
+    for i, entry in enumerate(e.strip() for e in spec.split(",") if e.strip()):
+        name, _, address = entry.rpartition("=")
+        host, _, port = address.partition(":")
+        replicas.append((name.strip() or f"replica{i + 1}", host.strip(), int(port) if port else default_port))
+    names = [name for name, _, _ in replicas]
+    if len(set(names)) != len(names) or PRIMARY in names:
+        raise ValueError(f"Replica names must be unique and not {PRIMARY!r}: {names}")
+    return replicas
+
+
+def parse_group_pins(spec: str) -> Dict[str, str]:
+    """Parse "group=source;group=source" (e.g. "admin=primary;finance=replica2")"""
+    pins: Dict[str, str] = {}
+    for entry in spec.split(";"):
+        group, _, source = entry.partition("=")
+        if group.strip() and source.strip():
+            pins[group.strip()] = source.strip()
+    return pins
+
+
+def is_read(sql: str) -> bool:
+    words = sql.strip().upper().split()
+    return bool(words) and words[0] in _READ_STATEMENTS and not extract_write_tables(sql)
+
+
+@dataclass
+class DataSource:
+    """One Postgres server behind the router, with its health and load"""
+    name: str
+    runner: SqlRunner
+    role: str  # primary | replica
+    lag_seconds: Optional[float] = None
+    checked_at: Optional[float] = None
+    healthy: bool = True
+    failures: int = 0  # consecutive
+    ejected_until: Optional[float] = None
+    ejections: int = 0
+    in_flight: int = 0
+    queries: int = 0
+    errors: int = 0
+    ewma_ms: Optional[float] = None
+
+    def observe(self, elapsed_ms: float) -> None:
+        self.ewma_ms = elapsed_ms if self.ewma_ms is None else 0.8 * self.ewma_ms + 0.2 * elapsed_ms
+
+    def load(self) -> float:
+        # Outstanding queries, weighted by how fast this server has been answering
+        return (self.in_flight + 1) * (self.ewma_ms or 1.0)
+
+
+class ReplicatedPostgresRunner(SqlRunner):
+    """
+    Sends writes to the primary and spreads reads over the replicas, picking
+    the one with the least outstanding work weighted by its recent latency.
+    A replica is only read from while its replication lag (measured every
+    `health_check_seconds`) is at most `max_lag_seconds`; a conversation
+    that just wrote reads from the primary for that long, so it sees its own
+    writes. Users in `pinned_groups` read from the source their group names
+    ("primary" or a replica). A replica that fails `eject_after` times in a
+    row (a failed query whose server then fails SELECT 1, or a failed health
+    check) is ejected for `eject_seconds`, then readmitted once a health
+    check passes; a read that failed on it is retried elsewhere. With no
+    replica eligible, reads go to the primary.
+    """
+
+    def __init__(
+        self,
+        primary: SqlRunner,
+        replicas: Mapping[str, SqlRunner],
+        max_lag_seconds: float = 30.0,
+        pinned_groups: Optional[Mapping[str, str]] = None,
+        eject_after: int = 2,
+        eject_seconds: float = 30.0,
+        health_check_seconds: float = 5.0,
+        read_from_primary: bool = False,
+        max_sticky_conversations: int = 1000,
+    ):
+        self.primary = DataSource(PRIMARY, primary, "primary")
+        self.replicas = [DataSource(name, runner, "replica") for name, runner in replicas.items()]
+        self.sources = {s.name: s for s in [self.primary, *self.replicas]}
+        self.pinned_groups = dict(pinned_groups or {})
+        unknown = set(self.pinned_groups.values()) - set(self.sources)
+        if unknown:
+            raise ValueError(f"Groups pinned to unknown sources {sorted(unknown)}; known: {sorted(self.sources)}")
+        self.max_lag_seconds = max_lag_seconds
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.health_check_seconds = health_check_seconds
+        self.read_from_primary = read_from_primary
+        self.max_sticky_conversations = max_sticky_conversations
+        self._written: "OrderedDict[str, float]" = OrderedDict()  # conversation -> last write (monotonic)
+        self._turn = 0
+        self._checked_at: Optional[float] = None
+        self._check_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        self.routed: Dict[str, int] = {"replica": 0, "write": 0, "pinned": 0, "sticky": 0, "fallback": 0}
+        self.failovers = 0
+
+    def __getattr__(self, name: str) -> Any:
+        # Anything else the primary's pool offers
+        return getattr(self.primary.runner, name)
+
+    # ---- health ----
+
+    @staticmethod
+    def _context() -> ToolContext:
+        return ToolContext.model_construct(
+            user=User(id="replica_health", group_memberships=["admin"]),
+            conversation_id="replica_health",
+            request_id="replica_health",
+            agent_memory=None,
+            metadata={},
+        )
+
+    def _failed(self, source: DataSource, error: BaseException) -> None:
+        source.failures += 1
+        source.healthy = False
+        now = time.monotonic()
+        if source.role == "replica" and source.failures >= self.eject_after \
+                and (source.ejected_until is None or now >= source.ejected_until):
+            source.ejected_until = now + self.eject_seconds
+            source.ejections += 1
+            logger.warning(f"Ejected replica {source.name} for {self.eject_seconds:.0f}s after "
+                           f"{source.failures} failures: {error}")
+
+    async def _check_source(self, source: DataSource) -> None:
+        if source.ejected_until is not None and time.monotonic() < source.ejected_until:
+            return  # not probed until its ejection is over
+        try:
+            df = await source.runner.run_sql(RunSqlToolArgs(sql=LAG_SQL), self._context())
+            lag = df.iloc[0, 0]
+            source.lag_seconds = float(lag) if lag is not None else 0.0
+        except Exception as e:
+            self._failed(source, e)
+            return
+        finally:
+            source.checked_at = time.monotonic()
+        if source.ejected_until is not None:
+            logger.info(f"Replica {source.name} is back (lag {source.lag_seconds:.1f}s)")
+        source.healthy = True
+        source.failures = 0
+        source.ejected_until = None
+
+    async def check(self, only_first: bool = False) -> Dict[str, Any]:
+        """Measure every source's lag and health now (`only_first`: unless another check already has)"""
+        async with self._check_lock:
+            if not (only_first and self._checked_at is not None):
+                await asyncio.gather(*(self._check_source(s) for s in self.sources.values()))
+                self._checked_at = time.monotonic()
+        return {s.name: {"healthy": s.healthy, "lag_seconds": s.lag_seconds} for s in self.sources.values()}
+
+    async def _ensure_checked(self) -> None:
+        # The first query of a worker measures lag before reading from a replica
+        if self._checked_at is None and self.replicas:
+            await self.check(only_first=True)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_check_seconds)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Replica health check failed: {e}")
+
+    def start(self) -> None:
+        if self._task is None and self.replicas:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # ---- routing ----
+
+    def _eligible(self, source: DataSource) -> bool:
+        return (source.healthy and source.ejected_until is None and source.lag_seconds is not None
+                and source.lag_seconds <= self.max_lag_seconds)
+
+    def choose(
+        self, sql: str, context: Optional[ToolContext], exclude: Set[str] = frozenset()
+    ) -> Tuple[DataSource, str]:
+        """The source to run a statement on, and why"""
+        conversation = getattr(context, "conversation_id", None)
+        if not is_read(sql):
+            if conversation:
+                self._written[conversation] = time.monotonic()
+                self._written.move_to_end(conversation)
+                while len(self._written) > self.max_sticky_conversations:
+                    self._written.popitem(last=False)
+            return self.primary, "write"
+
+        groups = getattr(getattr(context, "user", None), "group_memberships", None) or []
+        for group in groups:
+            pinned = self.sources.get(self.pinned_groups.get(group, ""))
+            if pinned is not None and pinned.name not in exclude and (pinned is self.primary or self._eligible(pinned)):
+                return pinned, "pinned"
+
+        written = self._written.get(conversation) if conversation else None
+        if written is not None and time.monotonic() - written <= self.max_lag_seconds:
+            return self.primary, "sticky"
+
+        candidates = [s for s in self.replicas if s.name not in exclude and self._eligible(s)]
+        if self.read_from_primary and PRIMARY not in exclude:
+            candidates.append(self.primary)
+        if not candidates:
+            return self.primary, "fallback"
+        # Least loaded; replicas within 25% of it take turns, so near-equal latencies still share the traffic
+        self._turn += 1
+        start = self._turn % len(candidates)
+        rotated = candidates[start:] + candidates[:start]
+        least = min(s.load() for s in rotated)
+        source = next(s for s in rotated if s.load() <= 1.25 * least)
+        return source, "replica" if source.role == "replica" else "fallback"
+
+    async def _source_down(self, source: DataSource, error: BaseException) -> bool:
+        """After a failed query: is the server itself failing (rather than the SQL)?"""
+        try:
+            await source.runner.run_sql(RunSqlToolArgs(sql="SELECT 1"), self._context())
+            return False
+        except Exception:
+            self._failed(source, error)
+            return True
+
+    async def run_sql(self, args: RunSqlToolArgs, context: ToolContext, **kwargs: Any) -> pd.DataFrame:
+        await self._ensure_checked()
+        tried: Set[str] = set()
+        while True:
+            source, reason = self.choose(args.sql, context, tried)
+            tried.add(source.name)
+            self.routed[reason] += 1
+            source.in_flight += 1
+            source.queries += 1
+            start = time.perf_counter()
+            try:
+                # kwargs: statement_timeout_ms from the cost guard
+                df = await source.runner.run_sql(args, context, **kwargs)
+            except Exception as e:
+                source.errors += 1
+                if source is self.primary or not await self._source_down(source, e):
+                    raise
+                self.failovers += 1
+                logger.warning(f"Read on replica {source.name} failed, retrying elsewhere: {e}")
+                continue
+            finally:
+                source.in_flight -= 1
+            source.observe((time.perf_counter() - start) * 1000)
+            source.failures = 0
+            return df
+
+    async def stream_sql(
+        self, args: RunSqlToolArgs, context: ToolContext, chunk_size: int = 5000, **kwargs: Any
+    ) -> AsyncGenerator[pd.DataFrame, None]:
+        await self._ensure_checked()
+        tried: Set[str] = set()
+        while True:
+            source, reason = self.choose(args.sql, context, tried)
+            tried.add(source.name)
+            self.routed[reason] += 1
+            stream_sql = getattr(source.runner, "stream_sql", None)
+            source.in_flight += 1
+            source.queries += 1
+            start = time.perf_counter()
+            rows_sent = False
+            try:
+                if stream_sql is None:
+                    df = await source.runner.run_sql(args, context, **kwargs)
+                    rows_sent = True
+                    yield df
+                else:
+                    async for chunk in stream_sql(args, context, chunk_size=chunk_size, **kwargs):
+                        rows_sent = True
+                        yield chunk
+            except Exception as e:
+                source.errors += 1
+                if rows_sent or source is self.primary or not await self._source_down(source, e):
+                    raise
+                self.failovers += 1
+                logger.warning(f"Read on replica {source.name} failed, retrying elsewhere: {e}")
+                continue
+            finally:
+                source.in_flight -= 1
+            source.observe((time.perf_counter() - start) * 1000)
+            source.failures = 0
+            return
+
+    async def warm_up(self) -> None:
+        for source in self.sources.values():
+            warm_up = getattr(source.runner, "warm_up", None)
+            if warm_up is not None:
+                await warm_up()
+
+    async def close(self) -> None:
+        await self.stop()
+        for source in self.sources.values():
+            close = getattr(source.runner, "close", None)
+            if close is not None:
+                await close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "sources": {
+                s.name: {
+                    "role": s.role,
+                    "eligible": s is self.primary or self._eligible(s),
+                    "healthy": s.healthy,
+                    "lag_seconds": s.lag_seconds,
+                    "ejected_for_seconds": max(0.0, s.ejected_until - now) if s.ejected_until else None,
+                    "ejections": s.ejections,
+                    "in_flight": s.in_flight,
+                    "queries": s.queries,
+                    "errors": s.errors,
+                    "ewma_ms": s.ewma_ms,
+                    "pool": s.runner.get_stats() if hasattr(s.runner, "get_stats") else None,
+                }
+                for s in self.sources.values()
+            },
+            "routed": dict(self.routed),
+            "failovers": self.failovers,
+            "max_lag_seconds": self.max_lag_seconds,
+            "pinned_groups": dict(self.pinned_groups),
+        }
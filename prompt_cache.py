@@ -0,0 +1,167 @@
+"""Prompt-prefix layout and token accounting for provider prompt caching"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import dataclass, asdict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Separates the byte-stable part of a system prompt from the per-question part.
+# AzureOpenAILlmService sends the two halves as separate system messages, static first.
+PROMPT_CACHE_BOUNDARY = "\n\n<<<dynamic-context>>>\n\n"
+
+# Route of the HTTP request being served, set by RouteContextMiddleware
+current_route: ContextVar[str] = ContextVar("current_route", default="-")
+
+
+def split_system_prompt(system_prompt: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """Split a system prompt into (static prefix, dynamic part) at the boundary marker"""
+    if not system_prompt:
+        return None, None
+    static, sep, dynamic = system_prompt.partition(PROMPT_CACHE_BOUNDARY)
+    if not sep:
+        return system_prompt, None
+    return static or None, dynamic or None
+
+
+def join_system_prompt(static: str, dynamic: str) -> str:
+    """Inverse of split_system_prompt"""
+    if not dynamic:
+        return static
+    return f"{static}{PROMPT_CACHE_BOUNDARY}{dynamic}"
+
+
+def prefix_fingerprint(*parts: Any) -> str:
+    """Short hash of the parts that should stay byte-identical between requests"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(repr(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+@dataclass
+class TokenUsage:
+    """Token counts of one completion, as reported in `resp.usage`"""
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+
+    @classmethod
+    def from_openai(cls, usage: Any) -> "TokenUsage":
+        details = getattr(usage, "prompt_tokens_details", None)
+        return cls(
+            prompt_tokens=int(getattr(usage, "prompt_tokens", 0) or 0),
+            cached_tokens=int(getattr(details, "cached_tokens", 0) or 0) if details is not None else 0,
+            completion_tokens=int(getattr(usage, "completion_tokens", 0) or 0),
+            total_tokens=int(getattr(usage, "total_tokens", 0) or 0),
+        )
+
+    def to_dict(self) -> Dict[str, int]:
+        return asdict(self)
+
+
+class _UsageTotals:
+    __slots__ = ("requests", "prompt_tokens", "cached_tokens", "completion_tokens")
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+
+    def add(self, usage: TokenUsage) -> None:
+        self.requests += 1
+        self.prompt_tokens += usage.prompt_tokens
+        self.cached_tokens += usage.cached_tokens
+        self.completion_tokens += usage.completion_tokens
+
+    def to_dict(self, cached_discount: float) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cache_hit_rate": self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+            "prompt_tokens_saved": int(self.cached_tokens * cached_discount),
+        }
+
+
+class UsageTracker:
+    """
+    Aggregates prompt, cached and completion tokens per user and per route.
+    Cached prompt tokens are billed at a discount (`cached_discount`, the
+    fraction saved), which gives the savings from prefix reuse. Also counts
+    how often the static prefix changed, since every change costs a cache miss.
+    Per-user totals are kept for the `max_users` most recently active users;
+    older ones are dropped (their usage stays in the overall totals).
+    """
+
+    def __init__(
+        self,
+        cached_discount: float = 0.5,
+        route_provider: Callable[[], str] = current_route.get,
+        max_users: int = 1000,
+    ):
+        self.cached_discount = cached_discount
+        self.route_provider = route_provider
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._total = _UsageTotals()
+        self._by_user: "OrderedDict[str, _UsageTotals]" = OrderedDict()
+        self._by_route: Dict[str, _UsageTotals] = {}
+        self._prefixes: Dict[str, int] = {}
+        self._last_prefix: Optional[str] = None
+        self.prefix_changes = 0
+        self.last_request: Optional[Dict[str, Any]] = None
+
+    def record(self, usage: TokenUsage, user_id: Optional[str] = None, prefix: Optional[str] = None) -> None:
+        """Add one completion's usage; `prefix` is the fingerprint of its static prefix"""
+        user_id = user_id or "anonymous"
+        route = self.route_provider()
+        with self._lock:
+            self._total.add(usage)
+            self._by_user.setdefault(user_id, _UsageTotals()).add(usage)
+            self._by_user.move_to_end(user_id)
+            while len(self._by_user) > self.max_users:
+                self._by_user.popitem(last=False)
+            self._by_route.setdefault(route, _UsageTotals()).add(usage)
+            if prefix is not None:
+                self._prefixes[prefix] = self._prefixes.get(prefix, 0) + 1
+                if self._last_prefix is not None and prefix != self._last_prefix:
+                    self.prefix_changes += 1
+                self._last_prefix = prefix
+            self.last_request = {**usage.to_dict(), "user": user_id, "route": route, "prefix": prefix}
+        logger.debug(f"LLM usage: {self.last_request}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self._total.to_dict(self.cached_discount),
+                "cached_discount": self.cached_discount,
+                "distinct_prefixes": len(self._prefixes),
+                "prefix_changes": self.prefix_changes,
+                "by_user": {k: v.to_dict(self.cached_discount) for k, v in self._by_user.items()},
+                "by_route": {k: v.to_dict(self.cached_discount) for k, v in self._by_route.items()},
+                "last_request": self.last_request,
+            }
+
+
+class RouteContextMiddleware:
+    """ASGI middleware that exposes the request path to token accounting through `current_route`"""
+
+    def __init__(self, app: Callable):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token = current_route.set(scope.get("path") or "-")
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_route.reset(token)
@@ -0,0 +1,322 @@
+"""Client-side request/token rate limiting for LLM deployments, with fair per-user queues"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Any, Callable, Deque, Dict, Mapping, Optional, Tuple
+
+from llm_resilience import LatencyWindow
+from token_budget import TokenCounter, get_token_counter
+
+logger = logging.getLogger(__name__)
+
+# Highest priority first
+PRIORITIES = ("interactive", "batch")
+PRIORITY_HEADER = b"x-request-priority"
+
+# Priority of the current HTTP request (set by PriorityMiddleware)
+current_priority: ContextVar[str] = ContextVar("current_priority", default="interactive")
+
+# bucket name -> (capacity, refill per second)
+Limits = Mapping[str, Tuple[float, float]]
+
+
+def _refill(level: float, updated: float, capacity: float, rate: float, now: float) -> float:
+    return min(capacity, level + max(0.0, now - updated) * rate)
+
+
+def _take(state: Dict[str, list], amounts: Mapping[str, float], limits: Limits, now: float) -> float:
+    """Take `amounts` from every bucket in `state` if all have enough; else seconds until they will"""
+    wait = 0.0
+    for name, amount in amounts.items():
+        if name not in limits:
+            continue
+        capacity, rate = limits[name]
+        level, updated = state.get(name, (capacity, now))
+        level = _refill(level, updated, capacity, rate, now)
+        state[name] = [level, now]
+        if level < amount:
+            wait = max(wait, (amount - level) / rate)
+    if wait > 0:
+        return wait
+    for name, amount in amounts.items():
+        if name in limits:
+            state[name][0] -= amount
+    return 0.0
+
+
+class LocalBucketBackend:
+    """Token buckets in this process (each worker has its own quota)"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._state: Dict[str, Dict[str, list]] = {}
+
+    def take(self, key: str, amounts: Mapping[str, float], limits: Limits) -> float:
+        with self._lock:
+            return _take(self._state.setdefault(key, {}), amounts, limits, time.monotonic())
+
+
+class FileBucketBackend:
+    """
+    Token buckets in a small JSON file under an exclusive lock, so every
+    worker process on the host draws from the same quota. take() blocks on
+    the lock and the file, so QuotaScheduler calls it on a worker thread.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str):
+        import fcntl  # POSIX only
+
+        self._fcntl = fcntl
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def take(self, key: str, amounts: Mapping[str, float], limits: Limits) -> float:
+        with self._lock, open(self.path, "a+", encoding="utf-8") as f:
+            self._fcntl.flock(f, self._fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or "{}")
+                except ValueError:
+                    state = {}
+                # Wall-clock time: monotonic clocks are not comparable across processes
+                wait = _take(state.setdefault(key, {}), amounts, limits, time.time())
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+                return wait
+            finally:
+                self._fcntl.flock(f, self._fcntl.LOCK_UN)
+
+
+def create_backend(kind: str = "local", path: Optional[str] = None) -> Any:
+    if kind == "local":
+        return LocalBucketBackend()
+    if kind == "file":
+        return FileBucketBackend(path or "/tmp/vanna_llm_quota.json")
+    raise ValueError(f"Unknown rate limit backend {kind!r}; use 'local' or 'file'")
+
+
+class _Waiter:
+    __slots__ = ("user_id", "priority", "amounts", "enqueued_at", "wake")
+
+    def __init__(self, user_id: str, priority: str, amounts: Dict[str, float]):
+        self.user_id = user_id
+        self.priority = priority
+        self.amounts = amounts
+        self.enqueued_at = time.monotonic()
+        self.wake = asyncio.Event()
+
+
+class _Lane:
+    """Waiters for one deployment: a queue per priority, round-robin across users within it"""
+
+    def __init__(self) -> None:
+        self.queues: Dict[str, "OrderedDict[str, Deque[_Waiter]]"] = {p: OrderedDict() for p in PRIORITIES}
+
+    def __len__(self) -> int:
+        return sum(len(q) for users in self.queues.values() for q in users.values())
+
+    def add(self, waiter: _Waiter) -> None:
+        self.queues[waiter.priority].setdefault(waiter.user_id, deque()).append(waiter)
+
+    def head(self) -> Optional[_Waiter]:
+        for priority in PRIORITIES:
+            users = self.queues[priority]
+            if users:
+                return users[next(iter(users))][0]
+        return None
+
+    def remove(self, waiter: _Waiter, served: bool) -> None:
+        users = self.queues[waiter.priority]
+        queue = users.get(waiter.user_id)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        if not queue:
+            del users[waiter.user_id]
+        elif served:
+            users.move_to_end(waiter.user_id)  # the user's next request waits for everyone else's turn
+
+
+class QuotaScheduler:
+    """
+    Meters requests and estimated tokens against a deployment's RPM/TPM
+    quota before each call, so bursts queue here instead of turning into
+    429s. Tokens are estimated the way Azure OpenAI counts them for rate
+    limiting: prompt tokens plus max_tokens (or `completion_estimate`).
+    Buckets hold `burst_seconds` worth of quota (Azure enforces the quota
+    over short windows), and live in a pluggable backend: LocalBucketBackend
+    per process, FileBucketBackend shared by the workers of a host.
+
+    Waiting requests are served interactive before batch and, within a
+    priority, round-robin across users, so one user's burst cannot starve
+    the others. Each deployment (key) has its own quota and queues.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int = 0,
+        tokens_per_minute: int = 0,
+        backend: Any = None,
+        burst_seconds: float = 10.0,
+        completion_estimate: int = 500,
+        counter: Optional[TokenCounter] = None,
+        max_users: int = 1000,
+    ):
+        self.backend = backend or LocalBucketBackend()
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.burst_seconds = burst_seconds
+        self.completion_estimate = completion_estimate
+        self.counter = counter or get_token_counter()
+        self.limits: Dict[str, Tuple[float, float]] = {}
+        for name, per_minute in (("requests", requests_per_minute), ("tokens", tokens_per_minute)):
+            if per_minute > 0:
+                self.limits[name] = (max(1.0, per_minute * burst_seconds / 60), per_minute / 60)
+        self._lanes: Dict[str, _Lane] = {}
+
+        self.granted = 0
+        self.queued = 0
+        self.cancelled = 0
+        self.tokens = 0
+        self.max_queue_depth = 0
+        self._waits: Dict[str, LatencyWindow] = {p: LatencyWindow(1000) for p in PRIORITIES}
+        self._total_wait = {p: 0.0 for p in PRIORITIES}
+        self._granted_by = {p: 0 for p in PRIORITIES}
+        # user -> [granted, total wait seconds], for the max_users most recently granted users
+        self.max_users = max_users
+        self._by_user: "OrderedDict[str, list]" = OrderedDict()
+
+    def estimate_tokens(self, payload: Mapping[str, Any]) -> int:
+        """Prompt tokens of a chat completions payload plus its completion allowance"""
+        prompt = sum(self.counter(m.get("content") or "") for m in payload.get("messages") or [])
+        if payload.get("tools"):
+            prompt += self.counter(json.dumps(payload["tools"], sort_keys=True))
+        return prompt + (payload.get("max_tokens") or self.completion_estimate)
+
+    def queue_depth(self) -> Dict[str, int]:
+        return {p: sum(len(q) for lane in self._lanes.values() for q in lane.queues[p].values())
+                for p in PRIORITIES}
+
+    async def acquire(
+        self, user_id: Optional[str], tokens: int, priority: str = "interactive", key: str = "default"
+    ) -> float:
+        """Wait until the call fits the quota; returns the seconds waited"""
+        if priority not in PRIORITIES:
+            priority = "interactive"
+        amounts: Dict[str, float] = {"requests": 1}
+        if "tokens" in self.limits:
+            # A request larger than the bucket goes through once it is full (and leaves it in debt)
+            amounts["tokens"] = min(float(tokens), self.limits["tokens"][0])
+        lane = self._lanes.setdefault(key, _Lane())
+
+        if not len(lane) and await self._take(key, amounts) == 0:
+            self._record(user_id or "anonymous", priority, tokens, 0.0)
+            return 0.0
+
+        waiter = _Waiter(user_id or "anonymous", priority, amounts)
+        lane.add(waiter)
+        self.queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, len(lane))
+        self._wake_head(lane)
+        try:
+            while True:
+                waiter.wake.clear()
+                timeout = None
+                if lane.head() is waiter:
+                    timeout = await self._take(key, amounts)
+                    if timeout == 0:
+                        lane.remove(waiter, served=True)
+                        waited = time.monotonic() - waiter.enqueued_at
+                        self._record(waiter.user_id, priority, tokens, waited)
+                        return waited
+                try:
+                    await asyncio.wait_for(waiter.wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            # Deadline or disconnect: give the turn to the next waiter
+            self.cancelled += 1
+            raise
+        finally:
+            lane.remove(waiter, served=False)
+            self._wake_head(lane)
+
+    async def _take(self, key: str, amounts: Mapping[str, float]) -> float:
+        if getattr(self.backend, "blocking", False):
+            # File locks and I/O stay off the event loop, however long other workers hold the lock
+            return await asyncio.to_thread(self.backend.take, key, amounts, self.limits)
+        return self.backend.take(key, amounts, self.limits)
+
+    @staticmethod
+    def _wake_head(lane: _Lane) -> None:
+        head = lane.head()
+        if head is not None:
+            head.wake.set()
+
+    def _record(self, user_id: str, priority: str, tokens: int, waited: float) -> None:
+        self.granted += 1
+        self.tokens += tokens
+        self._granted_by[priority] += 1
+        self._total_wait[priority] += waited
+        self._waits[priority].record(waited)
+        totals = self._by_user.setdefault(user_id, [0, 0.0])
+        totals[0] += 1
+        totals[1] += waited
+        self._by_user.move_to_end(user_id)
+        while len(self._by_user) > self.max_users:
+            self._by_user.popitem(last=False)
+        if waited > 1.0:
+            logger.info(f"LLM call of {user_id} ({priority}, {tokens} tokens) waited {waited:.1f}s for quota")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "requests_per_minute": self.requests_per_minute,
+            "tokens_per_minute": self.tokens_per_minute,
+            "backend": type(self.backend).__name__,
+            "granted": self.granted,
+            "queued": self.queued,
+            "cancelled": self.cancelled,
+            "estimated_tokens": self.tokens,
+            "queue_depth": self.queue_depth(),
+            "max_queue_depth": self.max_queue_depth,
+            "wait": {
+                p: {
+                    "granted": self._granted_by[p],
+                    "avg_ms": 1000 * self._total_wait[p] / self._granted_by[p] if self._granted_by[p] else 0.0,
+                    "p95_ms": 1000 * (self._waits[p].quantile(0.95) or 0.0),
+                }
+                for p in PRIORITIES
+            },
+            "by_user": {
+                user: {"granted": granted, "avg_wait_ms": 1000 * waited / granted}
+                for user, (granted, waited) in self._by_user.items()
+            },
+        }
+
+
+class PriorityMiddleware:
+    """ASGI middleware that exposes the X-Request-Priority header (interactive/batch) through `current_priority`"""
+
+    def __init__(self, app: Callable):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        value = dict(scope.get("headers") or []).get(PRIORITY_HEADER, b"").decode("latin-1").strip().lower()
+        token = current_priority.set(value if value in PRIORITIES else "interactive")
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_priority.reset(token)
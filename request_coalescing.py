@@ -0,0 +1,222 @@
+"""Single-flight coalescing of identical questions asked at the same time"""
+import asyncio
+import logging
+import shutil
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Any, AsyncGenerator, Dict, List, Optional
+
+from vanna.core.storage import Conversation, Message
+from vanna.core.user import User, RequestContext
+
+from answer_cache import AnswerCache, CacheKey, result_files
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """One agent run and the components it has produced so far, readable by any number of subscribers"""
+
+    def __init__(self, key: CacheKey):
+        self.key = key
+        self.components: List[Any] = []
+        self.messages: List[Message] = []
+        self.owner: Optional[User] = None
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.subscribers = 0
+        self.task: Optional["asyncio.Task[None]"] = None
+        self.started_at = time.perf_counter()
+        self._changed = asyncio.Event()
+
+    def publish(self, component: Any) -> None:
+        self.components.append(component)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.error = error
+        self.done = True
+        self._notify()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def stream(self) -> AsyncGenerator[Any, None]:
+        """Everything published so far, then each new component as it arrives"""
+        i = 0
+        while True:
+            while i < len(self.components):
+                yield self.components[i]
+                i += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class CoalescingAgent:
+    """
+    Wraps a Vanna Agent so that concurrent identical questions share one
+    run: the first request for a key (normalized question plus access
+    groups, as in AnswerCache) starts the agent, and requests arriving while
+    it is in flight subscribe to it instead of calling the LLM and the
+    database again. Every subscriber receives the whole stream, from the
+    first component, and the exchange is appended to its own conversation.
+    Result files the run saved are copied into each subscriber's own
+    directory (given file_system), so their /api/results/ links work for
+    every subscriber and not only for the user who started the run.
+    Only first questions of a conversation are coalesced, since follow-ups
+    depend on history. The run is cancelled if every subscriber disconnects.
+    """
+
+    def __init__(self, agent: Any, file_system: Optional[Any] = None):
+        self.agent = agent
+        self.file_system = file_system
+        self._flights: Dict[CacheKey, _Flight] = {}
+        self.flights = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self.errors = 0
+        self.max_subscribers = 0
+        self.copied_files = 0
+
+    def __getattr__(self, name: str) -> Any:
+        # Everything except send_message is served by the wrapped agent
+        return getattr(self.agent, name)
+
+    async def send_message(
+        self,
+        request_context: RequestContext,
+        message: str,
+        *,
+        conversation_id: Optional[str] = None,
+    ) -> AsyncGenerator[Any, None]:
+        flight = None
+        if message.strip() and not request_context.metadata.get("starter_ui_request", False):
+            flight = await self._join(request_context, message, conversation_id)
+        if flight is None:
+            async for component in self.agent.send_message(
+                request_context, message, conversation_id=conversation_id
+            ):
+                yield component
+            return
+
+        leader = flight.task is None
+        flight.subscribers += 1
+        self.max_subscribers = max(self.max_subscribers, flight.subscribers)
+        try:
+            if leader:
+                flight.task = asyncio.ensure_future(
+                    self._run(flight, request_context, message, conversation_id)
+                )
+            else:
+                self.coalesced += 1
+                logger.info(
+                    f"Coalesced with in-flight question {flight.key[0]!r} groups={list(flight.key[1])} "
+                    f"({flight.subscribers} subscribers, started {time.perf_counter() - flight.started_at:.1f}s ago)"
+                )
+            async for component in flight.stream():
+                yield component
+            if not leader:
+                await self._copy_result_files(request_context, flight)
+                await self._append_messages(request_context, conversation_id, flight.messages)
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done and flight.task is not None:
+                # Nobody is listening any more
+                self.cancelled += 1
+                if self._flights.get(flight.key) is flight:
+                    del self._flights[flight.key]
+                flight.task.cancel()
+
+    async def _join(
+        self, request_context: RequestContext, message: str, conversation_id: Optional[str]
+    ) -> Optional[_Flight]:
+        user = await self.agent.user_resolver.resolve_user(request_context)
+        if conversation_id:
+            conversation = await self.agent.conversation_store.get_conversation(conversation_id, user)
+            if conversation is not None and conversation.messages:
+                return None
+        key = AnswerCache.make_key(message, user)
+        flight = self._flights.get(key)
+        if flight is None or flight.done:
+            flight = _Flight(key)
+            self._flights[key] = flight
+            self.flights += 1
+        return flight
+
+    async def _run(
+        self,
+        flight: _Flight,
+        request_context: RequestContext,
+        message: str,
+        conversation_id: Optional[str],
+    ) -> None:
+        error: Optional[BaseException] = None
+        try:
+            flight.owner = await self.agent.user_resolver.resolve_user(request_context)
+            async for component in self.agent.send_message(
+                request_context, message, conversation_id=conversation_id
+            ):
+                flight.publish(component)
+            if conversation_id:
+                conversation = await self.agent.conversation_store.get_conversation(conversation_id, flight.owner)
+                flight.messages = list(conversation.messages) if conversation is not None else []
+        except asyncio.CancelledError as e:
+            error = e
+            raise
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Coalesced run failed for {flight.key[0]!r}: {e}")
+            error = e
+        finally:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            flight.finish(error)
+
+    async def _copy_result_files(self, request_context: RequestContext, flight: _Flight) -> None:
+        """Re-materialize the run's result files in a subscriber's directory under the same names"""
+        if self.file_system is None or flight.owner is None:
+            return
+        user: User = await self.agent.user_resolver.resolve_user(request_context)
+        if user.id == flight.owner.id:
+            return
+        for filename in result_files(flight.messages):
+            source = self.file_system._resolve_path(filename, SimpleNamespace(user=flight.owner))
+            target = self.file_system._resolve_path(filename, SimpleNamespace(user=user))
+            try:
+                await asyncio.to_thread(shutil.copyfile, source, target)
+                self.copied_files += 1
+            except OSError as e:
+                logger.warning(f"Could not copy result file {filename} for {user.id}: {e}")
+
+    async def _append_messages(
+        self, request_context: RequestContext, conversation_id: Optional[str], messages: List[Message]
+    ) -> None:
+        """Record the shared exchange in a subscriber's conversation so its follow-ups have context"""
+        if not conversation_id or not messages:
+            return
+        user: User = await self.agent.user_resolver.resolve_user(request_context)
+        store = self.agent.conversation_store
+        conversation = await store.get_conversation(conversation_id, user)
+        if conversation is None:
+            conversation = Conversation(id=conversation_id, user=user, messages=[])
+        for msg in messages:
+            conversation.add_message(msg.model_copy(update={"timestamp": datetime.utcnow()}, deep=True))
+        await store.update_conversation(conversation)
+
+    def get_stats(self) -> Dict[str, Any]:
+        requests = self.flights + self.coalesced
+        return {
+            "in_flight": len(self._flights),
+            "flights": self.flights,
+            "coalesced": self.coalesced,
+            "saved_rate": self.coalesced / requests if requests else 0.0,
+            "max_subscribers": self.max_subscribers,
+            "cancelled": self.cancelled,
+            "errors": self.errors,
+            "copied_files": self.copied_files,
+        }
@@ -0,0 +1,340 @@
+"""Bounded, streamed SQL results for the run_sql tool"""
+import asyncio
+import contextlib
+import logging
+import math
+import re
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import pandas as pd
+from vanna.capabilities.file_system import FileSystem
+from vanna.capabilities.sql_runner import SqlRunner, RunSqlToolArgs
+from vanna.components import (
+    ComponentType,
+    DataFrameComponent,
+    NotificationComponent,
+    SimpleTextComponent,
+    UiComponent,
+)
+from vanna.core.tool import ToolContext, ToolResult
+from vanna.core.user import User
+from vanna.integrations.local import LocalFileSystem
+from vanna.tools import RunSqlTool
+
+from columnar_results import ColumnarDataFrameComponent, ColumnarResult
+
+logger = logging.getLogger(__name__)
+
+RESULT_FILE_PATTERN = re.compile(r"^query_results_[0-9a-f]{8}\.csv$")
+
+
+@dataclass
+class _NumericSummary:
+    count: int = 0
+    total: float = 0.0
+    min: float = math.inf
+    max: float = -math.inf
+
+
+class ResultSummary:
+    """Row count and per-column min/max/mean/nulls, updated one chunk at a time"""
+
+    def __init__(self) -> None:
+        self.row_count = 0
+        self.columns: List[str] = []
+        self.nulls: Dict[str, int] = {}
+        self.numeric: Dict[str, _NumericSummary] = {}
+
+    def update(self, chunk: pd.DataFrame) -> None:
+        if not self.columns:
+            self.columns = [str(c) for c in chunk.columns]
+            self.nulls = {c: 0 for c in self.columns}
+            self.numeric = {c: _NumericSummary() for c in self.columns}
+        self.row_count += len(chunk)
+        for name, (_, column) in zip(self.columns, chunk.items()):
+            nulls = int(column.isna().sum())
+            self.nulls[name] += nulls
+            stats = self.numeric.get(name)
+            if stats is None:
+                continue
+            if column.dtype == object:
+                # Postgres NUMERIC arrives as Decimal
+                column = pd.to_numeric(column, errors="coerce")
+                if column.notna().sum() != len(chunk) - nulls:
+                    del self.numeric[name]
+                    continue
+            elif not pd.api.types.is_numeric_dtype(column) or pd.api.types.is_bool_dtype(column):
+                del self.numeric[name]
+                continue
+            values = column.dropna()
+            if len(values):
+                stats.count += len(values)
+                stats.total += float(values.sum())
+                stats.min = min(stats.min, float(values.min()))
+                stats.max = max(stats.max, float(values.max()))
+
+    def to_dict(self) -> Dict[str, Any]:
+        columns: Dict[str, Dict[str, Any]] = {}
+        for name in self.columns:
+            columns[name] = {"nulls": self.nulls[name]}
+            stats = self.numeric.get(name)
+            if stats and stats.count:
+                columns[name].update(min=stats.min, max=stats.max, mean=stats.total / stats.count)
+        return {"row_count": self.row_count, "columns": columns}
+
+    def format(self) -> str:
+        lines = [f"Summary: {self.row_count} rows, {len(self.columns)} columns"]
+        for name, stats in self.to_dict()["columns"].items():
+            if "mean" in stats:
+                lines.append(
+                    f"- {name}: min={stats['min']:g}, max={stats['max']:g}, "
+                    f"mean={stats['mean']:g}, nulls={stats['nulls']}"
+                )
+            elif stats["nulls"]:
+                lines.append(f"- {name}: nulls={stats['nulls']}")
+        return "\n".join(lines)
+
+
+class StreamingRunSqlTool(RunSqlTool):
+    """
+    run_sql tool that reads results in chunks through the runner's
+    stream_sql (a server-side cursor) instead of materializing them.
+    Each chunk is appended to the result CSV and folded into summary stats;
+    only the first llm_row_cap rows go to the LLM and the first ui_row_cap
+    rows to the UI table. The full result is downloadable in chunks from
+    /api/results/{filename}. Runners without stream_sql, non-SELECT
+    statements and non-local file systems use the regular RunSqlTool path.
+
+    With result_encoding="columnar" the UI preview is sent as one
+    compressed ColumnarResult payload instead of a list of row dicts, and
+    only the LLM's capped rows are converted back to a DataFrame.
+    """
+
+    def __init__(
+        self,
+        sql_runner: SqlRunner,
+        file_system: Optional[FileSystem] = None,
+        llm_row_cap: int = 25,
+        llm_max_chars: int = 2000,
+        ui_row_cap: int = 1000,
+        chunk_size: int = 5000,
+        result_encoding: str = "rows",
+        **kwargs: Any,
+    ):
+        if result_encoding not in ("rows", "columnar"):
+            raise ValueError(f"Unknown result encoding: {result_encoding!r}")
+        super().__init__(sql_runner=sql_runner, file_system=file_system, **kwargs)
+        self.llm_row_cap = llm_row_cap
+        self.llm_max_chars = llm_max_chars
+        self.ui_row_cap = ui_row_cap
+        self.chunk_size = chunk_size
+        self.result_encoding = result_encoding
+
+        # Metrics
+        self._streamed_queries = 0
+        self._streamed_rows = 0
+        self._truncated_results = 0
+        self._max_rows = 0
+        self._encoded_results = 0
+        self._encoded_bytes = 0
+        self._encode_seconds = 0.0
+
+    async def execute(self, context: ToolContext, args: RunSqlToolArgs) -> ToolResult:
+        stream_sql = getattr(self.sql_runner, "stream_sql", None)
+        query_type = args.sql.strip().upper().split()[0] if args.sql.strip() else ""
+        if (
+            stream_sql is None
+            or query_type not in ("SELECT", "WITH")
+            or not isinstance(self.file_system, LocalFileSystem)
+        ):
+            return await super().execute(context, args)
+
+        filename = f"query_results_{uuid.uuid4().hex[:8]}.csv"
+        path = self.file_system._resolve_path(filename, context)
+        try:
+            summary, preview = await self._stream_to_file(
+                stream_sql(args, context, chunk_size=self.chunk_size), path
+            )
+        except Exception as e:
+            path.unlink(missing_ok=True)
+            return self._error_result(e)
+
+        self._streamed_queries += 1
+        self._streamed_rows += summary.row_count
+        self._max_rows = max(self._max_rows, summary.row_count)
+        if summary.row_count == 0:
+            path.unlink(missing_ok=True)
+            result = "Query executed successfully. No rows returned."
+            return ToolResult(
+                success=True,
+                result_for_llm=result,
+                ui_component=UiComponent(
+                    rich_component=DataFrameComponent(
+                        rows=[], columns=[], title="Query Results", description="No rows returned"
+                    ),
+                    simple_component=SimpleTextComponent(text=result),
+                ),
+                metadata={"row_count": 0, "columns": [], "query_type": query_type, "results": []},
+            )
+
+        truncated = summary.row_count > len(preview)
+        if truncated:
+            self._truncated_results += 1
+        columnar = None
+        if self.result_encoding == "columnar":
+            start = time.perf_counter()
+            columnar = ColumnarResult.from_frame(preview)
+            self._encode_seconds += time.perf_counter() - start
+            llm_rows = columnar.head(self.llm_row_cap).to_frame()
+        else:
+            llm_rows = preview.head(self.llm_row_cap)
+        preview_csv = llm_rows.to_csv(index=False)
+        if len(preview_csv) > self.llm_max_chars:
+            preview_csv = preview_csv[:self.llm_max_chars] + "\n(Preview truncated)"
+        if summary.row_count > len(llm_rows):
+            preview_csv += (
+                f"\n(Showing the first {len(llm_rows)} of {summary.row_count} rows. "
+                "FOR LARGE RESULTS YOU DO NOT NEED TO SUMMARIZE THESE RESULTS OR PROVIDE OBSERVATIONS. "
+                "THE NEXT STEP SHOULD BE A VISUALIZE_DATA CALL)"
+            )
+        result = (
+            f"{preview_csv}\n\n{summary.format()}\n\nResults saved to file: {filename}\n\n"
+            f"**IMPORTANT: FOR VISUALIZE_DATA USE FILENAME: {filename}**"
+        )
+
+        description = f"SQL query returned {summary.row_count} rows with {len(summary.columns)} columns"
+        if truncated:
+            description += f" (showing the first {len(preview)}; full result: /api/results/{filename})"
+        metadata = {
+            "row_count": summary.row_count,
+            "columns": summary.columns,
+            "query_type": query_type,
+            "truncated": truncated,
+            "summary": summary.to_dict(),
+            "output_file": filename,
+        }
+        if columnar is not None:
+            start = time.perf_counter()
+            payload = columnar.encode()
+            self._encode_seconds += time.perf_counter() - start
+            self._encoded_results += 1
+            self._encoded_bytes += len(payload["buffer"])
+            dataframe_component = ColumnarDataFrameComponent(
+                rows=[],
+                columns=columnar.names,
+                column_types=columnar.column_types(),
+                title="Query Results",
+                description=description,
+                row_count=summary.row_count,
+                column_count=len(columnar.names),
+                columnar=payload,
+            )
+            metadata["encoding"] = "columnar"
+        else:
+            records = preview.to_dict("records")
+            dataframe_component = DataFrameComponent.from_records(
+                records=records,
+                title="Query Results",
+                description=description,
+                row_count=summary.row_count,
+            )
+            metadata["results"] = records
+        return ToolResult(
+            success=True,
+            result_for_llm=result,
+            ui_component=UiComponent(
+                rich_component=dataframe_component,
+                simple_component=SimpleTextComponent(text=result),
+            ),
+            metadata=metadata,
+        )
+
+    async def _stream_to_file(self, chunks: AsyncIterator[pd.DataFrame], path: Path):
+        """Append chunks to the CSV at path; keep only summary stats and the preview rows"""
+        summary = ResultSummary()
+        preview_parts: List[pd.DataFrame] = []
+        kept = 0
+        async with contextlib.aclosing(chunks):
+            with open(path, "w", newline="", encoding="utf-8") as f:
+                async for chunk in chunks:
+                    if chunk.empty:
+                        continue
+                    await asyncio.to_thread(chunk.to_csv, f, header=summary.row_count == 0, index=False)
+                    summary.update(chunk)
+                    if kept < self.ui_row_cap:
+                        part = chunk.head(self.ui_row_cap - kept)
+                        preview_parts.append(part)
+                        kept += len(part)
+        preview = pd.concat(preview_parts, ignore_index=True) if preview_parts else pd.DataFrame()
+        return summary, preview
+
+    @staticmethod
+    def _error_result(error: Exception) -> ToolResult:
+        # Same shape as RunSqlTool's error result
+        error_message = f"Error executing query: {str(error)}"
+        return ToolResult(
+            success=False,
+            result_for_llm=error_message,
+            ui_component=UiComponent(
+                rich_component=NotificationComponent(
+                    type=ComponentType.NOTIFICATION, level="error", message=error_message
+                ),
+                simple_component=SimpleTextComponent(text=error_message),
+            ),
+            error=str(error),
+            metadata={"error_type": "sql_error"},
+        )
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "streamed_queries": self._streamed_queries,
+            "streamed_rows": self._streamed_rows,
+            "truncated_results": self._truncated_results,
+            "max_rows": self._max_rows,
+            "llm_row_cap": self.llm_row_cap,
+            "ui_row_cap": self.ui_row_cap,
+            "chunk_size": self.chunk_size,
+            "result_encoding": self.result_encoding,
+            "encoded_results": self._encoded_results,
+            "encoded_bytes": self._encoded_bytes,
+            "encode_ms": round(self._encode_seconds * 1000, 2),
+        }
+
+
+def register_result_routes(app: Any, file_system: LocalFileSystem, user_resolver: Any,
+                           chunk_bytes: int = 64 * 1024) -> None:
+    """Serve saved query results to their owner in fixed-size chunks"""
+    from fastapi import HTTPException, Request
+    from fastapi.responses import StreamingResponse
+    from vanna.core.user import RequestContext
+
+    @app.get("/api/results/{filename}")
+    async def download_result(filename: str, request: Request):
+        if not RESULT_FILE_PATTERN.match(filename):
+            raise HTTPException(status_code=404, detail="Result not found")
+        user: User = await user_resolver.resolve_user(RequestContext(
+            cookies=dict(request.cookies),
+            headers=dict(request.headers),
+            remote_addr=request.client.host if request.client else None,
+            query_params=dict(request.query_params),
+        ))
+        # Same per-user directory the tool wrote to
+        path = file_system._resolve_path(filename, SimpleNamespace(user=user))
+        if not path.is_file():
+            raise HTTPException(status_code=404, detail="Result not found")
+
+        def read_chunks():
+            with open(path, "rb") as f:
+                while chunk := f.read(chunk_bytes):
+                    yield chunk
+
+        return StreamingResponse(
+            read_chunks(),
+            media_type="text/csv",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        )
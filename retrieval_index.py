@@ -0,0 +1,241 @@
+"""BM25 retrieval index (with an optional local vector index) over the knowledge base"""
+import re
+import math
+import hashlib
+import logging
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STOPWORDS = frozenset("""
+a an and are as at be by did do does for from has have how i in is it its me
+of on or our show the their there these this to was we what when where which
+who why with list give get all each
+""".split())
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens without stopwords, with a light plural strip"""
+    tokens = []
+    for tok in _TOKEN_RE.findall(text.lower()):
+        if tok in STOPWORDS or (len(tok) < 2 and not tok.isdigit()):
+            continue
+        if len(tok) > 3 and tok.endswith("s") and not tok.endswith("ss"):
+            tok = tok[:-1]
+        tokens.append(tok)
+    return tokens
+
+
+@dataclass
+class Document:
+    """A retrievable knowledge base item"""
+    kind: str  # "question", "sql_pattern", "term", "rule"
+    text: str
+    payload: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class SearchHit:
+    """A ranked search result"""
+    score: float
+    matched_terms: int
+    document: Document
+
+
+class Bm25Index:
+    """
+    Inverted index with BM25 weights precomputed per posting.
+    Querying is a sum of posting weights into a dense score array followed
+    by a partial sort, so cost depends on the query's postings, not on
+    re-tokenizing every document. Ties go to the shorter document.
+    """
+
+    def __init__(self, documents: Sequence[Document], k1: float = 1.5, b: float = 0.75):
+        self.documents = list(documents)
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, tuple] = {}
+        self._kind_masks: Dict[str, np.ndarray] = {}
+        self._lengths = np.zeros(0, dtype=np.float32)
+        self._build()
+
+    def _build(self) -> None:
+        n = len(self.documents)
+        doc_terms = [Counter(tokenize(doc.text)) for doc in self.documents]
+        lengths = np.array([sum(tf.values()) for tf in doc_terms], dtype=np.float32)
+        self._lengths = lengths
+        avg_len = float(lengths.mean()) if n else 0.0
+
+        raw: Dict[str, List[tuple]] = {}
+        for doc_id, tf in enumerate(doc_terms):
+            for term, count in tf.items():
+                raw.setdefault(term, []).append((doc_id, count))
+
+        for term, postings in raw.items():
+            df = len(postings)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            ids = np.fromiter((p[0] for p in postings), dtype=np.int32, count=df)
+            tfs = np.fromiter((p[1] for p in postings), dtype=np.float32, count=df)
+            norm = self.k1 * (1 - self.b + self.b * lengths[ids] / (avg_len or 1.0))
+            weights = idf * tfs * (self.k1 + 1) / (tfs + norm)
+            self._postings[term] = (ids, weights.astype(np.float32))
+
+        kinds = np.array([doc.kind for doc in self.documents])
+        for kind in set(kinds.tolist()):
+            self._kind_masks[kind] = kinds == kind
+
+    def search(self, query: str, k: int = 5, kinds: Optional[Iterable[str]] = None) -> List[SearchHit]:
+        """Return the top-k documents for the query, best first"""
+        terms = set(tokenize(query))
+        postings = [self._postings[t] for t in terms if t in self._postings]
+        if not postings or k <= 0:
+            return []
+
+        n = len(self.documents)
+        scores = np.zeros(n, dtype=np.float32)
+        for ids, weights in postings:
+            scores[ids] += weights
+
+        if kinds is not None:
+            mask = np.zeros(n, dtype=bool)
+            for kind in kinds:
+                if kind in self._kind_masks:
+                    mask |= self._kind_masks[kind]
+            scores[~mask] = 0.0
+
+        k = min(k, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[scores[top] > 0]
+        top = top[np.lexsort((self._lengths[top], -scores[top]))]
+
+        # Posting ids are sorted, so shared-term counts are binary searches
+        matched = np.zeros(top.size, dtype=np.int16)
+        for ids, _ in postings:
+            pos = np.searchsorted(ids, top)
+            pos[pos == ids.size] = 0
+            matched += ids[pos] == top
+        return [
+            SearchHit(score=float(scores[i]), matched_terms=int(m), document=self.documents[i])
+            for i, m in zip(top, matched)
+        ]
+
+
+def hashed_ngram_embedding(text: str, dim: int = 256) -> np.ndarray:
+    """Local embedding: hashed character trigrams of the token stream, L2-normalized"""
+    vec = np.zeros(dim, dtype=np.float32)
+    for tok in tokenize(text):
+        padded = f"#{tok}#"
+        for i in range(len(padded) - 2):
+            h = int.from_bytes(hashlib.blake2b(padded[i:i + 3].encode(), digest_size=4).digest(), "little")
+            vec[h % dim] += 1.0
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+class VectorIndex:
+    """
+    Brute-force cosine index over local embeddings.
+    Pass `embed_fn` to plug in a real embedding model; the default hashed
+    trigram embedding needs no model download and catches spelling variants
+    that exact-term BM25 misses.
+    """
+
+    def __init__(
+        self,
+        documents: Sequence[Document],
+        embed_fn: Callable[[str], np.ndarray] = hashed_ngram_embedding,
+    ):
+        self.documents = list(documents)
+        self.embed_fn = embed_fn
+        self._kinds = np.array([doc.kind for doc in self.documents])
+        if self.documents:
+            self._matrix = np.vstack([embed_fn(doc.text) for doc in self.documents])
+        else:
+            self._matrix = np.zeros((0, 1), dtype=np.float32)
+
+    def search(self, query: str, k: int = 5, kinds: Optional[Iterable[str]] = None) -> List[SearchHit]:
+        if not self.documents or k <= 0:
+            return []
+        scores = self._matrix @ self.embed_fn(query)
+        if kinds is not None:
+            scores = np.where(np.isin(self._kinds, list(kinds)), scores, 0.0)
+        k = min(k, len(self.documents))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [
+            SearchHit(score=float(scores[i]), matched_terms=0, document=self.documents[i])
+            for i in top
+            if scores[i] > 0
+        ]
+
+
+class RetrievalIndex:
+    """
+    Ranked retrieval over questions, SQL patterns and documentation.
+    BM25 is always built; the vector index is optional and, when enabled,
+    its ranking is merged with BM25 by reciprocal rank fusion.
+    """
+
+    def __init__(self, documents: Sequence[Document], use_vectors: bool = False):
+        self.documents = list(documents)
+        self.bm25 = Bm25Index(self.documents)
+        self.vectors = VectorIndex(self.documents) if use_vectors else None
+        self._exact: Dict[tuple, Document] = {}
+        for doc in self.documents:
+            self._exact.setdefault((doc.kind, self.term_key(doc.text)), doc)
+
+    @staticmethod
+    def term_key(text: str) -> str:
+        """Order-insensitive key of a text's terms (same key = same question)"""
+        return " ".join(sorted(set(tokenize(text))))
+
+    def lookup_exact(self, query: str, kind: str) -> Optional[Document]:
+        """Return the document whose terms exactly match the query's, if any"""
+        return self._exact.get((kind, self.term_key(query)))
+
+    @classmethod
+    def from_training_data(cls, cache: Dict[str, Any], use_vectors: bool = False) -> "RetrievalIndex":
+        """Build the index from the KnowledgeBase cache"""
+        documents: List[Document] = []
+
+        for q in (cache.get('queries') or {}).get('question_sql_pairs', []):
+            documents.append(Document(kind="question", text=q['question'], payload=q))
+
+        for p in (cache.get('sql_patterns') or {}).get('common_queries', []):
+            text = f"{p.get('description', '')} {p.get('sql', '')}"
+            documents.append(Document(kind="sql_pattern", text=text, payload=p))
+
+        doc = cache.get('documentation') or {}
+        for term in doc.get('business_terms', []):
+            documents.append(Document(kind="term", text=f"{term['term']} {term['definition']}", payload=term))
+        for rule in doc.get('business_rules', []):
+            documents.append(Document(kind="rule", text=f"{rule['rule']} {rule['description']}", payload=rule))
+
+        return cls(documents, use_vectors=use_vectors)
+
+    def search(self, query: str, k: int = 5, kinds: Optional[Iterable[str]] = None) -> List[SearchHit]:
+        kinds = list(kinds) if kinds is not None else None
+        bm25_hits = self.bm25.search(query, k=k, kinds=kinds)
+        if self.vectors is None:
+            return bm25_hits
+
+        vector_hits = self.vectors.search(query, k=k, kinds=kinds)
+        fused: Dict[int, float] = {}
+        by_id: Dict[int, SearchHit] = {}
+        for hits in (bm25_hits, vector_hits):
+            for rank, hit in enumerate(hits):
+                key = id(hit.document)
+                fused[key] = fused.get(key, 0.0) + 1.0 / (60 + rank)
+                if key not in by_id or hit.matched_terms > by_id[key].matched_terms:
+                    by_id[key] = hit
+        ranked = sorted(fused, key=fused.get, reverse=True)[:k]
+        return [
+            SearchHit(score=fused[key], matched_terms=by_id[key].matched_terms, document=by_id[key].document)
+            for key in ranked
+        ]
@@ -0,0 +1,211 @@
+"""
+Production launcher: serves main:app with several uvicorn worker processes.
+Workers are started fresh (spawned, not forked from a loaded app), so each
+one builds its own knowledge base, caches and lazily-connected pools.
+On SIGTERM/SIGINT every worker stops accepting connections and lets
+in-flight requests, including SSE chat streams, finish before exiting.
+
+    SERVER_WORKERS=4 python serve.py
+"""
+import asyncio
+import inspect
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_workers(value: Optional[str]) -> int:
+    """Parse a worker count; 'auto' means one worker per CPU"""
+    if not value:
+        return 1
+    if value.strip().lower() == "auto":
+        return os.cpu_count() or 1
+    return max(1, int(value))
+
+
+class InFlightRequests:
+    """Counts HTTP requests (and SSE streams) still being served by this worker"""
+
+    def __init__(self) -> None:
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.completed = 0
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """Wait until nothing is in flight; returns False if the timeout ran out first"""
+        deadline = time.monotonic() + timeout
+        while self.in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return self.in_flight == 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "pid": os.getpid(),
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "completed": self.completed,
+        }
+
+
+class InFlightMiddleware:
+    """ASGI middleware feeding an InFlightRequests counter; a request ends when its body has been sent"""
+
+    def __init__(self, app: Callable, tracker: InFlightRequests):
+        self.app = app
+        self.tracker = tracker
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        self.tracker.in_flight += 1
+        self.tracker.max_in_flight = max(self.tracker.max_in_flight, self.tracker.in_flight)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.tracker.in_flight -= 1
+            self.tracker.completed += 1
+
+
+def default_broadcast_path() -> str:
+    """A file shared by the workers of one server (they are children of the same supervisor)"""
+    return os.path.join(tempfile.gettempdir(), f"vanna-broadcast-{os.getppid()}.jsonl")
+
+
+class WorkerBroadcast:
+    """
+    Runs an admin action (cache invalidation, knowledge base reload) in
+    every worker process, not just the one that served the request.
+    `publish` appends the action to a JSON-lines file shared by the
+    workers and runs it here at once; each worker polls the file every
+    `interval` seconds and runs the actions published since it started.
+    Handlers are registered per action name with `on` and may be async.
+    """
+
+    def __init__(self, path: str, interval: float = 1.0):
+        self.path = Path(path)
+        self.interval = interval
+        self._handlers: Dict[str, Callable[..., Any]] = {}
+        self._own: Set[str] = set()  # published here and already run; skipped once when read back
+        self._task: Optional[asyncio.Task] = None
+        try:
+            self._offset = self.path.stat().st_size  # earlier actions predate this worker
+        except FileNotFoundError:
+            self._offset = 0
+        self.published = 0
+        self.received = 0
+
+    def on(self, action: str, handler: Callable[..., Any]) -> None:
+        self._handlers[action] = handler
+
+    async def publish(self, action: str, **payload: Any) -> Any:
+        """Run the action in this worker (returning its result) and have the other workers run it too"""
+        message = {"id": uuid.uuid4().hex, "action": action, "payload": payload, "pid": os.getpid()}
+        self._own.add(message["id"])
+        line = (json.dumps(message) + "\n").encode("utf-8")
+        # One O_APPEND write per message, so lines from concurrent workers never interleave
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        self.published += 1
+        return await self._run(message)
+
+    async def _run(self, message: Dict[str, Any]) -> Any:
+        handler = self._handlers.get(message["action"])
+        if handler is None:
+            return None
+        result = handler(**message["payload"])
+        return await result if inspect.isawaitable(result) else result
+
+    def _read_new(self) -> List[Dict[str, Any]]:
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        # Only complete lines; a line still being written is read on the next poll
+        data = data[:data.rfind(b"\n") + 1]
+        self._offset += len(data)
+        messages = []
+        for line in data.splitlines():
+            try:
+                messages.append(json.loads(line))
+            except ValueError:
+                logger.warning(f"Skipping unreadable broadcast line in {self.path}")
+        return messages
+
+    async def poll(self) -> int:
+        """Run the actions other workers published since the last poll; returns how many"""
+        count = 0
+        for message in self._read_new():
+            if message.get("id") in self._own:
+                self._own.discard(message["id"])
+                continue
+            try:
+                await self._run(message)
+            except Exception as e:
+                logger.error(f"Broadcast action {message.get('action')!r} failed: {e}")
+            count += 1
+        self.received += count
+        return count
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.poll()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"path": str(self.path), "published": self.published, "received": self.received}
+
+
+def run(
+    app: str = "main:app",
+    host: Optional[str] = None,
+    port: Optional[int] = None,
+    workers: Optional[int] = None,
+    graceful_timeout: Optional[float] = None,
+) -> None:
+    """Run the app (an import string, so each worker imports it itself) under uvicorn"""
+    import uvicorn
+
+    workers = workers or resolve_workers(os.getenv('SERVER_WORKERS') or os.getenv('WEB_CONCURRENCY'))
+    if graceful_timeout is None:
+        graceful_timeout = float(os.getenv('SERVER_GRACEFUL_TIMEOUT', 30))
+    host = host or os.getenv('HOST', '0.0.0.0')
+    port = port or int(os.getenv('PORT', 8000))
+    logger.info(f"Starting {app} on {host}:{port} with {workers} worker(s)")
+    uvicorn.run(
+        app,
+        host=host,
+        port=port,
+        workers=workers,
+        timeout_graceful_shutdown=graceful_timeout,
+        log_level=os.getenv('LOG_LEVEL', 'info'),
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run()
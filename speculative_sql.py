@@ -0,0 +1,352 @@
+"""Speculative execution of vetted SQL for questions that match the training queries"""
+import asyncio
+import logging
+import time
+import uuid
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, AsyncGenerator, Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+from vanna.capabilities.sql_runner import SqlRunner, RunSqlToolArgs
+from vanna.core.tool import ToolContext
+from vanna.core.user import RequestContext
+
+from sql_utils import canonicalize_sql, extract_write_tables
+
+logger = logging.getLogger(__name__)
+
+# The agent turn SQL runs in (set by SpeculativeAgent for each message): a speculation is
+# only claimed or cancelled from its own turn, so other conversations never see it
+current_turn: ContextVar[str] = ContextVar("current_sql_turn", default="")
+
+SpeculationKey = Tuple[str, str, str]  # (user id, turn, canonical SQL)
+
+
+def _is_read(sql: str) -> bool:
+    words = sql.strip().upper().split()
+    return bool(words) and words[0] in ("SELECT", "WITH") and not extract_write_tables(sql)
+
+
+@dataclass
+class Speculation:
+    """A known query started ahead of the LLM for one user"""
+    key: SpeculationKey
+    question: str
+    task: "asyncio.Task[Optional[pd.DataFrame]]"
+    started_at: float = field(default_factory=time.perf_counter)
+    finished_at: Optional[float] = None
+
+
+class SpeculativeSqlRunner(SqlRunner):
+    """
+    Wraps a SqlRunner and runs known-good SQL before the LLM asks for it.
+    `speculate` starts a query in the background; when the tool then runs
+    SQL that canonicalizes to the same statement for the same user in the
+    same turn (`current_turn`), the prefetched result is served (a hit).
+    Any other query in that turn cancels its pending speculations (a miss),
+    and so does the end of the turn. Speculations nobody claimed within
+    `max_age_seconds` are cancelled as well, so a turn that never ends
+    cleanly cannot keep a result alive. Speculative results are bounded by
+    `max_rows`; larger ones are dropped and the tool's query runs normally.
+    """
+
+    def __init__(
+        self, runner: SqlRunner, max_rows: int = 50_000, chunk_size: int = 5000, max_age_seconds: float = 60.0
+    ):
+        self.runner = runner
+        self.max_rows = max_rows
+        self.chunk_size = chunk_size
+        self.max_age_seconds = max_age_seconds
+        self._pending: Dict[SpeculationKey, Speculation] = {}
+
+        self.started = 0
+        self.hits = 0
+        self.misses = 0
+        self.cancelled = 0
+        self.expired = 0
+        self.too_large = 0
+        self.failed = 0
+        self.saved_ms = 0.0
+
+    def __getattr__(self, name: str) -> Any:
+        # close, warm_up, get_stats, ... of the wrapped runner
+        return getattr(self.runner, name)
+
+    @staticmethod
+    def make_key(sql: str, context: ToolContext) -> SpeculationKey:
+        user = getattr(context, "user", None)
+        return (getattr(user, "id", None) or "", current_turn.get(), canonicalize_sql(sql))
+
+    def speculate(self, sql: str, context: ToolContext, question: str = "") -> Optional[Speculation]:
+        """Start running a read-only query in the background; None if not speculated"""
+        self._expire()
+        if not _is_read(sql):
+            return None
+        key = self.make_key(sql, context)
+        if key in self._pending:
+            return self._pending[key]
+        speculation = Speculation(key=key, question=question, task=None)
+        speculation.task = asyncio.ensure_future(self._run(speculation, sql, context))
+        self._pending[key] = speculation
+        self.started += 1
+        return speculation
+
+    async def _run(self, speculation: Speculation, sql: str, context: ToolContext) -> Optional[pd.DataFrame]:
+        args = RunSqlToolArgs(sql=sql)
+        stream_sql = getattr(self.runner, "stream_sql", None)
+        try:
+            if stream_sql is None:
+                df = await self.runner.run_sql(args, context)
+                if len(df) > self.max_rows:
+                    self.too_large += 1
+                    return None
+                return df
+
+            chunks: List[pd.DataFrame] = []
+            rows = 0
+            stream = stream_sql(args, context, chunk_size=self.chunk_size)
+            try:
+                async for chunk in stream:
+                    rows += len(chunk)
+                    if rows > self.max_rows:
+                        self.too_large += 1
+                        return None
+                    chunks.append(chunk)
+            finally:
+                await stream.aclose()
+            return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            logger.info(f"Speculative SQL failed ({e}); the tool's query will run normally")
+            return None
+        finally:
+            speculation.finished_at = time.perf_counter()
+
+    async def _claim(self, sql: str, context: ToolContext) -> Optional[pd.DataFrame]:
+        """The prefetched result for this query, or None after cancelling the turn's other speculations"""
+        self._expire()
+        if not self._pending or not _is_read(sql):
+            return None
+        key = self.make_key(sql, context)
+        speculation = self._pending.pop(key, None)
+        if speculation is None:
+            self.misses += self.cancel_turn(key[1], user_id=key[0])
+            return None
+
+        claimed_at = time.perf_counter()
+        try:
+            df = await speculation.task
+        except asyncio.CancelledError:
+            df = None
+        if df is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Time the query had already been running before the tool asked for it
+        self.saved_ms += 1000 * (min(claimed_at, speculation.finished_at or claimed_at) - speculation.started_at)
+        logger.info(f"Speculative SQL hit for {speculation.question!r}")
+        return df
+
+    def cancel(self, speculation: Optional[Speculation]) -> bool:
+        """Cancel a speculation nobody claimed; True if it was still pending"""
+        if speculation is None or self._pending.get(speculation.key) is not speculation:
+            return False
+        del self._pending[speculation.key]
+        speculation.task.cancel()  # through the runner, which cancels the statement on the server
+        self.cancelled += 1
+        return True
+
+    def cancel_turn(self, turn: str, user_id: Optional[str] = None) -> int:
+        """Cancel every pending speculation of a turn (only `user_id`'s, if given); returns how many"""
+        return sum(self.cancel(s) for s in [
+            s for k, s in self._pending.items() if k[1] == turn and user_id in (None, k[0])
+        ])
+
+    def _expire(self) -> None:
+        cutoff = time.perf_counter() - self.max_age_seconds
+        for speculation in [s for s in self._pending.values() if s.started_at < cutoff]:
+            if self.cancel(speculation):
+                self.expired += 1
+
+    async def run_sql(self, args: RunSqlToolArgs, context: ToolContext) -> pd.DataFrame:
+        df = await self._claim(args.sql, context)
+        if df is not None:
+            return df.copy(deep=False)
+        return await self.runner.run_sql(args, context)
+
+    async def stream_sql(
+        self, args: RunSqlToolArgs, context: ToolContext, chunk_size: int = 5000
+    ) -> AsyncGenerator[pd.DataFrame, None]:
+        df = await self._claim(args.sql, context)
+        if df is not None:
+            for start in range(0, len(df), chunk_size):
+                yield df.iloc[start:start + chunk_size]
+            return
+        stream_sql = getattr(self.runner, "stream_sql", None)
+        if stream_sql is None:
+            yield await self.runner.run_sql(args, context)
+            return
+        async for chunk in stream_sql(args, context, chunk_size=chunk_size):
+            yield chunk
+
+    def get_stats(self) -> Dict[str, Any]:
+        claims = self.hits + self.misses
+        return {
+            "pending": len(self._pending),
+            "started": self.started,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / claims if claims else 0.0,
+            "cancelled": self.cancelled,
+            "expired": self.expired,
+            "too_large": self.too_large,
+            "failed": self.failed,
+            "saved_ms": self.saved_ms,
+            "avg_saved_ms": self.saved_ms / self.hits if self.hits else 0.0,
+        }
+
+
+class SpeculativeAgent:
+    """
+    Wraps a Vanna Agent and runs each message as its own turn of the
+    SpeculativeSqlRunner (`current_turn`): speculations started during the
+    turn, including early-dispatched run_sql queries, are cancelled when it
+    ends unclaimed. Given a knowledge base, a question that matches a
+    training query also starts that query's SQL while the LLM is still
+    writing its own. Only users in `access_groups` (those who may run SQL)
+    get speculative queries.
+    """
+
+    def __init__(
+        self,
+        agent: Any,
+        runner: SpeculativeSqlRunner,
+        kb: Optional[Any] = None,
+        min_overlap: float = 0.8,
+        access_groups: Optional[Iterable[str]] = None,
+    ):
+        self.agent = agent
+        self.runner = runner
+        self.kb = kb
+        self.min_overlap = min_overlap
+        self.access_groups = set(access_groups) if access_groups is not None else None
+        self.questions = 0
+        self.matched = 0
+
+    def __getattr__(self, name: str) -> Any:
+        # Everything except send_message is served by the wrapped agent
+        return getattr(self.agent, name)
+
+    async def send_message(
+        self,
+        request_context: RequestContext,
+        message: str,
+        *,
+        conversation_id: Optional[str] = None,
+    ) -> AsyncGenerator[Any, None]:
+        outer = current_turn.get()
+        turn = uuid.uuid4().hex
+        current_turn.set(turn)
+        try:
+            if (
+                self.kb is not None
+                and message.strip()
+                and not request_context.metadata.get("starter_ui_request", False)
+            ):
+                await self._speculate(request_context, message, conversation_id)
+            async for component in self.agent.send_message(
+                request_context, message, conversation_id=conversation_id
+            ):
+                yield component
+        finally:
+            self.runner.cancel_turn(turn)
+            current_turn.set(outer)
+
+    async def _speculate(
+        self, request_context: RequestContext, message: str, conversation_id: Optional[str]
+    ) -> Optional[Speculation]:
+        self.questions += 1
+        try:
+            match = self.kb.find_matching_question(message, self.min_overlap)
+        except Exception as e:
+            logger.warning(f"Speculative SQL lookup failed: {e}")
+            return None
+        if not match or not match.get("sql"):
+            return None
+
+        user = await self.agent.user_resolver.resolve_user(request_context)
+        if self.access_groups is not None and not self.access_groups & set(user.group_memberships or []):
+            return None
+        self.matched += 1
+        context = ToolContext.model_construct(
+            user=user,
+            conversation_id=conversation_id or "",
+            request_id=str(uuid.uuid4()),
+            agent_memory=None,
+            metadata={"speculative": True},
+        )
+        return self.runner.speculate(match["sql"], context, question=match.get("question", message))
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "questions": self.questions,
+            "matched": self.matched,
+            "match_rate": self.matched / self.questions if self.questions else 0.0,
+            **self.runner.get_stats(),
+        }
+
+
+class EarlySqlDispatcher:
+    """
+    on_tool_argument hook for AzureOpenAILlmService: as soon as the `sql`
+    argument of a run_sql call has streamed in, it is checked against the
+    schema (given a SchemaValidator) and started on the SpeculativeSqlRunner,
+    so the query is already running while the rest of the completion
+    streams and the tool claims its result. SQL the validator rejects is not
+    dispatched; the tool's own call reports the problems to the LLM. The
+    runner's agent must be wrapped in SpeculativeAgent, which scopes each
+    dispatch to its turn and cancels it if the turn ends without a claim.
+    """
+
+    def __init__(
+        self,
+        runner: SpeculativeSqlRunner,
+        validator: Optional[Any] = None,
+        tool_name: str = "run_sql",
+        access_groups: Optional[Iterable[str]] = None,
+    ):
+        self.runner = runner
+        self.validator = validator
+        self.tool_name = tool_name
+        self.access_groups = set(access_groups) if access_groups is not None else None
+        self.seen = 0
+        self.dispatched = 0
+        self.rejected = 0
+
+    def __call__(self, request: Any, early: Any) -> None:
+        if early.key != "sql" or early.tool_name != self.tool_name:
+            return
+        self.seen += 1
+        user = getattr(request, "user", None)
+        if user is None:
+            return
+        if self.access_groups is not None and not self.access_groups & set(user.group_memberships or []):
+            return
+        if self.validator is not None and self.validator.validate(early.value):
+            self.rejected += 1
+            return
+        context = ToolContext.model_construct(
+            user=user,
+            conversation_id="",
+            request_id=str(uuid.uuid4()),
+            agent_memory=None,
+            metadata={"speculative": True},
+        )
+        if self.runner.speculate(early.value, context, question="(streamed run_sql call)") is not None:
+            self.dispatched += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"seen": self.seen, "dispatched": self.dispatched, "rejected": self.rejected}
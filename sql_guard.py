@@ -0,0 +1,253 @@
+"""EXPLAIN-based cost guard and per-group statement timeouts in front of the Postgres runner"""
+import json
+import logging
+import re
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, asdict
+from typing import Any, AsyncGenerator, Deque, Dict, Mapping, Optional, Tuple
+
+import pandas as pd
+from vanna.capabilities.sql_runner import SqlRunner, RunSqlToolArgs
+from vanna.core.tool import ToolContext
+
+from sql_utils import canonicalize_sql, extract_tables, extract_write_tables
+
+logger = logging.getLogger(__name__)
+
+ROW_ACTIONS = ("limit", "reject")
+_LIMIT_RE = re.compile(r"\bLIMIT\s+(\d+|ALL)\s*(?:OFFSET\s+\d+\s*)?$")
+
+
+class QueryCostError(RuntimeError):
+    """A query whose estimated cost is over the guard's limit; the message tells the LLM how to refine it"""
+
+
+def parse_group_limits(spec: str) -> Dict[str, float]:
+    """Parse "group=seconds;group=seconds" (e.g. "read_sales=30;admin=300")"""
+    limits: Dict[str, float] = {}
+    for entry in spec.split(";"):
+        group, _, value = entry.partition("=")
+        if group.strip() and value.strip():
+            limits[group.strip()] = float(value)
+    return limits
+
+
+def add_limit(sql: str, limit: int) -> str:
+    """Cap the rows a read returns (a LIMIT already in place is kept)"""
+    if _LIMIT_RE.search(canonicalize_sql(sql)):
+        return sql
+    # New line: the statement may end in a line comment
+    return f"{sql.strip().rstrip(';').rstrip()}\nLIMIT {int(limit)}"
+
+
+@dataclass
+class QueryRecord:
+    """Plan estimate next to what the query actually did"""
+    sql: str
+    user: str
+    plan_cost: Optional[float]
+    plan_rows: Optional[int]
+    action: str  # ok, limited, rejected, unexplained
+    timeout_ms: Optional[int]
+    runtime_ms: Optional[float] = None
+    rows: Optional[int] = None
+    error: Optional[str] = None
+
+
+class CostGuardedSqlRunner(SqlRunner):
+    """
+    Wraps the Postgres runner and checks every read with EXPLAIN before it
+    runs. Plans are cached by canonical SQL (`plan_ttl_seconds`). A plan
+    over `max_cost` is rejected with a QueryCostError that asks the LLM for
+    a narrower query (filters, aggregation, no fact-to-fact joins); one
+    estimated at more than `max_rows` rows gets a LIMIT (or is rejected with
+    `row_action="reject"`). Queries run under the statement_timeout of the
+    user's most permissive group (`group_timeouts`, seconds), else
+    `default_timeout`. Each query's plan cost and row estimate are recorded
+    next to its actual runtime and row count.
+    """
+
+    def __init__(
+        self,
+        runner: SqlRunner,
+        max_cost: float = 1_000_000.0,
+        max_rows: int = 100_000,
+        row_action: str = "limit",
+        group_timeouts: Optional[Mapping[str, float]] = None,
+        default_timeout: Optional[float] = 60.0,
+        plan_ttl_seconds: float = 600.0,
+        max_plans: int = 1024,
+        history_size: int = 200,
+    ):
+        if row_action not in ROW_ACTIONS:
+            raise ValueError(f"Unknown row action {row_action!r}; use one of {ROW_ACTIONS}")
+        self.runner = runner
+        self.max_cost = max_cost
+        self.max_rows = max_rows
+        self.row_action = row_action
+        self.group_timeouts = dict(group_timeouts or {})
+        self.default_timeout = default_timeout
+        self.plan_ttl_seconds = plan_ttl_seconds
+        self.max_plans = max_plans
+        self._plans: "OrderedDict[str, Tuple[float, int, float]]" = OrderedDict()
+        self.history: Deque[QueryRecord] = deque(maxlen=history_size)
+
+        self.queries = 0
+        self.explained = 0
+        self.plan_cache_hits = 0
+        self.explain_errors = 0
+        self.explain_ms = 0.0
+        self.rejected = 0
+        self.limited = 0
+        self.timeouts = 0
+
+    def __getattr__(self, name: str) -> Any:
+        # close, warm_up, get_stats of the pool, ... of the wrapped runner
+        return getattr(self.runner, name)
+
+    def timeout_ms(self, context: ToolContext) -> Optional[int]:
+        user = getattr(context, "user", None)
+        limits = [self.group_timeouts[g] for g in (getattr(user, "group_memberships", None) or [])
+                  if g in self.group_timeouts]
+        seconds = max(limits) if limits else self.default_timeout
+        return int(seconds * 1000) if seconds else None
+
+    async def explain(self, sql: str, context: ToolContext) -> Optional[Tuple[float, int]]:
+        """(total cost, estimated rows) of the statement's plan, or None if it cannot be explained"""
+        key = canonicalize_sql(sql)
+        cached = self._plans.get(key)
+        if cached is not None and time.monotonic() - cached[2] <= self.plan_ttl_seconds:
+            self._plans.move_to_end(key)
+            self.plan_cache_hits += 1
+            return cached[0], cached[1]
+
+        start = time.perf_counter()
+        try:
+            explain = RunSqlToolArgs(sql=f"EXPLAIN (FORMAT JSON) {sql.strip().rstrip(';')}")
+            df = await self.runner.run_sql(explain, context)
+            plan = df.iloc[0, 0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            root = plan[0]["Plan"]
+            cost, rows = float(root["Total Cost"]), int(root["Plan Rows"])
+        except Exception as e:
+            # The query itself will report a real error; an unexplainable plan is not a reason to block it
+            self.explain_errors += 1
+            logger.warning(f"EXPLAIN failed, running the query unguarded: {e}")
+            return None
+        finally:
+            self.explain_ms += (time.perf_counter() - start) * 1000
+        self.explained += 1
+
+        self._plans[key] = (cost, rows, time.monotonic())
+        while len(self._plans) > self.max_plans:
+            self._plans.popitem(last=False)
+        return cost, rows
+
+    async def _check(self, args: RunSqlToolArgs, context: ToolContext) -> Tuple[str, QueryRecord]:
+        """SQL to run and the record of the decision (raises QueryCostError on rejection)"""
+        self.queries += 1
+        user = getattr(getattr(context, "user", None), "id", None) or "anonymous"
+        record = QueryRecord(sql=canonicalize_sql(args.sql)[:500], user=user, plan_cost=None, plan_rows=None,
+                             action="ok", timeout_ms=self.timeout_ms(context))
+        self.history.append(record)
+        words = args.sql.strip().upper().split()
+        if not words or words[0] not in ("SELECT", "WITH") or extract_write_tables(args.sql):
+            record.action = "unexplained"
+            return args.sql, record
+
+        plan = await self.explain(args.sql, context)
+        if plan is None:
+            record.action = "unexplained"
+            return args.sql, record
+        record.plan_cost, record.plan_rows = plan
+
+        if record.plan_cost > self.max_cost or (record.plan_rows > self.max_rows and self.row_action == "reject"):
+            self.rejected += 1
+            record.action = "rejected"
+            logger.warning(
+                f"SQL guard rejected a query of {user}: cost {record.plan_cost:,.0f}, "
+                f"~{record.plan_rows:,} rows, tables {extract_tables(args.sql)}"
+            )
+            raise QueryCostError(
+                f"Query rejected before running: its estimated cost is {record.plan_cost:,.0f} "
+                f"(limit {self.max_cost:,.0f}) and it would return about {record.plan_rows:,} rows "
+                f"(limit {self.max_rows:,}). Rewrite it to read less data: add filters (for example a "
+                f"date range), aggregate with GROUP BY instead of returning detail rows, and join fact "
+                f"tables only through their dimension keys, never to each other directly."
+            )
+        if record.plan_rows > self.max_rows:
+            self.limited += 1
+            record.action = "limited"
+            logger.info(f"SQL guard capped a query of {user} at {self.max_rows:,} rows (~{record.plan_rows:,} estimated)")
+            return add_limit(args.sql, self.max_rows), record
+        return args.sql, record
+
+    @staticmethod
+    def _timeout_kwargs(record: QueryRecord) -> Dict[str, Any]:
+        # Only runners that take a statement timeout (PooledPostgresRunner) are passed one
+        return {"statement_timeout_ms": record.timeout_ms} if record.timeout_ms else {}
+
+    def _finish(self, record: QueryRecord, start: float, rows: int, error: Optional[BaseException] = None) -> None:
+        record.runtime_ms = (time.perf_counter() - start) * 1000
+        record.rows = rows
+        if error is not None:
+            record.error = str(error)[:200]
+            if "statement timeout" in record.error:
+                self.timeouts += 1
+                logger.warning(f"Query of {record.user} hit its {record.timeout_ms} ms statement timeout "
+                               f"(plan cost {record.plan_cost})")
+
+    async def run_sql(self, args: RunSqlToolArgs, context: ToolContext) -> pd.DataFrame:
+        sql, record = await self._check(args, context)
+        start = time.perf_counter()
+        try:
+            df = await self.runner.run_sql(RunSqlToolArgs(sql=sql), context, **self._timeout_kwargs(record))
+        except Exception as e:
+            self._finish(record, start, 0, e)
+            raise
+        self._finish(record, start, len(df))
+        return df
+
+    async def stream_sql(
+        self, args: RunSqlToolArgs, context: ToolContext, chunk_size: int = 5000
+    ) -> AsyncGenerator[pd.DataFrame, None]:
+        stream_sql = getattr(self.runner, "stream_sql", None)
+        if stream_sql is None:
+            yield await self.run_sql(args, context)
+            return
+
+        sql, record = await self._check(args, context)
+        start = time.perf_counter()
+        rows = 0
+        try:
+            async for chunk in stream_sql(
+                RunSqlToolArgs(sql=sql), context, chunk_size=chunk_size, **self._timeout_kwargs(record)
+            ):
+                rows += len(chunk)
+                yield chunk
+        except Exception as e:
+            self._finish(record, start, rows, e)
+            raise
+        self._finish(record, start, rows)
+
+    def get_stats(self) -> Dict[str, Any]:
+        measured = [r for r in self.history if r.plan_cost and r.runtime_ms is not None and r.error is None]
+        ratios = sorted(r.runtime_ms / r.plan_cost for r in measured)
+        return {
+            "queries": self.queries,
+            "explained": self.explained,
+            "plan_cache_hits": self.plan_cache_hits,
+            "explain_errors": self.explain_errors,
+            "avg_explain_ms": self.explain_ms / (self.explained + self.explain_errors)
+            if self.explained + self.explain_errors else 0.0,
+            "rejected": self.rejected,
+            "limited": self.limited,
+            "timeouts": self.timeouts,
+            "max_cost": self.max_cost,
+            "max_rows": self.max_rows,
+            # Median runtime per unit of plan cost, to calibrate max_cost against the timeouts
+            "median_ms_per_cost": ratios[len(ratios) // 2] if ratios else None,
+            "recent": [asdict(r) for r in list(self.history)[-10:]],
+        }
@@ -0,0 +1,343 @@
+"""SQL result cache around the data source runner"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, AsyncGenerator, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import pandas as pd
+from vanna.capabilities.sql_runner import SqlRunner, RunSqlToolArgs
+from vanna.core.tool import ToolContext
+
+from sql_utils import canonicalize_sql, extract_tables, extract_write_tables
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedResult:
+    """A cached query result and the tables it was read from"""
+    df: pd.DataFrame
+    tables: List[str]
+    created_at: float = field(default_factory=time.time)
+    nbytes: int = 0
+
+
+class SqlResultCache:
+    """
+    LRU + TTL cache of query results keyed on canonicalized SQL.
+    Bounded by entry count and by DataFrame memory; entries are indexed by
+    the tables they read so a write (or an explicit call) can invalidate
+    just the affected results. With disk_dir set, results are also written
+    to disk and survive restarts; workers can share the directory, since
+    each entry carries its own metadata. Every hit, including one served
+    from memory, checks that metadata, so an invalidation in one worker
+    also drops the result from the other workers' memory.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        max_bytes: int = 256 * 1024 * 1024,
+        ttl_seconds: float = 900,
+        disk_dir: Optional[str] = None,
+        max_disk_entries: int = 2048,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_entries = max_disk_entries
+        self._entries: "OrderedDict[str, CachedResult]" = OrderedDict()
+        self._by_table: Dict[str, Set[str]] = {}
+        self._bytes = 0
+
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._clean_disk()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(sql: str) -> str:
+        return canonicalize_sql(sql)
+
+    def get(self, key: str) -> Optional[CachedResult]:
+        """Return a fresh cached result or None (counts a hit or a miss)"""
+        entry = self._entries.get(key)
+        if entry is not None and (
+            self._expired(entry.created_at)
+            # Invalidated or replaced by another worker sharing the directory
+            or (self.disk_dir and (self._read_meta(key) or {}).get("created_at") != entry.created_at)
+        ):
+            self._remove(key)
+            entry = None
+        if entry is None and self.disk_dir:
+            entry = self._read_disk(key)
+            if entry is not None:
+                self.disk_hits += 1
+                self._store(key, entry)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, df: pd.DataFrame, tables: Iterable[str]) -> None:
+        """Store a result, evicting the least recently used entries when over a bound"""
+        entry = CachedResult(df=df, tables=list(tables), nbytes=int(df.memory_usage(deep=True).sum()))
+        if entry.nbytes > self.max_bytes:
+            return
+        self._store(key, entry)
+        if self.disk_dir:
+            self._write_disk(key, entry)
+
+    def invalidate_tables(self, tables: Iterable[str]) -> int:
+        """Drop every result that read from any of the tables; returns how many"""
+        tables = [t.lower() for t in tables]
+        keys: Set[str] = set()
+        for table in tables:
+            keys |= self._by_table.get(table, set())
+        if self.disk_dir:
+            for path, meta in self._disk_entries():
+                if any(table in meta["tables"] for table in tables):
+                    keys.add(meta["key"])
+                    self._unlink_entry(path)
+        for key in keys:
+            self._remove(key)
+        if keys:
+            self.invalidations += 1
+            logger.info(f"SQL result cache: invalidated {len(keys)} results for tables {sorted(tables)}")
+        return len(keys)
+
+    def invalidate(self) -> None:
+        """Drop every cached result, in memory and on disk"""
+        for key in list(self._entries):
+            self._remove(key)
+        if self.disk_dir:
+            for path, _ in list(self._disk_entries()):
+                self._unlink_entry(path)
+        self.invalidations += 1
+
+    # Memory tier
+    def _expired(self, created_at: float) -> bool:
+        return time.time() - created_at > self.ttl_seconds
+
+    def _store(self, key: str, entry: CachedResult) -> None:
+        self._remove(key)
+        self._entries[key] = entry
+        self._bytes += entry.nbytes
+        for table in entry.tables:
+            self._by_table.setdefault(table, set()).add(key)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry.nbytes
+        for table in entry.tables:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_table[table]
+
+    # Disk tier: one pickle per result with its metadata (SQL, tables, timestamp) in a JSON
+    # file beside it, so workers sharing disk_dir never rewrite a common index
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.pkl"
+
+    def _tmp_path(self, path: Path) -> Path:
+        # Per process, so concurrent writers of the same entry never share a temp file
+        return path.with_name(f"{path.name}.{os.getpid()}.tmp")
+
+    def _disk_entries(self) -> Iterator[Tuple[Path, Dict[str, Any]]]:
+        """(metadata path, metadata) of every complete entry on disk, whichever worker wrote it"""
+        for path in self.disk_dir.glob("*.json"):
+            try:
+                meta = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                continue
+            if isinstance(meta, dict) and "key" in meta:
+                yield path, meta
+
+    def _clean_disk(self) -> None:
+        """Delete expired entries, and files left by writers that died mid-write once they can no longer be fresh"""
+        count = 0
+        for path, meta in self._disk_entries():
+            if self._expired(meta["created_at"]):
+                self._unlink_entry(path)
+            else:
+                count += 1
+        for path in [*self.disk_dir.glob("*.pkl"), *self.disk_dir.glob("*.tmp")]:
+            try:
+                orphaned = not path.with_suffix(".json").exists() and self._expired(path.stat().st_mtime)
+            except OSError:
+                continue
+            if orphaned:
+                path.unlink(missing_ok=True)
+        logger.info(f"SQL result cache: {count} results on disk in {self.disk_dir}")
+
+    def _unlink_entry(self, meta_path: Path) -> None:
+        # Metadata first: without it the pickle is never read
+        meta_path.unlink(missing_ok=True)
+        meta_path.with_suffix(".pkl").unlink(missing_ok=True)
+
+    def _read_meta(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            meta = json.loads(self._disk_path(key).with_suffix(".json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        return meta if isinstance(meta, dict) and meta.get("key") == key else None
+
+    def _read_disk(self, key: str) -> Optional[CachedResult]:
+        meta_path = self._disk_path(key).with_suffix(".json")
+        meta = self._read_meta(key)
+        if meta is None:
+            return None
+        if self._expired(meta["created_at"]):
+            self._unlink_entry(meta_path)
+            return None
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                df = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            logger.warning(f"SQL result cache: dropping unreadable disk entry: {e}")
+            self._unlink_entry(meta_path)
+            return None
+        return CachedResult(df=df, tables=meta["tables"], created_at=meta["created_at"],
+                            nbytes=int(df.memory_usage(deep=True).sum()))
+
+    def _write_disk(self, key: str, entry: CachedResult) -> None:
+        path = self._disk_path(key)
+        meta_path = path.with_suffix(".json")
+        try:
+            # Pickle first, then its metadata: an entry is visible only once both are complete
+            tmp_path = self._tmp_path(path)
+            with open(tmp_path, "wb") as f:
+                pickle.dump(entry.df, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+            tmp_path = self._tmp_path(meta_path)
+            meta = {"key": key, "tables": entry.tables, "created_at": entry.created_at}
+            tmp_path.write_text(json.dumps(meta), encoding="utf-8")
+            os.replace(tmp_path, meta_path)
+        except OSError as e:
+            logger.warning(f"SQL result cache: could not write disk entry: {e}")
+            return
+        self._trim_disk()
+
+    def _trim_disk(self) -> None:
+        """Delete the oldest entries while more than max_disk_entries are on disk"""
+        entries = []
+        for path in self.disk_dir.glob("*.json"):
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except OSError:
+                continue
+        if len(entries) <= self.max_disk_entries:
+            return
+        entries.sort()
+        for _, path in entries[:len(entries) - self.max_disk_entries]:
+            self._unlink_entry(path)
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "disk_entries": sum(1 for _ in self._disk_entries()) if self.disk_dir else None,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class CachedSqlRunner(SqlRunner):
+    """
+    Wraps a SqlRunner and serves repeated SELECT/WITH queries from a
+    SqlResultCache. Any other statement runs uncached and invalidates the
+    results of the tables it writes to. Streaming (stream_sql) is passed
+    through; streamed results are cached only up to max_cached_rows.
+    """
+
+    def __init__(self, runner: SqlRunner, cache: SqlResultCache, max_cached_rows: int = 50_000):
+        self.runner = runner
+        self.cache = cache
+        self.max_cached_rows = max_cached_rows
+
+    def __getattr__(self, name: str) -> Any:
+        # close, warm_up, get_stats, ... of the wrapped runner
+        return getattr(self.runner, name)
+
+    @staticmethod
+    def _is_read(sql: str) -> bool:
+        words = sql.strip().upper().split()
+        return bool(words) and words[0] in ("SELECT", "WITH") and not extract_write_tables(sql)
+
+    def _invalidate_writes(self, sql: str) -> None:
+        tables = extract_write_tables(sql)
+        if tables:
+            self.cache.invalidate_tables(tables)
+
+    async def run_sql(self, args: RunSqlToolArgs, context: ToolContext) -> pd.DataFrame:
+        if not self._is_read(args.sql):
+            try:
+                return await self.runner.run_sql(args, context)
+            finally:
+                self._invalidate_writes(args.sql)
+
+        key = self.cache.make_key(args.sql)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached.df.copy(deep=False)
+        df = await self.runner.run_sql(args, context)
+        if len(df) <= self.max_cached_rows:
+            self.cache.put(key, df, extract_tables(args.sql))
+        return df
+
+    async def stream_sql(
+        self, args: RunSqlToolArgs, context: ToolContext, chunk_size: int = 5000
+    ) -> AsyncGenerator[pd.DataFrame, None]:
+        stream_sql = getattr(self.runner, "stream_sql", None)
+        if stream_sql is None or not self._is_read(args.sql):
+            yield await self.run_sql(args, context)
+            return
+
+        key = self.cache.make_key(args.sql)
+        cached = self.cache.get(key)
+        if cached is not None:
+            for start in range(0, len(cached.df), chunk_size):
+                yield cached.df.iloc[start:start + chunk_size]
+            return
+
+        chunks: Optional[List[pd.DataFrame]] = []
+        rows = 0
+        async for chunk in stream_sql(args, context, chunk_size=chunk_size):
+            if chunks is not None:
+                rows += len(chunk)
+                if rows <= self.max_cached_rows:
+                    chunks.append(chunk)
+                else:
+                    chunks = None  # too large to cache; keep streaming
+            yield chunk
+        if chunks is not None:
+            df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+            self.cache.put(key, df, extract_tables(args.sql))
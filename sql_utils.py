@@ -0,0 +1,233 @@
+"""Lightweight SQL text helpers shared by the knowledge base, caches and guards"""
+import re
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Set, Tuple
+
+_WRITE_TARGET_RE = re.compile(
+    r'\b(?:insert\s+into|update|delete\s+from|truncate(?:\s+table)?|alter\s+table|drop\s+table(?:\s+if\s+exists)?'
+    r'|refresh\s+materialized\s+view)\s+((?:"?[a-z_][\w$]*"?\.)?"?[a-z_][\w$]*"?)',
+    re.IGNORECASE,
+)
+
+
+def extract_write_tables(sql: str) -> List[str]:
+    """Return the tables a statement writes to (INSERT/UPDATE/DELETE/TRUNCATE/ALTER/DROP/REFRESH)"""
+    tables: List[str] = []
+    for ref in _WRITE_TARGET_RE.findall(sql or ""):
+        name = ref.replace('"', '').split('.')[-1].lower()
+        if name not in tables:
+            tables.append(name)
+    return tables
+
+
+_LITERAL_RE = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+_COMMENT_RE = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+
+
+def canonicalize_sql(sql: str) -> str:
+    """
+    Canonical form of a SQL statement for cache keys: comments removed,
+    whitespace collapsed, keywords and identifiers uppercased, trailing
+    semicolons dropped. Quoted literals and identifiers keep their case.
+    """
+    parts = []
+    for i, part in enumerate(_LITERAL_RE.split(sql or "")):
+        if i % 2:
+            parts.append(part)  # quoted literal or identifier
+            continue
+        part = _COMMENT_RE.sub(" ", part).upper()
+        part = re.sub(r"\s*([(),;=<>+*/-])\s*", r" \1 ", part)
+        parts.append(part)
+    text = " ".join("".join(parts).split())
+    text = re.sub(r"\(\s", "(", text)
+    text = re.sub(r"\s([),])", r"\1", text)
+    text = re.sub(r"\s*([<>!]) (=|>)", r" \1\2", text)
+    return text.rstrip("; ").strip()
+
+
+_COLUMN_RE = re.compile(r'^\s+"?([a-z_][\w$]*)"?\s+[a-z]', re.IGNORECASE)
+_FK_RE = re.compile(
+    r'FOREIGN KEY \(([^)]*)\) REFERENCES (?:\w+\.)?(\w+)\(([^)]*)\)', re.IGNORECASE
+)
+
+
+def parse_ddl_columns(ddl: str) -> List[str]:
+    """Return the column names declared in a CREATE TABLE statement"""
+    columns: List[str] = []
+    for line in (ddl or "").splitlines():
+        match = _COLUMN_RE.match(line)
+        if match and match.group(1).upper() not in ("CONSTRAINT", "PRIMARY", "FOREIGN", "UNIQUE", "CHECK"):
+            columns.append(match.group(1).lower())
+    return columns
+
+
+def parse_foreign_keys(ddl: str) -> List[Tuple[List[str], str, List[str]]]:
+    """Return (columns, referenced_table, referenced_columns) for each FOREIGN KEY"""
+    keys = []
+    for cols, table, ref_cols in _FK_RE.findall(ddl or ""):
+        keys.append((
+            [c.strip().lower() for c in cols.split(',')],
+            table.lower(),
+            [c.strip().lower() for c in ref_cols.split(',')],
+        ))
+    return keys
+
+
+_NOT_NULL_RE = re.compile(r'\bNOT\s+NULL\b', re.IGNORECASE)
+_PRIMARY_KEY_RE = re.compile(r'PRIMARY KEY \(([^)]*)\)', re.IGNORECASE)
+
+
+def parse_not_null_columns(ddl: str) -> Set[str]:
+    """Return the columns of a CREATE TABLE statement declared NOT NULL"""
+    columns: Set[str] = set()
+    for line in (ddl or "").splitlines():
+        match = _COLUMN_RE.match(line)
+        if match and _NOT_NULL_RE.search(line):
+            columns.add(match.group(1).lower())
+    return columns | set(parse_primary_key(ddl))
+
+
+def parse_primary_key(ddl: str) -> List[str]:
+    """Return the PRIMARY KEY columns of a CREATE TABLE statement"""
+    match = _PRIMARY_KEY_RE.search(ddl or "")
+    return [c.strip().strip('"').lower() for c in match.group(1).split(',')] if match else []
+
+
+_CREATE_RE = re.compile(r'CREATE\s+(?:TABLE|VIEW)\s+(?:IF\s+NOT\s+EXISTS\s+)?(?:"?\w+"?\.)?"?(\w+)"?', re.IGNORECASE)
+
+
+def parse_schema_tables(ddls: Iterable[str]) -> Dict[str, List[str]]:
+    """Map each table created by the DDL statements to its columns (lowercase)"""
+    tables: Dict[str, List[str]] = {}
+    for ddl in ddls:
+        match = _CREATE_RE.search(ddl or "")
+        if match:
+            tables[match.group(1).lower()] = parse_ddl_columns(ddl)
+    return tables
+
+
+_TOKEN_RE = re.compile(
+    r"(?P<space>\s+|--[^\n]*|/\*.*?\*/)"
+    r"|(?P<string>[EeBbXxNn]?'(?:[^']|'')*')"
+    r"|(?P<dollar>\$(?P<tag>[A-Za-z_]*)\$.*?\$(?P=tag)\$)"
+    r'|(?P<quoted>"(?:[^"]|"")*")'
+    r"|(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)"
+    r"|(?P<param>\$\d+|%\(\w+\)s|%s)"
+    r"|(?P<word>[A-Za-z_][\w$]*)"
+    r"|(?P<op>::|->>|->|#>>|#>|@>|<@|&&|\|\||<=|>=|<>|!=|[-+*/%<>=~!@#^&|?,;().\[\]:])",
+    re.DOTALL,
+)
+
+
+# Reserved words, type names, date parts and niladic functions: never column references
+SQL_KEYWORDS = frozenset("""
+    all and any array as asc asymmetric at between both by case cast check collate column constraint create cross
+    current_catalog current_date current_role current_schema current_time current_timestamp current_user default
+    current deferrable desc distinct do else end except exists false fetch filter first following for foreign from full
+    grant group grouping having ilike in inner intersect interval into is isnull join lateral leading left like limit
+    localtime localtimestamp materialized natural not notnull null nulls of offset on only or order outer over
+    overlaps partition placing preceding primary range recursive references returning right row rows select
+    session_user sets similar some symmetric table tablesample then ties to trailing true unbounded union unique unknown
+    user using values variadic verbose when where window with within without ignore respect last next percent
+    zone time timestamp timestamptz date int integer smallint bigint numeric decimal real double precision float
+    text varchar char character varying boolean bool json jsonb money uuid bytea serial
+    year month day hour minute second quarter week dow doy isodow isoyear epoch decade century millennium
+    milliseconds microseconds
+""".split())
+
+
+@dataclass
+class SqlToken:
+    kind: str  # word, quoted, string, number, param or op
+    value: str  # words and quoted identifiers lowercased
+    pos: int
+    text: str  # as written
+
+
+def tokenize_sql(sql: str) -> Tuple[List[SqlToken], List[str]]:
+    """Split SQL into tokens (comments and whitespace dropped); the second item describes a lexing error"""
+    tokens: List[SqlToken] = []
+    pos = 0
+    while pos < len(sql):
+        match = _TOKEN_RE.match(sql, pos)
+        if match is None:
+            char = sql[pos]
+            if char in "'\"$":
+                kind = "string literal" if char != '"' else "quoted identifier"
+                return tokens, [f"Unterminated {kind} starting at character {pos + 1}: {sql[pos:pos + 30]!r}"]
+            return tokens, [f"Unexpected character {char!r} at character {pos + 1}"]
+        kind = match.lastgroup
+        if kind != "space":
+            text = value = match.group(0)
+            if kind == "word":
+                value = value.lower()
+            elif kind == "quoted":
+                value = value[1:-1].replace('""', '"').lower()
+            tokens.append(SqlToken("string" if kind == "dollar" else kind, value, match.start(), text))
+        pos = match.end()
+    return tokens, []
+
+
+# Words before "(" that open a subquery, a list or a group rather than a function call
+NOT_FUNCTION_WORDS = frozenset("""
+    in exists from join on where and or not as by select when then else using lateral over filter any all some
+    having union intersect except with materialized values into is between like ilike distinct case
+""".split())
+
+# Words that end a FROM list
+_FROM_LIST_END = frozenset("""
+    where group having order limit offset fetch window union intersect except returning for select set
+""".split())
+
+
+def extract_tables(sql: str) -> List[str]:
+    """
+    Return the tables a statement references (lowercase, schema stripped,
+    in order): every item of a FROM list, comma-separated ones included,
+    and every JOIN target, at any subquery depth. FROM inside a function
+    call (EXTRACT(YEAR FROM d), SUBSTRING(s FROM 2), ...) and IS DISTINCT
+    FROM are not table references; set-returning functions are skipped.
+    """
+    tokens, _ = tokenize_sql(sql or "")
+    tables: List[str] = []
+    # One frame per open "(": [is a function call, in a FROM list, expecting a FROM item]
+    frames = [[False, False, False]]
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        frame = frames[-1]
+        expecting, frame[2] = frame[2], False
+        if token.kind == "op":
+            if token.value == "(":
+                prev = tokens[i - 1] if i else None
+                function = prev is not None and prev.kind in ("word", "quoted") and (
+                    prev.value not in NOT_FUNCTION_WORDS
+                )
+                # A parenthesized FROM item is a subquery or a parenthesized join
+                frames.append([function, expecting, expecting])
+            elif token.value == ")" and len(frames) > 1:
+                frames.pop()
+            elif token.value == "," and frame[1]:
+                frame[2] = True
+            elif token.value == ";":
+                frames = [[False, False, False]]
+        elif expecting and token.kind == "word" and token.value in SQL_KEYWORDS:
+            frame[2] = token.value in ("lateral", "only")
+            if token.value in _FROM_LIST_END:
+                frame[1] = False  # "(SELECT ...": the subquery's own FROM starts its list
+        elif token.kind == "word" and token.value in ("from", "join"):
+            if not frame[0] and not (token.value == "from" and i and tokens[i - 1].value == "distinct"):
+                frame[1] = frame[2] = True
+        elif token.kind == "word" and token.value in _FROM_LIST_END:
+            frame[1] = False
+        elif expecting and token.kind in ("word", "quoted"):
+            # [schema.]table, unless it is a function call
+            while i + 2 < len(tokens) and tokens[i + 1].value == "." and tokens[i + 2].kind in ("word", "quoted"):
+                i += 2
+            if not (i + 1 < len(tokens) and tokens[i + 1].value == "("):
+                name = tokens[i].value
+                if name not in tables:
+                    tables.append(name)
+        i += 1
+    return tables
+
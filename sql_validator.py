@@ -0,0 +1,517 @@
+"""Local validation of generated SQL against the schema DDL, before anything reaches Postgres"""
+import difflib
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Set, Tuple
+
+import pandas as pd
+from vanna.capabilities.sql_runner import SqlRunner, RunSqlToolArgs
+from vanna.core.tool import ToolContext
+
+from sql_utils import NOT_FUNCTION_WORDS, SQL_KEYWORDS, SqlToken, parse_schema_tables, tokenize_sql
+
+logger = logging.getLogger(__name__)
+
+# Words that end a FROM item; they are never a table alias
+_FROM_ITEM_END = frozenset("""
+    where group having order limit offset fetch window union intersect except join inner left right full cross
+    natural on using for returning select
+""".split())
+
+
+class SqlValidationError(ValueError):
+    """Generated SQL that does not match the schema; the message lists each problem for the LLM"""
+
+    def __init__(self, problems: List[str]):
+        self.problems = problems
+        listed = "\n".join(f"- {p}" for p in problems)
+        super().__init__(
+            f"SQL validation failed, the query was not sent to the database:\n{listed}\n"
+            f"Fix these references and run the query again."
+        )
+
+
+@dataclass
+class ConversationRecord:
+    """Validator outcomes within one conversation"""
+    checked: int = 0
+    rejected: int = 0
+    fixed: int = 0  # rejections followed by a query that passed
+    attempts_to_fix: int = 0  # rejected queries before each fix, summed
+    warehouse_errors: int = 0  # passed validation but failed in Postgres
+    pending: int = 0  # consecutive rejections not yet fixed
+
+
+def _suggest(name: str, candidates: Set[str]) -> Optional[str]:
+    matches = difflib.get_close_matches(name, sorted(candidates), n=1, cutoff=0.6)
+    return matches[0] if matches else None
+
+
+class SchemaValidator:
+    """
+    Checks SQL against the CREATE TABLE statements of the schema (the DDL in
+    training_data/schema.json): statements must tokenize and balance their
+    parentheses, every FROM/JOIN table must exist, every alias.column must be
+    a column of the table behind the alias, and every bare identifier must be
+    a column of a table in the query (or an alias the query defines). Names
+    come from the sql_utils tokenizer rather than a full parser:
+    anything it cannot resolve (subquery and function outputs, tables in
+    other schemas) is let through, so valid SQL is never rejected.
+
+    `ddl_provider` returns the DDL statements; with a `version_provider`
+    the schema is rebuilt whenever the knowledge base version changes.
+    """
+
+    def __init__(
+        self,
+        ddl_provider: Callable[[], List[str]],
+        version_provider: Optional[Callable[[], str]] = None,
+        schemas: Tuple[str, ...] = ("public",),
+    ):
+        self.ddl_provider = ddl_provider
+        self.version_provider = version_provider
+        self.schemas = schemas
+        self._version: Optional[str] = None
+        self._tables: Dict[str, Set[str]] = {}
+        self._all_columns: Set[str] = set()
+        self._load()
+
+    @classmethod
+    def from_knowledge_base(cls, kb: Any) -> "SchemaValidator":
+        return cls(kb.get_schema_ddl, kb.get_version)
+
+    def _load(self) -> None:
+        # Version first: reading it may load the knowledge base the DDL comes from
+        if self.version_provider is not None:
+            self._version = self.version_provider()
+        tables = {name: set(columns) for name, columns in parse_schema_tables(self.ddl_provider()).items()}
+        self._tables = tables
+        self._all_columns = set().union(*tables.values()) if tables else set()
+
+    @property
+    def tables(self) -> Dict[str, Set[str]]:
+        if self.version_provider is not None and self.version_provider() != self._version:
+            self._load()
+        return self._tables
+
+    @staticmethod
+    def _statements(tokens: List[SqlToken]) -> List[List[SqlToken]]:
+        statements: List[List[SqlToken]] = [[]]
+        for token in tokens:
+            if token.kind == "op" and token.value == ";":
+                statements.append([])
+            else:
+                statements[-1].append(token)
+        return [s for s in statements if s]
+
+    # ---- validation ----
+
+    def validate(self, sql: str) -> List[str]:
+        """Problems found in the SQL (empty when it is fine or cannot be checked)"""
+        tokens, problems = tokenize_sql(sql or "")
+        if problems:
+            return problems
+        for statement in self._statements(tokens):
+            problems.extend(self._validate_statement(statement))
+        return problems
+
+    def _validate_statement(self, tokens: List[SqlToken]) -> List[str]:
+        first = tokens[0]
+        if not (first.kind == "word" and first.value in ("select", "with")) and first.value != "(":
+            return []  # writes and utility statements are checked elsewhere
+
+        problems: List[str] = []
+        matching: Dict[int, int] = {}
+        enclosing: Dict[int, int] = {}  # token index -> its innermost "("
+        stack: List[int] = []
+        for i, token in enumerate(tokens):
+            if stack:
+                enclosing[i] = stack[-1]
+            if token.kind != "op":
+                continue
+            if token.value == "(":
+                stack.append(i)
+            elif token.value == ")":
+                if not stack:
+                    return [f"Unbalanced parentheses: ')' at character {token.pos + 1} has no matching '('"]
+                matching[stack.pop()] = i
+        if stack:
+            return [f"Unbalanced parentheses: '(' at character {tokens[stack[-1]].pos + 1} is never closed"]
+
+        scope = _Scope()
+        self._collect_ctes(tokens, matching, scope)
+        self._collect_from_items(tokens, matching, enclosing, scope, problems)
+        self._collect_aliases(tokens, scope)
+        self._check_columns(tokens, scope, problems)
+        return problems
+
+    @staticmethod
+    def _word(tokens: List[SqlToken], i: int) -> Optional[str]:
+        if 0 <= i < len(tokens) and tokens[i].kind in ("word", "quoted"):
+            return tokens[i].value
+        return None
+
+    @staticmethod
+    def _is(tokens: List[SqlToken], i: int, *values: str) -> bool:
+        return 0 <= i < len(tokens) and tokens[i].kind in ("word", "op") and tokens[i].value in values
+
+    def _is_identifier(self, tokens: List[SqlToken], i: int) -> bool:
+        return 0 <= i < len(tokens) and (
+            tokens[i].kind == "quoted" or (tokens[i].kind == "word" and tokens[i].value not in SQL_KEYWORDS)
+        )
+
+    def _collect_ctes(self, tokens: List[SqlToken], matching: Dict[int, int], scope: "_Scope") -> None:
+        """name [(columns)] AS [NOT] [MATERIALIZED] (...) after each WITH"""
+        for i, token in enumerate(tokens):
+            if not (token.kind == "word" and token.value == "with"):
+                continue
+            j = i + 1 + self._is(tokens, i + 1, "recursive")
+            while self._word(tokens, j) is not None:
+                scope.ctes.add(tokens[j].value)
+                scope.consumed.add(j)
+                j += 1
+                if self._is(tokens, j, "(") and j in matching:
+                    j = self._column_list(tokens, j, matching, scope)
+                if not self._is(tokens, j, "as"):
+                    break
+                j += 1
+                while self._is(tokens, j, "not", "materialized"):
+                    j += 1
+                if not self._is(tokens, j, "(") or j not in matching:
+                    break
+                j = matching[j] + 1
+                if not self._is(tokens, j, ","):
+                    break
+                j += 1
+
+    def _column_list(self, tokens: List[SqlToken], start: int, matching: Dict[int, int], scope: "_Scope") -> int:
+        """Record the names in "(a, b)" as defined aliases; returns the index after ')'"""
+        end = matching[start]
+        for k in range(start + 1, end):
+            if tokens[k].kind in ("word", "quoted"):
+                scope.defined.add(tokens[k].value)
+                scope.consumed.add(k)
+        return end + 1
+
+    def _paren_is_function(self, tokens: List[SqlToken], i: int) -> bool:
+        prev = tokens[i - 1] if i > 0 else None
+        return prev is not None and prev.kind in ("word", "quoted") and prev.value not in NOT_FUNCTION_WORDS
+
+    def _collect_from_items(
+        self,
+        tokens: List[SqlToken],
+        matching: Dict[int, int],
+        enclosing: Dict[int, int],
+        scope: "_Scope",
+        problems: List[str],
+    ) -> None:
+        for i, token in enumerate(tokens):
+            if token.kind != "word" or token.value not in ("from", "join"):
+                continue
+            if i in enclosing and self._paren_is_function(tokens, enclosing[i]):
+                continue  # EXTRACT(... FROM ...), SUBSTRING(... FROM ...), TRIM(... FROM ...)
+            if token.value == "from" and self._is(tokens, i - 1, "distinct"):
+                continue  # IS [NOT] DISTINCT FROM
+            j = i + 1
+            while True:
+                j = self._from_item(tokens, j, matching, scope, problems)
+                if token.value != "from" or not self._is(tokens, j, ","):
+                    break
+                j += 1
+
+    def _from_item(
+        self, tokens: List[SqlToken], j: int, matching: Dict[int, int], scope: "_Scope", problems: List[str]
+    ) -> int:
+        """Parse one FROM item at j, record its alias; returns the index after it"""
+        while self._is(tokens, j, "lateral", "only"):
+            j += 1
+        if self._is(tokens, j, "("):
+            if j not in matching:
+                return j + 1
+            if not self._is(tokens, j + 1, "select", "with", "values"):
+                # Parenthesized join: its tables are picked up by their own FROM/JOIN keywords
+                return self._from_item(tokens, j + 1, matching, scope, problems)
+            return self._alias(tokens, matching[j] + 1, matching, scope, None)
+        if self._word(tokens, j) is None:
+            return j
+
+        parts = [j]
+        while self._is(tokens, parts[-1] + 1, ".") and self._word(tokens, parts[-1] + 2) is not None:
+            parts.append(parts[-1] + 2)
+        end = parts[-1] + 1
+        if self._is(tokens, end, "(") and end in matching:
+            # Set-returning function (generate_series, unnest, ...): its columns are unknown
+            return self._alias(tokens, matching[end] + 1, matching, scope, None)
+
+        scope.consumed.update(range(j, end))
+        name = tokens[parts[-1]].value
+        schema = tokens[parts[-2]].value if len(parts) > 1 else None
+        tables = self.tables
+        if schema is not None and schema not in self.schemas:
+            table: Optional[str] = None  # information_schema, pg_catalog, ...
+            scope.opaque = True
+        elif name in scope.ctes and schema is None:
+            table = None
+            scope.opaque = True
+        elif name in tables:
+            table = name
+        else:
+            suggestion = _suggest(name, set(tables) | scope.ctes)
+            hint = f' Did you mean "{suggestion}"?' if suggestion else ""
+            problems.append(f'Table "{name}" does not exist.{hint}')
+            table = None
+            scope.opaque = True
+        scope.add_alias(name, table)
+        return self._alias(tokens, end, matching, scope, table, default=name)
+
+    def _alias(
+        self,
+        tokens: List[SqlToken],
+        j: int,
+        matching: Dict[int, int],
+        scope: "_Scope",
+        table: Optional[str],
+        default: Optional[str] = None,
+    ) -> int:
+        """[AS] alias [(columns)] after a FROM item"""
+        if table is None:
+            scope.opaque = True
+        has_as = self._is(tokens, j, "as")
+        k = j + has_as
+        alias = self._word(tokens, k)
+        if alias is None or (tokens[k].kind == "word" and (alias in _FROM_ITEM_END or alias in SQL_KEYWORDS)):
+            return j
+        scope.consumed.add(k)
+        scope.add_alias(alias, table)
+        k += 1
+        if self._is(tokens, k, "(") and k in matching:
+            k = self._column_list(tokens, k, matching, scope)
+        return k
+
+    def _collect_aliases(self, tokens: List[SqlToken], scope: "_Scope") -> None:
+        """Output names the query defines: "expr AS name", "expr name", "OVER name", "WINDOW name AS" """
+        for i, token in enumerate(tokens):
+            if i in scope.consumed or not self._is_identifier(tokens, i):
+                continue
+            if self._is(tokens, i + 1, ".", "(") or self._is(tokens, i - 1, "."):
+                continue
+            prev = tokens[i - 1] if i > 0 else None
+            if prev is None:
+                continue
+            if prev.kind == "word" and prev.value in ("as", "over", "window"):
+                scope.defined.add(token.value)
+            elif prev.kind in ("string", "number", "quoted") or (prev.kind == "op" and prev.value == ")") or (
+                prev.kind == "word" and (prev.value not in SQL_KEYWORDS or prev.value == "end")
+            ):
+                # Two expressions in a row: the second is an alias without AS ("SUM(x) total", "d.year yr")
+                scope.defined.add(token.value)
+
+    def _check_columns(self, tokens: List[SqlToken], scope: "_Scope", problems: List[str]) -> None:
+        tables = self.tables
+        in_query = {t for targets in scope.aliases.values() for t in targets if t}
+        reported: Set[Tuple[Optional[str], str]] = set()
+        for i, token in enumerate(tokens):
+            if i in scope.consumed or token.kind not in ("word", "quoted"):
+                continue
+            if self._is(tokens, i + 1, "("):
+                continue  # function call
+            if self._is(tokens, i - 1, "::"):
+                continue  # type name
+            if self._is(tokens, i - 1, "."):
+                continue  # checked with its qualifier
+            if self._is(tokens, i + 1, "."):
+                column_index = i + 2
+                if self._is(tokens, column_index + 1, "."):
+                    continue  # schema.table.column
+                if self._is(tokens, column_index + 1, "(") or self._is(tokens, column_index, "*"):
+                    continue
+                column = self._word(tokens, column_index)
+                if column is None or (token.value, column) in reported:
+                    continue
+                reported.add((token.value, column))
+                problem = self._check_qualified(token.value, column, scope, tables)
+                if problem:
+                    problems.append(problem)
+                continue
+
+            name = token.value
+            if token.kind == "word" and name in SQL_KEYWORDS:
+                continue
+            if name in scope.defined or name in scope.aliases or name in scope.ctes:
+                continue
+            columns = set().union(*(tables[t] for t in in_query)) if in_query else set()
+            if name in columns or (scope.opaque and name in self._all_columns) or (None, name) in reported:
+                continue
+            if scope.opaque and not in_query:
+                continue  # nothing known to check against
+            reported.add((None, name))
+            suggestion = _suggest(name, columns | scope.defined) if columns else None
+            owner = [t for t in sorted(in_query) if suggestion in tables[t]] if suggestion else []
+            hint = f' Did you mean "{suggestion}"' + (f" ({owner[0]})?" if owner else "?") if suggestion else ""
+            listed = ", ".join(sorted(in_query))
+            problems.append(f'Column "{name}" does not exist in any table of the query ({listed}).{hint}')
+
+    def _check_qualified(
+        self, qualifier: str, column: str, scope: "_Scope", tables: Dict[str, Set[str]]
+    ) -> Optional[str]:
+        targets = scope.aliases.get(qualifier)
+        if targets is None:
+            if qualifier in self.schemas or qualifier in scope.defined:
+                return None
+            known = ", ".join(a if ts == {a} else f"{a} ({'/'.join(sorted(t for t in ts if t)) or 'subquery'})"
+                              for a, ts in sorted(scope.aliases.items()))
+            suggestion = _suggest(qualifier, set(scope.aliases))
+            hint = f' Did you mean "{suggestion}.{column}"?' if suggestion else ""
+            return f'Missing FROM-clause entry for "{qualifier}" in "{qualifier}.{column}".{hint} ' \
+                   f'Tables in the query: {known or "none"}.'
+        if None in targets:
+            return None  # a subquery, CTE or function: its columns are not known here
+        columns = set().union(*(tables[t] for t in targets))
+        if column in columns:
+            return None
+        table = "/".join(sorted(targets))
+        described = table if qualifier == table else f"{table} (alias {qualifier})"
+        suggestion = _suggest(column, columns)
+        if suggestion:
+            return f'Column "{qualifier}.{column}" does not exist in {described}. Did you mean "{qualifier}.{suggestion}"?'
+        return f'Column "{qualifier}.{column}" does not exist in {described}. Its columns are: {", ".join(sorted(columns))}.'
+
+
+class _Scope:
+    """Names one statement defines; subqueries share it, so checks only fail for names defined nowhere"""
+
+    def __init__(self) -> None:
+        self.aliases: Dict[str, Set[Optional[str]]] = {}  # alias or table name -> tables (None: unknown columns)
+        self.ctes: Set[str] = set()
+        self.defined: Set[str] = set()  # output and column aliases
+        self.consumed: Set[int] = set()  # token indices already resolved as table names or aliases
+        self.opaque = False  # some FROM item has columns the schema does not describe
+
+    def add_alias(self, alias: str, table: Optional[str]) -> None:
+        self.aliases.setdefault(alias, set()).add(table)
+
+
+class ValidatingSqlRunner(SqlRunner):
+    """
+    Wraps the SQL runner and validates every query with a SchemaValidator
+    before it is sent on. A query with bad references fails immediately with
+    a SqlValidationError listing each problem (with "did you mean"
+    suggestions), which RunSqlTool hands to the LLM as the tool result; the
+    warehouse round trip is saved. Outcomes are kept per conversation:
+    rejections, how many attempts the LLM needed to fix them, and queries
+    that passed validation but still failed in Postgres.
+    """
+
+    def __init__(self, runner: SqlRunner, validator: SchemaValidator, max_conversations: int = 500):
+        self.runner = runner
+        self.validator = validator
+        self.max_conversations = max_conversations
+        self._conversations: "OrderedDict[str, ConversationRecord]" = OrderedDict()
+        self.checked = 0
+        self.rejected = 0
+        self.warehouse_errors = 0
+        self.validation_ms = 0.0
+        self.warehouse_ms = 0.0
+        self.warehouse_runs = 0
+        self.problems_by_kind: Dict[str, int] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        # close, warm_up, get_stats of the pool, ... of the wrapped runner
+        return getattr(self.runner, name)
+
+    def _record(self, context: ToolContext) -> ConversationRecord:
+        conversation_id = getattr(context, "conversation_id", None) or "unknown"
+        record = self._conversations.get(conversation_id)
+        if record is None:
+            record = self._conversations[conversation_id] = ConversationRecord()
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+        else:
+            self._conversations.move_to_end(conversation_id)
+        return record
+
+    def _check(self, args: RunSqlToolArgs, context: ToolContext) -> ConversationRecord:
+        start = time.perf_counter()
+        problems = self.validator.validate(args.sql)
+        self.validation_ms += (time.perf_counter() - start) * 1000
+        self.checked += 1
+        record = self._record(context)
+        record.checked += 1
+        if problems:
+            self.rejected += 1
+            record.rejected += 1
+            record.pending += 1
+            for problem in problems:
+                kind = problem.split(" ", 1)[0].lower().strip('"')
+                kind = {"column": "column", "table": "table", "missing": "alias"}.get(kind, "syntax")
+                self.problems_by_kind[kind] = self.problems_by_kind.get(kind, 0) + 1
+            logger.info(f"SQL validation rejected a query: {problems}")
+            raise SqlValidationError(problems)
+        if record.pending:
+            record.fixed += 1
+            record.attempts_to_fix += record.pending
+            record.pending = 0
+        return record
+
+    def _finish(self, record: ConversationRecord, start: float, error: Optional[BaseException] = None) -> None:
+        if error is not None:
+            self.warehouse_errors += 1
+            record.warehouse_errors += 1
+            return
+        self.warehouse_runs += 1
+        self.warehouse_ms += (time.perf_counter() - start) * 1000
+
+    async def run_sql(self, args: RunSqlToolArgs, context: ToolContext) -> pd.DataFrame:
+        record = self._check(args, context)
+        start = time.perf_counter()
+        try:
+            df = await self.runner.run_sql(args, context)
+        except Exception as e:
+            self._finish(record, start, e)
+            raise
+        self._finish(record, start)
+        return df
+
+    async def stream_sql(
+        self, args: RunSqlToolArgs, context: ToolContext, chunk_size: int = 5000
+    ) -> AsyncGenerator[pd.DataFrame, None]:
+        stream_sql = getattr(self.runner, "stream_sql", None)
+        if stream_sql is None:
+            yield await self.run_sql(args, context)
+            return
+
+        record = self._check(args, context)
+        start = time.perf_counter()
+        try:
+            async for chunk in stream_sql(args, context, chunk_size=chunk_size):
+                yield chunk
+        except Exception as e:
+            self._finish(record, start, e)
+            raise
+        self._finish(record, start)
+
+    def get_stats(self) -> Dict[str, Any]:
+        records = list(self._conversations.values())
+        with_rejections = [r for r in records if r.rejected]
+        fixed = sum(r.fixed for r in records)
+        avg_warehouse_ms = self.warehouse_ms / self.warehouse_runs if self.warehouse_runs else 0.0
+        return {
+            "checked": self.checked,
+            "rejected": self.rejected,
+            # Each rejection is a query Postgres never saw
+            "warehouse_calls_saved": self.rejected,
+            "warehouse_ms_saved": self.rejected * avg_warehouse_ms,
+            "warehouse_errors_after_validation": self.warehouse_errors,
+            "problems_by_kind": dict(self.problems_by_kind),
+            "avg_validation_ms": self.validation_ms / self.checked if self.checked else 0.0,
+            "conversations": len(records),
+            "conversations_with_rejections": len(with_rejections),
+            "warehouse_calls_saved_per_conversation": self.rejected / len(with_rejections)
+            if with_rejections else 0.0,
+            "fixed": fixed,
+            # Tool iterations spent per fix; 1.0 means every fix landed on the next attempt
+            "avg_attempts_to_fix": sum(r.attempts_to_fix for r in records) / fixed if fixed else None,
+            "recent": {cid: asdict(r) for cid, r in list(self._conversations.items())[-10:]},
+        }
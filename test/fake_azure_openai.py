@@ -0,0 +1,233 @@
+"""
+Local fake Azure OpenAI endpoint for tests
+Serves /openai/deployments/<model>/chat/completions on 127.0.0.1 with a
+configurable response delay, so LLM client behaviour can be tested offline.
+Usage mimics provider prompt caching: the longest message prefix (tools
+first) already seen in an earlier request counts as cached, in 128-token
+blocks once it reaches 1024 tokens.
+With `tool_call` set, streamed responses carry that tool call instead of
+text, its arguments split into `fragment_size`-character deltas sent
+`chunk_delay` seconds apart.
+Faults are injected per request: each request takes the first entry of
+`faults` meant for its deployment ({"status": 429, "retry_after": 0.2},
+{"delay": 3.0}, {"stall": 3.0} to pause a stream after its first delta,
+optionally "model": "<deployment>"), and `model_delays`
+adds a fixed delay per deployment. `rate_limit` = (requests, seconds)
+mimics a quota: requests past it within a sliding window get a 429 with
+Retry-After, like an Azure deployment over its RPM.
+"""
+
+import hashlib
+import json
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients that give up (deadlines, lost hedge races) close the connection mid-response
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+
+class FakeAzureOpenAIServer:
+    """Threaded HTTP server that mimics the Azure OpenAI chat completions API"""
+
+    def __init__(self, delay: float = 0.0, content: str = "fake answer", tool_call=None,
+                 fragment_size: int = 4, chunk_delay: float = 0.0, faults=None, model_delays=None,
+                 rate_limit=None):
+        self.delay = delay
+        self.faults = list(faults or [])
+        self.model_delays = dict(model_delays or {})
+        self.models = []
+        self.rate_limit = rate_limit
+        self.throttled = 0
+        self._accepted = []
+        self.content = content
+        self.tool_call = tool_call
+        self.fragment_size = fragment_size
+        self.chunk_delay = chunk_delay
+        self.request_count = 0
+        self.requests = []
+        self._seen_prefixes = set()
+        self._lock = threading.Lock()
+        self._httpd = _Server(("127.0.0.1", 0), self._make_handler())
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def usage_for(self, body):
+        """Prompt/cached/completion tokens for a request body (~4 characters per token)"""
+        units = [json.dumps(body.get("tools") or [], sort_keys=True)]
+        units += [json.dumps(m, sort_keys=True) for m in body.get("messages", [])]
+        digest = hashlib.sha256()
+        prompt_tokens = 0
+        cached_tokens = 0
+        with self._lock:
+            for unit in units:
+                digest.update(unit.encode("utf-8"))
+                prompt_tokens += (len(unit) + 3) // 4
+                key = digest.hexdigest()
+                if key in self._seen_prefixes:
+                    cached_tokens = prompt_tokens
+                self._seen_prefixes.add(key)
+        cached_tokens = cached_tokens // 128 * 128 if cached_tokens >= 1024 else 0
+        completion_tokens = len(self.content.split())
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+
+    def add_faults(self, *faults):
+        with self._lock:
+            self.faults.extend(faults)
+
+    def _take_fault(self, model):
+        with self._lock:
+            for i, fault in enumerate(self.faults):
+                if fault.get("model") in (None, model):
+                    return self.faults.pop(i)
+            if self.rate_limit:
+                limit, window = self.rate_limit
+                now = time.monotonic()
+                self._accepted = [t for t in self._accepted if now - t < window]
+                if len(self._accepted) >= limit:
+                    self.throttled += 1
+                    return {"status": 429, "retry_after": window - (now - self._accepted[0])}
+                self._accepted.append(now)
+        return {}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                match = re.search(r"/deployments/([^/]+)/", self.path)
+                model = match.group(1) if match else body.get("model")
+                with server._lock:
+                    server.request_count += 1
+                    server.requests.append(body)
+                    server.models.append(model)
+
+                fault = server._take_fault(model)
+                time.sleep(server.delay + server.model_delays.get(model, 0.0) + fault.get("delay", 0.0))
+                if fault.get("status"):
+                    self._send_error(fault)
+                    return
+
+                if body.get("stream"):
+                    self._send_stream(body, fault.get("stall", 0.0))
+                else:
+                    self._send_json(body)
+
+            def _send_error(self, fault):
+                payload = json.dumps({"error": {
+                    "code": str(fault["status"]), "message": f"Injected fault {fault['status']}",
+                }}).encode("utf-8")
+                self.send_response(fault["status"])
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                if fault.get("retry_after") is not None:
+                    self.send_header("retry-after-ms", str(int(fault["retry_after"] * 1000)))
+                    self.send_header("retry-after", str(max(1, round(fault["retry_after"]))))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _send_json(self, body):
+                payload = json.dumps({
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "gpt-4"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": server.content},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": server.usage_for(body),
+                }).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _send_stream(self, body, stall=0.0):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                if server.tool_call:
+                    deltas = [{"tool_calls": [{
+                        "index": 0, "id": "call_fake", "type": "function",
+                        "function": {"name": server.tool_call["name"], "arguments": ""},
+                    }]}]
+                    arguments = server.tool_call["arguments"]
+                    for i in range(0, len(arguments), server.fragment_size):
+                        deltas.append({"tool_calls": [{
+                            "index": 0, "function": {"arguments": arguments[i:i + server.fragment_size]},
+                        }]})
+                    finish_reason = "tool_calls"
+                else:
+                    deltas = [{"content": word + " "} for word in server.content.split(" ")]
+                    finish_reason = "stop"
+                for i, delta in enumerate(deltas):
+                    if stall and i == 1:
+                        self.wfile.flush()
+                        time.sleep(stall)
+                    event = {
+                        "id": "chatcmpl-fake",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": body.get("model", "gpt-4"),
+                        "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+                    }
+                    self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+                    if server.chunk_delay:
+                        self.wfile.flush()
+                        time.sleep(server.chunk_delay)
+                final = {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body.get("model", "gpt-4"),
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}],
+                }
+                self.wfile.write(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    usage = {
+                        "id": "chatcmpl-fake",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": body.get("model", "gpt-4"),
+                        "choices": [],
+                        "usage": server.usage_for(body),
+                    }
+                    self.wfile.write(f"data: {json.dumps(usage)}\n\n".encode("utf-8"))
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+
+        return Handler
@@ -0,0 +1,95 @@
+"""
+Stand-in for main:app used by the multi-worker load test
+Builds its "knowledge base" lazily in each worker and serves a CPU-bound
+SSE chat endpoint in the same wire format as the Vanna server. POST
+/api/invalidate stands in for the admin actions broadcast to every worker.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from serve import InFlightMiddleware, InFlightRequests, WorkerBroadcast, default_broadcast_path
+
+app = FastAPI()
+in_flight = InFlightRequests()
+app.add_middleware(InFlightMiddleware, tracker=in_flight)
+
+_state = {"invalidations": 0}
+
+
+def _invalidate():
+    _state["invalidations"] += 1
+    return _state["invalidations"]
+
+
+broadcast = WorkerBroadcast(default_broadcast_path(), interval=0.2)
+broadcast.on("invalidate", _invalidate)
+
+
+def _knowledge_base():
+    # Built on first use inside the worker process, never in the supervisor
+    if "kb" not in _state:
+        from knowledge_base import KnowledgeBase
+
+        kb = KnowledgeBase()
+        kb.load_all()
+        _state["kb"] = kb
+        _state["built_in"] = os.getpid()
+    return _state["kb"]
+
+
+def _cpu_work(ms: float) -> str:
+    # Stands in for prompt assembly, retrieval and serialization
+    digest = b""
+    deadline = time.process_time() + ms / 1000
+    while time.process_time() < deadline:
+        digest = hashlib.sha256(digest).digest()
+    return digest.hex()[:8]
+
+
+@app.get("/api/vanna/v2/chat_sse")
+async def chat_sse(cpu_ms: float = 20.0, chunks: int = 1, delay: float = 0.0):
+    kb = _knowledge_base()
+
+    async def stream():
+        for i in range(chunks):
+            if delay:
+                await asyncio.sleep(delay)
+            payload = {"pid": os.getpid(), "chunk": i, "work": _cpu_work(cpu_ms / chunks),
+                       "kb_examples": len(kb.get_example_queries())}
+            yield f"data: {json.dumps(payload)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+@app.post("/api/invalidate")
+async def invalidate():
+    return {"invalidations": await broadcast.publish("invalidate")}
+
+
+@app.get("/health")
+async def health():
+    return {"status": "healthy", "pid": os.getpid(), "kb_built_in": _state.get("built_in"),
+            "invalidations": _state["invalidations"]}
+
+
+@app.on_event("startup")
+async def start_broadcast():
+    broadcast.start()
+
+
+@app.on_event("shutdown")
+async def drain():
+    await broadcast.stop()
+    await in_flight.wait_idle(10)
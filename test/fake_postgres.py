@@ -0,0 +1,164 @@
+"""
+Local Postgres stand-in for tests
+A DB-API style connection whose queries block for a configurable latency,
+like a network round trip to the warehouse, and return canned rows.
+EXPLAIN (FORMAT JSON) returns a plan with the cost and row estimate in
+`plans` (per statement, default 1.0 / 1 row), and SET statement_timeout is
+enforced: a query slower than it fails like Postgres cancels it, as does
+connection.cancel() from another thread. Setting `down` refuses new
+connections and drops open ones, like a crashed server.
+"""
+
+import itertools
+import re
+import threading
+import time
+
+_TIMEOUT_RE = re.compile(r"SET (?:LOCAL )?statement_timeout = (\w+)", re.IGNORECASE)
+
+
+class FakeDatabase:
+    """Shared state for FakeConnections: latency, canned results and counters"""
+
+    def __init__(self, latency: float = 0.0, rows=None, columns=("value",)):
+        self.latency = latency
+        self.rows = rows if rows is not None else [(1,)]
+        self.columns = columns
+        self.results = {}  # sql -> (columns, rows) overrides; rows may be a callable returning an iterator
+        self.named_cursors = []
+        self.fail_sql = set()
+        self.plans = {}  # sql -> (total cost, plan rows) for EXPLAIN
+        self.latencies = {}  # sql -> latency overrides
+        self.down = False
+        self.executed = []
+        self.connections = []
+        self.active = 0
+        self.max_active = 0
+        self.cancelled = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        if self.down:
+            raise ConnectionError("could not connect to server: Connection refused")
+        conn = FakeConnection(self)
+        with self._lock:
+            self.connections.append(conn)
+        return conn
+
+
+class FakeCursor:
+    def __init__(self, conn, name=None):
+        self.conn = conn
+        self.name = name
+        self.itersize = 2000
+        self.description = None
+        self.rowcount = -1
+        self._rows = iter(())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, sql, params=None):
+        db = self.conn.db
+        if self.conn.closed:
+            raise RuntimeError("connection already closed")
+        if db.down:
+            self.conn.closed = 2
+            raise RuntimeError("server closed the connection unexpectedly")
+        self.conn._cancel.clear()
+        with db._lock:
+            db.active += 1
+            db.max_active = max(db.max_active, db.active)
+            db.executed.append(sql)
+        try:
+            timeout = _TIMEOUT_RE.match(sql)
+            if timeout:
+                value = timeout.group(1)
+                self.conn.statement_timeout = int(value) / 1000 if value.isdigit() else None
+                self.conn.timeout_is_local = " LOCAL " in sql.upper()
+                self.description = None
+                return
+            if sql.upper().startswith("EXPLAIN (FORMAT JSON) "):
+                cost, rows = db.plans.get(sql[len("EXPLAIN (FORMAT JSON) "):], (1.0, 1))
+                plan = [{"Plan": {"Node Type": "Seq Scan", "Total Cost": cost, "Plan Rows": rows}}]
+                self.description = [("QUERY PLAN", None, None, None, None, None, None)]
+                self._rows = iter([(plan,)])
+                return
+            if sql != "SELECT 1":
+                latency = db.latencies.get(sql, db.latency)
+                limit = self.conn.statement_timeout
+                if limit is not None and latency > limit:
+                    self._sleep(limit)
+                    raise RuntimeError("canceling statement due to statement timeout")
+                self._sleep(latency)
+            if sql in db.fail_sql:
+                raise RuntimeError(f"query failed: {sql}")
+            if sql == "SELECT 1":
+                columns, rows = ("?column?",), [(1,)]
+            elif sql in db.results:
+                columns, rows = db.results[sql]
+            elif sql.strip().upper().startswith(("SELECT", "WITH", "EXPLAIN")):
+                columns, rows = db.columns, db.rows
+            else:
+                self.description = None
+                self.rowcount = 1
+                return
+            self.description = [(c, None, None, None, None, None, None) for c in columns]
+            if callable(rows):
+                rows = rows()  # generated lazily, like a server-side cursor
+            else:
+                self.rowcount = len(rows)
+            self._rows = iter(rows)
+        finally:
+            with db._lock:
+                db.active -= 1
+
+    def _sleep(self, seconds):
+        if self.conn._cancel.wait(seconds):
+            with self.conn.db._lock:
+                self.conn.db.cancelled += 1
+            raise RuntimeError("canceling statement due to user request")
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def fetchmany(self, size=1):
+        return list(itertools.islice(self._rows, size))
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+        self.closed = 0
+        self.autocommit = False
+        self.statement_timeout = None
+        self.timeout_is_local = False
+        self._cancel = threading.Event()
+
+    def cursor(self, name=None, **kwargs):
+        if name is not None:
+            self.db.named_cursors.append(name)
+        return FakeCursor(self, name=name)
+
+    def commit(self):
+        self._end_transaction()
+
+    def rollback(self):
+        self._end_transaction()
+
+    def _end_transaction(self):
+        if self.timeout_is_local:
+            self.statement_timeout = None
+            self.timeout_is_local = False
+
+    def cancel(self):
+        self._cancel.set()
+
+    def close(self):
+        self.closed = 1
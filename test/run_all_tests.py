@@ -5,6 +5,31 @@ Logs results to: test/logs/run_all_tests_YYYYMMDD_HHMMSS.log
 Available tests:
   - validate_training.py: Validates training data files and knowledge base
   - test_all_questions.py: Tests all 55 training questions
+  - test_llm_concurrency.py: Tests parallel Azure OpenAI calls against a local fake endpoint
+  - test_answer_cache.py: Tests the answer cache in front of the Agent
+  - test_retrieval_index.py: Tests and benchmarks the BM25 retrieval index
+  - test_context_builder.py: Tests question-relevant context assembly
+  - test_postgres_pool.py: Tests the pooled SQL runner against a Postgres stand-in
+  - test_result_streaming.py: Tests streamed, bounded SQL results and peak memory
+  - test_sql_result_cache.py: Tests the SQL result cache and table-level invalidation
+  - test_multi_worker.py: Load-tests the multi-worker server and graceful SSE draining
+  - test_kb_artifact.py: Tests and benchmarks the memory-mapped knowledge base artifact
+  - test_kb_reload.py: Tests hot reload of training data under load
+  - test_prompt_cache.py: Tests prompt-prefix stability and per-user/per-route token accounting
+  - test_token_budget.py: Tests and benchmarks local token counting and prompt budgeting
+  - test_history_compaction.py: Tests incremental compaction of long conversation histories
+  - test_tool_call_stream.py: Tests and benchmarks incremental assembly of streamed tool-call arguments
+  - test_speculative_sql.py: Tests speculative execution of known SQL alongside the LLM call
+  - test_direct_answer.py: Tests the LLM-free fast path for known questions
+  - test_llm_resilience.py: Tests retries, deadlines, hedging and circuit breaking against injected faults
+  - test_llm_router.py: Tests difficulty/cost/latency routing across deployments and fallback on errors
+  - test_rate_limiter.py: Tests RPM/TPM metering, fair per-user and priority queueing, shared quota across workers
+  - test_request_coalescing.py: Tests that concurrent identical questions share one streamed agent run
+  - test_sql_guard.py: Tests EXPLAIN-based rejection/LIMIT of costly queries and per-group statement timeouts
+  - test_sql_validator.py: Tests local schema validation of generated SQL and the warehouse calls it saves
+  - test_aggregate_layer.py: Tests summary mining, query rewriting onto materialized views and their speedup
+  - test_postgres_replicas.py: Tests read balancing, lag bounds, group pinning and ejection across replicas
+  - test_columnar_results.py: Tests the columnar result encoding, zero-copy previews and bytes/CPU vs row dicts
 """
 
 import json
@@ -26,6 +51,31 @@ TESTS = [
     ("validate_training.py", "Validate Training Data"),
     ("test_all_questions.py", "Test All Questions"),
     ("test_api_questions.py", "Test Questions via API"),
+    ("test_llm_concurrency.py", "Test LLM Concurrency"),
+    ("test_answer_cache.py", "Test Answer Cache"),
+    ("test_retrieval_index.py", "Test Retrieval Index"),
+    ("test_context_builder.py", "Test Context Builder"),
+    ("test_postgres_pool.py", "Test Postgres Pool"),
+    ("test_result_streaming.py", "Test Result Streaming"),
+    ("test_sql_result_cache.py", "Test SQL Result Cache"),
+    ("test_multi_worker.py", "Test Multi-Worker Server"),
+    ("test_kb_artifact.py", "Test Knowledge Base Artifact"),
+    ("test_kb_reload.py", "Test Knowledge Base Hot Reload"),
+    ("test_prompt_cache.py", "Test Prompt Cache Layout and Token Accounting"),
+    ("test_token_budget.py", "Test Token Budget"),
+    ("test_history_compaction.py", "Test History Compaction"),
+    ("test_tool_call_stream.py", "Test Tool Call Streaming"),
+    ("test_speculative_sql.py", "Test Speculative SQL"),
+    ("test_direct_answer.py", "Test Direct Answers"),
+    ("test_llm_resilience.py", "Test LLM Resilience"),
+    ("test_llm_router.py", "Test LLM Router"),
+    ("test_rate_limiter.py", "Test LLM Rate Limiter"),
+    ("test_request_coalescing.py", "Test Request Coalescing"),
+    ("test_sql_guard.py", "Test SQL Cost Guard"),
+    ("test_sql_validator.py", "Test SQL Validation"),
+    ("test_aggregate_layer.py", "Test Aggregate Layer"),
+    ("test_postgres_replicas.py", "Test Read Replicas"),
+    ("test_columnar_results.py", "Test Columnar Results"),
 ]
 
 
@@ -0,0 +1,479 @@
+"""
+Test the materialized aggregate layer
+Runs on an in-memory SQLite copy of the star schema (materialized views
+become tables) filled with generated sales:
+1. Summaries are mined from the join shapes the training queries share;
+   DISTINCT, AVG, CTEs and expressions inside SUM are left alone; a view
+   with more joins than a query serves it only if the extra joins are
+   NOT NULL foreign keys to primary keys
+2. Every training query routed to a summary returns the same result as
+   on the fact tables
+3. Per-query runtime on the summary next to the fact tables (speedup)
+4. A write through the runner marks summaries stale until they are refreshed
+5. Shapes seen in the query log become summaries; a summary dropped behind
+   the layer's back falls back to the fact tables
+6. One elected worker builds the views and the others route onto them;
+   a view dropped for its size is not rebuilt
+Logs results to: test/logs/test_aggregate_layer.log
+"""
+
+import asyncio
+import random
+import re
+import sqlite3
+import sys
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report, load_training_questions
+
+# Setup logger
+logger, log_path = setup_logger("test_aggregate_layer", "test_aggregate_layer.log")
+
+FACT_ROWS = 40_000
+MONTHS = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October",
+          "November", "December"]
+
+REPORT = {}
+
+
+class SqliteRunner:
+    """SqlRunner over SQLite; materialized views are tables re-filled from their query on REFRESH"""
+
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.views = {}
+        self.comments = {}
+        self.executed = []
+
+    def _translate(self, sql):
+        sql = sql.strip().rstrip(";")
+        match = re.match(r"CREATE MATERIALIZED VIEW IF NOT EXISTS (\w+) AS (.*)", sql, re.S)
+        if match:
+            self.views[match.group(1)] = match.group(2)
+            return [f"CREATE TABLE IF NOT EXISTS {match.group(1)} AS {match.group(2)}"]
+        match = re.match(r"REFRESH MATERIALIZED VIEW (?:CONCURRENTLY )?(\w+)", sql)
+        if match:
+            name = match.group(1)
+            return [f"DELETE FROM {name}", f"INSERT INTO {name} {self.views[name]}"]
+        match = re.match(r"DROP MATERIALIZED VIEW IF EXISTS (\w+)", sql)
+        if match:
+            self.views.pop(match.group(1), None)
+            self.comments.pop(match.group(1), None)
+            return [f"DROP TABLE IF EXISTS {match.group(1)}"]
+        match = re.match(r"COMMENT ON MATERIALIZED VIEW (\w+) IS '(.*)'", sql, re.S)
+        if match:
+            self.comments[match.group(1)] = match.group(2).replace("''", "'")
+            return ["SELECT 1 WHERE 0"]
+        match = re.match(r"SELECT reltuples::bigint FROM pg_class WHERE relname = '(\w+)'", sql)
+        if match:
+            return [f"SELECT COUNT(*) FROM {match.group(1)}"]
+        return [sql]
+
+    async def run_sql(self, args, context):
+        import pandas as pd
+        from aggregate_layer import SUMMARIES_SQL
+
+        self.executed.append(args.sql)
+        if args.sql == SUMMARIES_SQL:
+            return pd.DataFrame([(name, self.comments.get(name)) for name in self.views],
+                                columns=["relname", "definition"])
+        cursor = None
+        for statement in self._translate(args.sql):
+            cursor = self.conn.execute(statement)
+        if cursor.description is None:
+            self.conn.commit()
+            return pd.DataFrame({"rows_affected": [cursor.rowcount]})
+        return pd.DataFrame(cursor.fetchall(), columns=[d[0] for d in cursor.description])
+
+
+def _knowledge_base():
+    from knowledge_base import KnowledgeBase
+
+    kb = KnowledgeBase()
+    kb.load_all()
+    return kb
+
+
+def _load(runner, kb):
+    """Every schema table, with generated rows in the dimensions and facts the training queries use"""
+    from sql_utils import parse_schema_tables
+
+    rng = random.Random(7)
+    tables = parse_schema_tables(kb.get_schema_ddl())
+    for name, columns in tables.items():
+        runner.conn.execute(f"CREATE TABLE {name} ({', '.join(columns)})")
+
+    def insert(table, rows):
+        columns = list(rows[0])
+        runner.conn.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            [tuple(row[c] for c in columns) for row in rows],
+        )
+
+    dates = []
+    for year in (2011, 2012, 2013, 2014):
+        for month in range(1, 13):
+            for day in range(1, 29, 3):
+                dates.append({
+                    "datekey": year * 10000 + month * 100 + day,
+                    "fulldatealternatekey": f"{year}-{month:02d}-{day:02d}",
+                    "calendaryear": year,
+                    "calendarquarter": (month - 1) // 3 + 1,
+                    "monthnumberofyear": month,
+                    "englishmonthname": MONTHS[month - 1],
+                    "fiscalyear": year + (month >= 7),
+                })
+    insert("dimdate", dates)
+    insert("dimproductcategory", [{"productcategorykey": k, "englishproductcategoryname": f"Category {k}"}
+                                  for k in range(1, 5)])
+    insert("dimproductsubcategory", [{"productsubcategorykey": k, "productcategorykey": k % 4 + 1,
+                                      "englishproductsubcategoryname": f"Subcategory {k}"} for k in range(1, 13)])
+    insert("dimproduct", [{"productkey": k, "productsubcategorykey": k % 12 + 1,
+                           "englishproductname": f"Product {k}", "listprice": k * 10} for k in range(1, 61)])
+    insert("dimreseller", [{"resellerkey": k, "resellername": f"Reseller {k}",
+                            "businesstype": ["Warehouse", "Value Added Reseller", "Specialty Bike Shop"][k % 3]}
+                           for k in range(1, 31)])
+    insert("dimsalesterritory", [{"salesterritorykey": k, "salesterritoryregion": f"Region {k}",
+                                  "salesterritorycountry": f"Country {k % 4}", "salesterritorygroup": f"Group {k % 2}"}
+                                 for k in range(1, 11)])
+    for fact in ("factinternetsales", "factresellersales"):
+        rows = []
+        for line in range(FACT_ROWS):
+            quantity = rng.randint(1, 5)
+            rows.append({
+                "salesordernumber": f"SO{line // 3}", "salesorderlinenumber": line % 3 + 1,
+                "orderdatekey": rng.choice(dates)["datekey"], "productkey": rng.randint(1, 60),
+                "resellerkey": rng.randint(1, 30), "salesterritorykey": rng.randint(1, 10),
+                "customerkey": rng.randint(1, 500), "orderquantity": quantity,
+                "salesamount": quantity * rng.randint(5, 400), "totalproductcost": quantity * rng.randint(2, 200),
+            })
+        insert(fact, [{k: v for k, v in row.items() if k in tables[fact]} for row in rows])
+    runner.conn.commit()
+
+
+def _layer(runner, kb, training=True, **kwargs):
+    from aggregate_layer import AggregateLayer
+
+    sqls = [pair["sql"] for pair in load_training_questions()] if training else []
+    return AggregateLayer(runner, kb.get_schema_ddl, lambda: sqls, **kwargs)
+
+
+def _context():
+    from vanna.core.tool import ToolContext
+    from vanna.core.user import User
+
+    return ToolContext.model_construct(
+        user=User(id="analyst_1", group_memberships=["read_sales"]),
+        conversation_id="c1",
+        request_id="r1",
+        agent_memory=None,
+        metadata={},
+    )
+
+
+def _rows(df):
+    return sorted(tuple(round(v, 6) if isinstance(v, float) else v for v in row)
+                  for row in df.itertuples(index=False))
+
+
+def test_mining_plan():
+    """Summaries for the shared join shapes; unsupported aggregates are not analyzed"""
+    kb = _knowledge_base()
+    layer = _layer(None, kb)
+    for sql in (
+        "SELECT COUNT(DISTINCT customerkey) FROM factinternetsales",
+        "SELECT AVG(salesamount) FROM factinternetsales",
+        "SELECT SUM(salesamount - totalproductcost) FROM factinternetsales",
+        "WITH t AS (SELECT SUM(salesamount) s FROM factinternetsales) SELECT s FROM t",
+        "SELECT d.calendaryear, SUM(f.salesamount) FROM factinternetsales f LEFT JOIN dimdate d "
+        "ON f.orderdatekey = d.datekey GROUP BY d.calendaryear",
+        "SELECT salesordernumber, salesamount FROM factinternetsales",
+        "SELECT calendaryear, COUNT(*) FROM dimdate GROUP BY calendaryear",
+    ):
+        assert layer.analyze(sql) is None, sql
+
+    query = layer.analyze("SELECT d.calendaryear AS yr, SUM(f.salesamount) FROM factinternetsales f "
+                          "JOIN dimdate d ON f.orderdatekey = d.datekey WHERE d.monthnumberofyear = 12 "
+                          "GROUP BY d.calendaryear ORDER BY yr")
+    assert query.shape.joins == {("dimdate.datekey", "fact.orderdatekey")}
+    assert query.shape.columns == {"dimdate.calendaryear", "dimdate.monthnumberofyear"}
+    assert query.shape.measures == {"salesamount"}
+
+    plan = layer.plan()
+    for summary in plan:
+        logger.info(f"  {summary.name} (support {summary.support}): {summary.select_sql()}")
+    assert plan and all(s.support >= 2 for s in plan)
+    assert len({s.name for s in plan}) == len(plan)
+    sources = {(s.source, tuple(t for t in sorted(s.tables) if t.startswith("dim"))) for s in plan}
+    assert ("factinternetsales+factresellersales", ("dimdate",)) in sources
+    assert ("factinternetsales", ("dimdate",)) in sources
+
+
+def test_extra_joins_must_keep_fact_rows():
+    """A view with more joins than the query serves it only through NOT NULL foreign keys to primary keys"""
+    from aggregate_layer import SummaryTable
+
+    kb = _knowledge_base()
+    layer = _layer(None, kb)
+    total = layer.analyze("SELECT SUM(salesamount) FROM factinternetsales").shape
+    by_product = layer.analyze("SELECT p.color, SUM(f.salesamount) FROM factinternetsales f "
+                               "JOIN dimproduct p ON f.productkey = p.productkey GROUP BY p.color").shape
+
+    def view(*joins):
+        return SummaryTable(source="factinternetsales", joins=tuple(sorted(joins)),
+                            columns=("dimproduct.color",), measures=("salesamount",))
+
+    product = ("dimproduct.productkey", "fact.productkey")
+    promotion = ("dimpromotion.promotionkey", "fact.promotionkey")
+    subcategory = ("dimproduct.productsubcategorykey", "dimproductsubcategory.productsubcategorykey")
+    undeclared = ("dimcustomer.customerkey", "fact.salesterritorykey")
+    assert view(product).covers(by_product, layer.many_to_one)
+    assert view(product, promotion).covers(by_product, layer.many_to_one)  # FK promotionkey is NOT NULL
+    assert view(product).covers(total, layer.many_to_one)
+    # dimproduct.productsubcategorykey is nullable: the join drops products without a subcategory
+    assert not view(product, subcategory).covers(by_product, layer.many_to_one)
+    assert not view(product, subcategory).covers(total, layer.many_to_one)
+    # A join that is not a declared foreign key can drop or repeat rows
+    assert not view(product, undeclared).covers(by_product, layer.many_to_one)
+    assert not view(product).covers(total)  # no declared keys at all: joins must match
+
+    # Plans follow the same rule: a query's shape is not folded into a wider, lossy summary
+    layer = _layer(None, kb, training=False)
+    by_subcategory = ("SELECT s.englishproductsubcategoryname, SUM(f.salesamount) FROM factinternetsales f "
+                      "JOIN dimproduct p ON f.productkey = p.productkey JOIN dimproductsubcategory s "
+                      "ON p.productsubcategorykey = s.productsubcategorykey GROUP BY s.englishproductsubcategoryname")
+    for sql in [by_subcategory] * 2 + ["SELECT SUM(salesamount) FROM factinternetsales"] * 2:
+        layer.route(sql)
+    plan = layer.plan()
+    assert sorted(len(s.joins) for s in plan) == [0, 2]
+
+
+def test_rewrites_match_results():
+    """Each training query routed to a summary gives the same rows as on the fact tables"""
+    kb = _knowledge_base()
+    runner = SqliteRunner()
+    _load(runner, kb)
+    layer = _layer(runner, kb)
+    summaries = asyncio.run(layer.build())
+    assert summaries and all(not s["stale"] and s["rows"] for s in summaries.values())
+
+    async def scenario():
+        compared, skipped = 0, []
+        for pair in load_training_questions():
+            route = layer.route(pair["sql"])
+            if route.summary is None:
+                continue
+            from vanna.capabilities.sql_runner import RunSqlToolArgs
+            try:
+                expected = await runner.run_sql(RunSqlToolArgs(sql=pair["sql"]), _context())
+            except sqlite3.Error:
+                skipped.append(pair["sql"])  # Postgres-only functions (DATE_TRUNC, INTERVAL)
+                continue
+            actual = await runner.run_sql(RunSqlToolArgs(sql=route.sql), _context())
+            assert list(actual.columns) == list(expected.columns), (route.sql, list(actual.columns))
+            assert _rows(actual) == _rows(expected), route.sql
+            compared += 1
+        return compared, skipped
+
+    compared, skipped = asyncio.run(scenario())
+    logger.info(f"  {compared} routed queries match, {len(skipped)} skipped (Postgres-only SQL)")
+    REPORT["compared"] = compared
+    assert compared >= 15
+
+
+def test_speedup_per_query():
+    """Every rewritten query has a runtime on its summary and on the fact tables"""
+    kb = _knowledge_base()
+    runner = SqliteRunner()
+    _load(runner, kb)
+    layer = _layer(runner, kb)
+    asyncio.run(layer.build())
+
+    sqls = []
+    for pair in load_training_questions():
+        if layer.analyze(pair["sql"]) is None:
+            continue
+        try:
+            runner.conn.execute(pair["sql"])
+            sqls.append(pair["sql"])
+        except sqlite3.Error:
+            pass
+    results = asyncio.run(layer.benchmark(sqls))
+    for result in results:
+        logger.info(f"  {result['speedup']:.1f}x ({result['baseline_ms']:.1f} ms -> {result['avg_ms']:.2f} ms) "
+                    f"{result['sql'][:80]}")
+    stats = layer.get_stats()
+    REPORT["stats"] = stats
+    save_json_report(REPORT, "test_aggregate_layer_report.json")
+    assert len(results) >= 15 and all(r["speedup"] for r in results)
+    assert sum(r["baseline_ms"] for r in results) > 3 * sum(r["avg_ms"] for r in results)
+    assert all(s["rows"] <= 0.2 * s["source_rows"] for s in stats["summaries"])
+
+
+def test_stale_after_write():
+    """An INSERT into a fact table sends its queries back to the base tables until the refresh"""
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+    from aggregate_layer import AggregateRoutingSqlRunner
+
+    kb = _knowledge_base()
+    base = SqliteRunner()
+    _load(base, kb)
+    layer = _layer(base, kb)
+    asyncio.run(layer.build())
+    runner = AggregateRoutingSqlRunner(base, layer)
+    sql = "SELECT SUM(salesamount) as internet_revenue FROM factinternetsales"
+
+    async def scenario():
+        before = await runner.run_sql(RunSqlToolArgs(sql=sql), _context())
+        routed = base.executed[-1]
+        await runner.run_sql(RunSqlToolArgs(
+            sql="INSERT INTO factinternetsales (orderdatekey, productkey, salesamount, orderquantity) "
+                "VALUES (20130101, 1, 1000, 1)"), _context())
+        stale = await runner.run_sql(RunSqlToolArgs(sql=sql), _context())
+        unrouted = base.executed[-1]
+        await layer.build()
+        fresh = await runner.run_sql(RunSqlToolArgs(sql=sql), _context())
+        return before, routed, stale, unrouted, fresh, base.executed[-1]
+
+    before, routed, stale, unrouted, fresh, rerouted = asyncio.run(scenario())
+    assert routed.startswith("SELECT SUM(agg_factinternetsales_")
+    assert unrouted == sql
+    assert stale.iloc[0, 0] == fresh.iloc[0, 0] == before.iloc[0, 0] + 1000
+    assert rerouted == routed
+    assert layer.get_stats()["stale_skips"] == 1
+
+
+def test_query_log_and_fallback():
+    """Repeated shapes from the query log become a summary; a dropped summary falls back"""
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+    from aggregate_layer import AggregateRoutingSqlRunner
+
+    kb = _knowledge_base()
+    base = SqliteRunner()
+    _load(base, kb)
+    layer = _layer(base, kb, training=False)
+    runner = AggregateRoutingSqlRunner(base, layer)
+    sqls = [
+        "SELECT st.salesterritorygroup, SUM(f.orderquantity) units FROM factresellersales f "
+        "JOIN dimsalesterritory st ON f.salesterritorykey = st.salesterritorykey GROUP BY st.salesterritorygroup",
+        "select salesterritoryregion, count(*) from factresellersales r join dimsalesterritory t "
+        "on r.salesterritorykey = t.salesterritorykey group by salesterritoryregion order by 2 desc",
+    ]
+
+    async def scenario():
+        results = [await runner.run_sql(RunSqlToolArgs(sql=sql), _context()) for sql in sqls]
+        built = await layer.build()
+        routed = [await runner.run_sql(RunSqlToolArgs(sql=sql), _context()) for sql in sqls]
+        routed_sql = base.executed[-1]
+        base.conn.execute(f"DROP TABLE {next(iter(layer.summaries))}")
+        fallback = await runner.run_sql(RunSqlToolArgs(sql=sqls[1]), _context())
+        return results, built, routed, routed_sql, fallback
+
+    results, built, routed, routed_sql, fallback = asyncio.run(scenario())
+    logger.info(f"  Mined from the log: {list(built)} -> {routed_sql}")
+    assert len(built) == 1
+    assert routed_sql.startswith("select agg_factresellersales_") and "COALESCE(SUM(" in routed_sql
+    for expected, actual in zip(results, routed):
+        assert _rows(actual) == _rows(expected)
+    assert _rows(fallback) == _rows(results[1])
+    stats = layer.get_stats()
+    assert stats["fallbacks"] == 1 and stats["logged_shapes"] == 2
+
+
+class SharedLock:
+    """Stand-in for one AdvisoryLock per worker on the same key"""
+
+    def __init__(self, owners, worker):
+        self.owners, self.worker = owners, worker
+
+    async def try_acquire(self):
+        self.owners.setdefault("holder", self.worker)
+        return self.owners["holder"] == self.worker
+
+    async def release(self):
+        if self.owners.get("holder") == self.worker:
+            del self.owners["holder"]
+
+
+def test_single_builder_and_oversized():
+    """One worker builds the views, the others route onto them; too-large views are not rebuilt"""
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+    from aggregate_layer import AggregateRoutingSqlRunner
+
+    kb = _knowledge_base()
+    base = SqliteRunner()
+    _load(base, kb)
+    owners = {}
+    builder = _layer(base, kb, builder_lock=SharedLock(owners, "worker1"))
+    other = _layer(base, kb, builder_lock=SharedLock(owners, "worker2"))
+    ddl = ("CREATE", "REFRESH", "DROP", "COMMENT")
+    sql = next(pair["sql"] for pair in load_training_questions() if builder.analyze(pair["sql"]) is not None)
+
+    async def scenario():
+        built = await builder.build()
+        start = len(base.executed)
+        # The other worker's own query log would plan different views; it still only reads the builder's
+        for _ in range(3):
+            other.route("SELECT SUM(orderquantity) FROM factresellersales")
+        followed = await other.build()
+        other_statements = base.executed[start:]
+        routed = await AggregateRoutingSqlRunner(base, other).run_sql(RunSqlToolArgs(sql=sql), _context())
+        expected = await base.run_sql(RunSqlToolArgs(sql=sql), _context())
+
+        # The builder stops: the other worker takes over and refreshes the views instead of recreating them
+        await builder.stop()
+        start = len(base.executed)
+        await other.build()
+        takeover = base.executed[start:]
+        return built, followed, other_statements, routed, expected, takeover
+
+    built, followed, other_statements, routed, expected, takeover = asyncio.run(scenario())
+    logger.info(f"  Builder: {len(built)} views; follower: {len(followed)}; takeover ran {len(takeover)} statements")
+    assert built and set(followed) == set(built)
+    assert all(f["rows"] == built[name]["rows"] and not f["stale"] for name, f in followed.items())
+    assert not [s for s in other_statements if s.startswith(ddl)]
+    assert other.get_stats()["routed"] == 1 and _rows(routed) == _rows(expected)
+    # Only the view mined from its own log is new
+    created = [s.split()[6] for s in takeover if s.startswith("CREATE MATERIALIZED VIEW")]
+    assert other.leader and len(created) == 1 and created[0] not in built and created[0] in other.summaries
+    assert sum(s.startswith("REFRESH") for s in takeover) == len(set(built) & set(other.summaries))
+
+    # Views over max_row_ratio are dropped once and not planned again
+    base = SqliteRunner()
+    _load(base, kb)
+    layer = _layer(base, kb, max_row_ratio=0.0001)
+    first = asyncio.run(layer.build())
+    dropped = dict(layer.dropped)
+    start = len(base.executed)
+    second = asyncio.run(layer.build())
+    assert dropped and layer.oversized == set(dropped) and set(second) == set(first)
+    assert not [s for s in base.executed[start:] if s.startswith(("CREATE", "DROP"))]
+
+
+def main():
+    tests = [
+        test_mining_plan,
+        test_extra_joins_must_keep_fact_rows,
+        test_rewrites_match_results,
+        test_speedup_per_query,
+        test_stale_after_write,
+        test_query_log_and_fallback,
+        test_single_builder_and_oversized,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""
+Test the answer cache wired around the Agent
+Checks that repeated questions are served without calling the agent again,
+that keys include access groups (and the user, for answers that saved
+result files), and that TTL, LRU and knowledge base version changes
+invalidate entries.
+Logs results to: test/logs/test_answer_cache.log
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger
+
+# Setup logger
+logger, log_path = setup_logger("test_answer_cache", "test_answer_cache.log")
+
+
+class FakeAgent:
+    """Stands in for vanna.Agent: counts calls and stores the exchange"""
+
+    def __init__(self):
+        from vanna.integrations.local import MemoryConversationStore
+
+        self.calls = 0
+        self.saves_results = False
+        self.conversation_store = MemoryConversationStore()
+        self.user_resolver = self
+
+    async def resolve_user(self, request_context):
+        from vanna.core.user import User
+
+        role = request_context.get_cookie('role') or 'analyst'
+        groups = ['read_sales'] if role == 'analyst' else ['admin']
+        return User(id=request_context.get_cookie('user_id') or 'demo_user', group_memberships=groups)
+
+    async def send_message(self, request_context, message, *, conversation_id=None):
+        from vanna.core.storage import Conversation, Message
+
+        self.calls += 1
+        user = await self.resolve_user(request_context)
+        conversation = await self.conversation_store.get_conversation(conversation_id, user)
+        if conversation is None:
+            conversation = Conversation(id=conversation_id, user=user, messages=[])
+        conversation.add_message(Message(role="user", content=message))
+        if self.saves_results:
+            conversation.add_message(Message(role="tool", content="...\n\nResults saved to file: query_results_1.csv"))
+        conversation.add_message(Message(role="assistant", content=f"answer #{self.calls}"))
+        await self.conversation_store.update_conversation(conversation)
+        yield f"answer #{self.calls}"
+
+
+def _context(role="analyst", user_id="demo_user"):
+    from vanna.core.user import RequestContext
+
+    return RequestContext(cookies={"role": role, "user_id": user_id})
+
+
+async def _ask(agent, question, conversation_id, **ctx):
+    return [c async for c in agent.send_message(_context(**ctx), question, conversation_id=conversation_id)]
+
+
+def test_repeated_question_hits_cache():
+    """Second identical (normalized) question is served from the cache"""
+    from answer_cache import AnswerCache, CachedAgent
+
+    inner = FakeAgent()
+    agent = CachedAgent(inner, AnswerCache())
+
+    first = asyncio.run(_ask(agent, "What is our total revenue?", "conv_1"))
+    second = asyncio.run(_ask(agent, "  what is our TOTAL revenue ", "conv_2"))
+
+    logger.info(f"  Stats: {agent.cache.get_stats()}")
+    assert first == second == ["answer #1"]
+    assert inner.calls == 1
+    assert agent.cache.hits == 1 and agent.cache.misses == 1
+
+    # The cached exchange is recorded in the new conversation
+    from vanna.core.user import User
+    conv = asyncio.run(inner.conversation_store.get_conversation("conv_2", User(id="demo_user")))
+    assert [m.role for m in conv.messages] == ["user", "assistant"]
+
+
+def test_key_includes_groups_and_skips_follow_ups():
+    """Different access groups and follow-up turns bypass cached answers"""
+    from answer_cache import AnswerCache, CachedAgent
+
+    inner = FakeAgent()
+    agent = CachedAgent(inner, AnswerCache())
+
+    asyncio.run(_ask(agent, "What is our total revenue?", "conv_1"))
+    asyncio.run(_ask(agent, "What is our total revenue?", "conv_2", role="admin"))
+    assert inner.calls == 2
+
+    # Same conversation again: this is a follow-up, never cached
+    asyncio.run(_ask(agent, "What is our total revenue?", "conv_1"))
+    assert inner.calls == 3
+
+
+def test_result_files_are_cached_per_user():
+    """Answers that saved a result file are only replayed to the user who owns the file"""
+    from answer_cache import AnswerCache, CachedAgent
+
+    inner = FakeAgent()
+    inner.saves_results = True
+    agent = CachedAgent(inner, AnswerCache())
+
+    asyncio.run(_ask(agent, "Show me sales by product", "conv_1", user_id="alice"))
+    bob = asyncio.run(_ask(agent, "Show me sales by product", "conv_2", user_id="bob"))
+    alice = asyncio.run(_ask(agent, "Show me sales by product", "conv_3", user_id="alice"))
+
+    logger.info(f"  Stats: {agent.cache.get_stats()}")
+    assert bob == ["answer #2"]  # bob's run wrote his own file
+    assert alice == ["answer #1"]
+    assert inner.calls == 2
+    assert agent.cache.hits == 1 and agent.cache.misses == 2
+
+
+def test_ttl_lru_and_version_invalidation():
+    """Entries expire by TTL, are evicted LRU, and drop on a KB version change"""
+    from answer_cache import AnswerCache, CachedAnswer
+
+    version = {"value": "v1"}
+    cache = AnswerCache(max_entries=2, ttl_seconds=0.05, version_provider=lambda: version["value"])
+    keys = [(f"question {i}", ("read_sales",), "") for i in range(3)]
+
+    for key in keys:
+        cache.put(key, CachedAnswer(components=[key[0]], messages=[]))
+    assert cache.get(keys[0]) is None  # evicted (LRU)
+    assert cache.get(keys[2]) is not None
+    assert cache.evictions == 1
+
+    version["value"] = "v2"
+    assert cache.get(keys[2]) is None  # knowledge base changed
+    assert cache.invalidations == 1
+
+    cache.put(keys[1], CachedAnswer(components=[], messages=[]))
+    time.sleep(0.06)
+    assert cache.get(keys[1]) is None  # expired
+    logger.info(f"  Stats: {cache.get_stats()}")
+
+
+def main():
+    tests = [
+        test_repeated_question_hits_cache,
+        test_key_includes_groups_and_skips_follow_ups,
+        test_result_files_are_cached_per_user,
+        test_ttl_lru_and_version_invalidation,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,335 @@
+"""
+Test the columnar result encoding (columnar_results + StreamingRunSqlTool)
+1. encode/decode round-trips every column type, nulls included
+2. Slices share the result's buffers (zero-copy previews)
+3. The run_sql tool sends the UI preview as one columnar payload; only the
+   LLM's capped rows are converted back to a DataFrame
+4. Bytes on the wire and serialization CPU vs row dicts, for wide
+   dimension tables and a narrow fact result
+Logs results to: test/logs/test_columnar_results.log
+"""
+
+import asyncio
+import datetime
+import sys
+import tempfile
+import time
+from decimal import Decimal
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report
+from fake_postgres import FakeDatabase
+
+# Setup logger
+logger, log_path = setup_logger("test_columnar_results", "test_columnar_results.log")
+
+CUSTOMER_SQL = "SELECT * FROM dimcustomer"
+PRODUCT_SQL = "SELECT * FROM dimproduct"
+SALES_SQL = "SELECT orderdatekey, productkey, customerkey, orderquantity, salesamount FROM factinternetsales"
+
+OCCUPATIONS = ["Professional", "Management", "Skilled Manual", "Clerical", "Manual"]
+EDUCATION = ["Bachelors", "Partial College", "High School", "Graduate Degree", "Partial High School"]
+COLORS = ["Black", "Silver", "Red", "Yellow", "Blue", "Multi", None]
+
+
+def _customers(rows):
+    """Rows shaped like public.dimcustomer as psycopg2 returns them"""
+    columns = (
+        "customerkey", "geographykey", "customeralternatekey", "title", "firstname", "middlename", "lastname",
+        "namestyle", "birthdate", "maritalstatus", "suffix", "gender", "emailaddress", "yearlyincome",
+        "totalchildren", "numberchildrenathome", "englisheducation", "spanisheducation", "frencheducation",
+        "englishoccupation", "spanishoccupation", "frenchoccupation", "houseownerflag", "numbercarsowned",
+        "addressline1", "addressline2", "phone", "datefirstpurchase", "commutedistance",
+    )
+
+    def generate():
+        for i in range(rows):
+            education, occupation = EDUCATION[i % 5], OCCUPATIONS[i % 5]
+            yield (
+                11000 + i, 1 + i % 650, f"AW{11000 + i:08d}", None, f"First{i}", "A" if i % 3 else None,
+                f"Last{i % 400}", False, datetime.date(1950 + i % 40, 1 + i % 12, 1 + i % 28),
+                "MS"[i % 2], None, "MF"[i % 2], f"customer{i}@adventure-works.com",
+                Decimal(f"{10000 * (1 + i % 17)}.00"), i % 6, i % 4, education, education, education,
+                occupation, occupation, occupation, str(i % 2), i % 5, f"{1000 + i} Main St.",
+                None, f"1 (11) 500 555-{i % 10000:04d}", datetime.date(2011 + i % 3, 1 + i % 12, 1 + i % 28),
+                ["0-1 Miles", "1-2 Miles", "2-5 Miles", "5-10 Miles", "10+ Miles"][i % 5],
+            )
+
+    return columns, generate
+
+
+def _products(rows):
+    """Rows shaped like public.dimproduct"""
+    columns = (
+        "productkey", "productalternatekey", "productsubcategorykey", "weightunitmeasurecode",
+        "sizeunitmeasurecode", "englishproductname", "standardcost", "finishedgoodsflag", "color",
+        "safetystocklevel", "reorderpoint", "listprice", "size", "sizerange", "weight", "daystomanufacture",
+        "productline", "dealerprice", "class", "style", "modelname", "englishdescription", "startdate",
+        "enddate", "status",
+    )
+
+    def generate():
+        for i in range(rows):
+            yield (
+                1 + i, f"BK-R{i % 90:02d}B-{44 + i % 20}", 1 + i % 37, "LB" if i % 2 else None,
+                "CM" if i % 2 else None, f"Road-{150 + i % 9 * 100} {COLORS[i % 6]}, {44 + i % 20}",
+                Decimal(f"{100 + i % 2000}.{i % 100:02d}"), bool(i % 3), COLORS[i % 7], 500, 375,
+                Decimal(f"{300 + i % 3000}.99"), str(44 + i % 20), "42-46 CM", 14.68 + i % 10, i % 4,
+                "R ", Decimal(f"{200 + i % 1500}.59"), "H ", "U ", f"Road-{150 + i % 9 * 100}",
+                f"Top-of-the-line competition bike {i % 40}. Performance-enhancing options include the "
+                f"innovative HL Frame, super-smooth front suspension, and traction for all terrain.",
+                datetime.datetime(2011, 7, 1) + datetime.timedelta(days=i % 900),
+                datetime.datetime(2013, 6, 30) + datetime.timedelta(days=i % 4), "Current" if i % 4 else None,
+            )
+
+    return columns, generate
+
+
+def _sales(rows):
+    columns = ("orderdatekey", "productkey", "customerkey", "orderquantity", "salesamount")
+
+    def generate():
+        for i in range(rows):
+            yield 20130101 + i % 28, 214 + i % 150, 11000 + i % 18000, 1, Decimal(f"{(i % 3000) + 2}.29")
+
+    return columns, generate
+
+
+def _database(rows=1000):
+    db = FakeDatabase()
+    for sql, table in ((CUSTOMER_SQL, _customers), (PRODUCT_SQL, _products), (SALES_SQL, _sales)):
+        db.results[sql] = table(rows)
+    return db
+
+
+def _frame(sql, rows=1000):
+    import pandas as pd
+
+    columns, generate = _database(rows).results[sql]
+    return pd.DataFrame.from_records(list(generate()), columns=list(columns))
+
+
+def _context():
+    from vanna.core.tool import ToolContext
+    from vanna.core.user import User
+
+    return ToolContext.model_construct(
+        user=User(id="columnar_user", group_memberships=["read_sales"]),
+        conversation_id="c1",
+        request_id="r1",
+        agent_memory=None,
+        metadata={},
+    )
+
+
+def _args(sql):
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+
+    return RunSqlToolArgs(sql=sql)
+
+
+def _tool(db, workdir, **kwargs):
+    from vanna.integrations.local import LocalFileSystem
+    from postgres_pool import PooledPostgresRunner
+    from result_streaming import StreamingRunSqlTool
+
+    runner = PooledPostgresRunner(connection_factory=db.connect)
+    return StreamingRunSqlTool(sql_runner=runner, file_system=LocalFileSystem(workdir), **kwargs)
+
+
+def _sse(component):
+    """The SSE line routes.py writes for a component"""
+    from vanna.servers.base.models import ChatStreamChunk
+
+    chunk = ChatStreamChunk.from_component(component, "c1", "r1")
+    return f"data: {chunk.model_dump_json()}\n\n".encode("utf-8")
+
+
+def _same_values(decoded, original):
+    """Compare a decoded frame to the source frame, NUMERIC as float and dates as timestamps"""
+    import pandas as pd
+
+    for name in original.columns:
+        expected = original[name]
+        if expected.dtype == object and expected.dropna().map(lambda v: isinstance(v, Decimal)).all():
+            expected = pd.to_numeric(expected)
+        elif expected.dtype == object and expected.dropna().map(lambda v: isinstance(v, datetime.date)).all():
+            expected = pd.to_datetime(expected)
+        actual = decoded[name]
+        if not (expected.isna().to_numpy() == actual.isna().to_numpy()).all():
+            return f"{name}: nulls differ"
+        mask = expected.notna().to_numpy()
+        if not (expected[mask].to_numpy() == actual[mask].to_numpy()).all():
+            return f"{name}: values differ"
+    return None
+
+
+def test_round_trip():
+    import numpy as np
+    import pandas as pd
+    from columnar_results import ALIGNMENT, FORMAT, ColumnarResult
+
+    frames = {sql: _frame(sql, 300) for sql in (CUSTOMER_SQL, PRODUCT_SQL, SALES_SQL)}
+    frames["edge cases"] = pd.DataFrame({
+        "nullable_int": pd.array([1, None, -70000, 3], dtype="Int64"),
+        "small_float": [0.5, np.nan, -1e300, 2.0],
+        "all_null": [None, None, None, None],
+        "mixed": [1, "two", 3.5, None],
+        "flag": [True, None, False, True],
+        "utc": pd.to_datetime(["2013-01-01 10:00:00", None, "2014-06-30 23:59:59.123", "1969-12-31 00:00:00"],
+                              format="ISO8601", utc=True),
+        "unicode": ["Zürich", "東京", "", None],
+    })
+
+    for name, frame in frames.items():
+        result = ColumnarResult.from_frame(frame)
+        payload = result.encode()
+        assert payload["format"] == FORMAT and payload["rows"] == len(frame)
+        refs = [spec[key] for spec in payload["columns"] for key in ("validity", "offsets", "data") if key in spec]
+        assert all(offset % ALIGNMENT == 0 for offset, _ in refs)
+        decoded = ColumnarResult.decode(payload).to_frame()
+        assert list(decoded.columns) == list(frame.columns)
+        if name == "edge cases":
+            assert decoded["nullable_int"].tolist()[::2] == [1, -70000] and decoded["nullable_int"].isna()[1]
+            assert decoded["mixed"].tolist()[:3] == ["1", "two", "3.5"] and decoded["mixed"].isna()[3]
+            assert decoded["flag"].tolist() == [True, None, False, True]
+            assert decoded["utc"].iloc[2] == pd.Timestamp("2014-06-30 23:59:59.123")
+            assert decoded["unicode"].tolist()[:3] == ["Zürich", "東京", ""] and decoded["unicode"].isna()[3]
+            assert decoded["all_null"].isna().all() and np.isnan(decoded["small_float"][1])
+        else:
+            problem = _same_values(decoded, frame)
+            assert problem is None, f"{name}: {problem}"
+        logger.info(f"  {name}: {result.column_types()}")
+
+    try:
+        ColumnarResult.decode({"format": "arrow"})
+        assert False, "unknown format accepted"
+    except ValueError:
+        pass
+
+
+def test_slices_are_zero_copy():
+    import numpy as np
+    from columnar_results import ColumnarResult
+
+    result = ColumnarResult.from_frame(_frame(PRODUCT_SQL, 1000))
+    preview = result.slice(100, 125)
+    assert len(preview) == 25 and len(result.slice(990, 2000)) == 10
+    for full, part in zip(result.columns, preview.columns):
+        assert np.shares_memory(full.values, part.values), full.name
+        if full.valid is not None:
+            assert np.shares_memory(full.valid, part.valid)
+        assert part.dictionary is full.dictionary
+    # A slice of a slice is still a view of the original
+    nested = preview.slice(5, 10)
+    assert np.shares_memory(nested.columns[0].values, result.columns[0].values)
+    assert nested.to_frame()["productkey"].tolist() == [106, 107, 108, 109, 110]
+    assert nested.to_frame().equals(result.to_frame().iloc[105:110].reset_index(drop=True))
+
+
+def test_tool_sends_columnar_payload():
+    """Same preview as the row encoding, one payload instead of row dicts"""
+    from columnar_results import ColumnarDataFrameComponent, ColumnarResult
+
+    db = _database(rows=5000)
+    with tempfile.TemporaryDirectory() as workdir:
+        columnar_tool = _tool(db, workdir, llm_row_cap=10, ui_row_cap=1000, result_encoding="columnar")
+        rows_tool = _tool(db, workdir, llm_row_cap=10, ui_row_cap=1000)
+        context = _context()
+        columnar = asyncio.run(columnar_tool.execute(context, _args(CUSTOMER_SQL)))
+        rows = asyncio.run(rows_tool.execute(context, _args(CUSTOMER_SQL)))
+
+    assert columnar.success, columnar.error
+    component = columnar.ui_component.rich_component
+    assert isinstance(component, ColumnarDataFrameComponent)
+    assert component.rows == [] and component.row_count == 5000 and component.column_count == 29
+    assert component.column_types["yearlyincome"] == "float" and component.column_types["birthdate"] == "date"
+    assert "results" not in columnar.metadata and columnar.metadata["encoding"] == "columnar"
+    assert columnar.metadata["summary"] == rows.metadata["summary"]
+
+    import pandas as pd
+    decoded = ColumnarResult.decode(component.serialize_for_frontend()["data"]["columnar"]).to_frame()
+    assert len(decoded) == 1000
+    problem = _same_values(decoded, pd.DataFrame(rows.metadata["results"]))
+    assert problem is None, problem
+
+    llm_lines = columnar.result_for_llm.split("\n\n")[0].splitlines()
+    assert llm_lines[0] == rows.result_for_llm.splitlines()[0]  # same header
+    assert "Showing the first 10 of 5000 rows" in columnar.result_for_llm
+    stats = columnar_tool.get_stats()
+    assert stats["result_encoding"] == "columnar" and stats["encoded_results"] == 1 and stats["encoded_bytes"] > 0
+    assert rows_tool.get_stats()["encoded_results"] == 0
+
+    try:
+        _tool(db, ".", result_encoding="parquet")
+        assert False, "unknown encoding accepted"
+    except ValueError:
+        pass
+
+
+def test_wire_bytes_and_cpu():
+    """SSE bytes and serialization CPU for a 1000-row UI preview, row dicts vs columnar"""
+    from vanna.components import DataFrameComponent
+    from columnar_results import ColumnarDataFrameComponent, ColumnarResult
+
+    def rows_line(frame):
+        records = frame.to_dict("records")
+        return _sse(DataFrameComponent.from_records(records=records, title="Query Results"))
+
+    def columnar_line(frame):
+        result = ColumnarResult.from_frame(frame)
+        return _sse(ColumnarDataFrameComponent(
+            rows=[], columns=result.names, column_types=result.column_types(), title="Query Results",
+            row_count=len(result), column_count=len(result.names), columnar=result.encode(),
+        ))
+
+    def cpu_ms(encode, frame, repeat=10):
+        start = time.process_time()
+        for _ in range(repeat):
+            encode(frame)
+        return (time.process_time() - start) * 1000 / repeat
+
+    report = {}
+    for name, sql in (("dimcustomer", CUSTOMER_SQL), ("dimproduct", PRODUCT_SQL), ("factinternetsales", SALES_SQL)):
+        frame = _frame(sql, 1000)
+        rows_bytes, columnar_bytes = len(rows_line(frame)), len(columnar_line(frame))
+        report[name] = {
+            "columns": len(frame.columns),
+            "rows_bytes": rows_bytes,
+            "columnar_bytes": columnar_bytes,
+            "bytes_ratio": round(rows_bytes / columnar_bytes, 1),
+            "rows_cpu_ms": round(cpu_ms(rows_line, frame), 2),
+            "columnar_cpu_ms": round(cpu_ms(columnar_line, frame), 2),
+        }
+        logger.info(f"  {name}: {report[name]}")
+
+    save_json_report({"ui_preview_rows": 1000, "tables": report}, "test_columnar_results_report.json")
+    for name, stats in report.items():
+        assert stats["columnar_bytes"] * 4 < stats["rows_bytes"], name
+        assert stats["columnar_cpu_ms"] < stats["rows_cpu_ms"], name
+
+
+def main():
+    tests = [
+        test_round_trip,
+        test_slices_are_zero_copy,
+        test_tool_sends_columnar_payload,
+        test_wire_bytes_and_cpu,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
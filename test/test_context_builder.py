@@ -0,0 +1,80 @@
+"""
+Test question-relevant context assembly (ContextBuilder)
+Checks table selection with FK joins, the token budget and per-request stats
+over all training questions.
+Logs results to: test/logs/test_context_builder.log
+"""
+
+import sys
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report, load_training_questions
+
+# Setup logger
+logger, log_path = setup_logger("test_context_builder", "test_context_builder.log")
+
+
+def _builder(**kwargs):
+    from knowledge_base import KnowledgeBase
+    from context_builder import ContextBuilder
+
+    kb = KnowledgeBase()
+    kb.load_all()
+    return ContextBuilder(kb, **kwargs)
+
+
+def test_relevant_tables_and_joins():
+    """Tables come from the question and nearest examples, plus FK-joined tables"""
+    builder = _builder()
+    context, stats = builder.build("Internet sales amount by calendar year")
+
+    logger.info(f"  Tables: {stats.tables}")
+    assert stats.tables[:2] == ["factinternetsales", "dimdate"]
+    assert "=== EXAMPLE QUERIES ===" in context
+    assert "CREATE TABLE public.dimemployee" not in context
+
+    primary, joined = builder.select_tables("reseller sales by reseller", [])
+    assert "factresellersales" in primary
+    assert all(name not in primary for name in joined)
+
+
+def test_budget_and_stats_over_training_questions():
+    """Every training question fits the budget and saves tokens vs the full context"""
+    builder = _builder(token_budget=2000)
+    results = []
+    for q in load_training_questions():
+        _, stats = builder.build(q['question'])
+        assert stats.context_tokens <= stats.token_budget, (q['question'], stats)
+        results.append({"question": q['question'], "tables": stats.tables,
+                        "context_tokens": stats.context_tokens, "tokens_saved": stats.tokens_saved})
+
+    summary = builder.get_stats()
+    logger.info(f"  Full context: {summary['full_context_tokens']} tokens, "
+                f"avg selected: {summary['avg_context_tokens']:.0f} tokens, "
+                f"saved: {summary['total_tokens_saved']} tokens over {summary['requests']} requests")
+    save_json_report({"summary": summary, "questions": results}, "test_context_builder_report.json")
+    assert summary['avg_context_tokens'] < summary['full_context_tokens'] / 2
+
+
+def main():
+    tests = [
+        test_relevant_tables_and_joins,
+        test_budget_and_stats_over_training_questions,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+"""
+Test the direct answer fast path in front of the Agent
+1. Near-verbatim training questions are answered by the run_sql tool with
+   no agent/LLM call, in the components an agent turn ends with, and the
+   exchange is recorded for follow-ups
+2. Group/category allowlists, loose matches and tool errors go to the agent
+3. Latency of direct answers over every training question
+Logs results to: test/logs/test_direct_answer.log
+"""
+
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report, load_training_questions
+from fake_postgres import FakeDatabase
+
+# Setup logger
+logger, log_path = setup_logger("test_direct_answer", "test_direct_answer.log")
+
+LLM_LATENCY = 0.5  # seconds for an agent (LLM) turn
+QUERY_LATENCY = 0.005  # seconds per warehouse query
+
+
+class FakeAgent:
+    """Stands in for vanna.Agent: counts calls and takes LLM_LATENCY per answer"""
+
+    def __init__(self):
+        from vanna.integrations.local import MemoryConversationStore
+
+        self.calls = 0
+        self.conversation_store = MemoryConversationStore()
+        self.user_resolver = self
+
+    async def resolve_user(self, request_context):
+        from vanna.core.user import User
+
+        role = request_context.get_cookie('role') or 'analyst'
+        groups = ['read_sales'] if role == 'analyst' else ['admin']
+        return User(id=request_context.get_cookie('user_id') or 'demo_user', group_memberships=groups)
+
+    async def send_message(self, request_context, message, *, conversation_id=None):
+        self.calls += 1
+        await asyncio.sleep(LLM_LATENCY)
+        yield f"llm answer #{self.calls}"
+
+
+_kb_instance = None
+
+
+def _kb():
+    global _kb_instance
+    if _kb_instance is None:
+        from knowledge_base import KnowledgeBase
+
+        _kb_instance = KnowledgeBase()
+    return _kb_instance
+
+
+def _direct_agent(db, workdir, groups="read_sales=*;admin=*", **kwargs):
+    from direct_answer import DirectAnswerAgent, parse_group_allowlist
+    from postgres_pool import PooledPostgresRunner
+    from result_streaming import StreamingRunSqlTool
+    from vanna.integrations.local import LocalFileSystem
+
+    runner = PooledPostgresRunner(connection_factory=db.connect, max_size=4)
+    tool = StreamingRunSqlTool(sql_runner=runner, file_system=LocalFileSystem(workdir))
+    inner = FakeAgent()
+    return DirectAnswerAgent(inner, tool, _kb(), allowlist=parse_group_allowlist(groups), **kwargs), inner
+
+
+async def _ask(agent, question, conversation_id="conv_1", role="analyst"):
+    from vanna.core.user import RequestContext
+
+    context = RequestContext(cookies={"role": role, "user_id": "demo_user"})
+    return [c async for c in agent.send_message(context, question, conversation_id=conversation_id)]
+
+
+def test_parse_allowlist():
+    from direct_answer import parse_group_allowlist
+
+    assert parse_group_allowlist("read_sales=sales_overview, time_analysis;admin=*; ops") == {
+        "read_sales": {"sales_overview", "time_analysis"}, "admin": None, "ops": None,
+    }
+    assert parse_group_allowlist("") == {}
+
+
+def test_known_question_bypasses_llm():
+    """The stored SQL runs through the tool; the UI gets a table, status and text; history is recorded"""
+    from vanna.components import DataFrameComponent, RichTextComponent, StatusBarUpdateComponent
+    from vanna.core.user import User
+
+    question = load_training_questions()[0]
+    with tempfile.TemporaryDirectory() as workdir:
+        agent, inner = _direct_agent(FakeDatabase(latency=QUERY_LATENCY), workdir)
+        start = time.perf_counter()
+        components = asyncio.run(_ask(agent, question["question"].upper() + "?"))
+        elapsed = time.perf_counter() - start
+
+        rich = [c.rich_component for c in components]
+        assert inner.calls == 0
+        assert isinstance(rich[0], DataFrameComponent)
+        assert any(isinstance(r, StatusBarUpdateComponent) and r.status == "idle" for r in rich)
+        assert isinstance(rich[-1], RichTextComponent) and question["sql"] in rich[-1].content
+
+        user = User(id="demo_user", group_memberships=["read_sales"])
+        conversation = asyncio.run(inner.conversation_store.get_conversation("conv_1", user))
+        roles = [m.role for m in conversation.messages]
+        assert roles == ["user", "assistant", "tool", "assistant"]
+        assert conversation.messages[1].tool_calls[0].arguments == {"sql": question["sql"]}
+        assert conversation.messages[2].tool_call_id == conversation.messages[1].tool_calls[0].id
+        assert "Results saved to file" in conversation.messages[2].content
+
+    logger.info(f"  Direct answer in {elapsed * 1000:.1f} ms: {agent.get_stats()}")
+    assert elapsed < LLM_LATENCY / 5
+
+
+def test_fallbacks_to_agent():
+    """Categories outside the allowlist, loose matches and tool errors are answered by the agent"""
+    questions = load_training_questions()
+    question = questions[0]
+    other = next(q for q in questions if q["category"] != question["category"])
+    with tempfile.TemporaryDirectory() as workdir:
+        db = FakeDatabase(latency=QUERY_LATENCY)
+        agent, inner = _direct_agent(db, workdir, groups=f"read_sales={question['category']}")
+
+        assert asyncio.run(_ask(agent, other["question"])) == ["llm answer #1"]  # category not allowed
+        assert asyncio.run(_ask(agent, question["question"], role="admin")) == ["llm answer #2"]  # group not listed
+        assert asyncio.run(_ask(agent, "what about last year compared to my other numbers")) == ["llm answer #3"]
+        db.fail_sql.add(question["sql"])
+        assert asyncio.run(_ask(agent, question["question"])) == ["llm answer #4"]  # tool error
+        # Short and partial questions are not answered with a longer stored question's SQL
+        for i, vague in enumerate(("sales", "products", "total sales", "Show me sales by product"), start=5):
+            assert asyncio.run(_ask(agent, vague)) == [f"llm answer #{i}"], vague
+
+        stats = agent.get_stats()
+        logger.info(f"  {stats}")
+        assert stats["direct_answers"] == 0 and stats["not_allowed"] == 2 and stats["fallbacks"] == 1
+
+
+def test_latency_over_training_questions():
+    """Every training question is answered directly, in milliseconds instead of an LLM round trip"""
+    questions = load_training_questions()
+    with tempfile.TemporaryDirectory() as workdir:
+        agent, inner = _direct_agent(FakeDatabase(latency=QUERY_LATENCY), workdir)
+
+        async def run_all():
+            timings = []
+            for i, q in enumerate(questions):
+                start = time.perf_counter()
+                await _ask(agent, q["question"], conversation_id=f"conv_{i}")
+                timings.append((time.perf_counter() - start) * 1000)
+            return timings
+
+        timings = sorted(asyncio.run(run_all()))
+
+    stats = agent.get_stats()
+    report = {
+        "questions": len(questions),
+        "p50_ms": timings[len(timings) // 2],
+        "p95_ms": timings[int(len(timings) * 0.95)],
+        "max_ms": timings[-1],
+        "stats": stats,
+    }
+    logger.info(f"  {len(questions)} questions: p50 {report['p50_ms']:.1f} ms, p95 {report['p95_ms']:.1f} ms")
+    save_json_report(report, "test_direct_answer_report.json")
+    assert inner.calls == 0 and stats["direct_answers"] == len(questions)
+    assert report["p95_ms"] < 50
+
+
+def main():
+    tests = [
+        test_parse_allowlist,
+        test_known_question_bypasses_llm,
+        test_fallbacks_to_agent,
+        test_latency_over_training_questions,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""
+Test conversation history compaction
+Checks that recent turns stay verbatim, that old SQL results lose their row
+dumps but keep summary stats and the result file, that the oldest turns are
+collapsed when the history is still too large, that compaction is cached
+per conversation so each turn is compacted only once over a long session,
+and that sessions sharing an opening question share a bounded cache.
+Logs results to: test/logs/test_history_compaction.log
+"""
+
+import sys
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report
+
+# Setup logger
+logger, log_path = setup_logger("test_history_compaction", "test_history_compaction.log")
+
+SYSTEM = {"role": "system", "content": "You are a helpful data analyst."}
+
+
+def _sql_result(rows: int) -> str:
+    """Tool output in the StreamingRunSqlTool format"""
+    csv = "\n".join(["year,amount"] + [f"{2000 + n},{n * 1234.5}" for n in range(min(rows, 25))])
+    return (
+        f"{csv}\n(Showing the first 25 of {rows} rows. THE NEXT STEP SHOULD BE A VISUALIZE_DATA CALL)\n\n"
+        f"Summary: {rows} rows, 2 columns\n- year: min=2000, max={1999 + rows}, mean=2010, nulls=0\n\n"
+        f"Results saved to file: query_results_{rows:08x}.csv\n\n"
+        f"**IMPORTANT: FOR VISUALIZE_DATA USE FILENAME: query_results_{rows:08x}.csv**"
+    )
+
+
+def _turn(i: int, rows: int = 500):
+    return [
+        {"role": "user", "content": f"question {i}"},
+        {"role": "assistant", "content": None, "tool_calls": [{
+            "id": f"call_{i}", "type": "function",
+            "function": {"name": "run_sql", "arguments": f'{{"sql": "SELECT year, amount\\nFROM t{i}"}}'},
+        }]},
+        {"role": "tool", "tool_call_id": f"call_{i}", "content": _sql_result(rows) + "\n" + "x" * 2000},
+        {"role": "assistant", "content": f"Sales peaked in year {i}."},
+    ]
+
+
+def _session(turns: int):
+    return [SYSTEM] + [m for i in range(turns) for m in _turn(i)] + [{"role": "user", "content": "next question"}]
+
+
+def _compactor(**kwargs):
+    from history_compaction import HistoryCompactor
+    from token_budget import get_token_counter
+
+    return HistoryCompactor(counter=get_token_counter("estimate"), **kwargs)
+
+
+def test_recent_turns_verbatim_old_results_elided():
+    """Recent turns are untouched; old SQL results keep header, a few rows, summary and file"""
+    compactor = _compactor(keep_recent_turns=2, max_history_tokens=10**6)
+    messages = _session(5)
+    compacted = compactor.compact(messages)
+
+    assert compacted[0] == SYSTEM and compacted[-1] == messages[-1]
+    assert compacted[-9:] == messages[-9:]  # two recent turns + current question
+    assert len(compacted) == len(messages)
+    old_result = compacted[3]["content"]
+    logger.info(f"  Elided result:\n{old_result}")
+    assert old_result.startswith("year,amount\n2000,0.0")
+    assert "Summary: 500 rows, 2 columns" in old_result
+    assert "Results saved to file: query_results_000001f4.csv" in old_result
+    assert "2010,12345.0" not in old_result
+    assert len(old_result) < len(messages[3]["content"]) / 5
+    assert compacted[2] == messages[2]  # tool call kept with its result
+
+
+def test_oldest_turns_collapsed_over_budget():
+    """Past max_history_tokens the oldest turns collapse to question + SQL + answer"""
+    compactor = _compactor(keep_recent_turns=2, max_history_tokens=600)
+    compacted = compactor.compact(_session(8))
+
+    collapsed = [m for m in compacted if (m.get("content") or "").startswith("(Earlier turn, compacted)")]
+    logger.info(f"  Collapsed turns: {len(collapsed)}")
+    assert collapsed and compacted[2] == collapsed[0]
+    assert "Ran SQL: SELECT year, amount FROM t0" in collapsed[0]["content"]
+    assert "Answer: Sales peaked in year 0." in collapsed[0]["content"]
+    for i, msg in enumerate(compacted):
+        if msg["role"] == "tool":
+            ids = [tc["id"] for tc in compacted[i - 1].get("tool_calls") or []]
+            assert msg["tool_call_id"] in ids, "tool result without its call"
+
+
+def test_incremental_over_long_session():
+    """Each turn is compacted once; later requests reuse the conversation's cache"""
+    compactor = _compactor(keep_recent_turns=3, max_history_tokens=4000)
+    history = [SYSTEM]
+    sizes = []
+    for i in range(30):
+        messages = history + [{"role": "user", "content": f"question {i}"}]
+        compacted = compactor.compact(messages)
+        sizes.append({"turn": i, "messages_chars": sum(len(m.get("content") or "") for m in messages),
+                      "compacted_chars": sum(len(m.get("content") or "") for m in compacted)})
+        history += _turn(i)
+
+    # A second, unrelated conversation gets its own cache
+    compactor.compact([SYSTEM] + [m for i in range(5) for m in _turn(100 + i)] + [{"role": "user", "content": "q"}])
+
+    stats = compactor.get_stats()
+    logger.info(f"  {stats}")
+    save_json_report({"stats": stats, "turns": sizes}, "test_history_compaction_report.json")
+    assert stats["turns_compacted"] == 26 + 2
+    assert stats["conversations"] == 2
+    assert stats["cache_hits"] > stats["turns_compacted"] * 5
+    assert sizes[-1]["compacted_chars"] < sizes[-1]["messages_chars"] / 5
+    # Prompt size levels off instead of growing with the session
+    assert sizes[-1]["compacted_chars"] < 2 * sizes[10]["compacted_chars"]
+
+
+def test_shared_opening_question_is_bounded():
+    """Sessions that open with the same question share one bucket, capped at max_turns_per_conversation"""
+    compactor = _compactor(keep_recent_turns=1, max_history_tokens=10**6, max_turns_per_conversation=10)
+    for session in range(20):
+        turns = [_turn(0)] + [_turn(1000 * session + k) for k in range(1, 4)]
+        compactor.compact([SYSTEM] + [m for turn in turns for m in turn] + [{"role": "user", "content": "q"}])
+
+    stats = compactor.get_stats()
+    logger.info(f"  {stats}")
+    assert stats["conversations"] == 1
+    assert stats["cached_turns"] == 10
+    assert stats["turns_compacted"] == 1 + 20 * 2  # the shared opening turn is compacted once
+
+
+def main():
+    tests = [
+        test_recent_turns_verbatim_old_results_elided,
+        test_oldest_turns_collapsed_over_budget,
+        test_incremental_over_long_session,
+        test_shared_opening_question_is_bounded,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+Test the precompiled, memory-mapped knowledge base artifact
+1. The artifact answers exactly like the JSON path (context, version, search)
+2. Sections load lazily; samples.json is never decoded
+3. The retrieval index arrays are backed by the mapping (shared, read-only)
+4. A stale artifact is ignored
+5. Startup benchmark: JSON parsing vs mapping the artifact
+Logs results to: test/logs/test_kb_artifact.log
+"""
+
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report, load_training_questions
+
+# Setup logger
+logger, log_path = setup_logger("test_kb_artifact", "test_kb_artifact.log")
+
+ROOT = Path(__file__).parent.parent
+TRAINING_DATA = ROOT / "training_data"
+
+
+def _compile(workdir: Path, training_data: Path = TRAINING_DATA) -> Path:
+    from kb_artifact import compile_artifact
+
+    return compile_artifact(str(training_data), str(workdir / "knowledge_base.kba"))
+
+
+def _kb(artifact_path, training_data: Path = TRAINING_DATA):
+    from knowledge_base import KnowledgeBase
+
+    kb = KnowledgeBase(str(training_data), artifact_path=str(artifact_path) if artifact_path else "")
+    kb.load_all()
+    return kb
+
+
+def test_artifact_matches_json():
+    """Same system context, version, stats and search results as parsing the JSON"""
+    with tempfile.TemporaryDirectory() as workdir:
+        artifact = _compile(Path(workdir))
+        mapped, parsed = _kb(artifact), _kb(None)
+
+        assert mapped._artifact is not None and parsed._artifact is None
+        assert mapped.get_system_context() == parsed.get_system_context()
+        assert mapped.get_version() == parsed.get_version()
+        assert mapped.get_stats() == parsed.get_stats()
+        for q in load_training_questions():
+            expected = [(h.score, h.document.text) for h in parsed.search(q['question'], k=5)]
+            assert [(h.score, h.document.text) for h in mapped.search(q['question'], k=5)] == expected
+            assert mapped.find_similar_question(q['question']) == parsed.find_similar_question(q['question'])
+
+
+def test_sections_load_lazily_and_index_is_mapped():
+    """Only the sections a caller touches are decoded; index arrays live in the mapping"""
+    from context_builder import ContextBuilder
+
+    with tempfile.TemporaryDirectory() as workdir:
+        kb = _kb(_compile(Path(workdir)))
+        assert kb._cache.loaded_sections() == []
+
+        kb.search("internet sales by year")
+        kb.get_system_context()
+        assert kb._cache.loaded_sections() == []
+
+        builder = ContextBuilder(kb)
+        builder.build("internet sales by year")
+        loaded = kb._cache.loaded_sections()
+        logger.info(f"  Sections decoded after a context build: {loaded}")
+        assert "samples" not in loaded
+
+        ids, weights = next(iter(kb._index.bm25._postings.values()))
+        assert not ids.flags.writeable and not ids.flags.owndata
+
+        # Precomputed token counts match counting at startup
+        assert builder._full_tokens == ContextBuilder(_kb(None))._full_tokens
+
+
+def test_stale_artifact_is_ignored():
+    """Editing a training file makes the loader fall back to the JSON files"""
+    with tempfile.TemporaryDirectory() as workdir:
+        training_data = Path(workdir) / "training_data"
+        shutil.copytree(TRAINING_DATA, training_data)
+        artifact = _compile(Path(workdir), training_data)
+        assert _kb(artifact, training_data)._artifact is not None
+
+        with open(training_data / "documentation.json", "a") as f:
+            f.write("\n")
+        kb = _kb(artifact, training_data)
+        assert kb._artifact is None
+        assert kb.get_stats() == _kb(None).get_stats()
+
+
+def _startup_ms(artifact_path, runs: int = 15) -> dict:
+    """Median time to load, build the system context and answer the first search"""
+    load, first_request = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        kb = _kb(artifact_path)
+        loaded = time.perf_counter()
+        kb.get_system_context()
+        kb.search("internet sales by year", k=5)
+        done = time.perf_counter()
+        load.append((loaded - start) * 1000)
+        first_request.append((done - start) * 1000)
+    return {"load_ms": statistics.median(load), "first_search_ms": statistics.median(first_request)}
+
+
+def _cold_process_ms(artifact_path, runs: int = 5) -> float:
+    """Median time for a fresh interpreter (nothing warmed up) to load the knowledge base"""
+    code = (
+        "import time; from knowledge_base import KnowledgeBase; t = time.perf_counter(); "
+        f"kb = KnowledgeBase(artifact_path={str(artifact_path or '')!r}); kb.load_all(); "
+        "kb.get_system_context(); kb.search('internet sales by year'); "
+        "print((time.perf_counter() - t) * 1000)"
+    )
+    times = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", code], cwd=str(ROOT), capture_output=True, text=True, check=True)
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return statistics.median(times)
+
+
+def test_startup_benchmark():
+    """Mapping the artifact starts faster than parsing training_data/"""
+    with tempfile.TemporaryDirectory() as workdir:
+        artifact = _compile(Path(workdir))
+        json_path = _startup_ms(None)
+        mapped = _startup_ms(artifact)
+        json_cold = _cold_process_ms(None)
+        mapped_cold = _cold_process_ms(artifact)
+
+    logger.info(f"  JSON:     load {json_path['load_ms']:.2f} ms, first search {json_path['first_search_ms']:.2f} ms, "
+                f"cold process {json_cold:.1f} ms")
+    logger.info(f"  Artifact: load {mapped['load_ms']:.2f} ms, first search {mapped['first_search_ms']:.2f} ms, "
+                f"cold process {mapped_cold:.1f} ms")
+    save_json_report({
+        "json": {**json_path, "cold_process_ms": json_cold},
+        "artifact": {**mapped, "cold_process_ms": mapped_cold},
+    }, "test_kb_artifact_report.json")
+    assert mapped["load_ms"] < json_path["load_ms"] / 2
+    assert mapped["first_search_ms"] < json_path["first_search_ms"]
+
+
+def main():
+    tests = [
+        test_artifact_matches_json,
+        test_sections_load_lazily_and_index_is_mapped,
+        test_stale_artifact_is_ignored,
+        test_startup_benchmark,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
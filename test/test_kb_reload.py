@@ -0,0 +1,224 @@
+"""
+Test hot reload of training_data
+1. Only the changed file is re-parsed and only dependent structures rebuilt
+2. Invalid JSON leaves the live knowledge base untouched
+3. Reloading while requests are served swaps atomically with no latency spike
+4. The file watcher picks up an edit; dependent caches are invalidated
+5. Cancelling a reload, waiting or mid-parse, never leaves the lock taken
+Logs results to: test/logs/test_kb_reload.log
+"""
+
+import asyncio
+import json
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report
+
+# Setup logger
+logger, log_path = setup_logger("test_kb_reload", "test_kb_reload.log")
+
+TRAINING_DATA = Path(__file__).parent.parent / "training_data"
+NEW_QUESTION = "How many gift wrapped orders shipped to Canada last quarter?"
+
+
+def _copy_training_data(workdir: str) -> Path:
+    target = Path(workdir) / "training_data"
+    shutil.copytree(TRAINING_DATA, target)
+    return target
+
+
+def _kb(training_data: Path):
+    from knowledge_base import KnowledgeBase
+
+    kb = KnowledgeBase(str(training_data), artifact_path="")
+    kb.load_all()
+    return kb
+
+
+def _add_question(training_data: Path, question: str = NEW_QUESTION) -> None:
+    path = training_data / "queries.json"
+    data = json.loads(path.read_text(encoding="utf-8"))
+    data["question_sql_pairs"].insert(0, {"question": question, "sql": "SELECT COUNT(*) FROM factinternetsales"})
+    path.write_text(json.dumps(data, indent=2), encoding="utf-8")
+
+
+def test_only_changed_sections_are_rebuilt():
+    """Editing queries.json re-parses it alone and rebuilds context + index"""
+    with tempfile.TemporaryDirectory() as workdir:
+        training_data = _copy_training_data(workdir)
+        kb = _kb(training_data)
+        version = kb.get_version()
+        schema, samples = kb.get_cache()["schema"], kb.get_cache()["samples"]
+
+        assert kb.reload() == []  # nothing changed
+        _add_question(training_data)
+        update = kb.prepare_reload()
+        assert update.changed_sections == ["queries"]
+        assert update.cache["schema"] is schema and update.cache["samples"] is samples
+        kb.apply_reload(update)
+
+        assert kb.get_version() != version
+        assert NEW_QUESTION in kb.get_system_context()
+        assert kb.find_similar_question(NEW_QUESTION)["question"] == NEW_QUESTION
+
+        # samples.json changes nothing that is derived
+        index = kb._index
+        with open(training_data / "samples.json", "a") as f:
+            f.write("\n")
+        assert kb.reload() == ["samples"] and kb._index is index
+
+
+def test_invalid_json_keeps_live_state():
+    """A half-written file does not replace the working knowledge base"""
+    with tempfile.TemporaryDirectory() as workdir:
+        training_data = _copy_training_data(workdir)
+        kb = _kb(training_data)
+        version, context = kb.get_version(), kb.get_system_context()
+
+        (training_data / "documentation.json").write_text('{"business_terms": [', encoding="utf-8")
+        assert kb.reload() == []
+        assert kb.get_version() == version and kb.get_system_context() == context
+
+
+def test_reload_under_load_has_no_latency_spike():
+    """Requests keep being served, each seeing either the old or the new knowledge base"""
+    from context_builder import ContextBuilder
+
+    with tempfile.TemporaryDirectory() as workdir:
+        training_data = _copy_training_data(workdir)
+        kb = _kb(training_data)
+        builder = ContextBuilder(kb)
+        kb.add_reload_listener(lambda changed: builder.refresh())
+
+        seen_new = []
+
+        async def serve(latencies, stop):
+            while not stop.is_set():
+                start = time.perf_counter()
+                hit = kb.find_similar_question(NEW_QUESTION)
+                builder.build("internet sales by year")
+                latencies.append((time.perf_counter() - start) * 1000)
+                # Once the new knowledge base is visible it never goes back
+                is_new = bool(hit) and hit["question"] == NEW_QUESTION
+                assert is_new or not seen_new
+                if is_new:
+                    seen_new.append(True)
+                await asyncio.sleep(0.001)
+
+        async def scenario():
+            baseline, during = [], []
+            stop = asyncio.Event()
+            task = asyncio.create_task(serve(baseline, stop))
+            await asyncio.sleep(0.3)
+            stop.set()
+            await task
+
+            stop = asyncio.Event()
+            task = asyncio.create_task(serve(during, stop))
+            await asyncio.sleep(0.05)
+            _add_question(training_data)
+            changed = await kb.reload_async()
+            await asyncio.sleep(0.05)
+            stop.set()
+            await task
+            return baseline, during, changed
+
+        baseline, during, changed = asyncio.run(scenario())
+
+    result = {
+        "baseline_p50_ms": statistics.median(baseline),
+        "baseline_max_ms": max(baseline),
+        "during_reload_p50_ms": statistics.median(during),
+        "during_reload_max_ms": max(during),
+        "requests_during_reload": len(during),
+    }
+    logger.info(f"  {result}")
+    save_json_report(result, "test_kb_reload_report.json")
+    assert changed == ["queries"]
+    assert kb.find_similar_question(NEW_QUESTION)["question"] == NEW_QUESTION
+    assert result["during_reload_max_ms"] < max(25.0, 5 * result["baseline_max_ms"])
+
+
+def test_watcher_reloads_and_invalidates_caches():
+    """An edited file is picked up by the watcher and the answer cache is cleared"""
+    from answer_cache import AnswerCache, CachedAnswer
+    from knowledge_base import KnowledgeBaseWatcher
+
+    with tempfile.TemporaryDirectory() as workdir:
+        training_data = _copy_training_data(workdir)
+        kb = _kb(training_data)
+        cache = AnswerCache(version_provider=kb.get_version)
+        cache.put(("q", ()), CachedAnswer(components=[], messages=[]))
+        kb.add_reload_listener(lambda changed: cache.invalidate())
+
+        async def scenario():
+            watcher = KnowledgeBaseWatcher(kb, interval=0.05)
+            watcher.start()
+            _add_question(training_data)
+            deadline = time.monotonic() + 5
+            while kb.reloads == 0 and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            await watcher.stop()
+
+        asyncio.run(scenario())
+        assert kb.reloads == 1
+        assert cache.get(("q", ())) is None
+
+
+def test_cancelled_reload_releases_lock():
+    """A reload cancelled while waiting for the lock, or while parsing, does not block later reloads"""
+    with tempfile.TemporaryDirectory() as workdir:
+        training_data = _copy_training_data(workdir)
+        kb = _kb(training_data)
+
+        async def scenario():
+            kb._reload_lock.acquire()  # a reload in another thread
+            waiting = asyncio.ensure_future(kb.reload_async())
+            await asyncio.sleep(0.1)
+            waiting.cancel()
+            await asyncio.gather(waiting, return_exceptions=True)
+            kb._reload_lock.release()
+
+            _add_question(training_data)
+            parsing = asyncio.ensure_future(kb.reload_async())
+            await asyncio.sleep(0)  # cancelled while prepare_reload runs on its thread
+            parsing.cancel()
+            await asyncio.gather(parsing, return_exceptions=True)
+            return await asyncio.wait_for(kb.reload_async(), timeout=10)
+
+        changed = asyncio.run(scenario())
+        assert not kb._reload_lock.locked()
+        # The cancelled reload's parse was never applied, so the next one picks the edit up
+        assert changed == ["queries"] and kb.find_similar_question(NEW_QUESTION)["question"] == NEW_QUESTION
+
+
+def main():
+    tests = [
+        test_only_changed_sections_are_rebuilt,
+        test_invalid_json_keeps_live_state,
+        test_reload_under_load_has_no_latency_spike,
+        test_watcher_reloads_and_invalidates_caches,
+        test_cancelled_reload_releases_lock,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+"""
+Test that Azure OpenAI calls do not block the event loop
+Runs N parallel chats against a local fake Azure OpenAI endpoint and checks
+they complete in about the time of a single call.
+Logs results to: test/logs/test_llm_concurrency.log
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger
+from fake_azure_openai import FakeAzureOpenAIServer
+
+# Setup logger
+logger, log_path = setup_logger("test_llm_concurrency", "test_llm_concurrency.log")
+
+DELAY = 0.5  # seconds per fake completion
+PARALLEL_CHATS = 10
+
+
+def _make_request(question: str):
+    from vanna.core.llm import LlmRequest, LlmMessage
+    from vanna.core.user import User
+
+    return LlmRequest(
+        messages=[LlmMessage(role="user", content=question)],
+        user=User(id="demo_user", group_memberships=["read_sales"]),
+    )
+
+
+def _make_service(endpoint: str, use_sync_client: bool = False):
+    from azure_openai_llm import AzureOpenAILlmService
+
+    return AzureOpenAILlmService(
+        model="gpt-4",
+        api_key="test-key",
+        azure_endpoint=endpoint,
+        api_version="2024-02-15-preview",
+        use_sync_client=use_sync_client,
+        max_retries=0,
+    )
+
+
+async def _timed_parallel(coro_factory, n: int) -> float:
+    start = time.perf_counter()
+    await asyncio.gather(*(coro_factory(i) for i in range(n)))
+    return time.perf_counter() - start
+
+
+def test_parallel_send_requests():
+    """N parallel send_request calls finish in about the time of one"""
+    with FakeAzureOpenAIServer(delay=DELAY) as server:
+        llm = _make_service(server.endpoint)
+
+        async def one(i):
+            resp = await llm.send_request(_make_request(f"question {i}"))
+            assert resp.content == "fake answer"
+
+        elapsed = asyncio.run(_timed_parallel(one, PARALLEL_CHATS))
+        logger.info(f"  {PARALLEL_CHATS} parallel send_request calls: {elapsed:.2f}s (one call: {DELAY:.2f}s)")
+
+        assert server.request_count == PARALLEL_CHATS
+        assert elapsed < DELAY * 3, f"calls serialized: {elapsed:.2f}s"
+
+
+def test_parallel_stream_requests():
+    """N parallel stream_request calls finish in about the time of one"""
+    with FakeAzureOpenAIServer(delay=DELAY, content="total revenue is 42") as server:
+        llm = _make_service(server.endpoint)
+
+        async def one(i):
+            text = ""
+            async for chunk in llm.stream_request(_make_request(f"question {i}")):
+                text += chunk.content or ""
+            assert text.strip() == "total revenue is 42"
+
+        elapsed = asyncio.run(_timed_parallel(one, PARALLEL_CHATS))
+        logger.info(f"  {PARALLEL_CHATS} parallel stream_request calls: {elapsed:.2f}s")
+
+        assert elapsed < DELAY * 3, f"streams serialized: {elapsed:.2f}s"
+
+
+def test_event_loop_stays_responsive():
+    """A slow completion does not freeze other coroutines (e.g. /health)"""
+    with FakeAzureOpenAIServer(delay=DELAY) as server:
+        llm = _make_service(server.endpoint)
+
+        async def scenario():
+            call = asyncio.create_task(llm.send_request(_make_request("slow question")))
+            start = time.perf_counter()
+            await asyncio.sleep(0.05)
+            tick = time.perf_counter() - start
+            await call
+            return tick
+
+        tick = asyncio.run(scenario())
+        logger.info(f"  Event loop tick during LLM call: {tick * 1000:.1f}ms")
+        assert tick < DELAY / 2
+
+
+def test_sync_client_fallback():
+    """The opt-in sync client still runs calls in parallel via worker threads"""
+    with FakeAzureOpenAIServer(delay=DELAY) as server:
+        llm = _make_service(server.endpoint, use_sync_client=True)
+
+        async def one(i):
+            resp = await llm.send_request(_make_request(f"question {i}"))
+            assert resp.content == "fake answer"
+            text = ""
+            async for chunk in llm.stream_request(_make_request(f"question {i}")):
+                text += chunk.content or ""
+            assert text.strip() == "fake answer"
+
+        elapsed = asyncio.run(_timed_parallel(one, 4))
+        logger.info(f"  4 parallel chats on sync fallback: {elapsed:.2f}s")
+        assert elapsed < DELAY * 2 * 3
+
+
+def main():
+    tests = [
+        test_parallel_send_requests,
+        test_parallel_stream_requests,
+        test_event_loop_stays_responsive,
+        test_sync_client_fallback,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,313 @@
+"""
+Test deadlines, retries, hedging and circuit breaking of Azure OpenAI calls
+Runs AzureOpenAILlmService with a ResilientCaller against the local fake
+endpoint with injected 429/5xx errors and latency:
+1. 429s are retried after their Retry-After; 4xx request errors are not
+2. The deadline bounds the whole call, retries included, and the body of
+   a stream that stalls mid-response
+3. A call slower than the deployment's p95 is hedged to a second deployment,
+   but time spent queued for rate-limit quota is not counted as latency
+4. Repeated failures open the circuit: calls fail fast (or go straight to
+   the hedge deployment) until a probe succeeds
+5. A half-open probe that times out reopens the circuit, and one that is
+   cancelled lets the next call probe, so the circuit never stays stuck
+Logs results to: test/logs/test_llm_resilience.log
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report
+from fake_azure_openai import FakeAzureOpenAIServer
+
+# Setup logger
+logger, log_path = setup_logger("test_llm_resilience", "test_llm_resilience.log")
+
+REPORT = {}
+
+
+def _request(question="total sales"):
+    from vanna.core.llm import LlmRequest, LlmMessage
+    from vanna.core.user import User
+
+    return LlmRequest(
+        messages=[LlmMessage(role="user", content=question)],
+        user=User(id="demo_user", group_memberships=["read_sales"]),
+    )
+
+
+def _service(server, hedge=False, **policy):
+    from azure_openai_llm import AzureOpenAILlmService
+    from llm_resilience import ResilientCaller
+
+    policy.setdefault("backoff_base", 0.01)
+    return AzureOpenAILlmService(
+        model="gpt-4",
+        api_key="test-key",
+        azure_endpoint=server.endpoint,
+        api_version="2024-10-21",
+        resilience=ResilientCaller(**policy),
+        hedge_model="gpt-4-hedge" if hedge else None,
+    )
+
+
+async def _timed(coro):
+    start = time.perf_counter()
+    result = await coro
+    return result, time.perf_counter() - start
+
+
+def test_retry_after_is_honored():
+    """Two 429s with Retry-After 0.3s: the call succeeds after waiting them out"""
+    with FakeAzureOpenAIServer(faults=[{"status": 429, "retry_after": 0.3}] * 2) as server:
+        llm = _service(server, max_retries=3)
+        response, elapsed = asyncio.run(_timed(llm.send_request(_request())))
+        stats = llm.resilience.get_stats()
+
+    logger.info(f"  Succeeded after {elapsed * 1000:.0f} ms: {stats}")
+    REPORT["retry_after"] = {"elapsed_ms": elapsed * 1000, "stats": stats}
+    assert response.content == "fake answer"
+    assert server.request_count == 3 and stats["retries"] == 2 and stats["retry_after_waits"] == 2
+    assert elapsed >= 0.6
+
+
+def test_request_errors_not_retried():
+    """A 400 fails at once, without retries or breaker failures"""
+    import openai
+
+    with FakeAzureOpenAIServer(faults=[{"status": 400}]) as server:
+        llm = _service(server, max_retries=3)
+        try:
+            asyncio.run(llm.send_request(_request()))
+            raise AssertionError("400 did not raise")
+        except openai.BadRequestError:
+            pass
+    stats = llm.resilience.get_stats()
+    assert server.request_count == 1 and stats["retries"] == 0
+    assert stats["targets"]["primary"]["consecutive_failures"] == 0
+
+
+def test_deadline_bounds_the_call():
+    """A stalled region or a Retry-After past the deadline ends the call at the deadline"""
+    from llm_resilience import DeadlineExceededError
+
+    for fault in ({"delay": 3.0}, {"status": 429, "retry_after": 5.0}):
+        with FakeAzureOpenAIServer(faults=[fault]) as server:
+            llm = _service(server, deadline_seconds=0.5, max_retries=3)
+            start = time.perf_counter()
+            try:
+                asyncio.run(llm.send_request(_request()))
+                raise AssertionError("deadline not enforced")
+            except DeadlineExceededError:
+                elapsed = time.perf_counter() - start
+        logger.info(f"  {fault}: gave up after {elapsed * 1000:.0f} ms")
+        assert elapsed < 0.9
+        assert llm.resilience.get_stats()["deadline_exceeded"] == 1
+
+    # The stream opens in time, then stops sending events
+    with FakeAzureOpenAIServer(faults=[{"stall": 3.0}]) as server:
+        llm = _service(server, deadline_seconds=0.5, max_retries=3)
+        received = []
+
+        async def stalled():
+            async for chunk in llm.stream_request(_request()):
+                received.append(chunk)
+
+        start = time.perf_counter()
+        try:
+            asyncio.run(stalled())
+            raise AssertionError("stream deadline not enforced")
+        except DeadlineExceededError:
+            elapsed = time.perf_counter() - start
+    logger.info(f"  Stalled stream: gave up after {elapsed * 1000:.0f} ms, {len(received)} chunks received")
+    assert received and elapsed < 0.9
+    assert llm.resilience.get_stats()["deadline_exceeded"] == 1 and server.request_count == 1
+
+
+def test_slow_call_is_hedged():
+    """Once p95 is known, a call stuck on the primary is answered by the hedge deployment"""
+    with FakeAzureOpenAIServer(model_delays={"gpt-4": 0.02}) as server:
+        llm = _service(server, hedge=True, hedge_min_samples=10, hedge_min_delay=0.05)
+
+        async def scenario():
+            for _ in range(12):
+                await llm.send_request(_request())
+            server.add_faults({"model": "gpt-4", "delay": 2.0})
+            response, hedged = await _timed(llm.send_request(_request()))
+            assert response.content == "fake answer"
+
+            server.add_faults({"model": "gpt-4", "delay": 2.0})
+            start = time.perf_counter()
+            chunks = [chunk async for chunk in llm.stream_request(_request())]
+            streamed = time.perf_counter() - start
+            assert "".join(c.content or "" for c in chunks).strip() == "fake answer"
+            return hedged, streamed
+
+        hedged, streamed = asyncio.run(scenario())
+        stats = llm.resilience.get_stats()
+
+    logger.info(f"  Hedged call {hedged * 1000:.0f} ms, hedged stream {streamed * 1000:.0f} ms "
+                f"(primary stalled 2000 ms): {stats}")
+    REPORT["hedging"] = {"hedged_call_ms": hedged * 1000, "hedged_stream_ms": streamed * 1000, "stats": stats}
+    assert stats["hedges"] == 2 and stats["hedge_wins"] == 2
+    assert server.models.count("gpt-4-hedge") == 2
+    assert hedged < 0.5 and streamed < 0.5
+
+
+class _QueueingQuota:
+    """Stands in for QuotaScheduler: every acquire waits `wait` seconds"""
+
+    def __init__(self):
+        self.wait = 0.0
+        self.acquired = []
+
+    def estimate_tokens(self, payload):
+        return 1
+
+    async def acquire(self, user_id, tokens, priority=None, key=None):
+        await asyncio.sleep(self.wait)
+        self.acquired.append(key)
+
+
+def test_quota_wait_is_not_latency():
+    """Queueing for quota happens before the attempt is timed, so it triggers no hedges"""
+    with FakeAzureOpenAIServer(model_delays={"gpt-4": 0.02}) as server:
+        llm = _service(server, hedge=True, hedge_min_samples=10, hedge_min_delay=0.05)
+        quota = llm.rate_limiter = _QueueingQuota()
+
+        async def scenario():
+            for _ in range(10):
+                await llm.send_request(_request())
+            quota.wait = 0.3  # the deployment's quota is busy
+            _, queued = await _timed(llm.send_request(_request()))
+            return queued
+
+        queued = asyncio.run(scenario())
+        stats = llm.resilience.get_stats()
+
+    logger.info(f"  Call queued for quota took {queued * 1000:.0f} ms: {stats}")
+    assert queued >= 0.3
+    assert stats["hedges"] == 0 and server.models.count("gpt-4-hedge") == 0
+    assert stats["targets"]["primary"]["p95_ms"] < 200
+    assert quota.acquired == ["gpt-4"] * 11
+
+
+def test_circuit_breaker():
+    """Consecutive 500s open the circuit; calls then fail fast until a probe succeeds"""
+    from llm_resilience import CircuitOpenError
+
+    with FakeAzureOpenAIServer(faults=[{"status": 500}] * 3) as server:
+        llm = _service(server, max_retries=0, failure_threshold=3, reset_seconds=0.3)
+
+        async def scenario():
+            for _ in range(3):
+                try:
+                    await llm.send_request(_request())
+                except Exception as e:
+                    assert not isinstance(e, CircuitOpenError)
+            sent = server.request_count
+            start = time.perf_counter()
+            try:
+                await llm.send_request(_request())
+                raise AssertionError("circuit did not open")
+            except CircuitOpenError:
+                fast_fail = time.perf_counter() - start
+            assert server.request_count == sent
+            await asyncio.sleep(0.35)
+            response = await llm.send_request(_request())  # half-open probe
+            return fast_fail, response
+
+        fast_fail, response = asyncio.run(scenario())
+        stats = llm.resilience.get_stats()
+
+    logger.info(f"  Fast failure in {fast_fail * 1000:.2f} ms: {stats}")
+    REPORT["circuit_breaker"] = {"fast_fail_ms": fast_fail * 1000, "stats": stats}
+    assert fast_fail < 0.01 and response.content == "fake answer"
+    assert stats["targets"]["primary"]["state"] == "closed" and stats["targets"]["primary"]["opened"] == 1
+
+    # With a hedge deployment, failures fail over and an open primary is skipped
+    with FakeAzureOpenAIServer(faults=[{"status": 503, "model": "gpt-4"}] * 3) as server:
+        llm = _service(server, hedge=True, max_retries=0, failure_threshold=3, reset_seconds=60)
+
+        async def failover():
+            return [(await llm.send_request(_request())).content for _ in range(5)]
+
+        assert asyncio.run(failover()) == ["fake answer"] * 5
+        assert server.models == ["gpt-4", "gpt-4-hedge"] * 3 + ["gpt-4-hedge"] * 2
+        assert llm.resilience.get_stats()["targets"]["primary"]["state"] == "open"
+
+
+def test_abandoned_probe_releases_breaker():
+    """A probe that times out reopens the circuit; a cancelled probe hands probing to the next call"""
+    from llm_resilience import CircuitOpenError, DeadlineExceededError
+
+    with FakeAzureOpenAIServer(faults=[{"status": 503}, {"delay": 2.0}, {"delay": 2.0}]) as server:
+        llm = _service(server, max_retries=0, failure_threshold=1, reset_seconds=0.1, deadline_seconds=0.3)
+        breaker = llm.resilience.breaker("primary")
+
+        async def scenario():
+            try:
+                await llm.send_request(_request())
+            except Exception as e:
+                assert not isinstance(e, CircuitOpenError)
+            assert breaker.state == "open"
+
+            await asyncio.sleep(0.15)
+            try:
+                await llm.send_request(_request())  # half-open probe stalls past the deadline
+                raise AssertionError("deadline not enforced")
+            except DeadlineExceededError:
+                pass
+            timed_out = breaker.state
+
+            await asyncio.sleep(0.15)
+            probe = asyncio.ensure_future(llm.send_request(_request()))  # this probe's caller goes away
+            await asyncio.sleep(0.05)
+            probe.cancel()
+            try:
+                await probe
+            except asyncio.CancelledError:
+                pass
+            cancelled = breaker.state
+
+            response = await llm.send_request(_request())
+            return timed_out, cancelled, response
+
+        timed_out, cancelled, response = asyncio.run(scenario())
+        stats = llm.resilience.get_stats()
+
+    logger.info(f"  After timed-out probe: {timed_out}, after cancelled probe: {cancelled}: {stats}")
+    assert timed_out == "open" and cancelled == "half_open"
+    assert response.content == "fake answer" and stats["targets"]["primary"]["state"] == "closed"
+    save_json_report(REPORT, "test_llm_resilience_report.json")
+
+
+def main():
+    tests = [
+        test_retry_after_is_honored,
+        test_request_errors_not_retried,
+        test_deadline_bounds_the_call,
+        test_slow_call_is_hedged,
+        test_quota_wait_is_not_latency,
+        test_circuit_breaker,
+        test_abandoned_probe_releases_breaker,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,231 @@
+"""
+Test routing of LLM requests across several Azure OpenAI deployments
+Runs LlmRouter over AzureOpenAILlmService instances against the local fake
+endpoint, one deployment name per tier:
+1. Training questions go to the cheapest deployment of their difficulty's
+   tier; unknown questions, large prompts and tool-result summaries follow
+   their own rules
+2. The latency strategy follows the live latency EWMA of each deployment
+3. Errors fall back to the next qualified deployment; a deployment that
+   keeps failing cools down
+4. Cost of routing the training questions vs sending all of them to the
+   strongest deployment
+Logs results to: test/logs/test_llm_router.log
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report, load_training_questions
+from fake_azure_openai import FakeAzureOpenAIServer
+
+# Setup logger
+logger, log_path = setup_logger("test_llm_router", "test_llm_router.log")
+
+# name, tier, prompt cost, completion cost (per 1k tokens)
+DEPLOYMENTS = [
+    ("gpt-4o-mini", 1, 0.15, 0.6),
+    ("gpt-4o", 2, 2.5, 10.0),
+    ("gpt-4", 3, 30.0, 60.0),
+]
+
+_kb_instance = None
+
+
+def _kb():
+    global _kb_instance
+    if _kb_instance is None:
+        from knowledge_base import KnowledgeBase
+
+        _kb_instance = KnowledgeBase()
+    return _kb_instance
+
+
+def _request(question, tool_result=None):
+    from vanna.core.llm import LlmRequest, LlmMessage
+    from vanna.core.user import User
+
+    messages = [LlmMessage(role="user", content=question)]
+    if tool_result is not None:
+        messages.append(LlmMessage(role="tool", content=tool_result, tool_call_id="call_1"))
+    return LlmRequest(messages=messages, user=User(id="demo_user", group_memberships=["read_sales"]))
+
+
+def _router(server, deployments=DEPLOYMENTS, **kwargs):
+    from azure_openai_llm import AzureOpenAILlmService
+    from llm_router import Deployment, LlmRouter, RequestClassifier
+
+    return LlmRouter(
+        [
+            Deployment(
+                name=name, tier=tier, prompt_cost=prompt_cost, completion_cost=completion_cost,
+                service=AzureOpenAILlmService(
+                    model=name, api_key="test-key", azure_endpoint=server.endpoint,
+                    api_version="2024-10-21", max_retries=0,
+                ),
+            )
+            for name, tier, prompt_cost, completion_cost in deployments
+        ],
+        classifier=RequestClassifier(_kb()),
+        **kwargs,
+    )
+
+
+def _question(difficulty):
+    return next(q["question"] for q in load_training_questions() if q.get("difficulty") == difficulty)
+
+
+def test_parse_deployments():
+    from llm_router import parse_deployments
+
+    assert parse_deployments("gpt-4o-mini:1:0.15:0.6, gpt-4:3:30:60:8192") == [
+        {"name": "gpt-4o-mini", "tier": 1, "prompt_cost": 0.15, "completion_cost": 0.6},
+        {"name": "gpt-4", "tier": 3, "prompt_cost": 30.0, "completion_cost": 60.0, "context_window": 8192},
+    ]
+    assert parse_deployments("") == []
+
+
+def test_routes_by_difficulty():
+    """Simple/medium/complex questions, unknown questions, summaries and large prompts"""
+    with FakeAzureOpenAIServer() as server:
+        router = _router(server)
+
+        async def scenario():
+            for request in (
+                _request(_question("simple")),
+                _request(_question("medium")),
+                _request(_question("complex")),
+                _request("write me a poem about the weather"),
+                _request("write me a poem about the weather", tool_result="region,total\nNorth,42"),
+                _request(_question("simple") + " " + "padding " * 40000),
+            ):
+                response = await router.send_request(request)
+                assert response.content == "fake answer"
+            # Streaming is routed the same way
+            chunks = [c async for c in router.stream_request(_request(_question("simple")))]
+            assert "".join(c.content or "" for c in chunks).strip() == "fake answer"
+
+        asyncio.run(scenario())
+        stats = router.get_stats()
+
+    logger.info(f"  Routed to {server.models}: {stats['by_required_tier']}")
+    assert server.models == ["gpt-4o-mini", "gpt-4o", "gpt-4", "gpt-4", "gpt-4o", "gpt-4o", "gpt-4o-mini"]
+    assert stats["fallbacks"] == 0
+
+
+def test_latency_strategy():
+    """Among deployments of the same tier, the one with the lower latency EWMA wins"""
+    deployments = [("gpt-4-eastus", 3, 30.0, 60.0), ("gpt-4-westus", 3, 30.0, 60.0)]
+    with FakeAzureOpenAIServer(model_delays={"gpt-4-eastus": 0.15, "gpt-4-westus": 0.02}) as server:
+        router = _router(server, deployments, strategy="latency")
+
+        async def scenario():
+            for _ in range(10):
+                await router.send_request(_request("write me a poem about the weather"))
+
+        asyncio.run(scenario())
+        stats = router.get_stats()
+
+    logger.info(f"  {server.models}: {stats['deployments']}")
+    # Both are measured once, then the faster one takes every request
+    assert server.models[:2] == ["gpt-4-eastus", "gpt-4-westus"]
+    assert server.models[2:] == ["gpt-4-westus"] * 8
+    assert stats["deployments"]["gpt-4-westus"]["latency_ewma_ms"] < stats["deployments"]["gpt-4-eastus"]["latency_ewma_ms"]
+
+
+def test_fallback_and_cooldown():
+    """A failing deployment falls back to the next qualified one and cools down after repeated errors"""
+    with FakeAzureOpenAIServer(faults=[{"status": 500, "model": "gpt-4o-mini"}] * 3) as server:
+        router = _router(server, max_consecutive_errors=3, cooldown_seconds=60)
+
+        async def scenario():
+            answers = []
+            for _ in range(4):
+                answers.append((await router.send_request(_request(_question("simple")))).content)
+            chunks = [c async for c in router.stream_request(_request(_question("medium")))]
+            answers.append("".join(c.content or "" for c in chunks).strip())
+            return answers
+
+        answers = asyncio.run(scenario())
+        stats = router.get_stats()
+
+    logger.info(f"  {server.models}: {stats}")
+    assert answers == ["fake answer"] * 5
+    assert server.models == ["gpt-4o-mini", "gpt-4o"] * 3 + ["gpt-4o", "gpt-4o"]
+    assert stats["fallbacks"] == 3 and stats["deployments"]["gpt-4o-mini"]["cooling_down"]
+
+    # With no other deployment left, the error reaches the caller
+    import openai
+
+    with FakeAzureOpenAIServer(faults=[{"status": 500}] * 3) as server:
+        router = _router(server, deployments=DEPLOYMENTS[2:])
+        try:
+            asyncio.run(router.send_request(_request(_question("complex"))))
+            raise AssertionError("error was swallowed")
+        except openai.InternalServerError:
+            pass
+
+
+def test_cost_of_routing():
+    """Estimated cost of the training questions: routed vs always the strongest deployment"""
+    from llm_router import RequestClassifier
+
+    questions = load_training_questions()
+    with FakeAzureOpenAIServer() as server:
+        router = _router(server)
+        classifier = RequestClassifier(_kb())
+        strongest = router.deployments[-1]
+        baseline = sum(router.estimated_cost(strongest, classifier.classify(_request(q["question"])).prompt_tokens)
+                       for q in questions)
+
+        async def scenario():
+            for q in questions:
+                await router.send_request(_request(q["question"]))
+
+        asyncio.run(scenario())
+        stats = router.get_stats()
+
+    routed = sum(d["estimated_cost"] for d in stats["deployments"].values())
+    report = {
+        "questions": len(questions),
+        "by_deployment": {name: d["requests"] for name, d in stats["deployments"].items()},
+        "routed_cost": routed,
+        "strongest_only_cost": baseline,
+        "saving": 1 - routed / baseline,
+    }
+    logger.info(f"  {report}")
+    save_json_report(report, "test_llm_router_report.json")
+    counts = {}
+    for q in questions:
+        counts[q["difficulty"]] = counts.get(q["difficulty"], 0) + 1
+    assert report["by_deployment"] == {"gpt-4o-mini": counts["simple"], "gpt-4o": counts["medium"],
+                                       "gpt-4": counts["complex"]}
+    assert routed < baseline / 2
+
+
+def main():
+    tests = [
+        test_parse_deployments,
+        test_routes_by_difficulty,
+        test_latency_strategy,
+        test_fallback_and_cooldown,
+        test_cost_of_routing,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
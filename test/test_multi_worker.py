@@ -0,0 +1,196 @@
+"""
+Test the multi-worker production launcher (serve.py)
+1. Load test: requests/second with 1 worker vs N workers (N = CPU count, capped at 4)
+2. Every worker builds its own knowledge base after it starts
+3. SIGTERM drains an in-flight SSE stream before the server exits
+4. An admin action served by one worker runs in every worker
+Logs results to: test/logs/test_multi_worker.log
+"""
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report
+
+# Setup logger
+logger, log_path = setup_logger("test_multi_worker", "test_multi_worker.log")
+
+ROOT = Path(__file__).parent.parent
+CPU_MS = 20          # CPU time per request
+DURATION = 3.0       # seconds of load per measurement
+CLIENTS_PER_WORKER = 4
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start(workers: int):
+    port = _free_port()
+    code = (
+        "import serve; "
+        f"serve.run('fake_chat_app:app', host='127.0.0.1', port={port}, workers={workers}, graceful_timeout=10)"
+    )
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([str(ROOT), str(ROOT / "test")]), "LOG_LEVEL": "warning"}
+    proc = subprocess.Popen([sys.executable, "-c", code], cwd=str(ROOT), env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            # Wait until every worker answers
+            if len({requests.get(f"{base}/health", timeout=1).json()["pid"] for _ in range(workers * 8)}) >= workers:
+                return proc, base
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    proc.kill()
+    raise AssertionError(f"server with {workers} workers did not start: {proc.stderr.read().decode()[-500:]}")
+
+
+def _stop(proc) -> int:
+    proc.send_signal(signal.SIGTERM)
+    try:
+        return proc.wait(timeout=20)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        return -1
+
+
+def _load(base: str, clients: int):
+    """Closed-loop load: each client sends the next request when the last one finishes"""
+    counts = [0] * clients
+    pids = set()
+    stop = time.monotonic() + DURATION
+
+    def client(i):
+        session = requests.Session()
+        while time.monotonic() < stop:
+            body = session.get(f"{base}/api/vanna/v2/chat_sse", params={"cpu_ms": CPU_MS}, timeout=30).text
+            assert body.endswith("data: [DONE]\n\n")
+            pids.add(body.split('"pid": ')[1].split(",")[0])
+            counts[i] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts) / DURATION, pids
+
+
+def test_rps_scales_with_workers():
+    """Throughput grows with workers when there are cores to run them"""
+    cores = os.cpu_count() or 1
+    worker_counts = sorted({1, max(2, min(4, cores))})
+    results = []
+    for workers in worker_counts:
+        proc, base = _start(workers)
+        try:
+            rps, pids = _load(base, CLIENTS_PER_WORKER * workers)
+        finally:
+            _stop(proc)
+        results.append({"workers": workers, "rps": round(rps, 1), "workers_seen": len(pids)})
+        logger.info(f"  {workers} worker(s): {rps:.1f} req/s from {len(pids)} process(es)")
+
+    scaling = results[-1]["rps"] / results[0]["rps"]
+    logger.info(f"  Scaling {results[0]['workers']} -> {results[-1]['workers']} workers: {scaling:.2f}x on {cores} core(s)")
+    save_json_report({"cores": cores, "cpu_ms_per_request": CPU_MS, "results": results, "scaling": scaling},
+                     "test_multi_worker_report.json")
+    assert all(r["workers_seen"] == r["workers"] for r in results)
+    if cores >= results[-1]["workers"]:
+        # Near-linear: at least 70% of ideal
+        assert scaling >= 0.7 * results[-1]["workers"], scaling
+    else:
+        logger.info("  Not enough cores to measure scaling; checked that every worker serves traffic")
+
+
+def test_workers_build_their_own_knowledge_base():
+    """The knowledge base is built inside each worker, not in the supervisor"""
+    proc, base = _start(2)
+    try:
+        health = [requests.get(f"{base}/health", timeout=5).json() for _ in range(20)]
+        for _ in range(20):
+            requests.get(f"{base}/api/vanna/v2/chat_sse", params={"cpu_ms": 1}, timeout=5)
+        health += [requests.get(f"{base}/health", timeout=5).json() for _ in range(20)]
+    finally:
+        _stop(proc)
+    built = {h["pid"]: h["kb_built_in"] for h in health if h["kb_built_in"]}
+    logger.info(f"  KB built in: {built}, supervisor pid: {proc.pid}")
+    assert built and all(pid == built_in for pid, built_in in built.items())
+    assert proc.pid not in built
+
+
+def test_graceful_shutdown_drains_sse():
+    """A stream that is mid-flight when SIGTERM arrives still completes"""
+    proc, base = _start(2)
+    chunks = []
+    with requests.get(f"{base}/api/vanna/v2/chat_sse", params={"cpu_ms": 1, "chunks": 10, "delay": 0.2},
+                      stream=True, timeout=30) as response:
+        lines = response.iter_lines(decode_unicode=True)
+        for line in lines:
+            if line:
+                chunks.append(line)
+                break
+        start = time.monotonic()
+        proc.send_signal(signal.SIGTERM)
+        for line in lines:
+            if line:
+                chunks.append(line)
+    exit_code = proc.wait(timeout=20)
+    logger.info(f"  Received {len(chunks)} events after SIGTERM in {time.monotonic() - start:.2f}s, exit code {exit_code}")
+    assert chunks[-1] == "data: [DONE]"
+    assert len(chunks) == 11
+
+
+def test_admin_actions_reach_every_worker():
+    """An action published by the worker that served it is picked up by the others"""
+    proc, base = _start(2)
+    try:
+        assert requests.post(f"{base}/api/invalidate", timeout=5).json() == {"invalidations": 1}
+        seen = {}
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and (len(seen) < 2 or set(seen.values()) != {1}):
+            health = requests.get(f"{base}/health", timeout=5).json()
+            seen[health["pid"]] = health["invalidations"]
+            time.sleep(0.05)
+    finally:
+        _stop(proc)
+    logger.info(f"  Invalidations per worker: {seen}")
+    assert len(seen) == 2 and set(seen.values()) == {1}
+
+
+def main():
+    tests = [
+        test_rps_scales_with_workers,
+        test_workers_build_their_own_knowledge_base,
+        test_graceful_shutdown_drains_sse,
+        test_admin_actions_reach_every_worker,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+"""
+Test the pooled, async PostgreSQL runner against a local Postgres stand-in
+1. Throughput scales with concurrent users up to the pool size
+2. The pool never exceeds max_size and records wait time
+3. Broken or stale connections are health-checked and replaced
+4. Advisory locks are held on their own connection and lost with it
+5. A cancelled query or stream is cancelled on the server, and its
+   connection is not reused while the statement is still running
+Logs results to: test/logs/test_postgres_pool.log
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report
+from fake_postgres import FakeDatabase
+
+# Setup logger
+logger, log_path = setup_logger("test_postgres_pool", "test_postgres_pool.log")
+
+LATENCY = 0.05  # seconds per warehouse query
+QUERIES_PER_USER = 8
+
+
+def _args(sql="SELECT value FROM factinternetsales"):
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+
+    return RunSqlToolArgs(sql=sql)
+
+
+def _runner(db, **kwargs):
+    from postgres_pool import PooledPostgresRunner
+
+    return PooledPostgresRunner(connection_factory=db.connect, **kwargs)
+
+
+async def _users(runner, users: int) -> float:
+    async def user():
+        for _ in range(QUERIES_PER_USER):
+            df = await runner.run_sql(_args(), None)
+            assert df["value"].tolist() == [1]
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(users)))
+    return time.perf_counter() - start
+
+
+def test_throughput_scales_with_concurrent_users():
+    """Queries per second grow with concurrent users up to max_size"""
+    results = []
+    for users in (1, 2, 4, 8):
+        db = FakeDatabase(latency=LATENCY)
+        runner = _runner(db, min_size=1, max_size=8)
+        elapsed = asyncio.run(_users(runner, users))
+        qps = users * QUERIES_PER_USER / elapsed
+        results.append({"users": users, "qps": round(qps, 1), "max_active": db.max_active})
+        logger.info(f"  {users} users: {qps:.1f} queries/s (max concurrent on DB: {db.max_active})")
+
+    save_json_report({"throughput": results}, "test_postgres_pool_report.json")
+    assert results[-1]["qps"] > results[0]["qps"] * 4
+    assert results[-1]["max_active"] == 8
+
+
+def test_pool_is_bounded_and_reports_waits():
+    """More users than connections queue for a connection instead of opening new ones"""
+    db = FakeDatabase(latency=LATENCY)
+    runner = _runner(db, min_size=1, max_size=2)
+    asyncio.run(_users(runner, 6))
+
+    stats = runner.get_stats()
+    logger.info(f"  Pool stats: {stats}")
+    assert len(db.connections) == 2
+    assert db.max_active <= 2
+    assert stats["in_use"] == 0 and stats["idle"] == 2
+    assert stats["max_wait_ms"] > 0
+
+
+def test_broken_connections_are_replaced():
+    """A connection closed by the server is dropped on the next health check"""
+    db = FakeDatabase()
+    runner = _runner(db, min_size=1, max_size=2, health_check_after=0.0)
+
+    async def scenario():
+        await runner.run_sql(_args(), None)
+        db.connections[0].close()  # e.g. server restarted
+        df = await runner.run_sql(_args(), None)
+        return df
+
+    df = asyncio.run(scenario())
+    stats = runner.get_stats()
+    logger.info(f"  Pool stats after reconnect: {stats}")
+    assert df["value"].tolist() == [1]
+    assert stats["connections_created"] == 2 and stats["connections_discarded"] == 1
+
+
+def test_query_errors_keep_pool_usable():
+    """A failing query is raised and its connection returns to the pool"""
+    db = FakeDatabase()
+    db.fail_sql.add("SELECT broken")
+    runner = _runner(db, max_size=1)
+
+    async def scenario():
+        try:
+            await runner.run_sql(_args("SELECT broken"), None)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("expected the query error to propagate")
+        return await runner.run_sql(_args(), None)
+
+    asyncio.run(scenario())
+    assert runner.get_stats()["errors"] == 1
+    assert len(db.connections) == 1
+
+
+def test_cancelled_query_is_cancelled_on_server():
+    """Cancelling the caller cancels the statement; the busy connection is never handed out"""
+    db = FakeDatabase(latency=2.0)
+    runner = _runner(db, max_size=1)
+
+    async def stream():
+        async for _ in runner.stream_sql(_args(), None):
+            pass
+
+    async def scenario():
+        states = []
+        for call in (lambda: runner.run_sql(_args(), None), stream):
+            db.latency = 2.0
+            task = asyncio.ensure_future(call())
+            await asyncio.sleep(0.1)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            states.append(runner.get_stats()["idle"])
+            db.latency = 0.0
+            start = time.perf_counter()
+            await runner.run_sql(_args(), None)
+            states.append(time.perf_counter() - start)
+        return states
+
+    states = asyncio.run(scenario())
+    stats = runner.get_stats()
+    logger.info(f"  Idle after cancel / next query wait: {states}: {stats}")
+    assert states[0] == 0 and states[2] == 0  # not back in the pool while still busy
+    assert states[1] < 0.5 and states[3] < 0.5  # the server stopped the statement
+    assert db.cancelled == 2 and db.active == 0
+    assert stats["cancelled"] == 2 and stats["connections_discarded"] == 2 and stats["in_use"] == 0
+
+
+def test_advisory_lock():
+    """The lock lives on its own connection; losing the connection loses the lock"""
+    db = FakeDatabase()
+    runner = _runner(db, max_size=1)
+    lock = runner.advisory_lock(42)
+    lock_sql = "SELECT pg_try_advisory_lock(42)"
+
+    async def scenario():
+        db.results[lock_sql] = (("pg_try_advisory_lock",), [(False,)])
+        taken_elsewhere = await lock.try_acquire()
+        db.results[lock_sql] = (("pg_try_advisory_lock",), [(True,)])
+        acquired = await lock.try_acquire()
+        kept = await lock.try_acquire()  # still held on the same session: not asked again
+        asked = db.executed.count(lock_sql)
+        db.down = True
+        lost = await lock.try_acquire()
+        db.down = False
+        regained = await lock.try_acquire()
+        await lock.release()
+        return taken_elsewhere, acquired, kept, asked, lost, regained
+
+    taken_elsewhere, acquired, kept, asked, lost, regained = asyncio.run(scenario())
+    assert not taken_elsewhere and acquired and kept and asked == 2
+    assert not lost and regained and not lock.held
+    assert runner.get_stats()["connections_created"] == 0  # never took a pool connection
+    assert all(conn.closed for conn in db.connections)
+
+
+def main():
+    tests = [
+        test_throughput_scales_with_concurrent_users,
+        test_pool_is_bounded_and_reports_waits,
+        test_broken_connections_are_replaced,
+        test_query_errors_keep_pool_usable,
+        test_cancelled_query_is_cancelled_on_server,
+        test_advisory_lock,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,270 @@
+"""
+Test primary/replica routing of the data source runner
+Each server is a fake Postgres instance with its own pool:
+1. Reads spread over the replicas (less to a slow one), writes go to the primary
+2. A replica lagging past the bound gets no reads until it catches up;
+   with every replica lagging, reads go to the primary
+3. Pinned groups (admins on the primary) and read-your-writes per conversation
+4. A crashed replica: its in-flight read is retried elsewhere, it is ejected,
+   then readmitted once it answers health checks again
+5. Read throughput scales with the number of replicas
+Logs results to: test/logs/test_postgres_replicas.log
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report
+from fake_postgres import FakeDatabase
+
+# Setup logger
+logger, log_path = setup_logger("test_postgres_replicas", "test_postgres_replicas.log")
+
+READ_SQL = "SELECT SUM(salesamount) FROM factinternetsales"
+WRITE_SQL = "INSERT INTO factinternetsales (salesordernumber) VALUES ('SO1')"
+
+REPORT = {}
+
+
+def _cluster(replicas=2, latency=0.01, pool_size=2, **kwargs):
+    from postgres_pool import PooledPostgresRunner
+    from postgres_replicas import ReplicatedPostgresRunner
+
+    dbs = {"primary": FakeDatabase(latency=latency)}
+    dbs.update({f"replica{i + 1}": FakeDatabase(latency=latency) for i in range(replicas)})
+    pools = {name: PooledPostgresRunner(connection_factory=db.connect, max_size=pool_size)
+             for name, db in dbs.items()}
+    runner = ReplicatedPostgresRunner(pools.pop("primary"), pools, **kwargs)
+    return runner, dbs
+
+
+def _context(groups=("read_sales",), conversation_id="c1"):
+    from vanna.core.tool import ToolContext
+    from vanna.core.user import User
+
+    return ToolContext.model_construct(
+        user=User(id="analyst_1", group_memberships=list(groups)),
+        conversation_id=conversation_id,
+        request_id="r1",
+        agent_memory=None,
+        metadata={},
+    )
+
+
+def _reads(db):
+    return db.executed.count(READ_SQL)
+
+
+def _set_lag(db, seconds):
+    from postgres_replicas import LAG_SQL
+
+    db.results[LAG_SQL] = (("lag_seconds",), [(seconds,)])
+
+
+def test_parse_helpers():
+    from postgres_replicas import is_read, parse_group_pins, parse_replicas
+
+    assert parse_replicas("pg-r1, eu=pg-r2:6432") == [("replica1", "pg-r1", 5432), ("eu", "pg-r2", 6432)]
+    assert parse_replicas("") == []
+    assert parse_group_pins("admin=primary; finance=eu") == {"admin": "primary", "finance": "eu"}
+    assert is_read("  with t as (select 1) select * from t") and is_read("EXPLAIN (FORMAT JSON) SELECT 1")
+    assert not is_read(WRITE_SQL) and not is_read("WITH d AS (DELETE FROM dimdate RETURNING *) SELECT * FROM d")
+    assert not is_read("REFRESH MATERIALIZED VIEW agg_sales")
+
+
+def test_reads_balanced_writes_primary():
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+
+    runner, dbs = _cluster(replicas=2)
+
+    async def scenario():
+        await asyncio.gather(*(runner.run_sql(RunSqlToolArgs(sql=READ_SQL), _context(conversation_id=f"c{i}"))
+                               for i in range(20)))
+        chunks = [chunk async for chunk in runner.stream_sql(RunSqlToolArgs(sql=READ_SQL), _context())]
+        await runner.run_sql(RunSqlToolArgs(sql=WRITE_SQL), _context(conversation_id="writer"))
+        return chunks
+
+    chunks = asyncio.run(scenario())
+    logger.info(f"  Reads per server: { {name: _reads(db) for name, db in dbs.items()} }")
+    assert len(chunks) == 1
+    assert _reads(dbs["primary"]) == 0 and _reads(dbs["replica1"]) + _reads(dbs["replica2"]) == 21
+    assert abs(_reads(dbs["replica1"]) - _reads(dbs["replica2"])) <= 3
+    assert WRITE_SQL in dbs["primary"].executed
+    assert all(WRITE_SQL not in db.executed for name, db in dbs.items() if name != "primary")
+    stats = runner.get_stats()
+    assert stats["routed"]["replica"] == 21 and stats["routed"]["write"] == 1
+
+
+def test_slow_replica_gets_less_traffic():
+    """Reads favour the replica answering faster"""
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+
+    runner, dbs = _cluster(replicas=2, pool_size=4)
+    dbs["replica2"].latency = 0.08
+
+    async def scenario():
+        for _ in range(4):
+            await asyncio.gather(*(runner.run_sql(RunSqlToolArgs(sql=READ_SQL), _context(conversation_id=f"c{i}"))
+                                   for i in range(8)))
+
+    asyncio.run(scenario())
+    logger.info(f"  Reads with replica2 at 80 ms: { {name: _reads(db) for name, db in dbs.items()} }")
+    assert _reads(dbs["replica1"]) > 2 * _reads(dbs["replica2"])
+
+
+def test_lag_bound():
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+
+    runner, dbs = _cluster(replicas=2, max_lag_seconds=10)
+    _set_lag(dbs["replica2"], 45.0)
+
+    async def reads(n):
+        for i in range(n):
+            await runner.run_sql(RunSqlToolArgs(sql=READ_SQL), _context(conversation_id=f"c{i}"))
+
+    async def scenario():
+        await reads(6)
+        lagging = {name: _reads(db) for name, db in dbs.items()}
+        _set_lag(dbs["replica1"], 12.5)
+        await runner.check()
+        await reads(2)
+        all_lagging = _reads(dbs["primary"])
+        _set_lag(dbs["replica1"], 0.0)
+        _set_lag(dbs["replica2"], 0.0)
+        await runner.check()
+        await reads(6)
+        return lagging, all_lagging
+
+    lagging, all_lagging = asyncio.run(scenario())
+    assert lagging == {"primary": 0, "replica1": 6, "replica2": 0}
+    assert all_lagging == 2
+    assert _reads(dbs["replica2"]) >= 2
+    stats = runner.get_stats()
+    assert stats["sources"]["replica2"]["lag_seconds"] == 0.0 and stats["routed"]["fallback"] == 2
+
+
+def test_pinning_and_read_your_writes():
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+
+    runner, dbs = _cluster(replicas=2, pinned_groups={"admin": "primary", "finance": "replica2"})
+
+    async def scenario():
+        await runner.run_sql(RunSqlToolArgs(sql=READ_SQL), _context(("admin",), "admin_conv"))
+        for i in range(3):
+            await runner.run_sql(RunSqlToolArgs(sql=READ_SQL), _context(("read_sales", "finance"), f"f{i}"))
+        after_pins = {name: _reads(db) for name, db in dbs.items()}
+        # The writing conversation reads its own write from the primary; others still use replicas
+        await runner.run_sql(RunSqlToolArgs(sql=WRITE_SQL), _context(conversation_id="writer"))
+        await runner.run_sql(RunSqlToolArgs(sql=READ_SQL), _context(conversation_id="writer"))
+        await runner.run_sql(RunSqlToolArgs(sql=READ_SQL), _context(conversation_id="other"))
+        return after_pins
+
+    after_pins = asyncio.run(scenario())
+    assert after_pins == {"primary": 1, "replica1": 0, "replica2": 3}
+    assert _reads(dbs["primary"]) == 2
+    routed = runner.get_stats()["routed"]
+    assert routed["pinned"] == 4 and routed["sticky"] == 1 and routed["replica"] == 1
+
+    try:
+        _cluster(pinned_groups={"admin": "replica9"})
+        assert False, "pin to an unknown source accepted"
+    except ValueError:
+        pass
+
+
+def test_ejection_and_failover():
+    """Reads keep succeeding while a replica is down; it comes back after its ejection"""
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+
+    runner, dbs = _cluster(replicas=2, eject_after=2, eject_seconds=0.3)
+
+    async def reads(n):
+        results = []
+        for i in range(n):
+            results.append(await runner.run_sql(RunSqlToolArgs(sql=READ_SQL), _context(conversation_id=f"c{i}")))
+        return results
+
+    async def scenario():
+        await reads(4)
+        dbs["replica1"].down = True
+        down_results = await reads(6)
+        failovers = runner.failovers
+        await runner.check()  # second failure: ejected
+        before = _reads(dbs["replica1"])
+        await reads(4)
+        ejected_reads = _reads(dbs["replica1"]) - before
+        dbs["replica1"].down = False
+        await runner.check()  # still ejected, not probed
+        still_ejected = runner.get_stats()["sources"]["replica1"]["ejected_for_seconds"]
+        await asyncio.sleep(0.35)
+        await runner.check()
+        await reads(6)
+        return down_results, failovers, ejected_reads, still_ejected
+
+    down_results, failovers, ejected_reads, still_ejected = asyncio.run(scenario())
+    stats = runner.get_stats()
+    logger.info(f"  {stats['sources']['replica1']}")
+    assert len(down_results) == 6 and all(len(df) == 1 for df in down_results)
+    assert failovers == 1  # one failed read, then replica1 is unhealthy until it is checked
+    assert ejected_reads == 0 and still_ejected > 0
+    assert stats["sources"]["replica1"]["ejections"] == 1 and stats["sources"]["replica1"]["healthy"]
+    assert _reads(dbs["replica1"]) >= 4  # back in rotation
+
+
+def test_throughput_scales_with_replicas():
+    """Concurrent reads of 50 ms each on pools of 2: queries per second by replica count"""
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+
+    queries = 48
+    throughput = {}
+    for replicas in (1, 2, 4):
+        runner, dbs = _cluster(replicas=replicas, latency=0.05, pool_size=2)
+
+        async def scenario():
+            await runner.check()
+            start = time.perf_counter()
+            await asyncio.gather(*(runner.run_sql(RunSqlToolArgs(sql=READ_SQL), _context(conversation_id=f"c{i}"))
+                                   for i in range(queries)))
+            return time.perf_counter() - start
+
+        elapsed = asyncio.run(scenario())
+        throughput[replicas] = queries / elapsed
+        logger.info(f"  {replicas} replica(s): {throughput[replicas]:.0f} reads/s "
+                    f"({ {name: _reads(db) for name, db in dbs.items()} })")
+        assert _reads(dbs["primary"]) == 0
+
+    REPORT["reads_per_second"] = throughput
+    save_json_report(REPORT, "test_postgres_replicas_report.json")
+    assert throughput[2] > 1.6 * throughput[1]
+    assert throughput[4] > 3.0 * throughput[1]
+
+
+def main():
+    tests = [
+        test_parse_helpers,
+        test_reads_balanced_writes_primary,
+        test_slow_replica_gets_less_traffic,
+        test_lag_bound,
+        test_pinning_and_read_your_writes,
+        test_ejection_and_failover,
+        test_throughput_scales_with_replicas,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
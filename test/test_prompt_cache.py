@@ -0,0 +1,203 @@
+"""
+Test prompt-prefix stability and token accounting
+Checks that the cache_prefix layout keeps the system prompt prefix and tools
+byte-identical across questions, that usage (prompt, cached and completion
+tokens) is aggregated per user and per route for plain and streamed calls,
+and compares the cache hit rate of both layouts over all training questions
+against a local fake Azure OpenAI endpoint that models prefix caching.
+Logs results to: test/logs/test_prompt_cache.log
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report, load_training_questions
+from fake_azure_openai import FakeAzureOpenAIServer
+
+# Setup logger
+logger, log_path = setup_logger("test_prompt_cache", "test_prompt_cache.log")
+
+BASE_PROMPT = "You are a helpful data analyst. Answer questions by writing PostgreSQL queries."
+
+
+def _user(user_id="demo_user"):
+    from vanna.core.user import User
+
+    return User(id=user_id, group_memberships=["read_sales"])
+
+
+def _tools():
+    from vanna.core.tool import ToolSchema
+
+    return [
+        ToolSchema(name="visualize_data", description="Chart a result", parameters={"type": "object", "properties": {}}),
+        ToolSchema(name="run_sql", description="Run a SQL query", parameters={"type": "object", "properties": {}}),
+    ]
+
+
+def _enhancer(layout):
+    from knowledge_base import KnowledgeBase
+    from context_builder import ContextBuilder, KnowledgeContextEnhancer
+
+    kb = KnowledgeBase()
+    kb.load_all()
+    return KnowledgeContextEnhancer(ContextBuilder(kb, token_budget=1500, layout=layout))
+
+
+def _request(system_prompt, question, user_id="demo_user"):
+    from vanna.core.llm import LlmRequest, LlmMessage
+
+    return LlmRequest(
+        messages=[LlmMessage(role="user", content=question)],
+        tools=_tools(),
+        user=_user(user_id),
+        system_prompt=system_prompt,
+    )
+
+
+def _service(endpoint, tracker=None):
+    from azure_openai_llm import AzureOpenAILlmService
+
+    return AzureOpenAILlmService(
+        model="gpt-4",
+        api_key="test-key",
+        azure_endpoint=endpoint,
+        api_version="2024-10-21",
+        usage_tracker=tracker,
+        max_retries=0,
+    )
+
+
+def test_stable_prefix_layout():
+    """Static system message and tools are byte-identical across questions; the question's context follows"""
+    enhancer = _enhancer("cache_prefix")
+    llm = _service("http://127.0.0.1:1")
+    payloads = []
+    for question in ["Internet sales amount by calendar year", "Top 10 resellers by sales"]:
+        prompt = asyncio.run(enhancer.enhance_system_prompt(BASE_PROMPT, question, _user()))
+        payloads.append(llm._build_payload(_request(prompt, question)))
+
+    first, second = payloads
+    assert first["messages"][0] == second["messages"][0]
+    assert first["messages"][0]["content"].startswith(BASE_PROMPT)
+    assert "=== DATABASE SCHEMA ===" in first["messages"][0]["content"]
+    assert first["messages"][1]["role"] == "system"
+    assert first["messages"][1] != second["messages"][1]
+    assert [t["function"]["name"] for t in first["tools"]] == ["run_sql", "visualize_data"]
+    assert llm._prefix_fingerprint(first) == llm._prefix_fingerprint(second)
+
+    # Without a boundary the system prompt is sent as before
+    plain = llm._build_payload(_request(BASE_PROMPT, "hello"))
+    assert [m["role"] for m in plain["messages"]] == ["system", "user"]
+
+
+def test_static_prefix_over_training_questions():
+    """One static prefix for every training question; the per-question part stays within budget"""
+    builder = _enhancer("cache_prefix").builder
+    for q in load_training_questions():
+        context, stats = builder.build(q['question'])
+        assert "=== DATABASE SCHEMA ===" not in context
+        assert stats.context_tokens - stats.static_tokens <= stats.token_budget, (q['question'], stats)
+    summary = builder.get_stats()
+    logger.info(f"  Static prefix: {summary['static_prefix_tokens']} tokens, "
+                f"avg context: {summary['avg_context_tokens']:.0f} tokens")
+    assert summary['static_prefix_tokens'] >= 1024
+
+
+def test_usage_per_user_and_route():
+    """Plain and streamed calls record prompt, cached and completion tokens per user and route"""
+    from prompt_cache import UsageTracker, current_route
+
+    tracker = UsageTracker(cached_discount=0.5)
+    enhancer = _enhancer("cache_prefix")
+    question = "Internet sales amount by calendar year"
+    prompt = asyncio.run(enhancer.enhance_system_prompt(BASE_PROMPT, question, _user()))
+
+    async def run(llm):
+        current_route.set("/api/vanna/v2/chat_sse")
+        await llm.send_request(_request(prompt, question, "alice"))
+        async for _ in llm.stream_request(_request(prompt, question, "bob")):
+            pass
+        current_route.set("/api/vanna/v2/chat_poll")
+        await llm.send_request(_request(prompt, question, "alice"))
+
+    with FakeAzureOpenAIServer() as server:
+        asyncio.run(run(_service(server.endpoint, tracker)))
+        assert server.requests[1]["stream_options"] == {"include_usage": True}
+
+    stats = tracker.get_stats()
+    logger.info(f"  Usage: {stats['requests']} requests, {stats['prompt_tokens']} prompt, "
+                f"{stats['cached_tokens']} cached, {stats['completion_tokens']} completion tokens")
+    assert stats["requests"] == 3
+    assert stats["by_user"]["alice"]["requests"] == 2
+    assert stats["by_user"]["bob"]["requests"] == 1
+    assert stats["by_route"]["/api/vanna/v2/chat_sse"]["requests"] == 2
+    assert stats["by_route"]["/api/vanna/v2/chat_poll"]["requests"] == 1
+    assert stats["by_user"]["bob"]["cached_tokens"] > 0
+    assert stats["prompt_tokens_saved"] == stats["cached_tokens"] // 2
+    assert stats["distinct_prefixes"] == 1 and stats["prefix_changes"] == 0
+
+    # Per-user totals are bounded: the least recently active user is dropped
+    from prompt_cache import TokenUsage
+
+    bounded = UsageTracker(max_users=2)
+    for user in ("alice", "bob", "alice", "carol"):
+        bounded.record(TokenUsage(prompt_tokens=10, total_tokens=10), user)
+    stats = bounded.get_stats()
+    assert list(stats["by_user"]) == ["alice", "carol"] and stats["requests"] == 4
+
+
+def test_cache_hit_rate_by_layout():
+    """Over all training questions the cache_prefix layout reuses far more prompt tokens than compact"""
+    from prompt_cache import UsageTracker
+
+    results = {}
+    for layout in ("compact", "cache_prefix"):
+        tracker = UsageTracker()
+        enhancer = _enhancer(layout)
+
+        async def run(llm):
+            for q in load_training_questions():
+                prompt = await enhancer.enhance_system_prompt(BASE_PROMPT, q['question'], _user())
+                await llm.send_request(_request(prompt, q['question']))
+
+        with FakeAzureOpenAIServer() as server:
+            asyncio.run(run(_service(server.endpoint, tracker)))
+        stats = tracker.get_stats()
+        results[layout] = {k: stats[k] for k in ("requests", "prompt_tokens", "cached_tokens",
+                                                  "cache_hit_rate", "prompt_tokens_saved", "distinct_prefixes")}
+        logger.info(f"  {layout}: hit rate {stats['cache_hit_rate']:.1%}, "
+                    f"{stats['cached_tokens']}/{stats['prompt_tokens']} prompt tokens cached, "
+                    f"{stats['distinct_prefixes']} distinct prefixes")
+
+    save_json_report(results, "test_prompt_cache_report.json")
+    assert results["cache_prefix"]["distinct_prefixes"] == 1
+    assert results["cache_prefix"]["cache_hit_rate"] > 0.5
+    assert results["cache_prefix"]["cache_hit_rate"] > results["compact"]["cache_hit_rate"]
+
+
+def main():
+    tests = [
+        test_stable_prefix_layout,
+        test_static_prefix_over_training_questions,
+        test_usage_per_user_and_route,
+        test_cache_hit_rate_by_layout,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
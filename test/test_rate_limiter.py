@@ -0,0 +1,259 @@
+"""
+Test the client-side quota scheduler for Azure OpenAI
+1. Token buckets meter requests and estimated tokens
+2. Waiting requests are served round-robin across users, interactive
+   before batch; a cancelled waiter gives up its turn
+3. The file backend makes several workers share one quota, and waiting
+   for its lock does not block the event loop
+4. A burst against the local fake endpoint with an RPM quota: 429s
+   without the scheduler, none with it
+Logs results to: test/logs/test_rate_limiter.log
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report
+from fake_azure_openai import FakeAzureOpenAIServer
+
+# Setup logger
+logger, log_path = setup_logger("test_rate_limiter", "test_rate_limiter.log")
+
+REPORT = {}
+
+
+async def _grant_order(scheduler, calls, stagger=0.0):
+    """Acquire for each (user, priority, tokens) in order; returns who was granted, in grant order"""
+    order = []
+
+    async def one(user, priority, tokens):
+        await scheduler.acquire(user, tokens, priority=priority)
+        order.append((user, priority))
+
+    tasks = []
+    for call in calls:
+        tasks.append(asyncio.ensure_future(one(*call)))
+        await asyncio.sleep(stagger)
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_token_buckets():
+    """Requests and tokens are both metered; a call waits for whichever bucket is short"""
+    from rate_limiter import QuotaScheduler
+
+    scheduler = QuotaScheduler(requests_per_minute=600, tokens_per_minute=60000, burst_seconds=1)
+    assert scheduler.limits == {"requests": (10, 10), "tokens": (1000, 1000)}
+
+    async def scenario():
+        first = await scheduler.acquire("alice", 800)
+        start = time.perf_counter()
+        waited = await scheduler.acquire("alice", 800)  # needs 600 more tokens at 1000/s
+        return first, waited, time.perf_counter() - start
+
+    first, waited, elapsed = asyncio.run(scenario())
+    logger.info(f"  Second 800-token call waited {elapsed * 1000:.0f} ms")
+    assert first == 0.0
+    assert 0.5 <= elapsed < 0.9 and waited > 0.5
+
+    payload = {"messages": [{"role": "user", "content": "total sales " * 100}], "max_tokens": 50}
+    assert scheduler.estimate_tokens(payload) == scheduler.counter("total sales " * 100) + 50
+
+
+def test_fair_queueing():
+    """One user's burst does not starve another user's requests"""
+    from rate_limiter import QuotaScheduler
+
+    scheduler = QuotaScheduler(requests_per_minute=1200, burst_seconds=0.05)
+    calls = [("alice", "interactive", 100)] * 20 + [("bob", "interactive", 100)] * 2
+    order = asyncio.run(_grant_order(scheduler, calls))
+    bob_turns = [i for i, (user, _) in enumerate(order) if user == "bob"]
+    stats = scheduler.get_stats()
+
+    logger.info(f"  bob served at positions {bob_turns} of {len(order)}: {stats['by_user']}")
+    REPORT["fairness"] = {"bob_positions": bob_turns, "by_user": stats["by_user"]}
+    assert bob_turns[-1] <= 4
+    assert stats["queue_depth"] == {"interactive": 0, "batch": 0} and stats["max_queue_depth"] >= 20
+
+    # Per-user wait stats are bounded: the least recently granted user is dropped
+    bounded = QuotaScheduler(max_users=2)
+    asyncio.run(_grant_order(bounded, [(user, "interactive", 1) for user in ("alice", "bob", "alice", "carol")]))
+    assert list(bounded.get_stats()["by_user"]) == ["alice", "carol"]
+
+
+def test_interactive_before_batch():
+    """Interactive calls that arrive behind a batch backlog are served first"""
+    from rate_limiter import QuotaScheduler
+
+    scheduler = QuotaScheduler(requests_per_minute=1200, burst_seconds=0.05)
+    calls = [("etl", "batch", 100)] * 10 + [("alice", "interactive", 100)] * 3
+    order = asyncio.run(_grant_order(scheduler, calls, stagger=0.01))
+    interactive_turns = [i for i, (_, priority) in enumerate(order) if priority == "interactive"]
+    stats = scheduler.get_stats()
+
+    logger.info(f"  Interactive served at positions {interactive_turns}: {stats['wait']}")
+    REPORT["priority"] = {"interactive_positions": interactive_turns, "wait": stats["wait"]}
+    # The batch calls arrived 0.1s earlier; at 20/s only ~3 of them go before the interactive ones
+    assert interactive_turns == list(range(interactive_turns[0], interactive_turns[0] + 3))
+    assert interactive_turns[-1] < 8
+
+
+def test_cancelled_waiter_gives_up_turn():
+    from rate_limiter import QuotaScheduler
+
+    scheduler = QuotaScheduler(requests_per_minute=600, burst_seconds=0.1)
+
+    async def scenario():
+        await scheduler.acquire("alice", 1)
+        stuck = asyncio.ensure_future(scheduler.acquire("alice", 1))
+        behind = asyncio.ensure_future(scheduler.acquire("bob", 1))
+        await asyncio.sleep(0.01)
+        stuck.cancel()
+        await asyncio.wait_for(behind, 1.0)
+
+    asyncio.run(scenario())
+    stats = scheduler.get_stats()
+    assert stats["cancelled"] == 1 and stats["granted"] == 2
+    assert stats["queue_depth"] == {"interactive": 0, "batch": 0}
+
+
+def test_file_backend_shared_by_workers():
+    """Two schedulers on one quota file (two workers) get one quota between them"""
+    from rate_limiter import FileBucketBackend, LocalBucketBackend, QuotaScheduler
+
+    async def burst(schedulers):
+        start = time.perf_counter()
+        await asyncio.gather(*(s.acquire(f"user_{i}", 1) for s in schedulers for i in range(10)))
+        return time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "quota.json")
+        shared = [QuotaScheduler(requests_per_minute=600, burst_seconds=1, backend=FileBucketBackend(path))
+                  for _ in range(2)]
+        shared_elapsed = asyncio.run(burst(shared))
+    separate = [QuotaScheduler(requests_per_minute=600, burst_seconds=1, backend=LocalBucketBackend())
+                for _ in range(2)]
+    separate_elapsed = asyncio.run(burst(separate))
+
+    logger.info(f"  20 calls, 10/s quota: shared file {shared_elapsed * 1000:.0f} ms, "
+                f"per-process {separate_elapsed * 1000:.0f} ms")
+    REPORT["file_backend"] = {"shared_ms": shared_elapsed * 1000, "per_process_ms": separate_elapsed * 1000}
+    # 10 calls fit the burst; the other 10 wait for 10/s refill
+    assert 0.8 <= shared_elapsed < 1.6
+    assert separate_elapsed < 0.1
+
+
+def test_file_lock_wait_keeps_loop_responsive():
+    """While another worker holds the quota file lock, the event loop keeps serving other work"""
+    import fcntl
+    import threading
+    from rate_limiter import FileBucketBackend, QuotaScheduler
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "quota.json")
+        scheduler = QuotaScheduler(requests_per_minute=600, burst_seconds=1, backend=FileBucketBackend(path))
+        other_worker = open(path, "a+")
+        fcntl.flock(other_worker, fcntl.LOCK_EX)
+        unlock = threading.Timer(0.3, lambda: fcntl.flock(other_worker, fcntl.LOCK_UN))
+        unlock.start()
+
+        async def scenario():
+            ticks = 0
+
+            async def ticker():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            ticking = asyncio.ensure_future(ticker())
+            start = time.perf_counter()
+            await scheduler.acquire("alice", 1)
+            ticking.cancel()
+            return time.perf_counter() - start, ticks
+
+        try:
+            waited, ticks = asyncio.run(scenario())
+        finally:
+            unlock.join()
+            other_worker.close()
+
+    logger.info(f"  Waited {waited * 1000:.0f} ms for the file lock, loop ticked {ticks} times meanwhile")
+    assert ticks >= 10
+    assert scheduler.get_stats()["granted"] == 1
+
+
+def test_burst_against_quota():
+    """20 concurrent calls against an endpoint that allows 10 per second"""
+    from azure_openai_llm import AzureOpenAILlmService
+    from rate_limiter import QuotaScheduler
+    from vanna.core.llm import LlmRequest, LlmMessage
+    from vanna.core.user import User
+
+    def run(scheduler):
+        with FakeAzureOpenAIServer(rate_limit=(10, 1.0)) as server:
+            llm = AzureOpenAILlmService(
+                model="gpt-4", api_key="test-key", azure_endpoint=server.endpoint,
+                api_version="2024-10-21", rate_limiter=scheduler, max_retries=0,
+            )
+
+            async def burst():
+                requests = [
+                    LlmRequest(messages=[LlmMessage(role="user", content=f"question {i}")],
+                               user=User(id=f"user_{i % 4}", group_memberships=["read_sales"]))
+                    for i in range(20)
+                ]
+                return await asyncio.gather(*(llm.send_request(r) for r in requests), return_exceptions=True)
+
+            start = time.perf_counter()
+            results = asyncio.run(burst())
+            elapsed = time.perf_counter() - start
+        failures = sum(1 for r in results if isinstance(r, Exception))
+        return {"throttled": server.throttled, "failures": failures, "elapsed_ms": elapsed * 1000}
+
+    unlimited = run(None)
+    # 4/s with a 1s burst stays under 10 per sliding second
+    scheduler = QuotaScheduler(requests_per_minute=240, burst_seconds=1)
+    scheduled = run(scheduler)
+    scheduled["scheduler"] = scheduler.get_stats()
+
+    logger.info(f"  Without scheduler: {unlimited}")
+    logger.info(f"  With scheduler: {scheduled}")
+    REPORT["burst"] = {"without_scheduler": unlimited, "with_scheduler": scheduled}
+    save_json_report(REPORT, "test_rate_limiter_report.json")
+    assert unlimited["throttled"] == 10 and unlimited["failures"] == 10
+    assert scheduled["throttled"] == 0 and scheduled["failures"] == 0
+    assert scheduled["scheduler"]["granted"] == 20 and scheduled["scheduler"]["max_queue_depth"] >= 10
+
+
+def main():
+    tests = [
+        test_token_buckets,
+        test_fair_queueing,
+        test_interactive_before_batch,
+        test_cancelled_waiter_gives_up_turn,
+        test_file_backend_shared_by_workers,
+        test_file_lock_wait_keeps_loop_responsive,
+        test_burst_against_quota,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+"""
+Test single-flight coalescing of identical in-flight questions
+1. Concurrent identical questions (same normalized text and access groups)
+   share one agent run; every subscriber gets the full stream, including
+   those that join mid-stream, and the exchange in its own conversation
+2. Other groups, follow-ups and later questions get their own runs;
+   errors reach every subscriber; a run nobody listens to is cancelled
+3. Result files the shared run saved are copied to every subscriber's
+   own directory, so their download links resolve
+4. A stand-up burst: several users asking the same few questions at once
+Logs results to: test/logs/test_request_coalescing.log
+"""
+
+import asyncio
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report
+
+# Setup logger
+logger, log_path = setup_logger("test_request_coalescing", "test_request_coalescing.log")
+
+PARTS = 4
+PART_LATENCY = 0.05  # seconds between streamed components of an agent run
+
+
+class FakeAgent:
+    """Stands in for vanna.Agent: streams PARTS components and records the exchange"""
+
+    def __init__(self, fail=False, file_system=None):
+        from vanna.integrations.local import MemoryConversationStore
+
+        self.calls = 0
+        self.finished = 0
+        self.fail = fail
+        self.file_system = file_system  # when set, each run saves a result file like run_sql
+        self.conversation_store = MemoryConversationStore()
+        self.user_resolver = self
+
+    async def resolve_user(self, request_context):
+        from vanna.core.user import User
+
+        role = request_context.get_cookie('role') or 'analyst'
+        groups = ['read_sales'] if role == 'analyst' else ['admin']
+        return User(id=request_context.get_cookie('user_id') or 'demo_user', group_memberships=groups)
+
+    async def send_message(self, request_context, message, *, conversation_id=None):
+        from vanna.core.storage import Conversation, Message
+
+        self.calls += 1
+        run = self.calls
+        for i in range(PARTS):
+            await asyncio.sleep(PART_LATENCY)
+            if self.fail and i == 1:
+                raise RuntimeError("LLM unavailable")
+            yield f"run {run} part {i}"
+        if conversation_id:
+            user = await self.resolve_user(request_context)
+            conversation = Conversation(id=conversation_id, user=user, messages=[])
+            conversation.add_message(Message(role="user", content=message))
+            if self.file_system is not None:
+                filename = f"query_results_{run}.csv"
+                await self.file_system.write_file(filename, f"run,{run}\n", SimpleNamespace(user=user))
+                conversation.add_message(Message(role="tool", content=f"...\n\nResults saved to file: {filename}"))
+            conversation.add_message(Message(role="assistant", content=f"answer {run}"))
+            await self.conversation_store.update_conversation(conversation)
+        self.finished += 1
+
+
+def _context(user_id="demo_user", role="analyst"):
+    from vanna.core.user import RequestContext
+
+    return RequestContext(cookies={"role": role, "user_id": user_id})
+
+
+async def _ask(agent, question, user_id="demo_user", role="analyst", delay=0.0):
+    await asyncio.sleep(delay)
+    return [c async for c in agent.send_message(_context(user_id, role), question, conversation_id=f"conv_{user_id}")]
+
+
+def test_identical_questions_share_one_run():
+    """Ten users, same question (different case/punctuation), one joining mid-stream: one agent run"""
+    from request_coalescing import CoalescingAgent
+    from vanna.core.user import User
+
+    inner = FakeAgent()
+    agent = CoalescingAgent(inner)
+
+    async def scenario():
+        asks = [_ask(agent, "Total sales by region?", f"user_{i}") for i in range(9)]
+        asks.append(_ask(agent, "total SALES by region", "late_user", delay=PART_LATENCY * 2.5))
+        return await asyncio.gather(*asks)
+
+    results = asyncio.run(scenario())
+    expected = [f"run 1 part {i}" for i in range(PARTS)]
+    assert inner.calls == 1
+    assert all(r == expected for r in results)
+
+    for user_id in ["user_0", "user_5", "late_user"]:
+        user = User(id=user_id, group_memberships=["read_sales"])
+        conversation = asyncio.run(inner.conversation_store.get_conversation(f"conv_{user_id}", user))
+        assert [m.content for m in conversation.messages] == ["Total sales by region?", "answer 1"]
+
+    stats = agent.get_stats()
+    logger.info(f"  {stats}")
+    assert stats["flights"] == 1 and stats["coalesced"] == 9 and stats["in_flight"] == 0
+    assert stats["max_subscribers"] == 10
+
+
+def test_separate_runs():
+    """Different access groups, follow-ups and questions asked after the run are not coalesced"""
+    from request_coalescing import CoalescingAgent
+
+    inner = FakeAgent()
+    agent = CoalescingAgent(inner)
+
+    async def scenario():
+        await asyncio.gather(
+            _ask(agent, "total sales", "analyst_1"),
+            _ask(agent, "total sales", "admin_1", role="admin"),
+        )
+        assert inner.calls == 2
+        # analyst_1 now has history: a follow-up runs on its own even while an identical question is in flight
+        await asyncio.gather(
+            _ask(agent, "total sales", "analyst_1"),
+            _ask(agent, "total sales", "analyst_2"),
+        )
+        assert inner.calls == 4
+        await _ask(agent, "total sales", "analyst_3")  # nothing in flight any more
+        assert inner.calls == 5
+
+    asyncio.run(scenario())
+    assert agent.get_stats()["coalesced"] == 0
+
+
+def test_error_and_cancellation():
+    """A failed run fails every subscriber; a run whose subscribers all leave is cancelled"""
+    from request_coalescing import CoalescingAgent
+
+    agent = CoalescingAgent(FakeAgent(fail=True))
+
+    async def failing():
+        return await asyncio.gather(*(_ask(agent, "total sales", f"user_{i}") for i in range(3)),
+                                    return_exceptions=True)
+
+    results = asyncio.run(failing())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert agent.get_stats()["errors"] == 1
+
+    inner = FakeAgent()
+    agent = CoalescingAgent(inner)
+
+    async def abandoned():
+        tasks = [asyncio.ensure_future(_ask(agent, "total sales", f"user_{i}")) for i in range(3)]
+        await asyncio.sleep(PART_LATENCY * 1.5)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(PART_LATENCY * PARTS)
+
+    asyncio.run(abandoned())
+    stats = agent.get_stats()
+    logger.info(f"  {stats}")
+    assert inner.calls == 1 and inner.finished == 0
+    assert stats["cancelled"] == 1 and stats["in_flight"] == 0
+
+
+def test_result_files_reach_every_subscriber():
+    """Each subscriber gets its own copy of the leader's result file, under the same name"""
+    from request_coalescing import CoalescingAgent
+    from vanna.core.user import User
+    from vanna.integrations.local import LocalFileSystem
+
+    with tempfile.TemporaryDirectory() as workdir:
+        file_system = LocalFileSystem(workdir)
+        inner = FakeAgent(file_system=file_system)
+        agent = CoalescingAgent(inner, file_system=file_system)
+
+        async def scenario():
+            await asyncio.gather(*(_ask(agent, "sales by product", f"user_{i}") for i in range(3)))
+            return [
+                file_system._resolve_path("query_results_1.csv", SimpleNamespace(user=User(id=f"user_{i}")))
+                for i in range(3)
+            ]
+
+        paths = asyncio.run(scenario())
+        assert inner.calls == 1
+        assert all(path.read_text() == "run,1\n" for path in paths)
+        assert agent.get_stats()["copied_files"] == 2
+
+
+def test_standup_burst():
+    """8 users each asking the same 5 dashboard questions at once"""
+    from request_coalescing import CoalescingAgent
+
+    questions = ["total sales", "sales by region", "top 10 products", "monthly revenue trend", "orders today"]
+    users = [f"user_{i}" for i in range(8)]
+
+    def burst(agent):
+        async def run():
+            start = time.perf_counter()
+            await asyncio.gather(*(
+                _ask(agent, q, f"{u}_{j}", delay=0.01 * i)
+                for i, u in enumerate(users) for j, q in enumerate(questions)
+            ))
+            return time.perf_counter() - start
+        return asyncio.run(run())
+
+    baseline = FakeAgent()
+    baseline_elapsed = burst(baseline)
+    inner = FakeAgent()
+    agent = CoalescingAgent(inner)
+    elapsed = burst(agent)
+    stats = agent.get_stats()
+
+    report = {
+        "requests": len(users) * len(questions),
+        "agent_runs_without": baseline.calls,
+        "agent_runs_with": inner.calls,
+        "elapsed_ms_without": baseline_elapsed * 1000,
+        "elapsed_ms_with": elapsed * 1000,
+        "stats": stats,
+    }
+    logger.info(f"  {report}")
+    save_json_report(report, "test_request_coalescing_report.json")
+    assert inner.calls == len(questions) and baseline.calls == len(users) * len(questions)
+    assert stats["coalesced"] == (len(users) - 1) * len(questions)
+
+
+def main():
+    tests = [
+        test_identical_questions_share_one_run,
+        test_separate_runs,
+        test_error_and_cancellation,
+        test_result_files_reach_every_subscriber,
+        test_standup_burst,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+"""
+Test streamed, bounded SQL results (stream_sql + StreamingRunSqlTool)
+1. Results are read in chunks through a server-side cursor
+2. The LLM and UI get capped previews plus summary stats; the CSV has every row
+3. Peak memory stays flat as the result grows (vs the materializing RunSqlTool)
+4. The full result downloads in chunks from /api/results/{filename}
+Logs results to: test/logs/test_result_streaming.log
+"""
+
+import asyncio
+import contextlib
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report
+from fake_postgres import FakeDatabase
+
+# Setup logger
+logger, log_path = setup_logger("test_result_streaming", "test_result_streaming.log")
+
+BIG_SQL = "SELECT id, region, amount FROM factinternetsales"
+
+
+def _big_db(rows: int) -> FakeDatabase:
+    db = FakeDatabase()
+    db.results[BIG_SQL] = (
+        ("id", "region", "amount"),
+        lambda: ((i, f"region_{i % 7}", float(i % 1000)) for i in range(rows)),
+    )
+    return db
+
+
+def _runner(db, **kwargs):
+    from postgres_pool import PooledPostgresRunner
+
+    return PooledPostgresRunner(connection_factory=db.connect, **kwargs)
+
+
+def _context(user_id="stream_user"):
+    from vanna.core.tool import ToolContext
+    from vanna.core.user import User
+
+    return ToolContext.model_construct(
+        user=User(id=user_id, group_memberships=["read_sales"]),
+        conversation_id="c1",
+        request_id="r1",
+        agent_memory=None,
+        metadata={},
+    )
+
+
+def _tool(runner, workdir, **kwargs):
+    from vanna.integrations.local import LocalFileSystem
+    from result_streaming import StreamingRunSqlTool
+
+    return StreamingRunSqlTool(sql_runner=runner, file_system=LocalFileSystem(workdir), **kwargs)
+
+
+def _args(sql=BIG_SQL):
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+
+    return RunSqlToolArgs(sql=sql)
+
+
+def test_stream_sql_uses_server_side_cursor():
+    """Chunks come from a named cursor and the connection goes back to autocommit"""
+    db = _big_db(12_000)
+    runner = _runner(db, max_size=1)
+
+    async def scenario():
+        sizes = [len(chunk) async for chunk in runner.stream_sql(_args(), None, chunk_size=5000)]
+        # Stopping early still releases the connection
+        async with contextlib.aclosing(runner.stream_sql(_args(), None, chunk_size=100)) as chunks:
+            async for _ in chunks:
+                break
+        # Blank SQL is not a query: it falls through to run_sql instead of raising IndexError
+        blank = [chunk async for chunk in runner.stream_sql(_args("   "), None)]
+        return sizes, blank
+
+    sizes, blank = asyncio.run(scenario())
+    logger.info(f"  Chunk sizes: {sizes}, cursors: {db.named_cursors}")
+    assert sizes == [5000, 5000, 2000]
+    assert len(blank) == 1
+    assert len(db.named_cursors) == 2
+    assert db.connections[0].autocommit is True
+    stats = runner.get_stats()
+    assert stats["in_use"] == 0 and stats["idle"] == 1
+
+
+def test_previews_are_capped_and_file_is_complete():
+    """LLM sees llm_row_cap rows plus stats; the UI gets ui_row_cap rows; the CSV gets all"""
+    rows = 50_000
+    runner = _runner(_big_db(rows))
+    with tempfile.TemporaryDirectory() as workdir:
+        tool = _tool(runner, workdir, llm_row_cap=10, ui_row_cap=200, chunk_size=4000)
+        context = _context()
+        result = asyncio.run(tool.execute(context, _args()))
+
+        assert result.success, result.error
+        meta = result.metadata
+        logger.info(f"  Summary: {meta['summary']['columns']['amount']}")
+        assert meta["row_count"] == rows and meta["truncated"] is True
+        assert len(meta["results"]) == 200
+        assert result.ui_component.rich_component.row_count == rows
+        assert len(result.ui_component.rich_component.rows) == 200
+        assert f"Showing the first 10 of {rows} rows" in result.result_for_llm
+        assert "amount: min=0, max=999, mean=499.5" in result.result_for_llm
+        assert len(result.result_for_llm) < 3000
+
+        path = tool.file_system._resolve_path(meta["output_file"], context)
+        with open(path) as f:
+            assert sum(1 for _ in f) == rows + 1  # header
+
+        # Errors keep RunSqlTool's shape and leave no partial file behind
+        db = FakeDatabase()
+        db.fail_sql.add("SELECT broken")
+        failed = asyncio.run(_tool(_runner(db), workdir).execute(context, _args("SELECT broken")))
+        assert not failed.success and failed.metadata == {"error_type": "sql_error"}
+        assert len(list(path.parent.iterdir())) == 1
+
+
+def _peak_mb(tool_factory, rows: int) -> float:
+    runner = _runner(_big_db(rows))
+    with tempfile.TemporaryDirectory() as workdir:
+        tool = tool_factory(runner, workdir)
+        tracemalloc.start()
+        result = asyncio.run(tool.execute(_context(), _args()))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    assert result.success, result.error
+    return peak / 1e6
+
+
+def test_peak_memory_is_flat():
+    """Peak memory does not grow with the row count when streaming"""
+    from vanna.integrations.local import LocalFileSystem
+    from vanna.tools import RunSqlTool
+
+    streaming = lambda runner, workdir: _tool(runner, workdir, chunk_size=5000)
+    baseline = lambda runner, workdir: RunSqlTool(sql_runner=runner, file_system=LocalFileSystem(workdir))
+
+    results = []
+    for rows in (20_000, 100_000):
+        start = time.perf_counter()
+        streamed = _peak_mb(streaming, rows)
+        elapsed = time.perf_counter() - start
+        materialized = _peak_mb(baseline, rows) if rows == 20_000 else None
+        results.append({"rows": rows, "streaming_peak_mb": round(streamed, 1),
+                        "run_sql_tool_peak_mb": materialized and round(materialized, 1),
+                        "streaming_seconds": round(elapsed, 2)})
+        logger.info(f"  {rows} rows: streaming peak {streamed:.1f} MB"
+                    + (f", RunSqlTool peak {materialized:.1f} MB" if materialized else ""))
+
+    save_json_report({"memory": results}, "test_result_streaming_report.json")
+    assert results[1]["streaming_peak_mb"] < results[0]["streaming_peak_mb"] * 1.5
+    assert results[0]["streaming_peak_mb"] < results[0]["run_sql_tool_peak_mb"] / 3
+
+
+def test_chunked_download_route():
+    """The saved CSV is served to its owner only"""
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from vanna.core.user import User, UserResolver
+    from result_streaming import register_result_routes
+
+    class CookieUserResolver(UserResolver):
+        async def resolve_user(self, request_context):
+            return User(id=request_context.get_cookie("user_id") or "demo_user")
+
+    rows = 30_000
+    with tempfile.TemporaryDirectory() as workdir:
+        tool = _tool(_runner(_big_db(rows)), workdir)
+        result = asyncio.run(tool.execute(_context("alice"), _args()))
+        filename = result.metadata["output_file"]
+
+        app = FastAPI()
+        register_result_routes(app, tool.file_system, CookieUserResolver(), chunk_bytes=4096)
+        client = TestClient(app)
+
+        response = client.get(f"/api/results/{filename}", cookies={"user_id": "alice"})
+        assert response.status_code == 200
+        assert response.text.count("\n") == rows + 1
+        assert client.get(f"/api/results/{filename}", cookies={"user_id": "bob"}).status_code == 404
+        assert client.get("/api/results/..%2Fsecrets.csv").status_code == 404
+
+
+def main():
+    tests = [
+        test_stream_sql_uses_server_side_cursor,
+        test_previews_are_capped_and_file_is_complete,
+        test_peak_memory_is_flat,
+        test_chunked_download_route,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
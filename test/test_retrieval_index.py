@@ -0,0 +1,163 @@
+"""
+Test and benchmark the BM25 retrieval index behind KnowledgeBase.search
+1. Ranking quality on the real training data
+2. Query latency on 10k and 100k synthetic question/SQL pairs
+
+Run directly for the full benchmark:
+    python test/test_retrieval_index.py
+Logs results to: test/logs/test_retrieval_index.log
+"""
+
+import random
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report, load_training_questions
+
+# Setup logger
+logger, log_path = setup_logger("test_retrieval_index", "test_retrieval_index.log")
+
+METRICS = ["revenue", "sales amount", "order count", "profit", "freight", "tax", "discount", "quantity"]
+DIMENSIONS = ["year", "quarter", "month", "territory", "country", "product category", "subcategory",
+              "customer", "reseller", "promotion", "currency", "gender", "education", "color"]
+FILTERS = ["in 2013", "for bikes", "in Europe", "for online orders", "above average", "last 30 days"]
+TABLES = ["factinternetsales", "factresellersales", "dimcustomer", "dimproduct", "dimdate", "dimsalesterritory"]
+
+
+def make_synthetic_pairs(n: int, seed: int = 7):
+    """Generate n synthetic question/SQL pairs in the shape of queries.json"""
+    rng = random.Random(seed)
+    pairs = []
+    for i in range(n):
+        metric, dim, flt = rng.choice(METRICS), rng.choice(DIMENSIONS), rng.choice(FILTERS)
+        table = rng.choice(TABLES)
+        pairs.append({
+            "category": "synthetic",
+            "question": f"What is the {metric} by {dim} {flt} variant{i}",
+            "sql": f"SELECT {dim.replace(' ', '')}, SUM({metric.replace(' ', '')}) FROM {table} GROUP BY 1",
+            "difficulty": "simple",
+        })
+    return pairs
+
+
+def _benchmark(size: int, queries: int = 200):
+    from retrieval_index import RetrievalIndex
+
+    cache = {"queries": {"question_sql_pairs": make_synthetic_pairs(size)}}
+    start = time.perf_counter()
+    index = RetrievalIndex.from_training_data(cache)
+    build_s = time.perf_counter() - start
+
+    rng = random.Random(1)
+    probes = [f"{rng.choice(METRICS)} by {rng.choice(DIMENSIONS)} variant{rng.randrange(size)}" for _ in range(queries)]
+    index.search(probes[0], k=5)  # warm-up
+
+    timings = []
+    for probe in probes:
+        t = time.perf_counter()
+        index.search(probe, k=5)
+        timings.append(time.perf_counter() - t)
+    timings.sort()
+    return {
+        "size": size,
+        "build_s": round(build_s, 3),
+        "p50_ms": round(timings[len(timings) // 2] * 1000, 3),
+        "p95_ms": round(timings[int(len(timings) * 0.95)] * 1000, 3),
+    }
+
+
+def _baseline_linear_scan(examples, question):
+    """The previous find_similar_question algorithm, kept for comparison"""
+    question_lower = question.lower()
+    for example in examples:
+        example_q = example['question'].lower()
+        keywords = [word for word in question_lower.split() if len(word) > 3]
+        matches = sum(1 for kw in keywords if kw in example_q)
+        if matches >= 2:
+            return example
+    return None
+
+
+def test_training_questions_find_themselves():
+    """Every training question ranks itself first"""
+    from knowledge_base import KnowledgeBase
+
+    kb = KnowledgeBase()
+    kb.load_all()
+    questions = load_training_questions()
+    misses = [q['question'] for q in questions
+              if (kb.find_similar_question(q['question']) or {}).get('question') != q['question']]
+    logger.info(f"  {len(questions) - len(misses)}/{len(questions)} training questions rank themselves first")
+    assert not misses, misses
+
+
+def test_returns_best_not_first_match():
+    """The best match wins, not the first example with two shared keywords"""
+    from knowledge_base import KnowledgeBase
+
+    kb = KnowledgeBase()
+    kb.load_all()
+    hit = kb.find_similar_question("total revenue from reseller sales")
+    assert hit['question'] == "What is our total revenue from reseller sales?"
+
+    hits = kb.search("reseller", k=5)
+    assert hits and all(a.score >= b.score for a, b in zip(hits, hits[1:]))
+    assert kb.find_similar_question("zebra giraffe") is None
+
+
+def test_vector_index_option():
+    """The optional vector index is fused with BM25"""
+    from knowledge_base import KnowledgeBase
+
+    kb = KnowledgeBase(use_vector_index=True)
+    kb.load_all()
+    hits = kb.search("total revenu internet", k=3, kinds=["question"])
+    assert any("internet" in h.document.payload['question'].lower() for h in hits)
+
+
+def test_query_latency_10k():
+    """Top-k retrieval over 10k pairs stays well under a millisecond at p50"""
+    result = _benchmark(10_000, queries=100)
+    logger.info(f"  10k pairs: {result}")
+    assert result["p50_ms"] < 1.0
+
+
+def main():
+    tests = [
+        test_training_questions_find_themselves,
+        test_returns_best_not_first_match,
+        test_vector_index_option,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+
+    logger.info("\nBenchmark: BM25 index vs. previous linear keyword scan")
+    results = []
+    for size in (10_000, 100_000):
+        result = _benchmark(size)
+        pairs = make_synthetic_pairs(size)
+        # Worst case for the old scan: no example shares two keywords
+        t = time.perf_counter()
+        for _ in range(5):
+            _baseline_linear_scan(pairs, "average margin for clothing")
+        result["linear_scan_miss_ms"] = round((time.perf_counter() - t) / 5 * 1000, 3)
+        logger.info(f"  {size:>7} pairs: {result}")
+        results.append(result)
+    save_json_report({"benchmark": results}, "test_retrieval_index_report.json")
+
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
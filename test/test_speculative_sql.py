@@ -0,0 +1,332 @@
+"""
+Test speculative execution of known SQL alongside the LLM call
+1. Training questions match their own query; loosely related ones do not
+2. Generated SQL that canonicalizes to the speculated query is served from
+   the prefetched result, and end-to-end latency drops by the query time
+3. Different SQL cancels the speculation; unclaimed ones end with the turn,
+   and a cancelled speculation stops its statement on the server
+4. The LLM's own run_sql query starts as soon as its streamed `sql`
+   argument is complete, unless the schema validator rejects it
+5. Speculations belong to their turn: another conversation of the same
+   user neither claims nor cancels them, and unclaimed ones end with the
+   turn or after max_age_seconds
+Logs results to: test/logs/test_speculative_sql.log
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report, load_training_questions
+from fake_postgres import FakeDatabase
+
+# Setup logger
+logger, log_path = setup_logger("test_speculative_sql", "test_speculative_sql.log")
+
+LLM_LATENCY = 0.15  # seconds until the LLM's run_sql call
+QUERY_LATENCY = 0.1  # seconds per warehouse query
+
+
+def _runner(db):
+    from postgres_pool import PooledPostgresRunner
+    from speculative_sql import SpeculativeSqlRunner
+
+    return SpeculativeSqlRunner(PooledPostgresRunner(connection_factory=db.connect, max_size=4))
+
+
+def _context(user_id="demo_user"):
+    from vanna.core.tool import ToolContext
+    from vanna.core.user import User
+
+    return ToolContext.model_construct(
+        user=User(id=user_id, group_memberships=["read_sales"]),
+        conversation_id="c1", request_id="r1", agent_memory=None, metadata={},
+    )
+
+
+def _args(sql):
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+
+    return RunSqlToolArgs(sql=sql)
+
+
+class FakeAgent:
+    """Resolves the user, 'thinks' for LLM_LATENCY, then runs the SQL it was given"""
+
+    def __init__(self, runner, generated_sql):
+        from vanna.core.user import User
+
+        self.runner = runner
+        self.generated_sql = generated_sql
+        self.user = User(id="demo_user", group_memberships=["read_sales"])
+
+        agent = self
+
+        class Resolver:
+            async def resolve_user(self, request_context):
+                return agent.user
+
+        self.user_resolver = Resolver()
+
+    async def send_message(self, request_context, message, *, conversation_id=None):
+        await asyncio.sleep(LLM_LATENCY)
+        df = None
+        if self.generated_sql:
+            df = await self.runner.run_sql(_args(self.generated_sql), _context())
+        yield df
+
+
+def test_matching_questions():
+    """Every training question matches itself; a vague one falls back to the LLM"""
+    from knowledge_base import KnowledgeBase
+
+    kb = KnowledgeBase()
+    questions = load_training_questions()
+    for q in questions:
+        match = kb.find_matching_question(q["question"])
+        assert match is not None and match["sql"] == q["sql"], q["question"]
+        assert kb.find_matching_question(q["question"].upper() + "?") == match
+    assert kb.find_matching_question("what about last year compared to my other numbers") is None
+    # Short or partial questions covered by a longer stored question do not match it
+    for vague in ("sales", "products", "total sales", "sales by product"):
+        assert kb.find_matching_question(vague) is None, vague
+        assert kb.find_matching_question(vague, min_overlap=1.0) is None, vague
+    logger.info(f"  {len(questions)} training questions matched")
+
+
+def test_hit_serves_prefetched_result():
+    """Same query (different spelling) is served from the speculation, saving the query time"""
+    from speculative_sql import SpeculativeAgent
+    from vanna.core.user import RequestContext
+
+    question = load_training_questions()[0]
+    generated = "\n".join(question["sql"].lower().split()) + ";"
+    timings = {}
+    stats = {}
+    for speculate in (False, True):
+        db = FakeDatabase(latency=QUERY_LATENCY)
+        runner = _runner(db)
+        agent = FakeAgent(runner, generated)
+        served = SpeculativeAgent(agent, runner, _kb()) if speculate else agent
+
+        async def scenario():
+            start = time.perf_counter()
+            async for df in served.send_message(RequestContext(), question["question"], conversation_id="c1"):
+                assert df["value"].tolist() == [1]
+            return time.perf_counter() - start
+
+        timings["speculative" if speculate else "baseline"] = asyncio.run(scenario())
+        stats = served.get_stats() if speculate else stats
+        assert len([sql for sql in db.executed if sql != "SELECT 1"]) == 1
+
+    logger.info(f"  Baseline {timings['baseline'] * 1000:.0f} ms, speculative {timings['speculative'] * 1000:.0f} ms; {stats}")
+    save_json_report({"timings_ms": {k: v * 1000 for k, v in timings.items()}, "stats": stats},
+                     "test_speculative_sql_report.json")
+    assert stats["hits"] == 1 and stats["misses"] == 0 and stats["pending"] == 0
+    assert stats["saved_ms"] >= QUERY_LATENCY * 1000 * 0.8
+    assert timings["speculative"] < timings["baseline"] - QUERY_LATENCY * 0.5
+
+
+def test_miss_and_unclaimed_are_cancelled():
+    """Different generated SQL cancels the speculation; so does a turn that runs no SQL"""
+    from speculative_sql import SpeculativeAgent
+    from vanna.core.user import RequestContext
+
+    question = load_training_questions()[0]
+    for generated in ("SELECT 42 FROM dimcustomer", None):
+        db = FakeDatabase(latency=QUERY_LATENCY)
+        runner = _runner(db)
+        served = SpeculativeAgent(FakeAgent(runner, generated), runner, _kb())
+
+        async def scenario():
+            async for _ in served.send_message(RequestContext(), question["question"], conversation_id="c1"):
+                pass
+
+        asyncio.run(scenario())
+        stats = served.get_stats()
+        logger.info(f"  Generated {generated!r}: {stats}")
+        assert stats["started"] == 1 and stats["cancelled"] == 1 and stats["hits"] == 0
+        assert stats["misses"] == (1 if generated else 0) and stats["pending"] == 0
+
+    # Another user's query never claims or cancels this user's speculation
+    db = FakeDatabase(latency=QUERY_LATENCY)
+    runner = _runner(db)
+
+    async def two_users():
+        speculation = runner.speculate(question["sql"], _context("alice"))
+        df = await runner.run_sql(_args(question["sql"]), _context("bob"))
+        assert runner.get_stats()["pending"] == 1
+        await runner.run_sql(_args(question["sql"]), _context("alice"))
+        return speculation, df
+
+    asyncio.run(two_users())
+    assert runner.get_stats()["hits"] == 1 and runner.get_stats()["cancelled"] == 0
+
+
+def test_cancel_stops_the_warehouse_query():
+    """Cancelling a speculation cancels its statement and frees its pooled connection"""
+    sql = "SELECT customerkey FROM dimcustomer"
+    db = FakeDatabase(latency=2.0)
+    runner = _runner(db)
+
+    async def scenario():
+        speculation = runner.speculate(sql, _context())
+        await asyncio.sleep(0.1)
+        start = time.perf_counter()
+        assert runner.cancel(speculation)
+        while db.active or runner.runner.get_stats()["in_use"]:
+            await asyncio.sleep(0.01)
+        return time.perf_counter() - start
+
+    stopped = asyncio.run(scenario())
+    pool = runner.runner.get_stats()
+    logger.info(f"  Cancelled speculation stopped after {stopped * 1000:.0f} ms: {pool}")
+    assert stopped < 0.5 and db.cancelled == 1
+    assert pool["cancelled"] == 1 and pool["idle"] == 0  # the cancelled session is replaced, not reused
+
+
+def test_early_dispatch_of_streamed_sql():
+    """A streamed run_sql `sql` argument starts the query; the tool's call then claims it"""
+    from speculative_sql import EarlySqlDispatcher
+    from sql_validator import SchemaValidator
+    from tool_call_stream import EarlyArgument
+    from vanna.core.llm import LlmRequest, LlmMessage
+
+    sql = "SELECT customerkey FROM dimcustomer"
+    db = FakeDatabase(latency=QUERY_LATENCY)
+    runner = _runner(db)
+    validator = SchemaValidator.from_knowledge_base(_kb())
+    dispatch = EarlySqlDispatcher(runner, validator=validator, access_groups=["read_sales"])
+    request = LlmRequest(messages=[LlmMessage(role="user", content="customers")], user=_context().user)
+
+    def early(key, value, tool="run_sql"):
+        return EarlyArgument("call_1", tool, key, value, time.perf_counter())
+
+    async def scenario():
+        dispatch(request, early("sql", "SELECT nosuchcolumn FROM dimcustomer"))  # rejected by the schema
+        dispatch(request, early("explanation", sql))  # not the sql argument
+        dispatch(request, early("sql", sql, tool="visualize_data"))
+        dispatch(request, early("sql", sql))
+        await asyncio.sleep(QUERY_LATENCY)  # rest of the completion streams meanwhile
+        start = time.perf_counter()
+        await runner.run_sql(_args(sql), _context())
+        return time.perf_counter() - start
+
+    claim_seconds = asyncio.run(scenario())
+    stats = {**dispatch.get_stats(), **runner.get_stats()}
+    logger.info(f"  Claimed in {claim_seconds * 1000:.0f} ms: {stats}")
+    assert stats["seen"] == 2 and stats["rejected"] == 1 and stats["dispatched"] == 1
+    assert stats["hits"] == 1 and claim_seconds < QUERY_LATENCY / 2
+    assert [q for q in db.executed if q != "SELECT 1"] == [sql]
+
+
+def test_speculations_are_scoped_to_their_turn():
+    """Early dispatches are cancelled with their turn, never by another conversation, and expire"""
+    from speculative_sql import EarlySqlDispatcher, SpeculativeAgent, SpeculativeSqlRunner
+    from postgres_pool import PooledPostgresRunner
+    from tool_call_stream import EarlyArgument
+    from vanna.core.llm import LlmRequest, LlmMessage
+    from vanna.core.user import RequestContext
+
+    sql, other_sql = "SELECT customerkey FROM dimcustomer", "SELECT productkey FROM dimproduct"
+    db = FakeDatabase(latency=QUERY_LATENCY)
+    runner = _runner(db)
+    dispatch = EarlySqlDispatcher(runner)
+    request = LlmRequest(messages=[LlmMessage(role="user", content="customers")], user=_context().user)
+
+    class StreamingAgent(FakeAgent):
+        """Streams a run_sql call (dispatched early), then runs `generated_sql` unless the turn is cut short"""
+
+        def __init__(self, runner, streamed, generated_sql=None, pause=None):
+            super().__init__(runner, generated_sql)
+            self.streamed, self.pause = streamed, pause
+
+        async def send_message(self, request_context, message, *, conversation_id=None):
+            dispatch(request, EarlyArgument("call_1", "run_sql", "sql", self.streamed, time.perf_counter()))
+            if self.pause is not None:
+                await self.pause.wait()
+            if self.generated_sql:
+                yield await self.runner.run_sql(_args(self.generated_sql), _context())
+            yield None
+
+    async def turn(agent, conversation_id):
+        async for _ in SpeculativeAgent(agent, runner).send_message(
+            RequestContext(), "customers", conversation_id=conversation_id
+        ):
+            pass
+
+    async def scenario():
+        # The completion streamed one query, but the turn ended (e.g. unparsable args) without running it
+        await turn(StreamingAgent(runner, sql), "c1")
+        abandoned = runner.get_stats()["pending"]
+
+        # Conversation c2 misses while c1's dispatch is still waiting for its tool call
+        pause = asyncio.Event()
+        first = asyncio.ensure_future(turn(StreamingAgent(runner, sql, generated_sql=sql, pause=pause), "c1"))
+        await asyncio.sleep(0.01)
+        await turn(StreamingAgent(runner, other_sql, generated_sql=sql), "c2")
+        pause.set()
+        await first
+        return abandoned
+
+    abandoned = asyncio.run(scenario())
+    stats = runner.get_stats()
+    logger.info(f"  Turn-scoped speculations: {stats}")
+    assert abandoned == 0
+    # c1's abandoned dispatch and c2's own unclaimed one were cancelled; c1's claimed dispatch was a hit
+    assert stats["hits"] == 1 and stats["misses"] == 1 and stats["cancelled"] == 2 and stats["pending"] == 0
+
+    # Outside any turn, unclaimed speculations expire
+    db = FakeDatabase(latency=0.0)
+    runner = SpeculativeSqlRunner(PooledPostgresRunner(connection_factory=db.connect), max_age_seconds=0.05)
+
+    async def expiry():
+        runner.speculate(sql, _context())
+        await asyncio.sleep(0.1)
+        await runner.run_sql(_args(sql), _context())
+
+    asyncio.run(expiry())
+    stats = runner.get_stats()
+    assert stats["expired"] == 1 and stats["hits"] == 0 and stats["pending"] == 0
+    assert [q for q in db.executed if q != "SELECT 1"] == [sql, sql]
+
+
+_kb_instance = None
+
+
+def _kb():
+    global _kb_instance
+    if _kb_instance is None:
+        from knowledge_base import KnowledgeBase
+
+        _kb_instance = KnowledgeBase()
+    return _kb_instance
+
+
+def main():
+    tests = [
+        test_matching_questions,
+        test_hit_serves_prefetched_result,
+        test_miss_and_unclaimed_are_cancelled,
+        test_cancel_stops_the_warehouse_query,
+        test_early_dispatch_of_streamed_sql,
+        test_speculations_are_scoped_to_their_turn,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
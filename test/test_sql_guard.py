@@ -0,0 +1,212 @@
+"""
+Test the EXPLAIN cost guard in front of the Postgres runner
+Uses the fake Postgres connection, whose EXPLAIN returns per-statement
+cost and row estimates and which enforces statement_timeout:
+1. A fact-to-fact cross join is rejected before it runs, with a message
+   the LLM can act on; an unfiltered scan of many rows gets a LIMIT
+2. Plans are cached by canonical SQL
+3. statement_timeout follows the user's groups and is reset afterwards
+4. Plan cost is recorded next to actual runtime
+Logs results to: test/logs/test_sql_guard.log
+"""
+
+import asyncio
+import sys
+import tempfile
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report
+from fake_postgres import FakeDatabase
+
+# Setup logger
+logger, log_path = setup_logger("test_sql_guard", "test_sql_guard.log")
+
+CROSS_JOIN_SQL = "SELECT * FROM factinternetsales, factresellersales"
+SCAN_SQL = "SELECT * FROM factfinance"
+SMALL_SQL = "SELECT SUM(salesamount) FROM factinternetsales WHERE orderdatekey >= 20130101"
+SLOW_SQL = "SELECT productkey, SUM(salesamount) FROM factinternetsales GROUP BY productkey"
+
+REPORT = {}
+
+
+def _db():
+    db = FakeDatabase(latency=0.01)
+    db.plans[CROSS_JOIN_SQL] = (2.4e9, 3_660_000_000)
+    db.plans[SCAN_SQL] = (880.0, 400_000)
+    db.plans[SMALL_SQL] = (1500.0, 1)
+    db.plans[SLOW_SQL] = (4200.0, 158)
+    db.latencies[SLOW_SQL] = 0.3
+    return db
+
+
+def _guard(db, **kwargs):
+    from postgres_pool import PooledPostgresRunner
+    from sql_guard import CostGuardedSqlRunner
+
+    kwargs.setdefault("group_timeouts", {"read_sales": 0.1, "admin": 1.0})
+    return CostGuardedSqlRunner(PooledPostgresRunner(connection_factory=db.connect, max_size=2), **kwargs)
+
+
+def _context(groups=("read_sales",), user_id="analyst_1"):
+    from vanna.core.tool import ToolContext
+    from vanna.core.user import User
+
+    return ToolContext.model_construct(
+        user=User(id=user_id, group_memberships=list(groups)),
+        conversation_id="c1",
+        request_id="r1",
+        agent_memory=None,
+        metadata={},
+    )
+
+
+def _run_tool(guard, sql, workdir, groups=("read_sales",)):
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+    from vanna.integrations.local import LocalFileSystem
+    from result_streaming import StreamingRunSqlTool
+
+    tool = StreamingRunSqlTool(sql_runner=guard, file_system=LocalFileSystem(workdir))
+    return asyncio.run(tool.execute(_context(groups), RunSqlToolArgs(sql=sql)))
+
+
+def test_helpers():
+    from sql_guard import add_limit, parse_group_limits
+
+    assert parse_group_limits("read_sales=30; admin=300") == {"read_sales": 30.0, "admin": 300.0}
+    assert add_limit("SELECT * FROM factfinance;", 1000) == "SELECT * FROM factfinance\nLIMIT 1000"
+    assert add_limit("SELECT * FROM dimdate -- all dates", 10) == "SELECT * FROM dimdate -- all dates\nLIMIT 10"
+    assert add_limit("select * from dimdate limit 5 offset 10", 1000) == "select * from dimdate limit 5 offset 10"
+    assert add_limit("SELECT * FROM (SELECT * FROM dimdate LIMIT 5) d", 10).endswith("\nLIMIT 10")
+
+
+def test_cross_join_rejected():
+    """The warehouse never sees the cross join; the LLM gets a message telling it how to narrow the query"""
+    db = _db()
+    guard = _guard(db)
+    with tempfile.TemporaryDirectory() as workdir:
+        result = _run_tool(guard, CROSS_JOIN_SQL, workdir)
+
+    logger.info(f"  Tool result for the LLM: {result.result_for_llm}")
+    assert not result.success
+    assert "Query rejected before running" in result.result_for_llm and "filters" in result.result_for_llm
+    assert CROSS_JOIN_SQL not in db.executed
+    assert f"EXPLAIN (FORMAT JSON) {CROSS_JOIN_SQL}" in db.executed
+    assert guard.get_stats()["rejected"] == 1
+
+    # row_action="reject" also rejects the large scan instead of capping it
+    strict = _guard(_db(), row_action="reject")
+    with tempfile.TemporaryDirectory() as workdir:
+        assert not _run_tool(strict, SCAN_SQL, workdir).success
+
+
+def test_large_scan_limited():
+    """An unfiltered scan estimated over max_rows runs with a LIMIT"""
+    db = _db()
+    guard = _guard(db, max_rows=50_000)
+    with tempfile.TemporaryDirectory() as workdir:
+        result = _run_tool(guard, SCAN_SQL, workdir)
+    assert result.success
+    assert f"{SCAN_SQL}\nLIMIT 50000" in db.executed and SCAN_SQL not in db.executed
+    assert guard.get_stats()["limited"] == 1
+
+
+def test_plan_cache():
+    """Reformatted copies of a query reuse its plan"""
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+
+    db = _db()
+    guard = _guard(db)
+
+    async def scenario():
+        await guard.run_sql(RunSqlToolArgs(sql=SMALL_SQL), _context())
+        await guard.run_sql(RunSqlToolArgs(sql="select sum(salesamount) from factinternetsales\n"
+                                               " where orderdatekey >= 20130101;"), _context())
+
+    asyncio.run(scenario())
+    stats = guard.get_stats()
+    assert stats["explained"] == 1 and stats["plan_cache_hits"] == 1
+    assert sum(1 for sql in db.executed if sql.startswith("EXPLAIN")) == 1
+
+
+def test_statement_timeout_per_group():
+    """The 0.3s query times out for analysts (0.1s), runs for admins (1s); connections are reset"""
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+
+    db = _db()
+    guard = _guard(db)
+
+    async def scenario():
+        outcomes = {}
+        for groups in (("read_sales",), ("admin",)):
+            for mode in ("run", "stream"):
+                try:
+                    if mode == "run":
+                        await guard.run_sql(RunSqlToolArgs(sql=SLOW_SQL), _context(groups))
+                    else:
+                        async for _ in guard.stream_sql(RunSqlToolArgs(sql=SLOW_SQL), _context(groups)):
+                            pass
+                    outcomes[(groups[0], mode)] = "ok"
+                except RuntimeError as e:
+                    outcomes[(groups[0], mode)] = str(e)
+        return outcomes
+
+    outcomes = asyncio.run(scenario())
+    logger.info(f"  {outcomes}")
+    assert outcomes[("read_sales", "run")] == outcomes[("read_sales", "stream")] == \
+        "canceling statement due to statement timeout"
+    assert outcomes[("admin", "run")] == outcomes[("admin", "stream")] == "ok"
+    assert all(conn.statement_timeout is None for conn in db.connections)
+    assert "SET statement_timeout = 100" in db.executed and "SET LOCAL statement_timeout = 1000" in db.executed
+
+    stats = guard.get_stats()
+    assert stats["timeouts"] == 2
+
+
+def test_plan_cost_next_to_runtime():
+    """Each query's record holds its plan estimate and its actual runtime and rows"""
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+
+    db = _db()
+    guard = _guard(db)
+
+    async def scenario():
+        for sql in (SMALL_SQL, SLOW_SQL):
+            await guard.run_sql(RunSqlToolArgs(sql=sql), _context(("admin",)))
+
+    asyncio.run(scenario())
+    stats = guard.get_stats()
+    records = {r["plan_cost"]: r for r in stats["recent"]}
+    logger.info(f"  {stats}")
+    REPORT["stats"] = stats
+    save_json_report(REPORT, "test_sql_guard_report.json")
+    assert records[1500.0]["runtime_ms"] >= 10 and records[1500.0]["rows"] == 1
+    assert records[4200.0]["runtime_ms"] >= 300 and records[4200.0]["timeout_ms"] == 1000
+    assert stats["median_ms_per_cost"] is not None
+
+
+def main():
+    tests = [
+        test_helpers,
+        test_cross_join_rejected,
+        test_large_scan_limited,
+        test_plan_cache,
+        test_statement_timeout_per_group,
+        test_plan_cost_next_to_runtime,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,218 @@
+"""
+Test the SQL result cache around the data source runner
+1. Equivalent SQL (case, whitespace, comments) hits the same entry
+2. Entry/byte bounds evict LRU entries; TTL expires them
+3. Writes and explicit calls invalidate only results of the affected tables
+4. The on-disk tier survives a restart and is shared safely by workers,
+   whose invalidations reach each other's memory tier
+Logs results to: test/logs/test_sql_result_cache.log
+"""
+
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report
+from fake_postgres import FakeDatabase
+
+# Setup logger
+logger, log_path = setup_logger("test_sql_result_cache", "test_sql_result_cache.log")
+
+LATENCY = 0.05  # seconds per warehouse query
+SALES_SQL = """SELECT SUM(salesamount) AS total
+FROM factinternetsales -- all channels
+WHERE orderdatekey >= 20130101;"""
+SALES_SQL_VARIANT = "select sum( salesamount ) as total from FactInternetSales where orderdatekey>=20130101"
+RESELLER_SQL = "SELECT SUM(salesamount) FROM factresellersales"
+YEARLY_SQL = """SELECT EXTRACT(YEAR FROM f.orderdate) AS year, SUM(f.salesamount)
+FROM factinternetsales f, dimdate d WHERE f.orderdatekey = d.datekey GROUP BY 1"""
+
+
+def _args(sql):
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+
+    return RunSqlToolArgs(sql=sql)
+
+
+def _cached_runner(db, **cache_kwargs):
+    from postgres_pool import PooledPostgresRunner
+    from sql_result_cache import CachedSqlRunner, SqlResultCache
+
+    runner = PooledPostgresRunner(connection_factory=db.connect, max_size=4)
+    return CachedSqlRunner(runner, SqlResultCache(**cache_kwargs))
+
+
+def _warehouse_queries(db):
+    return len([sql for sql in db.executed if sql != "SELECT 1"])
+
+
+def test_canonical_sql_shares_entries():
+    """Different spellings of the same query run once against the warehouse"""
+    from sql_utils import canonicalize_sql
+
+    assert canonicalize_sql(SALES_SQL) == canonicalize_sql(SALES_SQL_VARIANT)
+    assert canonicalize_sql("SELECT 'Bob' FROM t") != canonicalize_sql("SELECT 'BOB' FROM t")
+
+    db = FakeDatabase(latency=LATENCY)
+    runner = _cached_runner(db)
+
+    async def scenario():
+        timings = []
+        for sql in (SALES_SQL, SALES_SQL_VARIANT, SALES_SQL):
+            start = time.perf_counter()
+            df = await runner.run_sql(_args(sql), None)
+            timings.append(time.perf_counter() - start)
+            assert df["value"].tolist() == [1]
+        return timings
+
+    timings = asyncio.run(scenario())
+    stats = runner.cache.get_stats()
+    logger.info(f"  Miss {timings[0] * 1000:.1f} ms, hits {timings[1] * 1000:.2f} / {timings[2] * 1000:.2f} ms; {stats}")
+    save_json_report({"timings_ms": [t * 1000 for t in timings], "stats": stats}, "test_sql_result_cache_report.json")
+    assert _warehouse_queries(db) == 1
+    assert stats["hits"] == 2 and stats["misses"] == 1
+    assert max(timings[1:]) < timings[0] / 10
+
+
+def test_bounds_and_ttl():
+    """LRU eviction by entry count and bytes, and TTL expiry"""
+    from sql_result_cache import SqlResultCache
+    import pandas as pd
+
+    cache = SqlResultCache(max_entries=2)
+    for i in range(3):
+        cache.put(f"Q{i}", pd.DataFrame({"v": [i]}), ["t"])
+    assert cache.get("Q0") is None and cache.get("Q2") is not None
+    assert cache.get_stats()["evictions"] == 1
+
+    big = pd.DataFrame({"v": range(10_000)})
+    cache = SqlResultCache(max_bytes=int(big.memory_usage(deep=True).sum() * 1.5))
+    cache.put("A", big, ["t"])
+    cache.put("B", big, ["t"])
+    assert cache.get("A") is None and cache.get("B") is not None
+
+    cache = SqlResultCache(ttl_seconds=0.05)
+    cache.put("A", pd.DataFrame({"v": [1]}), ["t"])
+    time.sleep(0.1)
+    assert cache.get("A") is None
+
+
+def test_table_level_invalidation():
+    """A write to one table drops only the results that read it"""
+    db = FakeDatabase()
+    runner = _cached_runner(db)
+
+    async def scenario():
+        await runner.run_sql(_args(SALES_SQL), None)
+        await runner.run_sql(_args(RESELLER_SQL), None)
+        await runner.run_sql(_args("UPDATE factinternetsales SET salesamount = 0 WHERE 1 = 0"), None)
+        await runner.run_sql(_args(SALES_SQL), None)      # re-runs
+        await runner.run_sql(_args(RESELLER_SQL), None)   # still cached
+        runner.cache.invalidate_tables(["FactResellerSales"])
+        await runner.run_sql(_args(RESELLER_SQL), None)   # re-runs
+        # Comma-joined tables are tracked too; EXTRACT(... FROM column) is not a table
+        await runner.run_sql(_args(YEARLY_SQL), None)
+        assert runner.cache.invalidate_tables(["orderdate"]) == 0
+        await runner.run_sql(_args(YEARLY_SQL), None)     # still cached
+        assert runner.cache.invalidate_tables(["dimdate"]) == 1
+        await runner.run_sql(_args(YEARLY_SQL), None)     # re-runs
+
+    asyncio.run(scenario())
+    stats = runner.cache.get_stats()
+    logger.info(f"  Executed: {db.executed}")
+    assert db.executed.count(SALES_SQL) == 2
+    assert db.executed.count(RESELLER_SQL) == 2
+    assert db.executed.count(YEARLY_SQL) == 2
+    assert stats["invalidations"] == 3
+
+
+def test_stream_sql_is_cached():
+    """Streamed results are cached and replayed in chunks"""
+    db = FakeDatabase()
+    db.results[SALES_SQL] = (("id",), [(i,) for i in range(250)])
+    runner = _cached_runner(db)
+
+    async def collect():
+        return [len(c) async for c in runner.stream_sql(_args(SALES_SQL), None, chunk_size=100)]
+
+    assert asyncio.run(collect()) == [100, 100, 50]
+    assert asyncio.run(collect()) == [100, 100, 50]
+    assert db.executed.count(SALES_SQL) == 1
+
+
+def test_disk_tier_survives_restart():
+    """A new cache over the same directory serves earlier results"""
+    with tempfile.TemporaryDirectory() as disk_dir:
+        db = FakeDatabase()
+        asyncio.run(_cached_runner(db, disk_dir=disk_dir).run_sql(_args(SALES_SQL), None))
+
+        restarted = _cached_runner(db, disk_dir=disk_dir)
+        df = asyncio.run(restarted.run_sql(_args(SALES_SQL_VARIANT), None))
+        stats = restarted.cache.get_stats()
+        logger.info(f"  After restart: {stats}")
+        assert df["value"].tolist() == [1]
+        assert _warehouse_queries(db) == 1
+        assert stats["disk_hits"] == 1
+
+        restarted.cache.invalidate_tables(["factinternetsales"])
+        assert _cached_runner(db, disk_dir=disk_dir).cache.get_stats()["disk_entries"] == 0
+
+
+def test_workers_share_disk_tier():
+    """Workers over one directory keep each other's entries and see them without a restart"""
+    with tempfile.TemporaryDirectory() as disk_dir:
+        db = FakeDatabase()
+        worker_a = _cached_runner(db, disk_dir=disk_dir)
+        worker_b = _cached_runner(db, disk_dir=disk_dir)
+
+        asyncio.run(worker_a.run_sql(_args(SALES_SQL), None))
+        asyncio.run(worker_b.run_sql(_args(RESELLER_SQL), None))
+        worker_c = _cached_runner(db, disk_dir=disk_dir)  # starting a worker deletes nothing fresh
+        for worker in (worker_a, worker_b, worker_c):
+            asyncio.run(worker.run_sql(_args(SALES_SQL), None))
+            asyncio.run(worker.run_sql(_args(RESELLER_SQL), None))
+
+        logger.info(f"  Worker C: {worker_c.cache.get_stats()}")
+        assert _warehouse_queries(db) == 2
+        assert worker_c.cache.get_stats()["disk_entries"] == 2
+        assert not list(Path(disk_dir).glob("*.tmp"))
+
+        # An invalidation in one worker also drops the result other workers hold in memory
+        worker_b.cache.invalidate_tables(["factresellersales"])
+        asyncio.run(worker_a.run_sql(_args(RESELLER_SQL), None))
+        assert _warehouse_queries(db) == 3
+        # ... and the re-run result replaces theirs: worker C reads it from disk
+        asyncio.run(worker_c.run_sql(_args(RESELLER_SQL), None))
+        asyncio.run(worker_c.run_sql(_args(SALES_SQL), None))
+        assert _warehouse_queries(db) == 3
+        assert worker_c.cache.get_stats()["disk_hits"] == 3
+
+
+def main():
+    tests = [
+        test_canonical_sql_shares_entries,
+        test_bounds_and_ttl,
+        test_table_level_invalidation,
+        test_stream_sql_is_cached,
+        test_disk_tier_survives_restart,
+        test_workers_share_disk_tier,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,224 @@
+"""
+Test local validation of generated SQL against training_data/schema.json
+1. Every training query and a set of valid edge cases (CTEs, subqueries,
+   EXTRACT ... FROM, window clauses, casts, information_schema) pass
+2. Typos in tables, columns and aliases get precise errors with
+   "did you mean" suggestions; broken syntax is caught
+3. Rejected queries never reach the database (fake Postgres connection)
+4. Per-conversation metrics: rejections, attempts to fix, warehouse calls saved
+Logs results to: test/logs/test_sql_validator.log
+"""
+
+import asyncio
+import sys
+import tempfile
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report, load_training_questions
+from fake_postgres import FakeDatabase
+
+# Setup logger
+logger, log_path = setup_logger("test_sql_validator", "test_sql_validator.log")
+
+VALID_SQL = [
+    "SELECT EXTRACT(YEAR FROM d.fulldatealternatekey) yr, COUNT(*) n FROM dimdate d GROUP BY yr ORDER BY n DESC",
+    "WITH m AS (SELECT productkey, SUM(salesamount) total FROM factinternetsales GROUP BY productkey) "
+    "SELECT p.englishproductname, m.total FROM m JOIN dimproduct p ON p.productkey = m.productkey "
+    "ORDER BY total DESC LIMIT 10",
+    "SELECT COALESCE((SELECT MAX(salesamount) FROM factinternetsales), 0) AS top_sale",
+    "SELECT g.d FROM generate_series(1, 10) AS g(d)",
+    "SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'",
+    "SELECT customerkey FROM dimcustomer WHERE middlename IS DISTINCT FROM lastname",
+    "SELECT CAST(salesamount AS double precision), salesamount::numeric(10, 2) FROM factinternetsales",
+    "SELECT productkey, RANK() OVER w FROM factinternetsales WINDOW w AS (ORDER BY salesamount DESC)",
+    'SELECT "SalesAmount" FROM public."FactInternetSales" -- quoted names\n',
+    "SELECT f.salesamount FROM (factinternetsales f JOIN dimdate d ON f.orderdatekey = d.datekey)",
+    "SELECT SUM(salesamount) FROM factinternetsales WHERE orderdate >= CURRENT_DATE - INTERVAL '1 year'; "
+    "SELECT 1",
+    "SELECT d.calendaryear, p.englishproductname, GROUPING(d.calendaryear) g, SUM(f.salesamount) "
+    "FROM factinternetsales f JOIN dimdate d ON f.orderdatekey = d.datekey "
+    "JOIN dimproduct p ON f.productkey = p.productkey "
+    "GROUP BY GROUPING SETS ((d.calendaryear), (p.englishproductname), ())",
+]
+
+# (sql, substrings the error must contain)
+INVALID_SQL = [
+    ("SELECT salesamt FROM factinternetsales",
+     ['Column "salesamt" does not exist', 'Did you mean "salesamount"']),
+    ("SELECT f.salesamt FROM factinternetsales f",
+     ['"f.salesamt" does not exist in factinternetsales (alias f)', 'Did you mean "f.salesamount"']),
+    ("SELECT SUM(fis.salesamount) FROM factinternetsales f",
+     ['Missing FROM-clause entry for "fis"', "f (factinternetsales)"]),
+    ("SELECT * FROM factinternetsale", ['Table "factinternetsale" does not exist', '"factinternetsales"']),
+    ("SELECT d.calendaryear, SUM(f.salesamount) FROM factinternetsales f JOIN dimdate d "
+     "ON f.orderdatekey = d.datekey GROUP BY d.calendaryr",
+     ['"d.calendaryr" does not exist in dimdate (alias d)', 'Did you mean "d.calendaryear"']),
+    ("SELECT p.englishproductname FROM dimproduct p WHERE p.listprice > (SELECT AVG(listprce) FROM dimproduct)",
+     ['Column "listprce" does not exist', '"listprice"']),
+    ("SELECT calendaryear FROM dimdate GROUP BY GROUPING SETS ((calendaryear), (calendaryr))",
+     ['Column "calendaryr" does not exist', '"calendaryear"']),
+    ("SELECT SUM(salesamount FROM factinternetsales", ["'(' at character 11 is never closed"]),
+    ("SELECT * FROM dimcustomer WHERE lastname = 'O'Brien'", ["Unterminated string literal"]),
+]
+
+
+def _validator():
+    from knowledge_base import KnowledgeBase
+    from sql_validator import SchemaValidator
+
+    kb = KnowledgeBase()
+    kb.load_all()
+    return SchemaValidator.from_knowledge_base(kb)
+
+
+def _context(conversation_id="c1"):
+    from vanna.core.tool import ToolContext
+    from vanna.core.user import User
+
+    return ToolContext.model_construct(
+        user=User(id="analyst_1", group_memberships=["read_sales"]),
+        conversation_id=conversation_id,
+        request_id="r1",
+        agent_memory=None,
+        metadata={},
+    )
+
+
+def _runner(db, validator):
+    from postgres_pool import PooledPostgresRunner
+    from sql_validator import ValidatingSqlRunner
+
+    return ValidatingSqlRunner(PooledPostgresRunner(connection_factory=db.connect, max_size=2), validator)
+
+
+def _run_tool(runner, sql, workdir, conversation_id="c1"):
+    from vanna.capabilities.sql_runner import RunSqlToolArgs
+    from vanna.integrations.local import LocalFileSystem
+    from result_streaming import StreamingRunSqlTool
+
+    tool = StreamingRunSqlTool(sql_runner=runner, file_system=LocalFileSystem(workdir))
+    return asyncio.run(tool.execute(_context(conversation_id), RunSqlToolArgs(sql=sql)))
+
+
+def test_valid_sql_passes():
+    """No false positives on the 55 training queries or the edge cases"""
+    validator = _validator()
+    queries = [pair["sql"] for pair in load_training_questions()] + VALID_SQL
+    failures = {sql: validator.validate(sql) for sql in queries if validator.validate(sql)}
+    for sql, problems in failures.items():
+        logger.error(f"  False positive: {sql}\n    {problems}")
+    assert len(validator.tables) == 35
+    assert not failures
+
+
+def test_precise_errors():
+    validator = _validator()
+    for sql, expected in INVALID_SQL:
+        problems = validator.validate(sql)
+        logger.info(f"  {sql}\n    -> {problems}")
+        assert len(problems) == 1, problems
+        for text in expected:
+            assert text in problems[0], (text, problems)
+
+    # Every problem in a query is reported at once
+    problems = validator.validate("SELECT f.salesamt, d.calendaryr FROM factinternetsales f JOIN dimdate d "
+                                  "ON f.orderdatekey = d.datekey")
+    assert len(problems) == 2
+
+
+def test_rejected_before_warehouse():
+    """A typo'd column fails in the tool result with the fix, and Postgres never sees the query"""
+    db = FakeDatabase(latency=0.01)
+    runner = _runner(db, _validator())
+    with tempfile.TemporaryDirectory() as workdir:
+        bad = _run_tool(runner, "SELECT SUM(salesamt) FROM factinternetsales", workdir)
+        good = _run_tool(runner, "SELECT SUM(salesamount) FROM factinternetsales", workdir)
+
+    logger.info(f"  Tool result for the LLM: {bad.result_for_llm}")
+    assert not bad.success and 'Did you mean "salesamount"' in bad.result_for_llm
+    assert "not sent to the database" in bad.result_for_llm
+    assert good.success
+    assert db.executed == ["SELECT SUM(salesamount) FROM factinternetsales"]
+
+
+def test_conversation_metrics():
+    """Rejections, attempts to fix and warehouse errors are tracked per conversation"""
+    db = FakeDatabase(latency=0.02)
+    db.fail_sql.add("SELECT englishproductname FROM dimproduct WHERE listprice > 'cheap'")
+    runner = _runner(db, _validator())
+    turns = {
+        # Two wrong attempts, then fixed
+        "conv_typos": ["SELECT SUM(f.salesamt) FROM factinternetsales f",
+                       "SELECT SUM(f.sales_amount) FROM factinternetsales f",
+                       "SELECT SUM(f.salesamount) FROM factinternetsales f"],
+        # Right first time
+        "conv_clean": ["SELECT COUNT(*) FROM dimcustomer"],
+        # Valid references, but Postgres rejects the comparison
+        "conv_db_error": ["SELECT englishproductname FROM dimproduct WHERE listprice > 'cheap'"],
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        for conversation_id, queries in turns.items():
+            for sql in queries:
+                _run_tool(runner, sql, workdir, conversation_id)
+
+    stats = runner.get_stats()
+    logger.info(f"  {stats}")
+    save_json_report(stats, "test_sql_validator_report.json")
+    assert stats["checked"] == 5 and stats["rejected"] == 2 and stats["warehouse_calls_saved"] == 2
+    assert stats["problems_by_kind"] == {"column": 2}
+    assert stats["conversations"] == 3 and stats["conversations_with_rejections"] == 1
+    assert stats["fixed"] == 1 and stats["avg_attempts_to_fix"] == 2.0
+    assert stats["warehouse_errors_after_validation"] == 1
+    assert stats["recent"]["conv_typos"]["rejected"] == 2 and stats["recent"]["conv_clean"]["rejected"] == 0
+    assert stats["warehouse_ms_saved"] >= 2 * 20
+    assert len([sql for sql in db.executed if sql != "SELECT 1"]) == 3  # SELECT 1: health check after the error
+
+
+def test_schema_follows_reload():
+    """A new KB version rebuilds the table map"""
+    from sql_validator import SchemaValidator
+
+    ddl = ["CREATE TABLE sales (\n    id integer,\n    amount numeric\n);"]
+    version = ["v1"]
+    validator = SchemaValidator(lambda: ddl, lambda: version[0])
+    assert validator.validate("SELECT region FROM sales")
+
+    ddl.append("CREATE TABLE regions (\n    id integer,\n    region text\n);")
+    ddl[0] = "CREATE TABLE sales (\n    id integer,\n    amount numeric,\n    region text\n);"
+    version[0] = "v2"
+    assert validator.validate("SELECT region FROM sales") == []
+    assert set(validator.tables) == {"sales", "regions"}
+
+    # Built on a knowledge base nobody has loaded yet: reading the version loads it, so it comes first
+    from knowledge_base import KnowledgeBase
+
+    validator = SchemaValidator.from_knowledge_base(KnowledgeBase())
+    assert "factinternetsales" in validator.tables
+    assert validator.validate("SELECT SUM(salesamount) FROM factinternetsales") == []
+
+
+def main():
+    tests = [
+        test_valid_sql_passes,
+        test_precise_errors,
+        test_rejected_before_warehouse,
+        test_conversation_metrics,
+        test_schema_follows_reload,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+"""
+Test local token counting and prompt budgeting
+Checks that every knowledge base section is counted at load time, that the
+budgeter trims old turns and context sections by priority while keeping the
+current turn and tool call/result pairs, and benchmarks counting + budgeting
+per request over all training questions (target: under 1 ms).
+Logs results to: test/logs/test_token_budget.log
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report, load_training_questions
+
+# Setup logger
+logger, log_path = setup_logger("test_token_budget", "test_token_budget.log")
+
+BASE_PROMPT = "You are a helpful data analyst. Answer questions by writing PostgreSQL queries."
+
+
+def _kb():
+    from knowledge_base import KnowledgeBase
+
+    kb = KnowledgeBase(artifact_path="")
+    kb.load_all()
+    return kb
+
+
+def _turn(i, question, answer_rows=50):
+    return [
+        {"role": "user", "content": question},
+        {"role": "assistant", "content": None, "tool_calls": [{
+            "id": f"call_{i}", "type": "function",
+            "function": {"name": "run_sql", "arguments": '{"sql": "SELECT 1"}'},
+        }]},
+        {"role": "tool", "tool_call_id": f"call_{i}", "content": "\n".join(f"row {n},{n * 7}" for n in range(answer_rows))},
+        {"role": "assistant", "content": f"Here is answer {i}."},
+    ]
+
+
+def test_section_counts_precomputed():
+    """Every table, term, rule and example has a token count after load"""
+    from knowledge_base import format_table
+
+    kb = _kb()
+    counts = kb.get_token_counts()
+    cache = kb.get_cache()
+    logger.info(f"  Tokenizer {counts['counter']}: full context {counts['full_context']} tokens")
+    assert counts["counter"] == kb.token_counter.name
+    assert set(counts["tables"]) == {t['name'] for t in cache['schema']['tables']}
+    assert len(counts["terms"]) == len(cache['documentation']['business_terms'])
+    assert len(counts["rules"]) == len(cache['documentation']['business_rules'])
+    assert len(counts["examples"]) == len(cache['queries']['question_sql_pairs'])
+    table = cache['schema']['tables'][0]
+    assert counts["tables"][table['name']] == kb.token_counter(format_table(table))
+    assert counts["full_context"] == kb.token_counter(kb.get_system_context())
+
+
+def test_trims_history_then_sections():
+    """Oldest turns go first, then examples/terms/rules; the current turn and tool pairs stay intact"""
+    from token_budget import PromptBudgeter
+
+    kb = _kb()
+    system = {"role": "system", "content": f"{BASE_PROMPT}\n\n{kb.get_system_context()}"}
+    history = [m for i in range(6) for m in _turn(i, f"question {i}", answer_rows=200)]
+    current = _turn(6, "Internet sales by year")[:3]
+    messages = [system] + history + current
+
+    budgeter = PromptBudgeter(context_window=10**6, completion_reserve=1000, counter=kb.token_counter)
+    untouched, stats = budgeter.fit(messages)
+    assert untouched == messages and not stats.dropped_messages
+
+    full_tokens = stats.prompt_tokens
+    system_tokens = budgeter.count_message(system)
+    # Room for the system prompt, the current turn and about two old turns
+    budgeter = PromptBudgeter(context_window=system_tokens + (full_tokens - system_tokens) // 2,
+                              completion_reserve=0, counter=kb.token_counter, keep_recent_turns=2)
+    trimmed, stats = budgeter.fit(messages)
+    logger.info(f"  History trim: {stats}")
+    assert trimmed[0] == system and trimmed[-3:] == current
+    assert stats.dropped_messages % 4 == 0 and stats.dropped_messages > 0
+    assert not stats.dropped_sections and not stats.over_budget
+    assert trimmed[1]["content"] == f"question {stats.dropped_messages // 4}"
+
+    # Too small for the whole context: sections go in priority order after the old turns
+    budgeter = PromptBudgeter(context_window=system_tokens - 50, completion_reserve=0,
+                              counter=kb.token_counter, keep_recent_turns=0)
+    trimmed, stats = budgeter.fit(messages)
+    logger.info(f"  Section trim: {stats}")
+    assert stats.dropped_sections[0] == "EXAMPLE QUERIES"
+    assert "=== EXAMPLE QUERIES ===" not in trimmed[0]["content"]
+    assert "=== DATABASE SCHEMA ===" in trimmed[0]["content"]
+    assert trimmed[-3:] == current
+    for i, msg in enumerate(trimmed):
+        if msg["role"] == "tool":
+            assert trimmed[i - 1].get("tool_calls"), "tool result without its call"
+
+
+def test_budgeting_overhead_per_request():
+    """Counting and budgeting a realistic request adds well under a millisecond"""
+    from vanna.core.llm import LlmRequest, LlmMessage
+    from vanna.core.user import User
+    from azure_openai_llm import AzureOpenAILlmService
+    from context_builder import ContextBuilder, KnowledgeContextEnhancer
+    from token_budget import PromptBudgeter
+
+    kb = _kb()
+    enhancer = KnowledgeContextEnhancer(ContextBuilder(kb))
+    budgeter = PromptBudgeter(counter=kb.token_counter)
+    llm = AzureOpenAILlmService(model="gpt-4", api_key="test-key", azure_endpoint="http://127.0.0.1:1",
+                                api_version="2024-10-21", budgeter=budgeter)
+    user = User(id="demo_user", group_memberships=["read_sales"])
+
+    history = []
+    timings = []
+    for i, q in enumerate(load_training_questions()):
+        prompt = asyncio.run(enhancer.enhance_system_prompt(BASE_PROMPT, q['question'], user))
+        messages = [LlmMessage(role=m["role"], content=m["content"] or "") for m in history[-40:]]
+        messages.append(LlmMessage(role="user", content=q['question']))
+        start = time.perf_counter()
+        llm._build_payload(LlmRequest(messages=messages, user=user, system_prompt=prompt))
+        timings.append((time.perf_counter() - start) * 1000)
+        history += [{"role": "user", "content": q['question']}, {"role": "assistant", "content": f"SQL: {q['sql']}"}]
+
+    stats = budgeter.get_stats()
+    warm = sorted(timings[1:])
+    summary = {
+        "tokenizer": stats["tokenizer"],
+        "requests": stats["requests"],
+        "budgeter_avg_ms": stats["avg_ms"],
+        "budgeter_max_ms": stats["max_ms"],
+        "payload_p50_ms": warm[len(warm) // 2],
+        "payload_p95_ms": warm[int(len(warm) * 0.95)],
+    }
+    logger.info(f"  {summary}")
+    save_json_report(summary, "test_token_budget_report.json")
+    assert stats["avg_ms"] < 1.0, stats
+
+
+def main():
+    tests = [
+        test_section_counts_precomputed,
+        test_trims_history_then_sections,
+        test_budgeting_overhead_per_request,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
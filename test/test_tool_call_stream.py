@@ -0,0 +1,203 @@
+"""
+Test incremental assembly of streamed tool-call arguments
+Checks the assembler against json.loads for every way of splitting tricky
+arguments into deltas, that a complete `sql` argument is reported before the
+stream ends (also through AzureOpenAILlmService against a fake endpoint),
+and micro-benchmarks it against per-delta string concatenation over
+simulated streams of the training SQL and of very large SQL payloads.
+Logs results to: test/logs/test_tool_call_stream.log
+"""
+
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from conftest import setup_logger, save_json_report, load_training_questions
+from fake_azure_openai import FakeAzureOpenAIServer
+
+# Setup logger
+logger, log_path = setup_logger("test_tool_call_stream", "test_tool_call_stream.log")
+
+TRICKY_ARGUMENTS = [
+    {"sql": "SELECT 1"},
+    {"sql": "SELECT name FROM t WHERE note = 'say \"hi\"' AND path LIKE 'C:\\\\temp\\\\%'"},
+    {"sql": "SELECT '{not: json}', '[1, 2]' -- : , }", "limit": 10},
+    {"options": {"sql": "nested, not top-level"}, "sql": "SELECT 'caf\u00e9 \u2603'\nFROM t\tWHERE x > 1"},
+    {"title": "first", "sql": "", "tags": ["a", "b"]},
+]
+
+
+def _fragments(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def _assemble(fragments):
+    from tool_call_stream import ToolCallAssembler
+
+    early = []
+    assembler = ToolCallAssembler(on_argument=early.append)
+    assembler.feed(0, id="call_1", name="run_sql")
+    for fragment in fragments:
+        assembler.feed(0, arguments=fragment)
+    return assembler, early
+
+
+def test_matches_json_for_every_split():
+    """Arguments and early values match json.loads whatever the delta boundaries"""
+    for args in TRICKY_ARGUMENTS:
+        for ensure_ascii in (True, False):
+            text = json.dumps(args, ensure_ascii=ensure_ascii)
+            for size in range(1, 9):
+                assembler, early = _assemble(_fragments(text, size))
+                builder = assembler.completed()[0]
+                assert builder.parse_arguments() == args, (text, size)
+                expected = {k: v for k, v in args.items() if isinstance(v, str)}
+                assert {e.key: e.value for e in early} == expected, (text, size, early)
+                assert all(e.tool_call_id == "call_1" and e.tool_name == "run_sql" for e in early)
+
+    # Invalid JSON keeps the non-streamed fallback
+    assembler, _ = _assemble(['{"sql": "SELECT', ' 1'])
+    assert assembler.completed()[0].parse_arguments() == {"_raw": '{"sql": "SELECT 1'}
+
+
+def test_sql_known_before_stream_ends():
+    """The sql value is reported at its closing quote, before later arguments arrive"""
+    text = json.dumps({"sql": "SELECT * FROM dimcustomer", "explanation": "x" * 400})
+    fragments = _fragments(text, 4)
+    from tool_call_stream import ToolCallAssembler
+
+    seen_at = []
+    assembler = ToolCallAssembler(on_argument=lambda e: seen_at.append((e.key, fed)))
+    assembler.feed(0, id="call_1", name="run_sql")
+    for fed, fragment in enumerate(fragments, 1):
+        assembler.feed(0, arguments=fragment)
+    assert seen_at[0] == ("sql", text.index('", "explanation"') // 4 + 1)
+    assert seen_at[0][1] < len(fragments) / 5
+
+
+def test_early_sql_through_llm_service():
+    """stream_request hands the SQL to on_tool_argument while deltas are still arriving"""
+    from vanna.core.llm import LlmRequest, LlmMessage
+    from vanna.core.user import User
+    from azure_openai_llm import AzureOpenAILlmService
+
+    sql = "SELECT d.calendaryear, SUM(f.salesamount) FROM factinternetsales f JOIN dimdate d ON f.orderdatekey = d.datekey GROUP BY 1"
+    arguments = json.dumps({"sql": sql, "reason": "yearly totals " * 10})
+    early_calls = []
+
+    def on_tool_argument(request, early):
+        early_calls.append((request.user.id, early.key, early.value, time.perf_counter()))
+
+    with FakeAzureOpenAIServer(tool_call={"name": "run_sql", "arguments": arguments},
+                               fragment_size=8, chunk_delay=0.005) as server:
+        llm = AzureOpenAILlmService(model="gpt-4", api_key="test-key", azure_endpoint=server.endpoint,
+                                    api_version="2024-10-21", on_tool_argument=on_tool_argument, max_retries=0)
+        request = LlmRequest(messages=[LlmMessage(role="user", content="sales by year")],
+                             user=User(id="demo_user", group_memberships=["read_sales"]))
+
+        async def run():
+            chunks = [chunk async for chunk in llm.stream_request(request)]
+            return chunks, time.perf_counter()
+
+        chunks, ended = asyncio.run(run())
+
+    tool_calls = chunks[-1].tool_calls
+    assert tool_calls[0].name == "run_sql" and tool_calls[0].arguments["sql"] == sql
+    assert early_calls[0][:3] == ("demo_user", "sql", sql)
+    stats = llm.get_stats()
+    logger.info(f"  SQL known {1000 * (ended - early_calls[0][3]):.1f} ms before the stream ended: {stats}")
+    assert stats["early_sql"] == 1 and stats["avg_early_sql_lead_ms"] > 20
+
+
+def _concatenate(fragments):
+    """The previous per-delta assembly"""
+    b = {"arguments": ""}
+    for fragment in fragments:
+        b["arguments"] = (b["arguments"] or "") + fragment
+    return json.loads(b["arguments"])
+
+
+def _best_of(fn, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def test_benchmark_assembly():
+    """Linear assembly; clearly faster than concatenation once SQL payloads get large"""
+    streams = [_fragments(json.dumps({"sql": q['sql']}), 4) for q in load_training_questions()]
+
+    def assemble_all(all_fragments):
+        for fragments in all_fragments:
+            _assemble(fragments)[0].completed()[0].parse_arguments()
+
+    def concatenate_all(all_fragments):
+        for fragments in all_fragments:
+            _concatenate(fragments)
+
+    results = {"training_sql": {
+        "streams": len(streams),
+        "deltas": sum(len(f) for f in streams),
+        "assembler_ms": _best_of(assemble_all, streams),
+        "concatenation_ms": _best_of(concatenate_all, streams),
+    }}
+    row = "SELECT customerkey, firstname, lastname, emailaddress FROM dimcustomer WHERE customerkey = 11000 UNION ALL\n"
+    for size_kb in (16, 128):
+        text = json.dumps({"sql": row * (size_kb * 1024 // len(row))})
+        fragments = _fragments(text, 4)
+        results[f"sql_{size_kb}kb"] = {
+            "deltas": len(fragments),
+            "assembler_ms": _best_of(lambda f: _assemble(f)[0].completed()[0].parse_arguments(), fragments),
+            "concatenation_ms": _best_of(_concatenate, fragments, repeat=1),
+        }
+    # Many short top-level strings: each closing quote costs only its own string
+    for keys in (2000, 16000):
+        fragments = _fragments(json.dumps({f"k{i}": "v" * 8 for i in range(keys)}), 4)
+        results[f"strings_{keys}"] = {
+            "deltas": len(fragments),
+            "assembler_ms": _best_of(lambda f: _assemble(f)[0].completed()[0].parse_arguments(), fragments),
+            "concatenation_ms": _best_of(_concatenate, fragments, repeat=1),
+        }
+    for name, r in results.items():
+        logger.info(f"  {name}: {r['deltas']} deltas, assembler {r['assembler_ms']:.2f} ms, "
+                    f"concatenation {r['concatenation_ms']:.2f} ms")
+    save_json_report(results, "test_tool_call_stream_report.json")
+
+    # Linear: 8x the data costs well under 16x the time
+    assert results["sql_128kb"]["assembler_ms"] < 16 * results["sql_16kb"]["assembler_ms"]
+    assert results["sql_128kb"]["assembler_ms"] < results["sql_128kb"]["concatenation_ms"]
+    # Closing a string never re-joins the buffer: the fragments stay as received until the end
+    fragments = _fragments(json.dumps({f"k{i}": "v" * 8 for i in range(2000)}), 4)
+    builder = _assemble(fragments)[0].completed()[0]
+    assert len(builder.early_arguments) == 2000 and len(builder._parts) == len(fragments)
+
+
+def main():
+    tests = [
+        test_matches_json_for_every_split,
+        test_sql_known_before_stream_ends,
+        test_early_sql_through_llm_service,
+        test_benchmark_assembly,
+    ]
+    failed = 0
+    for test in tests:
+        logger.info(f"Running {test.__name__}")
+        try:
+            test()
+            logger.info("  ✅ PASSED")
+        except AssertionError as e:
+            failed += 1
+            logger.error(f"  ❌ FAILED: {e}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
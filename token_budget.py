@@ -0,0 +1,268 @@
+"""Local token counting and prompt budgeting for Azure OpenAI requests"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field, asdict
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+ESTIMATE = "estimate_tokens"
+DEFAULT_ENCODING = "o200k_base"  # gpt-4o family; cl100k_base for gpt-4 / gpt-35-turbo
+
+# Context sections the budgeter may drop, first to last (the schema is never dropped)
+CONTEXT_SECTION_PRIORITY = ("EXAMPLE QUERIES", "BUSINESS TERMINOLOGY", "BUSINESS RULES")
+_SECTION_HEADER = re.compile(r"\n*=== ([A-Z][A-Z ]*) ===")
+
+# Chat format overhead (OpenAI cookbook): per message and for priming the reply
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_PRIMING_TOKENS = 3
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token)"""
+    return (len(text) + 3) // 4
+
+
+class TokenCounter:
+    """
+    Named, memoized token counter.
+    Text is counted paragraph by paragraph ("\\n\\n"-separated) through an LRU
+    memo, so the tables, rules and examples that recur in every prompt are
+    tokenized once and a request only pays for the text it has not seen.
+    """
+
+    def __init__(self, name: str, count: Callable[[str], int], cache_size: int = 8192):
+        self.name = name
+        self._count = count
+        self.cache_size = cache_size
+        self._memo: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, text: str) -> int:
+        if not text:
+            return 0
+        chunks = text.split("\n\n")
+        return sum(self._count_chunk(chunk) for chunk in chunks) + len(chunks) - 1
+
+    def _count_chunk(self, chunk: str) -> int:
+        with self._lock:
+            count = self._memo.get(chunk)
+            if count is not None:
+                self._memo.move_to_end(chunk)
+                return count
+        count = self._count(chunk) if chunk else 0
+        with self._lock:
+            self._memo[chunk] = count
+            while len(self._memo) > self.cache_size:
+                self._memo.popitem(last=False)
+        return count
+
+    def __repr__(self) -> str:
+        return f"TokenCounter({self.name!r})"
+
+
+_counters: Dict[str, TokenCounter] = {}
+
+
+def get_token_counter(encoding: Optional[str] = None) -> TokenCounter:
+    """
+    Shared counter for a tiktoken encoding (KB_TOKENIZER, default o200k_base).
+    'estimate' or a missing/unloadable tiktoken falls back to ~4 characters per token.
+    """
+    encoding = encoding or os.getenv('KB_TOKENIZER', DEFAULT_ENCODING)
+    if encoding in ("estimate", ESTIMATE):
+        encoding = ESTIMATE
+    if encoding in _counters:
+        return _counters[encoding]
+
+    counter = None
+    if encoding != ESTIMATE:
+        try:
+            import tiktoken
+
+            enc = tiktoken.get_encoding(encoding)
+            counter = TokenCounter(encoding, lambda text: len(enc.encode(text, disallowed_special=())))
+        except Exception as e:
+            logger.warning(f"⚠ Tokenizer {encoding!r} unavailable ({e}), estimating tokens from length")
+    if counter is None:
+        counter = _counters.get(ESTIMATE) or TokenCounter(ESTIMATE, estimate_tokens)
+        _counters[ESTIMATE] = counter
+    _counters[encoding] = counter
+    return counter
+
+
+Message = Dict[str, Any]
+
+
+def split_turns(messages: List[Message]) -> Tuple[List[Message], List[List[Message]], List[Message]]:
+    """
+    Split chat messages into (leading system messages, history turns, current turn).
+    The current turn starts at the last user message; every history turn starts
+    at a user message, so a tool call always stays in the turn of its result.
+    """
+    n_system = 0
+    while n_system < len(messages) and messages[n_system]["role"] == "system":
+        n_system += 1
+    current_start = len(messages)
+    for i in range(len(messages) - 1, n_system - 1, -1):
+        if messages[i]["role"] == "user":
+            current_start = i
+            break
+    turns: List[List[Message]] = []
+    for msg in messages[n_system:current_start]:
+        if msg["role"] == "user" or not turns:
+            turns.append([])
+        turns[-1].append(msg)
+    return list(messages[:n_system]), turns, messages[current_start:]
+
+
+def count_message_tokens(message: Message, counter: TokenCounter) -> int:
+    """Tokens of one chat message: content, tool calls and the per-message overhead"""
+    tokens = MESSAGE_OVERHEAD_TOKENS + counter(message.get("content") or "")
+    if message.get("tool_calls"):
+        tokens += counter(json.dumps(message["tool_calls"]))
+    return tokens
+
+
+def drop_section(text: str, name: str) -> str:
+    """Remove a `=== NAME ===` section (header to the next header) from a context string"""
+    headers = list(_SECTION_HEADER.finditer(text))
+    for i, header in enumerate(headers):
+        if header.group(1).strip() == name:
+            end = headers[i + 1].start() if i + 1 < len(headers) else len(text)
+            return text[:header.start()] + text[end:]
+    return text
+
+
+@dataclass
+class BudgetStats:
+    """What the budgeter did to one request"""
+    budget: int
+    prompt_tokens: int
+    dropped_messages: int = 0
+    dropped_sections: List[str] = field(default_factory=list)
+    over_budget: bool = False
+    elapsed_ms: float = 0.0
+
+
+class PromptBudgeter:
+    """
+    Keeps a chat request inside the deployment's context window.
+    The budget is the window minus the completion reserve (the request's
+    max_tokens) and the tools. When the messages do not fit, it drops in
+    order: the oldest conversation turns beyond `keep_recent_turns`, the
+    context sections in CONTEXT_SECTION_PRIORITY order, then the remaining
+    history. System messages, the current question and its tool calls are
+    always kept; whole turns are dropped so tool calls keep their results.
+    """
+
+    def __init__(
+        self,
+        context_window: int = 128000,
+        completion_reserve: int = 4096,
+        counter: Optional[TokenCounter] = None,
+        keep_recent_turns: int = 2,
+        droppable_sections: Sequence[str] = CONTEXT_SECTION_PRIORITY,
+    ):
+        self.context_window = context_window
+        self.completion_reserve = completion_reserve
+        self.counter = counter or get_token_counter()
+        self.keep_recent_turns = keep_recent_turns
+        self.droppable_sections = tuple(droppable_sections)
+
+        self.requests = 0
+        self.trimmed_requests = 0
+        self.over_budget_requests = 0
+        self.dropped_messages = 0
+        self.dropped_sections = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_stats: Optional[BudgetStats] = None
+
+    def count_message(self, message: Dict[str, Any]) -> int:
+        return count_message_tokens(message, self.counter)
+
+    def fit(
+        self,
+        messages: List[Dict[str, Any]],
+        tools: Optional[List[Dict[str, Any]]] = None,
+        max_tokens: Optional[int] = None,
+    ) -> Tuple[List[Dict[str, Any]], BudgetStats]:
+        """Return the messages trimmed to the budget (the input list is not modified)"""
+        start = time.perf_counter()
+        budget = self.context_window - (max_tokens or self.completion_reserve) - REPLY_PRIMING_TOKENS
+        if tools:
+            budget -= self.counter(json.dumps(tools))
+
+        system, turns, current = split_turns(messages)
+        system_tokens = [self.count_message(m) for m in system]
+        turn_tokens = [sum(self.count_message(m) for m in turn) for turn in turns]
+        fixed = sum(self.count_message(m) for m in current)
+        stats = BudgetStats(budget=budget, prompt_tokens=sum(system_tokens) + sum(turn_tokens) + fixed)
+
+        if stats.prompt_tokens > budget:
+            # 1. Oldest turns beyond the most recent ones
+            while len(turns) > self.keep_recent_turns and stats.prompt_tokens > budget:
+                stats.prompt_tokens -= turn_tokens.pop(0)
+                stats.dropped_messages += len(turns.pop(0))
+            # 2. Context sections by priority, per-question (later) system messages first
+            for section in self.droppable_sections:
+                if stats.prompt_tokens <= budget:
+                    break
+                for i in range(len(system) - 1, -1, -1):
+                    content = system[i].get("content") or ""
+                    trimmed = drop_section(content, section)
+                    if trimmed == content:
+                        continue
+                    system[i] = {**system[i], "content": trimmed}
+                    tokens = self.count_message(system[i])
+                    stats.prompt_tokens -= system_tokens[i] - tokens
+                    system_tokens[i] = tokens
+                    stats.dropped_sections.append(section)
+                    if stats.prompt_tokens <= budget:
+                        break
+            # 3. The rest of the history
+            while turns and stats.prompt_tokens > budget:
+                stats.prompt_tokens -= turn_tokens.pop(0)
+                stats.dropped_messages += len(turns.pop(0))
+            stats.over_budget = stats.prompt_tokens > budget
+
+        stats.elapsed_ms = (time.perf_counter() - start) * 1000
+        self._record(stats)
+        return system + [m for turn in turns for m in turn] + current, stats
+
+    def _record(self, stats: BudgetStats) -> None:
+        self.requests += 1
+        self.total_ms += stats.elapsed_ms
+        self.max_ms = max(self.max_ms, stats.elapsed_ms)
+        if stats.dropped_messages or stats.dropped_sections:
+            self.trimmed_requests += 1
+            self.dropped_messages += stats.dropped_messages
+            self.dropped_sections += len(stats.dropped_sections)
+            logger.info(
+                f"Prompt trimmed to {stats.prompt_tokens}/{stats.budget} tokens: "
+                f"dropped {stats.dropped_messages} messages, sections {stats.dropped_sections}"
+            )
+        if stats.over_budget:
+            self.over_budget_requests += 1
+            logger.warning(f"⚠ Prompt still over budget after trimming: {stats.prompt_tokens}/{stats.budget} tokens")
+        self.last_stats = stats
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "tokenizer": self.counter.name,
+            "context_window": self.context_window,
+            "requests": self.requests,
+            "trimmed_requests": self.trimmed_requests,
+            "over_budget_requests": self.over_budget_requests,
+            "dropped_messages": self.dropped_messages,
+            "dropped_sections": self.dropped_sections,
+            "avg_ms": self.total_ms / self.requests if self.requests else 0.0,
+            "max_ms": self.max_ms,
+            "last_request": asdict(self.last_stats) if self.last_stats else None,
+        }
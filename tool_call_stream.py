@@ -0,0 +1,166 @@
+"""Incremental assembly of streamed tool-call arguments"""
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class EarlyArgument:
+    """A top-level string argument that became complete while the stream was still running"""
+    tool_call_id: Optional[str]
+    tool_name: Optional[str]
+    key: str
+    value: str
+    detected_at: float
+
+
+class ToolCallBuilder:
+    """
+    One streamed tool call. Argument fragments go into a list (joined once at
+    the end, instead of re-concatenating the whole string per delta) and
+    through a small JSON scanner that tracks the top-level object, so a
+    string argument such as `sql` is known as soon as its closing quote
+    arrives. Scanning jumps from quote to quote inside strings, and only the
+    pieces of the open top-level string are kept aside, so the work per
+    delta is proportional to the delta.
+    """
+
+    def __init__(self, on_argument: Optional[Callable[["ToolCallBuilder", str, str], None]] = None):
+        self.id: Optional[str] = None
+        self.name: Optional[str] = None
+        self.on_argument = on_argument
+        self.early_arguments: Dict[str, str] = {}
+        self._parts: List[str] = []
+        # Scanner state
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_parts: List[str] = []  # text of the open top-level string from earlier fragments
+        self._string_role: Optional[str] = None  # "key" / "value" at depth 1, None when nested
+        self._expect = "key"
+        self._key: Optional[str] = None
+
+    def feed(self, fragment: str) -> None:
+        """Append an argument fragment and report any top-level string value it completes"""
+        if not fragment:
+            return
+        self._parts.append(fragment)
+        self._scan(fragment)
+
+    @property
+    def arguments(self) -> str:
+        """The argument text received so far"""
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def parse_arguments(self) -> Dict[str, Any]:
+        """Parse the complete arguments (same fallbacks as a non-streamed tool call)"""
+        args_raw = self.arguments or "{}"
+        try:
+            loaded = json.loads(args_raw)
+        except Exception:
+            return {"_raw": args_raw}
+        return loaded if isinstance(loaded, dict) else {"args": loaded}
+
+    def _scan(self, fragment: str) -> None:
+        i, n = 0, len(fragment)
+        start = 0  # where the open string's text begins in this fragment
+        while i < n:
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                    i += 1
+                    continue
+                quote = fragment.find('"', i)
+                backslash = fragment.find("\\", i, quote if quote >= 0 else n)
+                if backslash >= 0:
+                    self._escape = True
+                    i = backslash + 1
+                    continue
+                if quote < 0:
+                    break
+                self._in_string = False
+                self._close_string(fragment[start:quote])
+                i = quote + 1
+                continue
+
+            c = fragment[i]
+            if c == '"':
+                self._in_string = True
+                start = i + 1
+                self._string_role = self._expect if self._depth == 1 else None
+            elif c == "{" or c == "[":
+                self._depth += 1
+                if self._depth == 1:
+                    self._expect = "key"
+            elif c == "}" or c == "]":
+                self._depth -= 1
+            elif self._depth == 1:
+                if c == ":":
+                    self._expect = "value"
+                elif c == ",":
+                    self._expect = "key"
+            i += 1
+        if self._in_string and self._string_role is not None:
+            self._string_parts.append(fragment[start:])
+
+    def _close_string(self, tail: str) -> None:
+        if self._string_role is None:
+            return
+        raw = "".join(self._string_parts) + tail
+        self._string_parts = []
+        try:
+            text = json.loads(f'"{raw}"')
+        except ValueError:
+            return
+        if self._string_role == "key":
+            self._key = text
+            return
+        if self._key is not None:
+            self.early_arguments[self._key] = text
+            if self.on_argument is not None:
+                self.on_argument(self, self._key, text)
+
+
+class ToolCallAssembler:
+    """
+    Assembles the tool calls of one streamed completion (by delta index) and
+    passes each top-level string argument to `on_argument` the moment it is
+    complete, e.g. to validate or pre-dispatch `sql` before the stream ends.
+    """
+
+    def __init__(self, on_argument: Optional[Callable[[EarlyArgument], None]] = None):
+        self.on_argument = on_argument
+        self.builders: Dict[int, ToolCallBuilder] = {}
+        self.early: List[EarlyArgument] = []
+
+    def feed(self, index: int, id: Optional[str] = None, name: Optional[str] = None,
+             arguments: Optional[str] = None) -> None:
+        builder = self.builders.get(index)
+        if builder is None:
+            builder = self.builders[index] = ToolCallBuilder(self._on_builder_argument)
+        if id:
+            builder.id = id
+        if name:
+            builder.name = name
+        if arguments:
+            builder.feed(arguments)
+
+    def _on_builder_argument(self, builder: ToolCallBuilder, key: str, value: str) -> None:
+        early = EarlyArgument(builder.id, builder.name, key, value, time.perf_counter())
+        self.early.append(early)
+        if self.on_argument is None:
+            return
+        try:
+            self.on_argument(early)
+        except Exception as e:
+            logger.error(f"Early tool argument handler failed: {e}")
+
+    def completed(self) -> List[ToolCallBuilder]:
+        """Builders that received a tool name, in index order"""
+        return [self.builders[i] for i in sorted(self.builders) if self.builders[i].name]